@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Measures the boilerplate index: how fast paragraphs are signed, how many lookups per second the
+# LSH index answers as it grows, compared with comparing against every entry, and how well it finds
+# near duplicates (a sponsor read with a few words changed) without flagging unrelated paragraphs.
+#
+#   python benchmarks/boilerplate_lsh.py --sizes 1000 10000 50000 --queries 2000
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+os.environ.setdefault('METRICS_ENABLED', 'FALSE')
+
+from boilerplate import BOILERPLATE_SIMILARITY, BoilerplateIndex, band_keys, signature, similarity  # noqa: E402
+
+VOCABULARY = ['word{}'.format(i) for i in range(5000)]
+
+
+def paragraph(rng, words=30):
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+# The paragraph with a few of its words replaced, the way transcription differs between episodes
+def near_duplicate(rng, text, changes=2):
+    words = text.split(' ')
+    for _ in range(changes):
+        words[rng.randrange(len(words))] = rng.choice(VOCABULARY)
+    return ' '.join(words)
+
+
+def build_index(rng, size):
+    index = BoilerplateIndex()
+    texts = []
+    for i in range(size):
+        text = paragraph(rng)
+        texts.append(text)
+        index.add({"id": str(i), "sig": signature(text), "count": 2, "last": 1, "text": text})
+    return index, texts
+
+
+def brute_force(index, sig):
+    for entry in index.entries.values():
+        if similarity(sig, entry['sig']) >= BOILERPLATE_SIMILARITY:
+            return entry
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the boilerplate LSH index')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='index sizes')
+    parser.add_argument('--queries', type=int, default=2000, help='lookups per size')
+    parser.add_argument('--brute-force-limit', type=int, default=10000,
+                        help='largest index to also scan entry by entry')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    texts = [paragraph(rng) for _ in range(args.queries)]
+    start = time.time()
+    for text in texts:
+        signature(text)
+    elapsed = time.time() - start
+    print("signatures: {:.0f} paragraphs/s ({:.3f} ms each)".format(len(texts) / elapsed, elapsed / len(texts) * 1000))
+    print()
+
+    print("{:>8} {:>14} {:>16} {:>12} {:>12} {:>10}".format(
+        "entries", "lsh lookups/s", "brute lookups/s", "candidates", "recall", "false pos"))
+    for size in args.sizes:
+        index, stored = build_index(rng, size)
+        duplicates = [signature(near_duplicate(rng, rng.choice(stored))) for _ in range(args.queries // 2)]
+        unrelated = [signature(paragraph(rng)) for _ in range(args.queries // 2)]
+        queries = duplicates + unrelated
+
+        candidates = 0
+        start = time.time()
+        results = [index.boilerplate(sig) for sig in queries]
+        lsh_rate = len(queries) / (time.time() - start)
+        for sig in queries:
+            keys = set()
+            for key in band_keys(sig):
+                keys.update(index.bands.get(key, ()))
+            candidates += len(keys)
+
+        brute_rate = None
+        if size <= args.brute_force_limit:
+            sample = queries[:200]
+            start = time.time()
+            for sig in sample:
+                brute_force(index, sig)
+            brute_rate = len(sample) / (time.time() - start)
+
+        found = sum(1 for result in results[:len(duplicates)] if result is not None)
+        false_positives = sum(1 for result in results[len(duplicates):] if result is not None)
+        print("{:>8} {:>14.0f} {:>16} {:>12.1f} {:>12.3f} {:>10}".format(
+            size, lsh_rate, "{:.0f}".format(brute_rate) if brute_rate else "-",
+            candidates / float(len(queries)), found / float(len(duplicates)), false_positives))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Compares the byte aware chunk packer with the character based chunking it replaced, on synthetic
+# transcripts in several scripts. For every corpus it reports the chunks per episode, how full the
+# chunks are (encoded bytes over the 5000 byte limit), the Comprehend units billed per episode, and
+# the chunks that go over the limit and would be rejected by Comprehend.
+#
+#   python benchmarks/chunk_packer.py --episodes 20 --words 9000
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from chunk_packer import ChunkPacker, comprehend_units, utf8_length  # noqa: E402
+
+LIMIT = 5000
+
+CORPORA = {
+    'english': ['the', 'podcast', 'episode', 'today', 'we', 'talk', 'about', 'serverless', 'search', 'with',
+                'Amazon', 'Comprehend', 'and', 'a', 'guest', 'who', 'builds', 'data', 'pipelines'],
+    'latin': ['le', 'café', 'où', 'nous', 'étions', 'für', 'größere', 'Müller', 'señor', 'año', 'Zürich',
+              'déjà', 'São', 'Paulo', 'naïve', 'Ångström', 'über', 'und', 'der'],
+    'cyrillic': ['сегодня', 'мы', 'говорим', 'о', 'поиске', 'в', 'Москве', 'и', 'Санкт-Петербурге', 'с',
+                 'гостем', 'который', 'строит', 'системы'],
+    'cjk': ['今日は', '東京', 'の', 'エンジニア', 'と', '検索', 'について', '話します', '大阪', '株式会社',
+            '데이터', '서울', '팟캐스트'],
+    'mixed': ['the', 'guest', 'from', 'Zürich', 'and', 'Москва', 'talked', 'about', '東京', 'search', 'with',
+              'José', 'Núñez', 'and', 'Łukasz', 'on', 'the', 'podcast']
+}
+
+
+# Pieces of a transcript the way chunk_up_transcript sees them: words with the space before them
+# and punctuation, with a sentence end every 8 to 30 words
+def synthetic_transcript(words, count, rng):
+    pieces = []
+    until_end = rng.randint(8, 30)
+    for _ in range(count):
+        pieces.append((" " + rng.choice(words), False))
+        until_end -= 1
+        if until_end == 0:
+            pieces.append((rng.choice(['.', '?', '!']), True))
+            until_end = rng.randint(8, 30)
+        elif rng.random() < 0.05:
+            pieces.append((',', False))
+    return pieces
+
+
+# The chunking chunk_up_transcript did before: cut at the first punctuation after 4500 characters,
+# or after 4900 characters
+def character_chunks(pieces):
+    chunks = []
+    chunk = ""
+    for piece, sentence_end in pieces:
+        chunk += piece
+        is_punctuation = not piece.startswith(" ")
+        if (is_punctuation and len(chunk) >= 4500) or len(chunk) > 4900:
+            chunks.append(chunk)
+            chunk = ""
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def packed_chunks(pieces):
+    packer = ChunkPacker(LIMIT)
+    for piece, sentence_end in pieces:
+        packer.add(piece, sentence_end)
+    return packer.finish()
+
+
+def measure(chunker, episodes):
+    totals = {"chunks": 0, "bytes": 0, "units": 0, "oversize": 0, "seconds": 0.0}
+    for pieces in episodes:
+        start = time.time()
+        chunks = chunker(pieces)
+        totals['seconds'] += time.time() - start
+        totals['chunks'] += len(chunks)
+        for chunk in chunks:
+            size = utf8_length(chunk)
+            totals['bytes'] += size
+            totals['units'] += comprehend_units(chunk)
+            totals['oversize'] += size > LIMIT
+    count = float(len(episodes))
+    return {
+        "chunks_per_episode": round(totals['chunks'] / count, 1),
+        "fill_ratio": round(totals['bytes'] / float(totals['chunks'] * LIMIT), 3),
+        "units_per_episode": round(totals['units'] / count, 1),
+        "oversize_chunks": totals['oversize'],
+        "ms_per_episode": round(totals['seconds'] / count * 1000, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the comprehend chunk packer on multilingual text')
+    parser.add_argument('--episodes', type=int, default=20, help='synthetic episodes per corpus')
+    parser.add_argument('--words', type=int, default=9000, help='words per episode (about an hour of speech)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:<10} {:<10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "corpus", "chunker", "chunks/ep", "fill", "units/ep", "oversize", "ms/ep"))
+    for name, words in sorted(CORPORA.items()):
+        rng = random.Random(args.seed)
+        episodes = [synthetic_transcript(words, args.words, rng) for _ in range(args.episodes)]
+        for chunker_name, chunker in (('chars', character_chunks), ('packed', packed_chunks)):
+            result = measure(chunker, episodes)
+            print("{:<10} {:<10} {chunks_per_episode:>10} {fill_ratio:>8} {units_per_episode:>10} "
+                  "{oversize_chunks:>10} {ms_per_episode:>8}".format(name, chunker_name, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Measures the cold start of every lambda handler: the time to import its module, and the time the
+# first invocation spends building the clients that the handler uses. Each handler is measured in a
+# fresh interpreter, the same way a new lambda container starts.
+#
+# Run it on two revisions to compare them:
+#
+#   python benchmarks/cold_start.py --runs 5
+#   git checkout <other revision> && python benchmarks/cold_start.py --runs 5
+#
+# By default no AWS request is made, only the clients are built. With --event the handler is invoked
+# with the given payload instead, which is only useful against a real account or local stand-ins
+# (see AWS_ENDPOINT_URL in aws_clients).
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+HANDLERS = [
+    'download_podcast.lambda_handler',
+    'long_episode.split_handler',
+    'long_episode.stitch_handler',
+    'podcast_transcribe.lambda_handler',
+    'check_transcribe.lambda_handler',
+    'elasticsearch_createindex.lambda_handler',
+    'process_transcription_paragraph.lambda_handler',
+    'process_transcription_full_text.lambda_handler',
+    'upload_to_elasticsearch.lambda_handler',
+    'upload_to_elasticsearch.delete_episode_handler',
+    'transcript_search.lambda_handler',
+    'process_podcast_rss.lambda_handler',
+    'process_podcast_item.lambda_handler',
+    'create_transcribe_vocabulary.lambda_handler',
+    'create_transcribe_vocabulary.check_vocabulary_status',
+    'create_transcribe_vocabulary.delete_vocabulary'
+]
+
+# The modules read these at import time
+DEFAULT_ENV = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BUCKET_NAME': 'cold-start-benchmark',
+    'ES_DOMAIN': 'localhost',
+    'DEBUG_MODE': 'TRUE',
+    'AUDIO_OFFSET': '1',
+    'STEP_FUNCTION_ARN': 'arn:aws:states:us-east-1:000000000000:stateMachine:benchmark',
+    'METRICS_ENABLED': 'FALSE'
+}
+
+# Runs in the fresh interpreter. Prints the import and first use times in milliseconds as JSON.
+PROBE = '''
+import json, sys, time
+start = time.time()
+import importlib
+module = importlib.import_module(sys.argv[1])
+handler = getattr(module, sys.argv[2])
+imported = time.time()
+if len(sys.argv) > 3:
+    with open(sys.argv[3]) as f:
+        handler(json.load(f), None)
+else:
+    # Build what the first invocation would: the lazy boto3 clients of the module and the
+    # elasticsearch client if the module uses one. Modules that build their clients at import
+    # time have nothing left to do here.
+    for value in list(vars(module).values()):
+        if type(value).__name__ == 'LazyClient':
+            value.resolve()
+    if hasattr(module, 'get_es_client'):
+        module.get_es_client()
+first_use = time.time()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_use_ms": (first_use - imported) * 1000}))
+'''
+
+
+def measure(handler, event=None):
+    module, function = handler.split('.')
+    env = dict(os.environ)
+    for name, value in DEFAULT_ENV.items():
+        env.setdefault(name, value)
+    command = [sys.executable, '-c', PROBE, module, function]
+    if event:
+        command.append(os.path.abspath(event))
+    output = subprocess.check_output(command, cwd=SRC, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the cold start time of the lambda handlers')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler')
+    parser.add_argument('--handler', action='append', help='module.function to measure, defaults to all')
+    parser.add_argument('--event', help='invoke the handler with the payload in this file')
+    args = parser.parse_args()
+
+    print("{:<55} {:>10} {:>12} {:>10}".format("handler", "import ms", "first use ms", "total ms"))
+    for handler in args.handler or HANDLERS:
+        try:
+            results = [measure(handler, args.event) for _ in range(args.runs)]
+        except subprocess.CalledProcessError:
+            print("{:<55} failed".format(handler))
+            continue
+        imported = median([r['import_ms'] for r in results])
+        first_use = median([r['first_use_ms'] for r in results])
+        print("{:<55} {:>10.1f} {:>12.1f} {:>10.1f}".format(handler, imported, first_use, imported + first_use))
+
+
+if __name__ == '__main__':
+    main()
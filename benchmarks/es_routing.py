@@ -0,0 +1,136 @@
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Measures what routing the documents by feed saves on the queries for a single feed. For every shard
+# count, a paragraphs index is created with that many shards and loaded with the same synthetic feeds,
+# routed the way the upload lambda routes them. The same single feed queries then run with the routing
+# of the feed, served by one shard, and without it, fanned out to all the shards.
+#
+# Needs a domain to run against, a local one will do:
+#
+#   python benchmarks/es_routing.py --endpoint http://localhost:9200 --shards 1 5 20
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+os.environ.setdefault('METRICS_ENABLED', 'FALSE')
+os.environ['ES_FEED_ROUTING'] = 'TRUE'
+
+from es_bulk import bulk_index  # noqa: E402
+from es_client import get_es_client  # noqa: E402
+from es_documents import generate_keyword_actions, routing_params  # noqa: E402
+
+WORDS = ['serverless', 'search', 'podcast', 'lambda', 'index', 'shard', 'query', 'episode', 'speaker', 'audio',
+         'transcript', 'entity', 'kibana', 'cluster', 'feed', 'routing', 'latency', 'throughput', 'data', 'cloud']
+
+MAPPINGS = {
+    "_routing": {"required": True},
+    "properties": {
+        "PodcastName": {"type": "keyword"},
+        "episode_url": {"type": "keyword"},
+        "source_feed": {"type": "keyword"},
+        "published_time": {"type": "date", "format": "yyyy:MM:dd HH:mm:ss"},
+        "text": {"type": "text"},
+        "tags": {"type": "keyword"},
+        "speaker": {"type": "keyword"}
+    }
+}
+
+
+def feed_url(feed):
+    return 'https://example.com/feed/{}.xml'.format(feed)
+
+
+# The actions of the paragraphs of every episode of every feed, the way the upload lambda writes them
+def paragraph_actions(index, rng, feeds, episodes, paragraphs):
+    for feed in range(feeds):
+        for episode in range(episodes):
+            event = {
+                "podcastUrl": 'https://example.com/audio/{}/{}.mp3'.format(feed, episode),
+                "PodcastName": 'Podcast {}'.format(feed),
+                "Episode": 'Episode {}'.format(episode),
+                "sourceFeed": feed_url(feed),
+                "publishTime": '2020:01:{:02d} 10:00:00'.format(episode % 28 + 1)
+            }
+            keywords = [{
+                "startTime": paragraph * 15.0,
+                "text": ' '.join(rng.choice(WORDS) for _ in range(40)),
+                "tags": [],
+                "speaker": 'spk_{}'.format(paragraph % 2)
+            } for paragraph in range(paragraphs)]
+            for action in generate_keyword_actions(event, keywords, 1):
+                action['_index'] = index
+                yield action
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_queries(es, index, queries, routed):
+    latencies = []
+    took = []
+    shards = 0
+    for feed, word in queries:
+        body = {"size": 10, "query": {"bool": {"must": [{"match": {"text": word}}],
+                                               "filter": [{"term": {"source_feed": feed}}]}}}
+        params = routing_params(feed) if routed else {}
+        start = time.time()
+        response = es.search(index=index, body=body, request_cache=False, **params)
+        latencies.append(time.time() - start)
+        took.append(response['took'])
+        shards = response['_shards']['total']
+    return latencies, took, shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark single feed queries with and without feed routing')
+    parser.add_argument('--endpoint', default=os.getenv('ES_DOMAIN', 'http://localhost:9200'))
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 5, 20], help='primary shards of the index')
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--episodes', type=int, default=5, help='episodes per feed')
+    parser.add_argument('--paragraphs', type=int, default=100, help='paragraphs per episode')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark indices')
+    args = parser.parse_args()
+    es = get_es_client(args.endpoint)
+
+    rng = random.Random(args.seed)
+    queries = [(feed_url(rng.randrange(args.feeds)), rng.choice(WORDS)) for _ in range(args.queries)]
+
+    print("{:>7} {:>9} {:>12} {:>12} {:>12} {:>12}".format(
+        "shards", "routing", "p50 ms", "p95 ms", "took p50", "shards hit"))
+    for shard_count in args.shards:
+        index = 'routing-benchmark-{}'.format(shard_count)
+        es.indices.delete(index=index, ignore=[404])
+        es.indices.create(index=index, body={
+            "settings": {"number_of_shards": shard_count, "number_of_replicas": 0},
+            "mappings": MAPPINGS
+        })
+        stats = bulk_index(es, paragraph_actions(index, random.Random(args.seed), args.feeds, args.episodes,
+                                                 args.paragraphs))
+        es.indices.refresh(index=index)
+        es.indices.forcemerge(index=index, max_num_segments=1)
+
+        # Warm up the caches of the shards before measuring
+        run_queries(es, index, queries[:20], False)
+        for routed in (False, True):
+            latencies, took, shards = run_queries(es, index, queries, routed)
+            print("{:>7} {:>9} {:>12.2f} {:>12.2f} {:>12} {:>12}".format(
+                shard_count, 'feed' if routed else 'none', percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000, percentile(took, 0.5), shards))
+
+        if stats.errors:
+            print("{} documents failed to index".format(len(stats.errors)))
+        if not args.keep:
+            es.indices.delete(index=index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+# Simulates concurrent invocations calling a rate limited API and compares how the calls get through
+#
+#   none    no client side limit, throttled calls are retried with jittered backoff
+#   local   a token bucket per invocation, the way the limiter works without RATE_LIMIT_TABLE
+#   shared  one token bucket in a store shared by all invocations, like with RATE_LIMIT_TABLE
+#
+# The simulated service accepts --limit calls per second and throttles the rest. For every mode the
+# benchmark reports the accepted calls per second, how steady that rate is from one second to the
+# next, the number of throttled calls and the latency of the calls including waits and retries.
+#
+#   python benchmarks/rate_limiter.py --workers 12 --calls 40 --limit 20
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+os.environ.setdefault('METRICS_ENABLED', 'FALSE')
+os.environ.setdefault('RATE_LIMIT_ATTEMPTS', '30')
+
+import rate_limiter  # noqa: E402
+
+
+class ThrottlingError(Exception):
+    def __init__(self):
+        super(ThrottlingError, self).__init__('Rate exceeded')
+        self.response = {'Error': {'Code': 'ThrottlingException'}}
+
+
+# Accepts limit calls per second (with a burst of one second) and throttles the rest
+class SimulatedService(object):
+    def __init__(self, limit, latency):
+        self.bucket = rate_limiter.TokenBucket(limit)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.accepted = []
+        self.throttled = 0
+
+    def call(self):
+        time.sleep(self.latency)
+        if self.bucket.take():
+            with self.lock:
+                self.throttled += 1
+            raise ThrottlingError()
+        with self.lock:
+            self.accepted.append(time.time())
+
+
+# In memory version of the DynamoDB store, with the latency of a round trip to the table per take
+class MemoryTokenStore(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, api, rate, burst):
+        time.sleep(self.latency)
+        with self.lock:
+            if api not in self.buckets:
+                self.buckets[api] = rate_limiter.TokenBucket(rate, burst)
+            return self.buckets[api].take()
+
+
+class Unlimited(object):
+    def acquire(self):
+        return 0
+
+
+def run(mode, args):
+    service = SimulatedService(args.limit, args.latency)
+    store = MemoryTokenStore(args.store_latency)
+    latencies = []
+    lock = threading.Lock()
+
+    def invocation():
+        if mode == 'none':
+            bucket = Unlimited()
+        elif mode == 'local':
+            bucket = rate_limiter.TokenBucket(args.limit)
+        else:
+            bucket = rate_limiter.SharedTokenBucket(store, 'simulated.Operation', args.limit)
+        for _ in range(args.calls):
+            start = time.time()
+            rate_limiter.call_with_limit(bucket, 'simulated.Operation', service.call)
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=invocation) for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    # Accepted calls per whole second of the run, the last partial second left out
+    per_second = [0] * int(elapsed)
+    for accepted in service.accepted:
+        second = int(accepted - start)
+        if second < len(per_second):
+            per_second[second] += 1
+    mean = sum(per_second) / float(len(per_second)) if per_second else 0
+    deviation = (sum((count - mean) ** 2 for count in per_second) / len(per_second)) ** 0.5 if per_second else 0
+    latencies.sort()
+    return {
+        "mode": mode,
+        "calls": len(service.accepted),
+        "elapsed": round(elapsed, 2),
+        "calls_per_second": round(len(service.accepted) / elapsed, 1),
+        "per_second_stddev": round(deviation, 1),
+        "per_second_max": max(per_second) if per_second else 0,
+        "throttled": service.throttled,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated load against a rate limited API')
+    parser.add_argument('--workers', type=int, default=12, help='concurrent invocations')
+    parser.add_argument('--calls', type=int, default=40, help='calls per invocation')
+    parser.add_argument('--limit', type=float, default=20, help='calls per second the service accepts')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per call')
+    parser.add_argument('--store-latency', type=float, default=0.005, help='seconds per shared store round trip')
+    parser.add_argument('--mode', action='append', choices=['none', 'local', 'shared'],
+                        help='modes to run, defaults to all')
+    args = parser.parse_args()
+
+    print("{:<8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8}".format(
+        "mode", "calls", "seconds", "calls/s", "stddev", "max/s", "throttled", "p50 ms", "p99 ms"))
+    for mode in args.mode or ['none', 'local', 'shared']:
+        result = run(mode, args)
+        print("{mode:<8} {calls:>6} {elapsed:>8} {calls_per_second:>8} {per_second_stddev:>8} "
+              "{per_second_max:>8} {throttled:>10} {p50_ms:>8} {p99_ms:>8}".format(**result))
+        if os.getenv('BENCHMARK_JSON'):
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
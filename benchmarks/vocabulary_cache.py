@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# Measures what the vocabulary cache saves per episode: parsing the mapping and compiling its
+# matcher on every invocation against taking it from the cache, and mapping the words of an episode
+# with a replace per entry of the mapping against the compiled matcher.
+#
+#   python benchmarks/vocabulary_cache.py --sizes 50 500 2000 --words 9000
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+os.environ.setdefault('METRICS_ENABLED', 'FALSE')
+
+from transcript_segmenter import VocabularyMapping  # noqa: E402
+
+WORDS = ['the', 'podcast', 'today', 'we', 'talk', 'about', 'serverless', 'search', 'with', 'a', 'guest']
+
+
+# Terms the way create_transcribe_vocabulary writes them for Amazon Transcribe
+def vocabulary(rng, size):
+    mapping = {}
+    while len(mapping) < size:
+        term = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(rng.randint(2, 4)))
+        mapping['-'.join(term) + '-Two'] = term + '2'
+    return mapping
+
+
+def replace_each(mapping, word):
+    for key in mapping:
+        word = word.replace(key, mapping[key])
+    return word
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the vocabulary mapping cache and matcher')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500, 2000], help='entries in the mapping')
+    parser.add_argument('--words', type=int, default=9000, help='words per episode (about an hour of speech)')
+    parser.add_argument('--episodes', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print("{:>8} {:>12} {:>12} {:>14} {:>14}".format(
+        "entries", "load ms", "cached ms", "replace ms/ep", "matcher ms/ep"))
+    for size in args.sizes:
+        mapping = vocabulary(rng, size)
+        document = json.dumps(mapping, indent=2)
+        terms = list(mapping)
+        words = [rng.choice(terms) if rng.random() < 0.01 else rng.choice(WORDS) for _ in range(args.words)]
+
+        start = time.time()
+        for _ in range(args.episodes):
+            compiled = VocabularyMapping(json.loads(document))
+        load = (time.time() - start) / args.episodes
+
+        cache = {('bucket', 'key'): compiled}
+        start = time.time()
+        for _ in range(args.episodes):
+            cache[('bucket', 'key')]
+        cached = (time.time() - start) / args.episodes
+
+        start = time.time()
+        for _ in range(args.episodes):
+            expected = [replace_each(mapping, word) for word in words]
+        replace = (time.time() - start) / args.episodes
+
+        start = time.time()
+        for _ in range(args.episodes):
+            mapped = [compiled.replace(word) for word in words]
+        matcher = (time.time() - start) / args.episodes
+        assert mapped == expected
+
+        print("{:>8} {:>12.2f} {:>12.4f} {:>14.1f} {:>14.1f}".format(
+            size, load * 1000, cached * 1000, replace * 1000, matcher * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+from __future__ import print_function
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from aws_clients import get_client
+from common_lib import id_generator
+from instrumentation import record
+
+# Reads and writes the intermediate artifacts the pipeline keeps in S3 (transcripts, keywords, episode
+# lists) as gzip compressed, newline delimited JSON.
+#
+# The first line of an artifact is a header object with the fields that aren't part of the record
+# list, every following line is one record:
+#
+#   {"maxConcurrentEpisodes": 10}
+#   {"Episode": "...", "podcastUrl": "...", ...}
+#   {"Episode": "...", "podcastUrl": "...", ...}
+#
+# Records are encoded one at a time into a spooled temporary file and compressed on the way, so the
+# whole payload never exists as one string, and they are decoded one line at a time straight off the
+# S3 stream. Artifacts written before the switch are plain JSON documents ending in .json; the readers
+# tell the formats apart by the key suffix.
+
+# Log level
+logging.basicConfig()
+logger = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+ARTIFACT_SUFFIX = '.ndjson.gz'
+
+# The output of Amazon Transcribe for every episode, kept so the episode can be processed again
+# (see rerender_episodes) without transcribing it again
+RAW_TRANSCRIPT_PREFIX = 'podcasts/raw/'
+
+# Compressed artifacts up to this size are kept in memory before the upload, larger ones go to /tmp
+ARTIFACT_SPOOL_BYTES = int(os.getenv('ARTIFACT_SPOOL_BYTES', default=str(16 * 1024 * 1024)))
+
+# The NDJSON lines are very repetitive (the same keys on every line), so a fast level compresses
+# almost as well as the default level at a fraction of the cost
+ARTIFACT_COMPRESS_LEVEL = int(os.getenv('ARTIFACT_COMPRESS_LEVEL', default='5'))
+
+
+class ArtifactStats(object):
+    def __init__(self):
+        self.records = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.encode_seconds = 0.0
+        self.upload_seconds = 0.0
+
+    def summary(self):
+        return {
+            "records": self.records,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "ratio": round(self.raw_bytes / float(self.compressed_bytes), 1) if self.compressed_bytes else 0,
+            "encode_seconds": round(self.encode_seconds, 4),
+            "upload_seconds": round(self.upload_seconds, 4)
+        }
+
+
+def artifact_key(prefix):
+    return prefix + id_generator() + ARTIFACT_SUFFIX
+
+
+def is_artifact(key):
+    return key.endswith(ARTIFACT_SUFFIX)
+
+
+def encode_line(value):
+    return (json.dumps(value, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def write_artifact(bucket, key, records, header=None):
+    stats = ArtifactStats()
+    start = time.time()
+    with tempfile.SpooledTemporaryFile(max_size=ARTIFACT_SPOOL_BYTES) as buffer:
+        # No timestamp in the gzip header, so the same records always give the same bytes
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=ARTIFACT_COMPRESS_LEVEL, mtime=0) as stream:
+            line = encode_line(header or {})
+            stream.write(line)
+            stats.raw_bytes += len(line)
+            for item in records:
+                line = encode_line(item)
+                stream.write(line)
+                stats.raw_bytes += len(line)
+                stats.records += 1
+        stats.compressed_bytes = buffer.tell()
+        stats.encode_seconds = time.time() - start
+        record('artifact.encode', stats.encode_seconds, bytes_out=stats.compressed_bytes, items=stats.records)
+
+        buffer.seek(0)
+        start = time.time()
+        get_client('s3').upload_fileobj(buffer, bucket, key, ExtraArgs={
+            'ContentType': 'application/x-ndjson',
+            'ContentEncoding': 'gzip'
+        })
+        stats.upload_seconds = time.time() - start
+
+    logger.info("wrote s3://" + bucket + "/" + key + ": " + json.dumps(stats.summary()))
+    return stats
+
+
+# Returns the header and an iterator over the records. The records are read from S3 as they are
+# consumed.
+def read_artifact(bucket, key):
+    body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    stream = gzip.GzipFile(fileobj=body, mode='rb')
+    header = json.loads(stream.readline().decode('utf-8'))
+
+    def records():
+        with stream:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+    return header, records()
+
+
+# Returns the header of the artifact without reading its records. The body is closed explicitly, a
+# records iterator that is closed before it starts never gets to close it.
+def read_artifact_header(bucket, key):
+    body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        with gzip.GzipFile(fileobj=body, mode='rb') as stream:
+            return json.loads(stream.readline().decode('utf-8'))
+    finally:
+        body.close()
+
+
+def read_json(bucket, key):
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+# The paragraphs written by process_transcription_paragraph. Returns the number of paragraphs and an
+# iterator over them.
+def read_keywords(bucket, key):
+    if not is_artifact(key):
+        keywords = read_json(bucket, key)
+        return len(keywords), iter(keywords)
+    header, records = read_artifact(bucket, key)
+    return header.get('records'), records
+
+
+def write_keywords(bucket, key, keywords, **fields):
+    fields['records'] = len(keywords)
+    return write_artifact(bucket, key, keywords, header=fields)
+
+
+# The full text transcript written by process_transcription_full_text, as the
+# {"transcript", "transcript_entities", ...} document. The artifact stores a paragraph per line and
+# the other fields of the document in the header.
+def read_transcript(bucket, key):
+    if not is_artifact(key):
+        return read_json(bucket, key)
+    header, records = read_artifact(bucket, key)
+    header['transcript'] = "\n\n".join(paragraph['text'] for paragraph in records)
+    return header
+
+
+def write_transcript(bucket, key, paragraphs, **fields):
+    return write_artifact(bucket, key, ({"text": paragraph} for paragraph in paragraphs), header=fields)
+
+
+# The episode list written by process_podcast_rss and process_podcast_item, as the
+# {"maxConcurrentEpisodes", "episodes"} document
+def read_episode_list(bucket, key):
+    if not is_artifact(key):
+        return read_json(bucket, key)
+    header, records = read_artifact(bucket, key)
+    header['episodes'] = list(records)
+    return header
+
+
+def write_episode_list(bucket, key, request):
+    header = dict((k, v) for k, v in request.items() if k != 'episodes')
+    return write_artifact(bucket, key, request['episodes'], header=header)
+
+
+# The shards of a long transcript planned by long_episode.shard_handler, a record per shard with its
+# range of items and the state of the segmentation at its start
+def write_shard_plan(bucket, key, shards, items):
+    return write_artifact(bucket, key, shards, header={"shards": len(shards), "items": items})
+
+
+def read_shard(bucket, key, index):
+    header, records = read_artifact(bucket, key)
+    for shard in records:
+        if shard['index'] == index:
+            return shard
+    raise ValueError("no shard {} in s3://{}/{}".format(index, bucket, key))
+
+
+def raw_transcript_key(podcast_url):
+    return RAW_TRANSCRIPT_PREFIX + hashlib.sha1(podcast_url.encode('utf-8')).hexdigest() + '.json.gz'
+
+
+# Stores the transcribe output as it was downloaded, compressed, under a key derived from the episode
+# url, so processing the episode again replaces it
+def write_raw_transcript(bucket, podcast_url, body):
+    key = raw_transcript_key(podcast_url)
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=ARTIFACT_COMPRESS_LEVEL, mtime=0) as stream:
+        stream.write(body)
+    get_client('s3').put_object(Body=buffer.getvalue(), Bucket=bucket, Key=key, ContentType='application/json',
+                                ContentEncoding='gzip')
+    logger.info("kept raw transcript of {} bytes at s3://{}/{}".format(len(body), bucket, key))
+    return {"bucket": bucket, "key": key}
+
+
+# Returns the transcribe output of the episode
+def read_raw_transcript(bucket, podcast_url):
+    body = get_client('s3').get_object(Bucket=bucket, Key=raw_transcript_key(podcast_url))['Body']
+    with gzip.GzipFile(fileobj=body, mode='rb') as stream:
+        return json.loads(stream.read().decode('utf-8'))
@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import os
+import threading
+from instrumentation import instrument_client
+from rate_limiter import is_limited, limit_client
+
+# Lazily built, memoized boto3 clients.
+#
+# The modules declare their clients at import time as before, but the client (and boto3 itself) is
+# only built the first time one of its methods is called, so a cold start only pays for the clients
+# the invoked handler actually uses. Clients are shared across the modules of a container.
+#
+# The endpoint of a service can be overridden with AWS_ENDPOINT_URL_<SERVICE> (e.g.
+# AWS_ENDPOINT_URL_S3), or for every service with AWS_ENDPOINT_URL, to run against local stand-ins.
+#
+# The Comprehend and Transcribe clients are rate limited (see rate_limiter). The limiter is their only
+# retry policy: it retries the throttled, failed and timed out calls itself, so the client doesn't retry
+# them as well.
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def endpoint_url(service_name):
+    return os.getenv('AWS_ENDPOINT_URL_' + service_name.upper().replace('-', '_')) or os.getenv('AWS_ENDPOINT_URL')
+
+
+def _build_client(service_name, **kwargs):
+    import boto3
+
+    url = endpoint_url(service_name)
+    if url and 'endpoint_url' not in kwargs:
+        kwargs['endpoint_url'] = url
+    if is_limited(service_name) and 'config' not in kwargs:
+        from botocore.config import Config
+        kwargs['config'] = Config(retries={'max_attempts': 0})
+    return limit_client(instrument_client(boto3.client(service_name, **kwargs)), service_name)
+
+
+# Returns the shared client for the service, building it on first use
+def get_client(service_name):
+    with _clients_lock:
+        if service_name not in _clients:
+            _clients[service_name] = _build_client(service_name)
+        return _clients[service_name]
+
+
+class LazyClient(object):
+    def __init__(self, service_name, **kwargs):
+        self._service_name = service_name
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    # Clients with their own settings (region, retry config) are not shared with the other modules
+    def resolve(self):
+        if self._client is None:
+            if not self._kwargs:
+                self._client = get_client(self._service_name)
+            else:
+                with self._lock:
+                    if self._client is None:
+                        self._client = _build_client(self._service_name, **self._kwargs)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+# Declares a client that is built the first time it is used
+def client(service_name, **kwargs):
+    return LazyClient(service_name, **kwargs)
@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from es_bulk import bulk_index, detect_feed_routing, unsealed_partitions
+from artifact_io import read_json, read_keywords, read_transcript
+from aws_clients import get_client
+from es_client import get_es_client, latency_histogram
+from es_documents import KEYWORDS_INDEX, MANIFEST_PREFIX, episode_action, generate_keyword_actions, rollup_actions, \
+    set_routed_indices
+
+# Rebuilds the episodes and paragraphs indices from the artifacts that the episode state machine
+# stored in S3, without transcribing anything again. Every processed episode has a manifest under
+# podcasts/manifest/ that points to its transcript (podcasts/transcript/) and keywords
+# (podcasts/keywords/) artifacts.
+#
+# Episodes processed before the manifests were written can't be rebuilt this way: the keywords were
+# deleted once indexed, and the transcripts under podcasts/transcript/ carry neither the episode url
+# nor its title, feed or publish time. Listing those prefixes finds nothing to index them with, so
+# these episodes have to go through the episode state machine again, which writes their manifests.
+#
+# The artifacts are downloaded and turned into index actions in a process pool, so parsing scales
+# with the number of cores, while the number of bulk requests in flight against the domain is capped
+# separately. Every episode that is fully indexed is appended to a checkpoint file, and episodes in
+# the checkpoint are skipped when the backfill is started again.
+#
+#   python backfill_elasticsearch.py --bucket my-bucket --endpoint search-podcasts-xxxx.es.amazonaws.com
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def list_manifests(bucket, prefix):
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+# Runs in the worker processes. Downloads and parses the artifacts of one episode and returns the
+# index actions for it.
+def load_episode(bucket, key, audio_offset):
+    manifest = read_json(bucket, key)
+    keywords_location, transcript_location = manifest['processedTranscription']
+    count, keywords = read_keywords(keywords_location['bucket'], keywords_location['key'])
+    fullepisode = read_transcript(transcript_location['bucket'], transcript_location['key'])
+
+    entity_counts = {}
+    actions = [episode_action(manifest, fullepisode)]
+    actions.extend(generate_keyword_actions(manifest, keywords, audio_offset, entity_counts=entity_counts))
+    actions.extend(rollup_actions(manifest, entity_counts))
+    return key, actions
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.strip() for line in f if line.strip())
+
+    def mark_done(self, key):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(key + '\n')
+            self.done.add(key)
+
+
+def backfill(es, bucket, prefix, checkpoint, workers, bulk_concurrency, audio_offset):
+    keys = [key for key in list_manifests(bucket, prefix) if key not in checkpoint.done]
+    logger.info("{} episodes to backfill, {} already done".format(len(keys), len(checkpoint.done)))
+
+    totals = {"episodes": 0, "failed_episodes": 0, "docs": 0}
+    totals_lock = threading.Lock()
+    start = time.time()
+
+    def index_episode(key, actions):
+        # The partitions of old episodes are sealed
+        with unsealed_partitions(es, [action['_index'] for action in actions
+                                      if action['_index'].startswith(KEYWORDS_INDEX + '-')]):
+            stats = bulk_index(es, actions)
+        if stats.errors:
+            logger.error("{} documents of {} failed to index".format(len(stats.errors), key))
+        else:
+            checkpoint.mark_done(key)
+        with totals_lock:
+            totals['failed_episodes' if stats.errors else 'episodes'] += 1
+            totals['docs'] += stats.indexed
+
+    remaining = iter(keys)
+    # The workers are spawned rather than forked, so they build their own boto3 clients instead of sharing
+    # the connections of the s3 client that listed the manifests. They route the documents the way the
+    # indices read here require.
+    routed = detect_feed_routing(es)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=set_routed_indices, initargs=(routed,)) as parse_pool, \
+            ThreadPoolExecutor(max_workers=bulk_concurrency) as bulk_pool:
+        parsing = set()
+        indexing = set()
+        while True:
+            # Keep a couple of episodes queued per worker, but don't read ahead of what we can index
+            while len(parsing) < workers * 2:
+                key = next(remaining, None)
+                if key is None:
+                    break
+                parsing.add(parse_pool.submit(load_episode, bucket, key, audio_offset))
+            if not parsing:
+                break
+
+            done, parsing = wait(parsing, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    key, actions = future.result()
+                except Exception as e:
+                    logger.exception("unable to load episode: " + str(e))
+                    with totals_lock:
+                        totals['failed_episodes'] += 1
+                    continue
+                # Bound the number of bulk requests in flight to what the domain can absorb
+                while len(indexing) >= bulk_concurrency:
+                    finished, indexing = wait(indexing, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        f.result()
+                indexing.add(bulk_pool.submit(index_episode, key, actions))
+
+            elapsed = time.time() - start
+            logger.info("progress: {} episodes, {} docs, {:.1f} docs/s".format(
+                totals['episodes'], totals['docs'], totals['docs'] / elapsed if elapsed else 0))
+
+        for f in wait(indexing).done:
+            f.result()
+
+    elapsed = time.time() - start
+    totals['elapsed'] = round(elapsed, 1)
+    totals['docs_per_second'] = round(totals['docs'] / elapsed, 1) if elapsed else 0
+    logger.info("backfill complete: " + json.dumps(totals))
+    latency_histogram.log_summary()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the Elasticsearch indices from the artifacts stored in S3')
+    parser.add_argument('--bucket', required=True, help='bucket the episode state machine writes to')
+    parser.add_argument('--endpoint', default=os.getenv('ES_DOMAIN'), help='Elasticsearch domain endpoint')
+    parser.add_argument('--prefix', default=MANIFEST_PREFIX,
+                        help='prefix of the episode manifests, episodes without one are not rebuilt')
+    parser.add_argument('--checkpoint', default='backfill.checkpoint', help='file that records finished episodes')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of parsing processes')
+    parser.add_argument('--bulk-concurrency', type=int, default=4, help='maximum bulk requests in flight')
+    parser.add_argument('--audio-offset', type=int, default=int(os.getenv('AUDIO_OFFSET', default='1')),
+                        help='seconds before a paragraph that its deep link starts')
+    args = parser.parse_args()
+
+    es = get_es_client(args.endpoint, pool_size=args.bulk_concurrency)
+    backfill(es, args.bucket, args.prefix, Checkpoint(args.checkpoint), args.workers, args.bulk_concurrency,
+             args.audio_offset)
+
+
+if __name__ == '__main__':
+    main()
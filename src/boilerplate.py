@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import random
+import zlib
+from artifact_io import read_artifact, write_artifact
+from aws_clients import get_client
+from gazetteer import normalize
+
+# Finds the paragraphs a feed repeats in every episode: the intro, the sponsor reads, the outro.
+#
+# Every paragraph of enough words gets a MinHash signature of its word 3-shingles, and the signatures
+# of the recent episodes of a feed are kept in an index in S3:
+#
+#   podcasts/boilerplate/<sha1 of the feed url>.ndjson.gz
+#   {"episodes": 42}
+#   {"id": "3f2a...", "sig": [...], "count": 17, "last": 42, "seen": ["9b1e..."], "text": "This episode is"}
+#
+# count is the number of episodes the paragraph (or one very much like it) showed up in, last the
+# number of the most recent one, seen the hashes of the urls of the most recent of them. An episode
+# that is processed again (a retried step, a state machine executed again) is found in seen and not
+# counted a second time. A paragraph that matches an entry seen in BOILERPLATE_MIN_EPISODES
+# episodes is boilerplate. Entries that only showed up once are dropped after BOILERPLATE_WINDOW
+# episodes so the index stays the size of a few episodes.
+#
+# Lookups go through locality sensitive hashing: the signature is cut into bands, and only entries
+# that share a whole band with the paragraph are compared, so the cost of a lookup doesn't depend on
+# the size of the index.
+
+logger = logging.getLogger()
+
+BOILERPLATE_PREFIX = 'podcasts/boilerplate/'
+
+BOILERPLATE_MIN_EPISODES = int(os.getenv('BOILERPLATE_MIN_EPISODES', default='2'))
+
+BOILERPLATE_WINDOW = int(os.getenv('BOILERPLATE_WINDOW', default='5'))
+
+# Estimated Jaccard similarity of the shingles from which two paragraphs are the same
+BOILERPLATE_SIMILARITY = float(os.getenv('BOILERPLATE_SIMILARITY', default='0.6'))
+
+# Shorter paragraphs ("Thank you.", "Yeah, exactly.") repeat without being boilerplate
+MIN_WORDS = 8
+
+SHINGLE_WORDS = 3
+
+# 20 bands of 3 rows: paragraphs with a similarity of 0.6 share a band with a probability of 0.99,
+# paragraphs with a similarity of 0.2 with a probability of 0.15
+BANDS = 20
+ROWS = 3
+PERMUTATIONS = BANDS * ROWS
+
+# Number of episode hashes kept per entry, enough to recognize an episode processed again
+SEEN_EPISODES = max(BOILERPLATE_MIN_EPISODES, BOILERPLATE_WINDOW)
+
+PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+_random = random.Random(1)
+COEFFICIENTS = [(_random.randint(1, PRIME - 1), _random.randint(0, PRIME - 1)) for _ in range(PERMUTATIONS)]
+
+
+def shingles(text):
+    words = normalize(text).split(' ')
+    if len(words) < MIN_WORDS:
+        return None
+    return set(' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+
+
+# Returns the MinHash signature of the paragraph, or None for paragraphs too short to compare
+def signature(text):
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return None
+    hashes = [zlib.crc32(shingle.encode('utf-8')) & MAX_HASH for shingle in shingle_set]
+    return [min((a * h + b) % PRIME for h in hashes) & MAX_HASH for a, b in COEFFICIENTS]
+
+
+def similarity(first, second):
+    return sum(1 for a, b in zip(first, second) if a == b) / float(PERMUTATIONS)
+
+
+def episode_hash(podcast_url):
+    return hashlib.sha1(podcast_url.encode('utf-8')).hexdigest()[:16]
+
+
+def band_keys(sig):
+    return [(band, tuple(sig[band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+
+class BoilerplateIndex(object):
+    def __init__(self, entries=None, episodes=0):
+        self.episodes = episodes
+        self.entries = {}
+        self.bands = {}
+        for entry in entries or []:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        self.entries[entry['id']] = entry
+        for key in band_keys(entry['sig']):
+            self.bands.setdefault(key, set()).add(entry['id'])
+
+    def remove(self, entry):
+        del self.entries[entry['id']]
+        for key in band_keys(entry['sig']):
+            ids = self.bands[key]
+            ids.discard(entry['id'])
+            if not ids:
+                del self.bands[key]
+
+    # The most similar entry that shares a band with the signature, if it is similar enough
+    def match(self, sig):
+        candidates = set()
+        for key in band_keys(sig):
+            candidates.update(self.bands.get(key, ()))
+        best = None
+        best_similarity = BOILERPLATE_SIMILARITY
+        for entry_id in candidates:
+            entry = self.entries[entry_id]
+            score = similarity(sig, entry['sig'])
+            if score >= best_similarity:
+                best, best_similarity = entry, score
+        return best
+
+    # Returns the entry of known boilerplate the paragraph is a near duplicate of, or None
+    def boilerplate(self, sig):
+        if sig is None:
+            return None
+        entry = self.match(sig)
+        if entry is not None and entry['count'] >= BOILERPLATE_MIN_EPISODES:
+            return entry
+        return None
+
+    # True if the paragraphs of the episode were counted already
+    def counted(self, podcast_url):
+        seen = episode_hash(podcast_url)
+        return any(seen in entry.get('seen', ()) for entry in self.entries.values())
+
+    # Counts the paragraphs of a new episode, each entry at most once per episode, and drops the
+    # entries that haven't repeated within the window. An episode that was counted before is left out.
+    def add_episode(self, podcast_url, paragraphs):
+        if self.counted(podcast_url):
+            logger.info("boilerplate of {} already counted".format(podcast_url))
+            return False
+        seen = episode_hash(podcast_url)
+        self.episodes += 1
+        for text, sig in paragraphs:
+            if sig is None:
+                continue
+            entry = self.match(sig)
+            if entry is None:
+                self.add({
+                    "id": hashlib.sha1(normalize(text).encode('utf-8')).hexdigest()[:16],
+                    "sig": sig,
+                    "count": 1,
+                    "last": self.episodes,
+                    "seen": [seen],
+                    "text": text[:200]
+                })
+            elif entry['last'] != self.episodes:
+                entry['count'] += 1
+                entry['last'] = self.episodes
+                entry['seen'] = (entry.get('seen', []) + [seen])[-SEEN_EPISODES:]
+        for entry in list(self.entries.values()):
+            if entry['count'] < BOILERPLATE_MIN_EPISODES and entry['last'] <= self.episodes - BOILERPLATE_WINDOW:
+                self.remove(entry)
+        return True
+
+
+def index_key(feed_url):
+    return BOILERPLATE_PREFIX + hashlib.sha1(feed_url.encode('utf-8')).hexdigest() + '.ndjson.gz'
+
+
+def read_index(bucket, feed_url):
+    try:
+        header, records = read_artifact(bucket, index_key(feed_url))
+    except get_client('s3').exceptions.NoSuchKey:
+        return BoilerplateIndex()
+    return BoilerplateIndex(records, header.get('episodes', 0))
+
+
+# Episodes of a feed that finish at the same time can overwrite each other's update of the index,
+# which only delays the detection of a repeated paragraph by an episode
+def write_index(bucket, feed_url, index):
+    write_artifact(bucket, index_key(feed_url), list(index.entries.values()), header={"episodes": index.episodes})
@@ -1,16 +1,18 @@
 from __future__ import print_function
-import boto3
-from botocore.client import Config
 import datetime
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler
+
+transcribe_client = lazy_client('transcribe')
     
 
 # The entry point for the lambda function
+@instrumented_handler('check_transcribe')
 def lambda_handler(event, context):
     transcribeJob = event['transcribeJob']
-    client = boto3.client('transcribe')
     
     # Call the AWS SDK to get the status of the transcription job
-    response = client.get_transcription_job(TranscriptionJobName=transcribeJob)
+    response = transcribe_client.get_transcription_job(TranscriptionJobName=transcribeJob)
     
     # Pull the status
     status = response['TranscriptionJob']['TranscriptionJobStatus']
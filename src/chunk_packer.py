@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import os
+
+# Packs the text of a transcript into as few Comprehend documents as possible.
+#
+# Comprehend takes documents of up to 5000 bytes of UTF-8, so the size of a chunk is measured in
+# encoded bytes, not characters: a transcript full of non-ASCII names has fewer characters per chunk.
+# Whole sentences are added to the chunk as long as they fit and a chunk is only closed when the next
+# sentence doesn't, which fills every chunk as close to the limit as the sentence boundaries allow
+# (and filling greedily in order gives the fewest chunks). A sentence longer than a chunk is split
+# between words, and a word longer than a chunk between characters.
+#
+# Comprehend bills a document in units of 100 characters, with a minimum of 3 units.
+
+COMPREHEND_CHUNK_BYTES = int(os.getenv('COMPREHEND_CHUNK_BYTES', default='5000'))
+
+UNIT_CHARACTERS = 100
+MINIMUM_UNITS = 3
+
+
+def utf8_length(text):
+    return len(text.encode('utf-8'))
+
+
+# Cuts the text to at most max_bytes of UTF-8 without splitting a character
+def truncate_utf8(text, max_bytes):
+    return text.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore')
+
+
+def comprehend_units(text):
+    return max(MINIMUM_UNITS, -(-len(text) // UNIT_CHARACTERS))
+
+
+class ChunkPacker(object):
+    def __init__(self, max_bytes=COMPREHEND_CHUNK_BYTES):
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.sentence = []
+        self.sentence_bytes = 0
+
+    # Adds the next piece of the transcript, a word with the space before it or a punctuation mark
+    def add(self, piece, sentence_end=False):
+        self.sentence.append(piece)
+        self.sentence_bytes += utf8_length(piece)
+        if sentence_end:
+            self.end_sentence()
+
+    def end_sentence(self):
+        if not self.sentence:
+            return
+        if self.chunk_bytes + self.sentence_bytes > self.max_bytes:
+            self.close_chunk()
+        if self.sentence_bytes > self.max_bytes:
+            self.split_sentence()
+        else:
+            self.chunk.extend(self.sentence)
+            self.chunk_bytes += self.sentence_bytes
+        self.sentence = []
+        self.sentence_bytes = 0
+
+    # Fills chunks with the words of a sentence that doesn't fit in one
+    def split_sentence(self):
+        for piece in self.sentence:
+            parts = [piece] if utf8_length(piece) <= self.max_bytes else split_piece(piece, self.max_bytes)
+            for part in parts:
+                size = utf8_length(part)
+                if self.chunk_bytes + size > self.max_bytes:
+                    self.close_chunk()
+                self.chunk.append(part)
+                self.chunk_bytes += size
+
+    def close_chunk(self):
+        text = ''.join(self.chunk).strip()
+        if text:
+            self.chunks.append(text)
+        self.chunk = []
+        self.chunk_bytes = 0
+
+    def finish(self):
+        self.end_sentence()
+        self.close_chunk()
+        return self.chunks
+
+    def stats(self):
+        total = sum(utf8_length(chunk) for chunk in self.chunks)
+        return {
+            "chunks": len(self.chunks),
+            "bytes": total,
+            "fill_ratio": round(total / float(len(self.chunks) * self.max_bytes), 3) if self.chunks else 0,
+            "units": sum(comprehend_units(chunk) for chunk in self.chunks)
+        }
+
+
+# Splits a piece between characters into parts of at most max_bytes
+def split_piece(piece, max_bytes):
+    parts = []
+    part = ''
+    size = 0
+    for character in piece:
+        length = utf8_length(character)
+        if size + length > max_bytes:
+            parts.append(part)
+            part = ''
+            size = 0
+        part += character
+        size += length
+    if part:
+        parts.append(part)
+    return parts
@@ -1,3 +1,4 @@
+import json
 import logging
 import random
 import string
@@ -24,3 +25,12 @@ def find_duplicate_person(people):
 # Creates a random string for file name
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
+
+
+# Returns a log friendly preview of a payload: the compact JSON cut off after limit characters, with
+# the full length appended when it was cut
+def summarize(value, limit=500):
+    text = json.dumps(value, separators=(',', ':'), default=str)
+    if len(text) <= limit:
+        return text
+    return text[:limit] + "... ({} chars)".format(len(text))
@@ -0,0 +1,399 @@
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import tarfile
+import tempfile
+import time
+from artifact_io import artifact_key, is_artifact, read_artifact, read_artifact_header, read_json, write_artifact, \
+    write_keywords, write_transcript
+from aws_clients import get_client
+from es_documents import MANIFEST_PREFIX
+from es_client import get_es_client
+from time_offsets import decode_offsets
+
+# Tags the episodes that were processed with COMPREHEND_MODE=BATCH using one asynchronous Comprehend
+# entities detection job, instead of a detect call per paragraph and a batch of calls per transcript.
+#
+# The pending paragraphs and transcript chunks of all the episodes are written as one document per
+# line to a single input file, next to an index that maps every line back to its episode, artifact
+# and position. When the job is done its output is read line by line, the entities are turned into
+# the same tags and transcript entities the synchronous path produces, and every episode gets new
+# keywords and transcript artifacts and an updated manifest. The tagged episodes are then indexed again.
+#
+# An artifact with a document that comprehend rejected is left as it is, still pending, so the next
+# run submits it again. A pending artifact with nothing to submit (only boilerplate paragraphs, or no
+# text) is marked done along with the others.
+#
+#   python comprehend_batch_job.py --bucket my-bucket --role-arn arn:aws:iam::123456789012:role/comprehend-s3 \
+#       --endpoint search-podcasts-xxxx.es.amazonaws.com
+#
+# Jobs take several minutes, an interrupted run picks up the submitted job with --resume <job name>.
+#
+# With --local the job is run by LocalComprehendJobClient, which implements the job API on top of the
+# input and output files and tags capitalized phrases, so the whole flow can be tried without
+# Comprehend (point AWS_ENDPOINT_URL_S3 at a local S3 to run it offline).
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+JOB_PREFIX = 'comprehend-jobs/'
+
+INPUT_FILE = 'documents.txt'
+
+FINISHED_STATES = ['COMPLETED', 'FAILED', 'STOP_REQUESTED', 'STOPPED']
+
+
+def list_keys(bucket, prefix):
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+def read_header(location):
+    return read_artifact_header(location['bucket'], location['key'])
+
+
+# The episodes whose keywords or transcript artifact is still waiting for comprehend
+def find_pending(bucket, prefix, limit=None):
+    pending = []
+    for key in list_keys(bucket, prefix):
+        manifest = read_json(bucket, key)
+        keywords_location, transcript_location = manifest['processedTranscription']
+        if not is_artifact(keywords_location['key']) or not is_artifact(transcript_location['key']):
+            continue
+        if read_header(keywords_location).get('comprehend') == 'pending' or \
+                read_header(transcript_location).get('comprehend') == 'pending':
+            pending.append(key)
+            if limit and len(pending) >= limit:
+                break
+    return pending
+
+
+# Writes the documents of the pending episodes to the input file. Returns the index, a
+# [manifest key, kind, position] entry per line of the input, and a [manifest key, kind] entry per
+# pending artifact without any document to submit.
+def write_input(bucket, manifest_keys, input_key):
+    index = []
+    empty = []
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as buffer:
+        for manifest_key in manifest_keys:
+            manifest = read_json(bucket, manifest_key)
+            keywords_location, transcript_location = manifest['processedTranscription']
+
+            lines = len(index)
+            if read_header(keywords_location).get('comprehend') == 'pending':
+                header, paragraphs = read_artifact(keywords_location['bucket'], keywords_location['key'])
+                for position, paragraph in enumerate(paragraphs):
+                    if paragraph.get('boilerplate'):
+                        continue
+                    write_document(buffer, paragraph['text'])
+                    index.append([manifest_key, 'paragraph', position])
+                if len(index) == lines:
+                    empty.append([manifest_key, 'paragraph'])
+
+            lines = len(index)
+            header = read_header(transcript_location)
+            if header.get('comprehend') == 'pending':
+                for position, chunk in enumerate(header.get('comprehend_chunks', [])):
+                    write_document(buffer, chunk)
+                    index.append([manifest_key, 'chunk', position])
+                if len(index) == lines:
+                    empty.append([manifest_key, 'chunk'])
+
+        size = buffer.tell()
+        buffer.seek(0)
+        get_client('s3').upload_fileobj(buffer, bucket, input_key)
+    logger.info("wrote {} documents ({} bytes) of {} episodes to s3://{}/{}, {} empty artifacts".format(
+        len(index), size, len(manifest_keys), bucket, input_key, len(empty)))
+    return index, empty
+
+
+# One document per line: a line break inside the text would start a new document. Replacing it with
+# a space keeps the character offsets of the entities valid for the original text.
+def write_document(buffer, text):
+    buffer.write((text.replace('\r', ' ').replace('\n', ' ') + '\n').encode('utf-8'))
+
+
+def submit(comprehend, bucket, job_name, role_arn):
+    response = comprehend.start_entities_detection_job(
+        JobName=job_name,
+        LanguageCode='en',
+        DataAccessRoleArn=role_arn,
+        InputDataConfig={
+            'S3Uri': 's3://' + bucket + '/' + JOB_PREFIX + job_name + '/input/',
+            'InputFormat': 'ONE_DOC_PER_LINE'
+        },
+        OutputDataConfig={
+            'S3Uri': 's3://' + bucket + '/' + JOB_PREFIX + job_name + '/output/'
+        }
+    )
+    logger.info("submitted comprehend job " + response['JobId'])
+    return response['JobId']
+
+
+def wait_for_job(comprehend, job_id, poll_seconds):
+    start = time.time()
+    while True:
+        properties = comprehend.describe_entities_detection_job(JobId=job_id)['EntitiesDetectionJobProperties']
+        status = properties['JobStatus']
+        if status in FINISHED_STATES:
+            break
+        logger.info("job {} is {} after {:.0f}s".format(job_id, status, time.time() - start))
+        time.sleep(poll_seconds)
+    if status != 'COMPLETED':
+        raise RuntimeError("comprehend job {} ended as {}: {}".format(job_id, status, properties.get('Message')))
+    logger.info("job {} completed after {:.0f}s".format(job_id, time.time() - start))
+    return properties['OutputDataConfig']['S3Uri']
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+# Reads the entities of every input line from the output.tar.gz of the job. Documents that comprehend
+# could not process are logged and returned as the failed lines.
+def read_output(output_uri):
+    bucket, key = split_s3_uri(output_uri)
+    results = {}
+    failed = set()
+    with tempfile.TemporaryFile() as archive:
+        get_client('s3').download_fileobj(bucket, key, archive)
+        archive.seek(0)
+        with tarfile.open(fileobj=archive, mode='r:gz') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                for line in tar.extractfile(member):
+                    if not line.strip():
+                        continue
+                    result = json.loads(line.decode('utf-8'))
+                    if 'ErrorCode' in result:
+                        logger.error("document {} failed: {} {}".format(
+                            result['Line'], result['ErrorCode'], result.get('ErrorMessage')))
+                        failed.add(result['Line'])
+                        continue
+                    results[result['Line']] = result['Entities']
+    return results, failed
+
+
+# Writes the tagged artifacts of every episode in the index, and of the empty artifacts, and points
+# its manifest at them. An artifact with a document in failed keeps its pending marker and is
+# submitted again by the next run. Returns the manifest keys of the episodes that were tagged.
+def apply_results(bucket, index, results, failed=(), empty=()):
+    missing = [line for line in range(len(index)) if line not in results and line not in failed]
+    if missing:
+        raise RuntimeError("the job output covers {} of {} documents, the first missing is line {}".format(
+            len(index) - len(missing), len(index), missing[0]))
+
+    # process_transcription_full_text reads the bucket at import time
+    os.environ.setdefault('BUCKET_NAME', bucket)
+    from process_transcription_full_text import clean_up_entity_results, parse_detected_entities_response
+    from process_transcription_paragraph import paragraph_entities
+
+    # The entities per position of every artifact that was submitted, None for the others
+    episodes = {}
+    for manifest_key, kind in empty:
+        episodes.setdefault(manifest_key, {'paragraph': None, 'chunk': None})[kind] = {}
+    for line, (manifest_key, kind, position) in enumerate(index):
+        episode = episodes.setdefault(manifest_key, {'paragraph': None, 'chunk': None})
+        if line in failed:
+            episode.setdefault('failed', set()).add(kind)
+        else:
+            if episode[kind] is None:
+                episode[kind] = {}
+            episode[kind][position] = results[line]
+
+    s3_client = get_client('s3')
+    tagged_episodes = []
+    for manifest_key, detected in episodes.items():
+        for kind in detected.pop('failed', ()):
+            logger.error("{} of {} failed, left pending".format(kind, manifest_key))
+            detected[kind] = None
+        if detected['paragraph'] is None and detected['chunk'] is None:
+            continue
+        manifest = read_json(bucket, manifest_key)
+        keywords_location, transcript_location = manifest['processedTranscription']
+
+        if detected['paragraph'] is not None:
+            header, paragraphs = read_artifact(keywords_location['bucket'], keywords_location['key'])
+            tagged = []
+            for position, paragraph in enumerate(paragraphs):
+                offsets, times = decode_offsets(paragraph['offsets'])
+                paragraph['tags'], paragraph['entities'] = paragraph_entities(
+                    detected['paragraph'].get(position, []), offsets, times)
+                tagged.append(paragraph)
+            keywords_location = replace_artifact(keywords_location, 'podcasts/keywords/',
+                                                 lambda key: write_keywords(bucket, key, tagged))
+
+        if detected['chunk'] is not None:
+            header, paragraphs = read_artifact(transcript_location['bucket'], transcript_location['key'])
+            texts = [paragraph['text'] for paragraph in paragraphs]
+            response = {'ResultList': [{'Index': position, 'Entities': entities}
+                                       for position, entities in sorted(detected['chunk'].items())]}
+            entities = parse_detected_entities_response(response, {})
+            entities_as_list = dict((entity_type, sorted(entities[entity_type])) for entity_type in entities)
+            clean_up_entity_results(entities_as_list)
+            header['transcript_entities'] = entities_as_list
+            del header['comprehend']
+            del header['comprehend_chunks']
+            transcript_location = replace_artifact(transcript_location, 'podcasts/transcript/',
+                                                   lambda key: write_transcript(bucket, key, texts, **header))
+
+        previous = manifest['processedTranscription']
+        manifest['processedTranscription'] = [keywords_location, transcript_location]
+        s3_client.put_object(Body=json.dumps(manifest, indent=2), Bucket=bucket, Key=manifest_key)
+        for old, new in zip(previous, manifest['processedTranscription']):
+            if old != new:
+                s3_client.delete_object(Bucket=old['bucket'], Key=old['key'])
+        logger.info("tagged {}: {} paragraphs, {} chunks".format(
+            manifest_key, len(detected['paragraph'] or ()), len(detected['chunk'] or ())))
+        tagged_episodes.append(manifest_key)
+    return tagged_episodes
+
+
+# Indexes the tagged episodes again, the same way rerender_episodes does. Returns the number of
+# episodes that failed to index.
+def reindex(es, bucket, manifest_keys, audio_offset):
+    from backfill_elasticsearch import load_episode
+    from es_bulk import detect_feed_routing
+    from rerender_episodes import reindex_episode
+
+    detect_feed_routing(es)
+    failures = 0
+    for manifest_key in manifest_keys:
+        key, actions = load_episode(bucket, manifest_key, audio_offset)
+        if reindex_episode(es, actions).errors:
+            logger.error("{} failed to index, run backfill_elasticsearch.py to index it".format(manifest_key))
+            failures += 1
+    return failures
+
+
+def replace_artifact(location, prefix, write):
+    key = artifact_key(prefix)
+    write(key)
+    return {"bucket": location['bucket'], "key": key}
+
+
+# Stands in for the asynchronous entities detection API of Comprehend. The job runs as soon as it is
+# started: the input files are read, every line goes through the detector, and the results are
+# written as output.tar.gz in the layout Comprehend uses.
+class LocalComprehendJobClient(object):
+    def __init__(self, detector=None):
+        self.detector = detector or detect_capitalized_phrases
+        self.jobs = {}
+
+    def start_entities_detection_job(self, JobName, InputDataConfig, OutputDataConfig, **kwargs):
+        s3_client = get_client('s3')
+        input_bucket, input_prefix = split_s3_uri(InputDataConfig['S3Uri'])
+        output_bucket, output_prefix = split_s3_uri(OutputDataConfig['S3Uri'])
+        job_id = 'local-' + JobName
+
+        lines = []
+        for key in list_keys(input_bucket, input_prefix):
+            body = s3_client.get_object(Bucket=input_bucket, Key=key)['Body']
+            for number, line in enumerate(body.read().decode('utf-8').splitlines()):
+                lines.append({"File": key[len(input_prefix):], "Line": number,
+                              "Entities": self.detector(line)})
+
+        data = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            info = tarfile.TarInfo('output')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        output_key = output_prefix + '000000000000-NER-' + job_id + '/output/output.tar.gz'
+        s3_client.put_object(Body=archive.getvalue(), Bucket=output_bucket, Key=output_key)
+
+        self.jobs[job_id] = {
+            'JobId': job_id,
+            'JobName': JobName,
+            'JobStatus': 'COMPLETED',
+            'OutputDataConfig': {'S3Uri': 's3://' + output_bucket + '/' + output_key}
+        }
+        return {'JobId': job_id, 'JobStatus': 'SUBMITTED'}
+
+    def describe_entities_detection_job(self, JobId):
+        return {'EntitiesDetectionJobProperties': self.jobs[JobId]}
+
+
+CAPITALIZED_PHRASE = re.compile(r"[A-Z][\w'&.-]*(?: [A-Z][\w'&.-]*)+")
+
+
+# Tags runs of two or more capitalized words, which is enough to exercise the pipeline
+def detect_capitalized_phrases(text):
+    return [{
+        "Score": 1.0,
+        "Type": "OTHER",
+        "Text": match.group(0),
+        "BeginOffset": match.start(),
+        "EndOffset": match.end()
+    } for match in CAPITALIZED_PHRASE.finditer(text)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tag the pending episodes with one asynchronous comprehend job')
+    parser.add_argument('--bucket', required=True, help='bucket the episode state machine writes to')
+    parser.add_argument('--role-arn', help='role that gives comprehend access to the bucket')
+    parser.add_argument('--prefix', default=MANIFEST_PREFIX, help='prefix of the episode manifests')
+    parser.add_argument('--max-episodes', type=int, help='number of pending episodes to put in the job')
+    parser.add_argument('--resume', metavar='JOB_NAME', help='wait for a submitted job and apply its results')
+    parser.add_argument('--poll-seconds', type=int, default=60, help='seconds between job status checks')
+    parser.add_argument('--local', action='store_true', help='run the job locally instead of in comprehend')
+    parser.add_argument('--endpoint', default=os.getenv('ES_DOMAIN'), help='Elasticsearch domain endpoint')
+    parser.add_argument('--no-index', action='store_true', help='only write the artifacts, don\'t reindex')
+    parser.add_argument('--audio-offset', type=int, default=int(os.getenv('AUDIO_OFFSET', default='1')),
+                        help='seconds before a paragraph that its deep link starts')
+    args = parser.parse_args()
+
+    if not args.no_index and not args.endpoint:
+        parser.error('--endpoint is required to index the tagged episodes, or pass --no-index')
+    comprehend = LocalComprehendJobClient() if args.local else get_client('comprehend')
+    bucket = args.bucket
+
+    if args.resume:
+        job_name = args.resume
+        header, records = read_artifact(bucket, JOB_PREFIX + job_name + '/index.ndjson.gz')
+        index = list(records)
+        empty = header.get('empty', [])
+        job_id = header['JobId']
+    else:
+        if not args.local and not args.role_arn:
+            parser.error('--role-arn is required to submit a comprehend job')
+        manifest_keys = find_pending(bucket, args.prefix, args.max_episodes)
+        if not manifest_keys:
+            logger.info("no pending episodes")
+            return
+        job_name = 'podcast-entities-' + time.strftime('%Y%m%d-%H%M%S')
+        index, empty = write_input(bucket, manifest_keys, JOB_PREFIX + job_name + '/input/' + INPUT_FILE)
+        job_id = None
+        if index:
+            job_id = submit(comprehend, bucket, job_name, args.role_arn)
+            write_artifact(bucket, JOB_PREFIX + job_name + '/index.ndjson.gz', index,
+                           header={'JobId': job_id, 'JobName': job_name, 'episodes': len(manifest_keys),
+                                   'empty': empty})
+
+    results, failed = {}, set()
+    if job_id is not None:
+        output_uri = wait_for_job(comprehend, job_id, args.poll_seconds)
+        results, failed = read_output(output_uri)
+        logger.info("{} of {} documents tagged, {} failed".format(len(results), len(index), len(failed)))
+    episodes = apply_results(bucket, index, results, failed, empty)
+    logger.info("tagged {} episodes".format(len(episodes)))
+    if args.no_index:
+        logger.info("run backfill_elasticsearch.py to index them")
+        return
+    failures = reindex(get_es_client(args.endpoint), bucket, episodes, args.audio_offset)
+    if failures:
+        raise RuntimeError("{} of {} tagged episodes failed to index".format(failures, len(episodes)))
+
+
+if __name__ == '__main__':
+    main()
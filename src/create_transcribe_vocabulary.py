@@ -2,28 +2,30 @@ from __future__ import print_function
 import json
 import os
 import re
-import boto3
-from botocore.client import Config
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
 import xml.etree.ElementTree as ET
 import string
 import random
 import time
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler
+from vocabulary_cache import write_feed_mapping
 
-transcribe_client = boto3.client('transcribe')
+transcribe_client = lazy_client('transcribe')
 
 # Transribe will return spoken numbers in their word form, so if the custom vocabulary
 # has 'S3' it needs to be converted to S-Three
 convertDigitToWord = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']
 
-s3_client = boto3.client('s3')
+s3_client = lazy_client('s3')
 
 # Generates a random ID for the step function execution
 def id_generator(size=8, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))     
 
 # Lambda S3 function
+@instrumented_handler('create_vocabulary')
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event, indent=2))
     
@@ -96,6 +98,9 @@ def lambda_handler(event, context):
     mappingKey = 'podcasts/vocabularyMapping/' + id_generator() + '.json'
     s3_response = s3_client.put_object(Body= json.dumps(mapping, indent=2), Bucket= bucket, Key=mappingKey)
 
+    # rerender_episodes processes the old episodes of the feed with its latest mapping
+    if 'rss' in event:
+        write_feed_mapping(bucket, event['rss'], {"bucket": bucket, "key": mappingKey})
 
     return {
         "status": response['VocabularyState'],
@@ -107,6 +112,7 @@ def lambda_handler(event, context):
     }
 
 # Lambda S3 function
+@instrumented_handler('check_vocabulary')
 def check_vocabulary_status(event, context):
     print("Received event: " + json.dumps(event, indent=2))
     response = transcribe_client.get_vocabulary(
@@ -120,6 +126,7 @@ def check_vocabulary_status(event, context):
     return event
 
 # Lambda S3 function
+@instrumented_handler('delete_vocabulary')
 def delete_vocabulary(event, context):
     print("Delete Received event: " + json.dumps(event, indent=2))
 
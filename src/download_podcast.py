@@ -1,10 +1,11 @@
 from __future__ import print_function
-import boto3
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
 import os
 import logging
 from common_lib import id_generator
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler, timer
 
 # Log level
 logging.basicConfig()
@@ -14,7 +15,7 @@ if os.getenv('LOG_LEVEL') == 'DEBUG':
 else:
     logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
+s3_client = lazy_client('s3')
 
 
 # This is the entry point for the lambda function.
@@ -25,6 +26,7 @@ s3_client = boto3.client('s3')
 #  "dryrun": "Tells the step function to skip this step. Won't impact this function",
 #  "podcastUrl": "The url of the mp3 file provided by the RSS feed."
 # }
+@instrumented_handler('download_podcast')
 def lambda_handler(event, context):
     url = event['podcastUrl']
     bucket = event['bucket']
@@ -36,21 +38,26 @@ def lambda_handler(event, context):
     try:
         logger.info("downloading from: " + url)
 
-        # Open the url
-        stream = urlopen(url)
-
         s3_object_metadata = {'href': url}
 
-        logger.info("writing to s3://" + bucket + "/" + key)
-        s3_client.upload_fileobj(
-            Fileobj=stream,
-            Bucket=bucket,
-            Key=key,
-            ExtraArgs={
-                "Metadata": s3_object_metadata,
-                'ContentType': content_type
-            }
-        )
+        # The audio is streamed from the url straight into the multipart upload, so the download and
+        # the upload are timed together
+        with timer('download') as m:
+            # Open the url
+            stream = urlopen(url)
+            m.bytes_in = int(stream.headers.get('Content-Length') or 0)
+
+            logger.info("writing to s3://" + bucket + "/" + key)
+            s3_client.upload_fileobj(
+                Fileobj=stream,
+                Bucket=bucket,
+                Key=key,
+                ExtraArgs={
+                    "Metadata": s3_object_metadata,
+                    'ContentType': content_type
+                }
+            )
+            m.bytes_out = m.bytes_in
         logger.info("done writing to s3://" + bucket + "/" + key)
 
         # Return the bucket and key the location of the podcast file stored in S3
@@ -1,11 +1,12 @@
 from __future__ import print_function
 
-import boto3
-import certifi
 import json
 import os
-from aws_requests_auth.aws_auth import AWSRequestsAuth
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+import re
+from es_bulk import live_writers, restore_expired_bulk_loads, update_meta
+from es_client import get_es_client, latency_histogram
+from es_documents import ENTITY_ROLLUP_INDEX, FEED_ROUTING, PARAGRAPH_PARTITIONS, paragraph_index
+from instrumentation import instrumented_handler
 import logging
 import time
 
@@ -17,9 +18,6 @@ if os.getenv('LOG_LEVEL') == 'DEBUG':
 else:
     logger.setLevel(logging.INFO)
 
-# Parameters
-REGION = os.getenv('AWS_REGION', default='us-east-1')
-
 # Pull environment data for the ES domain
 esendpoint = os.environ['ES_DOMAIN']
 # If debug mode is TRUE, then S3 files are not deleted
@@ -30,36 +28,55 @@ FULL_EPISODE_INDEX = os.getenv('ES_EPISODE_INDEX', default='episodes')
 # get the Elasticsearch index name from the environment variables
 KEYWORDS_INDEX = os.getenv('ES_PARAGRAPH_INDEX', default='paragraphs')
 
-s3_client = boto3.client('s3')
-# Create the auth token for the sigv4 signature
-session = boto3.session.Session()
-credentials = session.get_credentials().get_frozen_credentials()
-awsauth = AWSRequestsAuth(
-    aws_access_key=credentials.access_key,
-    aws_secret_access_key=credentials.secret_key,
-    aws_token=credentials.token,
-    aws_host=esendpoint,
-    aws_region=REGION,
-    aws_service='es'
-)
-
-# Connect to the elasticsearch cluster using aws authentication. The lambda function
-# must have access in an IAM policy to the ES cluster.
-es = Elasticsearch(
-    hosts=[{'host': esendpoint, 'port': 443}],
-    http_auth=awsauth,
-    use_ssl=True,
-    verify_certs=True,
-    ca_certs=certifi.where(),
-    timeout=120,
-    connection_class=RequestsHttpConnection
-)
-
-
-def create_episode_index():
+# Primary shards of each monthly paragraph partition
+PARAGRAPH_PARTITION_SHARDS = int(os.getenv('ES_PARAGRAPH_PARTITION_SHARDS', default='1'))
+
+# The partitions of the last this many months take writes, older ones are force merged and made read
+# only by the maintenance
+PARTITION_WRITABLE_MONTHS = int(os.getenv('PARAGRAPH_PARTITION_WRITABLE_MONTHS', default='3'))
+
+# Seconds to wait for the force merge of a partition. The merge goes on in the domain when the request
+# times out, and is requested again by the next maintenance run.
+FORCE_MERGE_TIMEOUT = int(os.getenv('FORCE_MERGE_TIMEOUT', default='600'))
+
+# Seconds to wait for the reindex of a paragraphs index created before the monthly partitions. The
+# reindex goes on in the domain when the request times out, and the next run reindexes again and
+# finishes the migration.
+MIGRATION_TIMEOUT = int(os.getenv('PARAGRAPH_MIGRATION_TIMEOUT', default='840'))
+
+PARTITION_NAME = re.compile('^' + re.escape(KEYWORDS_INDEX) + r'-(\d{4})\.(\d{2})$')
+
+
+class MigrationError(Exception):
+    pass
+
+
+
+def create_episode_index(es):
+    # Fields that are only filtered or aggregated on are keywords, and text fields that don't
+    # need relevance scoring have norms disabled to save heap and disk. The fields the saved objects of
+    # kibana.json aggregate on keep the .keyword multi-field dynamic mapping gave them, so the
+    # dashboards work on indices created either way.
     mappings = '''
     {
         "mappings": {
+            "dynamic_templates": [
+                {
+                    "transcript_entities": {
+                        "path_match": "transcript_entities.*",
+                        "match_mapping_type": "string",
+                        "mapping": {
+                            "type": "keyword",
+                            "fields": {
+                                "keyword": {
+                                    "type": "keyword",
+                                    "ignore_above": 256
+                                }
+                            }
+                        }
+                    }
+                }
+            ],
             "properties": {
                 "audio_url":{
                     "type": "keyword"
@@ -67,11 +84,22 @@ def create_episode_index():
                 "audio_type":{
                     "type": "keyword"
                 },
+                "title":{
+                    "type": "text",
+                    "norms": false,
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "ignore_above": 256
+                        }
+                    }
+                },
                 "transcript":{
                     "type": "text"
                 },
                 "audio_s3_location": {
-                    "type": "keyword"
+                    "type": "keyword",
+                    "index": false
                 },
                 "published_time":{
                     "type":   "date",
@@ -82,21 +110,384 @@ def create_episode_index():
                 },
                 "source_feed":{
                     "type": "keyword"
+                },
+                "speakerNames":{
+                    "type": "keyword",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "ignore_above": 256
+                        }
+                    }
+                },
+                "transcript_entities":{
+                    "type": "object"
+                },
+                "key_phrases":{
+                    "type": "keyword",
+                    "ignore_above": 256
+                },
+                "sentiment":{
+                    "properties": {
+                        "label": {
+                            "type": "keyword"
+                        },
+                        "scores": {
+                            "properties": {
+                                "positive": {
+                                    "type": "scaled_float",
+                                    "scaling_factor": 10000
+                                },
+                                "negative": {
+                                    "type": "scaled_float",
+                                    "scaling_factor": 10000
+                                },
+                                "neutral": {
+                                    "type": "scaled_float",
+                                    "scaling_factor": 10000
+                                },
+                                "mixed": {
+                                    "type": "scaled_float",
+                                    "scaling_factor": 10000
+                                }
+                            }
+                        }
+                    }
+                },
+                "analytics":{
+                    "properties": {
+                        "duration_seconds": {
+                            "type": "float"
+                        },
+                        "speech_seconds": {
+                            "type": "float"
+                        },
+                        "silence_seconds": {
+                            "type": "float"
+                        },
+                        "silence_ratio": {
+                            "type": "scaled_float",
+                            "scaling_factor": 10000
+                        },
+                        "words": {
+                            "type": "integer"
+                        },
+                        "words_per_minute": {
+                            "type": "float"
+                        },
+                        "speakers": {
+                            "type": "nested",
+                            "properties": {
+                                "speaker": {
+                                    "type": "keyword"
+                                },
+                                "talk_seconds": {
+                                    "type": "float"
+                                },
+                                "talk_ratio": {
+                                    "type": "scaled_float",
+                                    "scaling_factor": 10000
+                                },
+                                "words": {
+                                    "type": "integer"
+                                },
+                                "words_per_minute": {
+                                    "type": "float"
+                                }
+                            }
+                        }
+                    }
                 }
             }
         }
     }
     '''
+    create_index(es, FULL_EPISODE_INDEX, mappings)
+
+
+# Entity counts per feed and day (see es_documents.rollup_actions). The counts of the single episodes
+# are only read by the update script, they aren't indexed.
+def create_entity_rollup_index(es):
+    mappings = '''
+    {
+        "mappings": {
+            "properties": {
+                "entity":{
+                    "type": "keyword"
+                },
+                "entity_type":{
+                    "type": "keyword"
+                },
+                "source_feed":{
+                    "type": "keyword"
+                },
+                "PodcastName":{
+                    "type": "keyword"
+                },
+                "day":{
+                    "type":   "date",
+                    "format": "yyyy:MM:dd"
+                },
+                "paragraphs":{
+                    "type": "integer"
+                },
+                "mentions":{
+                    "type": "integer"
+                },
+                "episodes":{
+                    "type": "integer"
+                },
+                "episode_ids":{
+                    "type": "keyword"
+                },
+                "contributions":{
+                    "type": "object",
+                    "enabled": false
+                }
+            }
+        }
+    }
+    '''
+    create_index(es, ENTITY_ROLLUP_INDEX, mappings)
+
+
+# The template the monthly paragraph partitions are created from, on the first document written to
+# them. Every partition joins the KEYWORDS_INDEX alias, unless an index still has that name.
+def put_paragraph_template(es, alias=True):
+    # Without an explicit mapping every string field of the paragraph documents gets a text field
+    # plus a keyword multi-field. Only the paragraph text needs to be scored, everything else is
+    # used for filters and aggregations. tags keeps its .keyword multi-field for kibana.json.
+    mappings = '''
+    {
+        "mappings": {
+            "properties": {
+                "PodcastName":{
+                    "type": "keyword"
+                },
+                "Episode":{
+                    "type": "text",
+                    "norms": false,
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "ignore_above": 256
+                        }
+                    }
+                },
+                "episode_url":{
+                    "type": "keyword"
+                },
+                "source_feed":{
+                    "type": "keyword"
+                },
+                "published_time":{
+                    "type":   "date",
+                    "format": "yyyy:MM:dd HH:mm:ss"
+                },
+                "url":{
+                    "type": "keyword",
+                    "index": false,
+                    "doc_values": false
+                },
+                "text":{
+                    "type": "text"
+                },
+                "tags":{
+                    "type": "keyword",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "ignore_above": 256
+                        }
+                    }
+                },
+                "speaker":{
+                    "type": "keyword"
+                },
+                "boilerplate":{
+                    "type": "boolean"
+                },
+                "startTime":{
+                    "type": "scaled_float",
+                    "scaling_factor": 1000
+                },
+                "entities":{
+                    "type": "nested",
+                    "properties": {
+                        "text": {
+                            "type": "keyword"
+                        },
+                        "type": {
+                            "type": "keyword"
+                        },
+                        "time": {
+                            "type": "scaled_float",
+                            "scaling_factor": 1000
+                        },
+                        "url": {
+                            "type": "keyword",
+                            "index": false,
+                            "doc_values": false
+                        }
+                    }
+                },
+                "offsets":{
+                    "type": "object",
+                    "enabled": false
+                }
+            }
+        }
+    }
+    '''
+    template = with_routing(json.loads(mappings))
+    template['index_patterns'] = [PARAGRAPH_PARTITIONS]
+    template['aliases'] = {KEYWORDS_INDEX: {}} if alias else {}
+    template['settings'] = {"number_of_shards": PARAGRAPH_PARTITION_SHARDS}
+    start = time.time()
+    logger.info("template for the partitions " + PARAGRAPH_PARTITIONS + ": " + json.dumps(template))
+    res = es.indices.put_template(name=KEYWORDS_INDEX, body=template)
+    logger.info(json.dumps(res, indent=2))
+    logger.info('REQUEST_TIME es_client.indices.put_template {:10.4f}'.format(time.time() - start))
+
+
+# Every document is indexed with the routing of its feed, a document without it is rejected instead
+# of ending up on another shard than the rest of its feed
+def with_routing(body):
+    if FEED_ROUTING:
+        body['mappings']['_routing'] = {"required": True}
+    return body
+
+
+def create_index(es, index, mappings):
+    mappings = json.dumps(with_routing(json.loads(mappings)), indent=2)
     start = time.time()
-    logger.info("mappings to create for index: " + mappings)
-    res = es.indices.create(index=FULL_EPISODE_INDEX, body=mappings)
+    logger.info("mappings to create for index " + index + ": " + mappings)
+    res = es.indices.create(index=index, body=mappings)
     round_trip = time.time() - start
     logger.info(json.dumps(res, indent=2))
     logger.info('REQUEST_TIME es_client.indices.create {:10.4f}'.format(round_trip))
 
 
+@instrumented_handler('create_index')
 def lambda_handler(event, context):
+    latency_histogram.reset()
+    # Shared client with refreshing sigv4 auth and a pooled connection, built on first use
+    es = get_es_client(esendpoint)
+
     if not es.indices.exists(index=FULL_EPISODE_INDEX):
-        create_episode_index()
+        create_episode_index(es)
     else:
         logger.info("index " + FULL_EPISODE_INDEX + " already exists. skipping index creation.")
+
+    if not es.indices.exists(index=ENTITY_ROLLUP_INDEX):
+        create_entity_rollup_index(es)
+    else:
+        logger.info("index " + ENTITY_ROLLUP_INDEX + " already exists. skipping index creation.")
+
+    # The partition of the current month, so the alias exists before the first episode is uploaded
+    partition = paragraph_index(time.strftime('%Y:%m:%d %H:%M:%S', time.gmtime()))
+    if es.indices.exists(index=KEYWORDS_INDEX) and not es.indices.exists_alias(name=KEYWORDS_INDEX):
+        migrate_paragraph_index(es, partition)
+    else:
+        # Put on every run, so the partitions of the coming months get the current mapping
+        put_paragraph_template(es)
+        if not es.indices.exists(index=partition):
+            es.indices.create(index=partition)
+            logger.info("created paragraph partition " + partition)
+
+    latency_histogram.log_summary()
+
+
+# Moves the paragraphs of an index created before the monthly partitions into the partition of the
+# current month, then deletes the index and adds the alias of the partitions in the same update, so
+# searches always find the paragraphs under KEYWORDS_INDEX.
+#
+# Until then the index has the name of the alias, so the partitions are created without it: the
+# template leaves the alias out, and the alias is added to every partition by the update, including
+# the ones uploads created in the meantime.
+def migrate_paragraph_index(es, partition):
+    logger.info("index " + KEYWORDS_INDEX + " predates the monthly partitions, moving it to " + partition)
+    put_paragraph_template(es, alias=False)
+    if not es.indices.exists(index=partition):
+        es.indices.create(index=partition)
+        logger.info("created paragraph partition " + partition)
+
+    body = {"source": {"index": KEYWORDS_INDEX}, "dest": {"index": partition}}
+    # Paragraphs indexed before the documents were routed take the routing of their feed
+    if FEED_ROUTING:
+        body['script'] = {"lang": "painless",
+                          "source": "if (ctx._routing == null) { ctx._routing = ctx._source.source_feed }"}
+    start = time.time()
+    res = es.reindex(body=body, refresh=True, slices='auto', request_timeout=MIGRATION_TIMEOUT)
+    logger.info('REQUEST_TIME es_client.reindex {:10.4f}'.format(time.time() - start))
+    logger.info("reindexed {} paragraphs into {}".format(res['created'] + res['updated'], partition))
+    if res['failures']:
+        logger.error("reindex failures: " + json.dumps(res['failures'][:10], default=str))
+        raise MigrationError("{} paragraphs failed to reindex into {}".format(len(res['failures']), partition))
+
+    es.indices.update_aliases(body={"actions": [
+        {"remove_index": {"index": KEYWORDS_INDEX}},
+        {"add": {"index": PARAGRAPH_PARTITIONS, "alias": KEYWORDS_INDEX}}
+    ]})
+    logger.info("replaced index " + KEYWORDS_INDEX + " with the alias of the partitions")
+    put_paragraph_template(es)
+
+
+# Entry point of the daily maintenance of the paragraph partitions
+# {
+#  "writableMonths": "Optional, overrides PARAGRAPH_PARTITION_WRITABLE_MONTHS.",
+#  "reopen": "Optional, a partition to take writes again, for writes that don't go through the upload
+#             or the tools, which lift the block themselves. It is merged and made read only again by
+#             the next maintenance run."
+# }
+@instrumented_handler('maintain_partitions')
+def maintain_partitions_handler(event, context):
+    latency_histogram.reset()
+    es = get_es_client(esendpoint)
+    # Partitions an upload left without refresh and replicas when it timed out
+    restored = restore_expired_bulk_loads(es, PARAGRAPH_PARTITIONS)
+    if event.get('reopen'):
+        es.indices.put_settings(index=event['reopen'], body={"index": {"blocks.write": False}})
+        logger.info("reopened partition " + event['reopen'])
+        result = {"reopened": [event['reopen']]}
+    else:
+        result = {"sealed": seal_partitions(es, int(event.get('writableMonths', PARTITION_WRITABLE_MONTHS)))}
+    result['restored'] = restored
+    latency_histogram.log_summary()
+    return result
+
+
+# Force merges the partitions of the months before the last writable_months down to one segment and
+# blocks writes to them, so they take no more merges and recover from a few large files. Partitions
+# that are already read only are left alone, and so are partitions an upload unsealed and is still
+# writing to (see es_bulk.unsealed_partitions).
+def seal_partitions(es, writable_months, now=None):
+    today = time.gmtime(now)
+    first_writable = today.tm_year * 12 + today.tm_mon - writable_months
+
+    settings = es.indices.get_settings(index=PARAGRAPH_PARTITIONS, name='index.blocks.write', flat_settings=True)
+    sealed = []
+    for index in sorted(settings):
+        match = PARTITION_NAME.match(index)
+        if match is None or int(match.group(1)) * 12 + int(match.group(2)) > first_writable:
+            continue
+        if settings[index].get('settings', {}).get('index.blocks.write') == 'true':
+            continue
+        mappings = es.indices.get_mapping(index=index)
+        if live_writers(mappings.get(index, {}).get('mappings', {}).get('_meta', {}), now):
+            logger.info("partition {} is being written to, sealing it on the next run".format(index))
+            continue
+
+        start = time.time()
+        try:
+            es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=FORCE_MERGE_TIMEOUT)
+        except Exception as e:
+            logger.error("force merge of {} didn't finish: {}".format(index, e))
+            continue
+        logger.info('REQUEST_TIME es_client.indices.forcemerge {:10.4f}'.format(time.time() - start))
+        es.indices.put_settings(index=index, body={"index": {"blocks.write": True}})
+        # The writers that died before sealing it again
+        update_meta(es, index, lambda meta: meta.pop('unsealed', None))
+        logger.info("sealed paragraph partition " + index)
+        sealed.append(index)
+    return sealed
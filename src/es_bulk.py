@@ -0,0 +1,360 @@
+from __future__ import print_function
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from es_documents import ENTITY_ROLLUP_INDEX, FEED_ROUTING, FULL_EPISODE_INDEX, KEYWORDS_INDEX, \
+    episode_paragraphs_query, routed_indices, set_routed_indices
+from instrumentation import record
+
+# Log level
+logging.basicConfig()
+logger = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+# Maximum number of documents sent in a single bulk request
+BULK_CHUNK_SIZE = int(os.getenv('ES_BULK_CHUNK_SIZE', default='500'))
+
+# Maximum size in bytes of a single bulk request. Amazon Elasticsearch rejects requests over the
+# http payload limit of the instance type (10MB for the smaller instances) with a 413.
+BULK_MAX_BYTES = int(os.getenv('ES_BULK_MAX_BYTES', default=str(5 * 1024 * 1024)))
+
+# Number of times documents rejected with a 429 are retried, and the backoff between attempts.
+# The backoff doubles with every attempt up to BULK_MAX_BACKOFF seconds.
+BULK_MAX_RETRIES = int(os.getenv('ES_BULK_MAX_RETRIES', default='5'))
+BULK_INITIAL_BACKOFF = float(os.getenv('ES_BULK_INITIAL_BACKOFF', default='2'))
+BULK_MAX_BACKOFF = float(os.getenv('ES_BULK_MAX_BACKOFF', default='60'))
+
+# Loads with at least this many documents switch the index to bulk load settings while they run
+BULK_LOAD_THRESHOLD = int(os.getenv('ES_BULK_LOAD_THRESHOLD', default='1000'))
+
+
+# Seconds the indices that require the feed routing are remembered for, so warm containers pick up an
+# index migrated to the routing
+ROUTING_CACHE_SECONDS = int(os.getenv('ES_ROUTING_CACHE_SECONDS', default='300'))
+
+
+# Raised by the loads that have to be retried as a whole when some documents failed to index
+class BulkIndexError(Exception):
+    pass
+
+
+class BulkStats(object):
+    def __init__(self):
+        self.indexed = 0
+        self.errors = []
+        self.chunk_latencies = []
+        self.elapsed = 0.0
+
+    @property
+    def docs_per_second(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.indexed / self.elapsed
+
+    def summary(self):
+        latencies = sorted(self.chunk_latencies)
+        summary = {
+            "indexed": self.indexed,
+            "failed": len(self.errors),
+            "chunks": len(latencies),
+            "elapsed": round(self.elapsed, 4),
+            "docs_per_second": round(self.docs_per_second, 1)
+        }
+        if latencies:
+            summary["chunk_latency_avg"] = round(sum(latencies) / len(latencies), 4)
+            summary["chunk_latency_p50"] = round(latencies[len(latencies) // 2], 4)
+            summary["chunk_latency_max"] = round(latencies[-1], 4)
+        return summary
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise BulkIndexError("{} documents failed to index".format(len(self.errors)))
+
+
+# Approximates the number of bytes an action takes up in the bulk request body: the action line,
+# the source line and their newlines.
+def action_size(action):
+    meta = dict((k, v) for k, v in action.items() if k.startswith('_') and k != '_source')
+    size = len(json.dumps(meta).encode('utf-8')) + 1
+    if '_source' in action:
+        size += len(json.dumps(action['_source']).encode('utf-8')) + 1
+    else:
+        source = dict((k, v) for k, v in action.items() if not k.startswith('_'))
+        if source:
+            size += len(json.dumps(source).encode('utf-8')) + 1
+    return size
+
+
+# Groups a stream of actions into chunks capped by both the number of actions and their size in
+# bytes. Only one chunk is held in memory at a time.
+def chunk_actions(actions, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_BYTES):
+    chunk = []
+    chunk_bytes = 0
+    for action in actions:
+        size = action_size(action)
+        if chunk and (len(chunk) >= chunk_size or chunk_bytes + size > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(action)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+# Indexes a stream of actions with streaming_bulk, one chunk per bulk request. Documents rejected
+# with a 429 are retried with exponential backoff by streaming_bulk; documents that still fail are
+# collected in the returned stats instead of failing the whole load. Callers that need every document
+# indexed call raise_for_errors on the stats.
+def bulk_index(es, actions, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_BYTES,
+               max_retries=BULK_MAX_RETRIES, initial_backoff=BULK_INITIAL_BACKOFF, max_backoff=BULK_MAX_BACKOFF):
+    from elasticsearch import helpers
+
+    stats = BulkStats()
+    start = time.time()
+    for chunk in chunk_actions(actions, chunk_size, max_chunk_bytes):
+        chunk_start = time.time()
+        for ok, item in helpers.streaming_bulk(es, chunk,
+                                               chunk_size=len(chunk),
+                                               max_chunk_bytes=max_chunk_bytes,
+                                               max_retries=max_retries,
+                                               initial_backoff=initial_backoff,
+                                               max_backoff=max_backoff,
+                                               raise_on_error=False,
+                                               yield_ok=False):
+            if not ok:
+                stats.errors.append(item)
+        latency = time.time() - chunk_start
+        stats.chunk_latencies.append(latency)
+        stats.indexed += len(chunk)
+        record('bulk_chunk', latency, items=len(chunk))
+        logger.debug('REQUEST_TIME es_client.bulk {:10.4f} ({} docs)'.format(latency, len(chunk)))
+    stats.indexed -= len(stats.errors)
+    stats.elapsed = time.time() - start
+
+    logger.info("bulk index: " + json.dumps(stats.summary()))
+    for error in stats.errors[:10]:
+        logger.error("bulk index error: " + json.dumps(error, default=str))
+    return stats
+
+
+# Seconds after which a bulk load is taken to have died without restoring the settings of the index,
+# longer than any lambda runs
+BULK_LOAD_EXPIRY = int(os.getenv('ES_BULK_LOAD_EXPIRY', default='1800'))
+
+
+def timed_request(description, call, **kwargs):
+    start = time.time()
+    result = call(**kwargs)
+    logger.info('REQUEST_TIME es_client.{} {:10.4f}'.format(description, time.time() - start))
+    return result
+
+
+# The markers of the loads and writes in flight share the _meta of the mapping, which is replaced as a
+# whole. The threads of a backfill update it one at a time.
+_meta_lock = threading.Lock()
+
+
+# Applies update to the _meta of the mapping of the index and puts it back. Returns the new _meta.
+def update_meta(es, index, update):
+    with _meta_lock:
+        mappings = timed_request('indices.get_mapping', es.indices.get_mapping, index=index)
+        meta = mappings.get(index, {}).get('mappings', {}).get('_meta', {})
+        update(meta)
+        timed_request('indices.put_mapping', es.indices.put_mapping, index=index, body={"_meta": meta})
+        return meta
+
+
+# Puts back the refresh interval and replicas an index had before a bulk load. Settings that were
+# never set explicitly are None, which resets them to the default. The marker is dropped after the
+# settings are back, unless a load started in between.
+def restore_settings(es, index, previous):
+    timed_request('indices.put_settings', es.indices.put_settings, index=index, body={"index": {
+        "refresh_interval": previous.get('index.refresh_interval'),
+        "number_of_replicas": previous.get('index.number_of_replicas')
+    }})
+
+    def drop_marker(meta):
+        if not live_loads(meta.get('bulk_load')):
+            meta.pop('bulk_load', None)
+    update_meta(es, index, drop_marker)
+
+
+# The loads of the marker that haven't expired, by load id
+def live_loads(marker, now=None):
+    now = time.time() if now is None else now
+    return dict((load, expires) for load, expires in (marker or {}).get('loads', {}).items() if expires > now)
+
+
+# Restores the settings of the indices behind the name that are in bulk load mode without a live load:
+# the loads that switched them over were killed before they restored them (a lambda timeout), or they
+# predate the marker. Returns the indices that were restored.
+def restore_expired_bulk_loads(es, index, now=None):
+    settings = timed_request('indices.get_settings', es.indices.get_settings, index=index,
+                             name='index.refresh_interval', flat_settings=True)
+    loading = [name for name, index_settings in settings.items()
+               if index_settings.get('settings', {}).get('index.refresh_interval') == '-1']
+    if not loading:
+        return []
+    mappings = timed_request('indices.get_mapping', es.indices.get_mapping, index=','.join(loading))
+    restored = []
+    for name in loading:
+        marker = mappings.get(name, {}).get('mappings', {}).get('_meta', {}).get('bulk_load')
+        if live_loads(marker, now):
+            continue
+        logger.warning("index {} was left in bulk load mode, restoring its settings".format(name))
+        restore_settings(es, name, marker['previous'] if marker is not None else {})
+        restored.append(name)
+    return restored
+
+
+# Switches an index to bulk load settings (no refresh, no replicas) for the duration of a large load
+# and restores the previous settings afterwards.
+#
+# Several episodes can be uploaded at the same time. Every load is recorded in the _meta of the
+# mapping with an expiry, next to the settings the index had before the first of them, and the
+# settings are only restored when the last load is done. The marker outlives the loads until the
+# settings are back, so a load that starts in the meantime keeps the settings to restore rather than
+# taking the bulk load ones for them. When a load dies before it is done, its entry expires and the
+# next load (or the partition maintenance) restores the settings instead of finding the index stuck
+# without refresh and replicas.
+@contextmanager
+def bulk_load_settings(es, index):
+    restore_expired_bulk_loads(es, index)
+    settings = timed_request('indices.get_settings', es.indices.get_settings, index=index,
+                             name=['index.refresh_interval', 'index.number_of_replicas'], flat_settings=True)
+    current = dict((index_name, index_settings.get('settings', {})) for index_name, index_settings in settings.items())
+
+    load = uuid.uuid4().hex
+    expires = time.time() + BULK_LOAD_EXPIRY
+
+    def join(index_name):
+        def update(meta):
+            marker = meta.get('bulk_load')
+            if marker is None:
+                logger.info("index {} switched to bulk load mode".format(index_name))
+                marker = {"previous": current[index_name]}
+            meta['bulk_load'] = {"previous": marker['previous'], "loads": dict(live_loads(marker), **{load: expires})}
+        return update
+
+    for index_name in current:
+        update_meta(es, index_name, join(index_name))
+    timed_request('indices.put_settings', es.indices.put_settings, index=index,
+                  body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    load_start = time.time()
+    try:
+        yield
+    finally:
+        logger.info('bulk load into {} took {:10.4f}'.format(index, time.time() - load_start))
+        def leave(meta):
+            if 'bulk_load' in meta:
+                meta['bulk_load']['loads'] = dict((other, until) for other, until in
+                                                  live_loads(meta['bulk_load']).items() if other != load)
+
+        for index_name in current:
+            marker = update_meta(es, index_name, leave).get('bulk_load', {"previous": current[index_name]})
+            if live_loads(marker):
+                logger.info("index {} has other loads, leaving it to them to restore".format(index_name))
+                continue
+            restore_settings(es, index_name, marker['previous'])
+            timed_request('indices.refresh', es.indices.refresh, index=index_name)
+
+
+# The paragraph partitions that hold documents of the episode
+def episode_partitions(es, podcast_url, routing):
+    body = episode_paragraphs_query(podcast_url)
+    body['size'] = 0
+    body['aggs'] = {"partitions": {"terms": {"field": "_index", "size": 100}}}
+    res = timed_request('search', es.search, index=KEYWORDS_INDEX, body=body, **routing)
+    return [bucket['key'] for bucket in res['aggregations']['partitions']['buckets']]
+
+
+# The writers in the unsealed marker of the _meta of a partition that haven't expired
+def live_writers(meta, now=None):
+    now = time.time() if now is None else now
+    return dict((writer, expires) for writer, expires in meta.get('unsealed', {}).items() if expires > now)
+
+
+# Partitions older than PARAGRAPH_PARTITION_WRITABLE_MONTHS are sealed with a write block by the
+# partition maintenance (see elasticsearch_createindex). A write to one of them, an old episode uploaded,
+# deleted or rendered again, lifts the block for its duration and puts it back once the last writer is
+# done.
+#
+# Every writer is recorded in the _meta of the mapping with an expiry, so a writer that finds a
+# partition another writer unsealed doesn't leave it writable or seal it under the other one. When a
+# writer dies before sealing the partition again, the maintenance seals it once the marker expires.
+@contextmanager
+def unsealed_partitions(es, indices):
+    indices = sorted(set(indices))
+    if not indices:
+        yield
+        return
+    settings = timed_request('indices.get_settings', es.indices.get_settings, index=','.join(indices),
+                             name='index.blocks.write', flat_settings=True)
+    mappings = timed_request('indices.get_mapping', es.indices.get_mapping, index=','.join(indices))
+    sealed = [name for name in sorted(settings)
+              if settings[name].get('settings', {}).get('index.blocks.write') == 'true' or
+              live_writers(mappings.get(name, {}).get('mappings', {}).get('_meta', {}))]
+    if not sealed:
+        yield
+        return
+
+    writer = uuid.uuid4().hex
+    expires = time.time() + BULK_LOAD_EXPIRY
+
+    def add_writer(meta):
+        meta['unsealed'] = dict(live_writers(meta), **{writer: expires})
+
+    def remove_writer(meta):
+        meta['unsealed'] = dict((other, until) for other, until in live_writers(meta).items() if other != writer)
+        if not meta['unsealed']:
+            del meta['unsealed']
+
+    for name in sealed:
+        logger.info("partition {} is sealed, lifting its write block for this write".format(name))
+        update_meta(es, name, add_writer)
+    timed_request('indices.put_settings', es.indices.put_settings, index=','.join(sealed),
+                  body={"index": {"blocks.write": False}})
+    try:
+        yield
+    finally:
+        for name in sealed:
+            if 'unsealed' in update_meta(es, name, remove_writer):
+                logger.info("partition {} has other writers, leaving it to them to seal".format(name))
+                continue
+            timed_request('indices.put_settings', es.indices.put_settings, index=name,
+                          body={"index": {"blocks.write": True}})
+            logger.info("sealed paragraph partition {} again".format(name))
+
+
+_routing_detected_at = None
+
+
+# Reads which of the indices require the feed routing of their documents from their mappings, and routes
+# the documents of those only (see es_documents.FEED_ROUTING). The paragraphs are routed when every
+# partition requires it. An index that doesn't exist yet is created the way FEED_ROUTING says.
+def detect_feed_routing(es, max_age=ROUTING_CACHE_SECONDS):
+    global _routing_detected_at
+    if _routing_detected_at is not None and time.time() - _routing_detected_at < max_age:
+        return routed_indices()
+    mappings = timed_request('indices.get_mapping', es.indices.get_mapping,
+                             index=','.join([FULL_EPISODE_INDEX, KEYWORDS_INDEX, ENTITY_ROLLUP_INDEX]),
+                             ignore_unavailable=True)
+    routed = {}
+    for name in (FULL_EPISODE_INDEX, KEYWORDS_INDEX, ENTITY_ROLLUP_INDEX):
+        required = [mapping.get('mappings', {}).get('_routing', {}).get('required', False)
+                    for index, mapping in mappings.items()
+                    if index == name or name == KEYWORDS_INDEX and index.startswith(KEYWORDS_INDEX + '-')]
+        routed[name] = all(required) if required else FEED_ROUTING
+    set_routed_indices(routed)
+    _routing_detected_at = time.time()
+    logger.info("feed routing: " + json.dumps(routed))
+    return routed
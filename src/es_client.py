@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from instrumentation import record
+
+# Shared Elasticsearch client for the lambdas and offline tools.
+#
+# Requests are signed with credentials pulled from the botocore credential provider on every request,
+# so warm containers that outlive the session token keep working. The client is built once per
+# container and reused across invocations, and its http pool is sized for the number of bulk requests
+# we send concurrently. elasticsearch, certifi and aws_requests_auth are only imported when the first
+# client is built, so handlers that never reach the domain don't pay for them on a cold start.
+
+# Log level
+logging.basicConfig()
+logger = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+# Parameters
+REGION = os.getenv('AWS_REGION', default='us-east-1')
+
+# Number of keep-alive connections held open to the domain
+ES_POOL_SIZE = int(os.getenv('ES_POOL_SIZE', default='10'))
+
+ES_TIMEOUT = int(os.getenv('ES_TIMEOUT', default='120'))
+
+# Upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def record(self, operation, seconds):
+        milliseconds = seconds * 1000
+        with self.lock:
+            if operation not in self.operations:
+                self.operations[operation] = {"count": 0, "total": 0.0, "max": 0.0,
+                                              "buckets": [0] * (len(self.buckets) + 1)}
+            stats = self.operations[operation]
+            stats['count'] += 1
+            stats['total'] += milliseconds
+            stats['max'] = max(stats['max'], milliseconds)
+            stats['buckets'][bisect.bisect_left(self.buckets, milliseconds)] += 1
+
+    # Approximates a percentile from the bucket counts, returning the upper bound of the bucket
+    def percentile(self, operation, percentile):
+        stats = self.operations[operation]
+        threshold = stats['count'] * percentile / 100.0
+        seen = 0
+        for i, count in enumerate(stats['buckets']):
+            seen += count
+            if seen >= threshold and count:
+                return self.buckets[i] if i < len(self.buckets) else stats['max']
+        return stats['max']
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for operation, stats in self.operations.items():
+                summary[operation] = {
+                    "count": stats['count'],
+                    "avg_ms": round(stats['total'] / stats['count'], 1),
+                    "p50_ms": self.percentile(operation, 50),
+                    "p99_ms": self.percentile(operation, 99),
+                    "max_ms": round(stats['max'], 1),
+                    "histogram": dict(zip([str(b) for b in self.buckets] + ['inf'], stats['buckets']))
+                }
+            return summary
+
+    def log_summary(self):
+        logger.info("es request latency: " + json.dumps(self.summary()))
+
+
+latency_histogram = LatencyHistogram()
+
+
+# Names the request after the API it calls, e.g. "POST _bulk" or "PUT _doc"
+def operation_name(method, url):
+    for part in url.split('?')[0].split('/'):
+        if part.startswith('_'):
+            return method + " " + part
+    return method + " /"
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    return len(body.encode('utf-8') if not isinstance(body, bytes) else body)
+
+
+# Builds the connection class that times every request. It subclasses RequestsHttpConnection, so it
+# is created together with the first client.
+#
+# RequestsHttpConnection ignores pool_maxsize and keeps the requests default of 10 connections, so the
+# connection mounts an adapter with a pool of that size on its session itself.
+def timed_connection_class():
+    from elasticsearch import RequestsHttpConnection
+    from requests.adapters import HTTPAdapter
+
+    class TimedRequestsHttpConnection(RequestsHttpConnection):
+        def __init__(self, *args, **kwargs):
+            pool_size = kwargs.pop('pool_maxsize', ES_POOL_SIZE)
+            super(TimedRequestsHttpConnection, self).__init__(*args, **kwargs)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+        def perform_request(self, method, url, params=None, body=None, *args, **kwargs):
+            start = time.time()
+            response = None
+            try:
+                response = super(TimedRequestsHttpConnection, self).perform_request(method, url, params, body,
+                                                                                    *args, **kwargs)
+                return response
+            finally:
+                elapsed = time.time() - start
+                operation = operation_name(method, url)
+                latency_histogram.record(operation, elapsed)
+                record("es." + operation, elapsed, bytes_out=body_size(body),
+                       bytes_in=len(response[2] or '') if response else 0, error=response is None)
+
+    return TimedRequestsHttpConnection
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Returns the client for the endpoint, building it on first use.
+#
+# An endpoint given as a plain http url, e.g. http://localhost:9200, is a local stand-in for the
+# domain: requests go to it unsigned and without TLS.
+def get_es_client(endpoint=None, pool_size=ES_POOL_SIZE):
+    endpoint = endpoint or os.environ['ES_DOMAIN']
+    with _clients_lock:
+        if (endpoint, pool_size) not in _clients:
+            import certifi
+            from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+            from elasticsearch import Elasticsearch
+
+            if endpoint.startswith('http://'):
+                _clients[(endpoint, pool_size)] = Elasticsearch(
+                    hosts=[endpoint],
+                    timeout=ES_TIMEOUT,
+                    pool_maxsize=pool_size,
+                    connection_class=timed_connection_class()
+                )
+                return _clients[(endpoint, pool_size)]
+
+            # BotoAWSRequestsAuth asks the botocore credential provider for credentials on every
+            # request, which refreshes them before they expire.
+            awsauth = BotoAWSRequestsAuth(aws_host=endpoint, aws_region=REGION, aws_service='es')
+
+            # Connect to the elasticsearch cluster using aws authentication. The lambda function
+            # must have access in an IAM policy to the ES cluster.
+            _clients[(endpoint, pool_size)] = Elasticsearch(
+                hosts=[{'host': endpoint, 'port': 443}],
+                http_auth=awsauth,
+                use_ssl=True,
+                verify_certs=True,
+                ca_certs=certifi.where(),
+                timeout=ES_TIMEOUT,
+                pool_maxsize=pool_size,
+                connection_class=timed_connection_class()
+            )
+        return _clients[(endpoint, pool_size)]
@@ -0,0 +1,317 @@
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+
+# Document shapes for the episodes and paragraphs indices. Shared by the upload lambda and the
+# offline backfill so both index exactly the same documents.
+
+# get the Elasticsearch index name from the environment variables
+FULL_EPISODE_INDEX = os.getenv('ES_EPISODE_INDEX', default='episodes')
+# get the Elasticsearch index name from the environment variables
+KEYWORDS_INDEX = os.getenv('ES_PARAGRAPH_INDEX', default='paragraphs')
+
+# The paragraphs are kept in an index per month of the publish time of their episode, paragraphs-2020.01
+# and so on, created from a template on the first write (see elasticsearch_createindex). KEYWORDS_INDEX
+# is the alias over all of them that searches and deletes go through, the documents are written to
+# their partition. The boilerplate documents of the feeds are shared by episodes of every month and
+# have a partition of their own.
+PARAGRAPH_PARTITIONS = KEYWORDS_INDEX + '-*'
+BOILERPLATE_PARTITION = KEYWORDS_INDEX + '-boilerplate'
+PARTITION_MONTH = re.compile(r'^(\d{4}):(\d{2})')
+
+# The fields of the episode payload that are needed to build the documents. They are stored next
+# to the processed artifacts in the episode manifest so the indices can be rebuilt from S3.
+MANIFEST_FIELDS = ['podcastUrl', 'PodcastName', 'Episode', 'audio_type', 'summary', 'publishTime', 'sourceFeed',
+                   'speakerNames', 'audioS3Location', 'processedTranscription', 'vocabularyInfo']
+
+MANIFEST_PREFIX = 'podcasts/manifest/'
+
+# Counts of the entities of the paragraphs per feed and day of publication, kept up to date by the
+# upload so dashboards read them instead of aggregating over every paragraph
+ENTITY_ROLLUP_INDEX = os.getenv('ES_ENTITY_ROLLUP_INDEX', default='entity_rollup')
+
+# Documents are routed by the url of their feed, so the documents of a feed are on a single shard and
+# a query for one feed is served by that shard instead of fanning out to all of them. New indices are
+# created requiring the routing unless this is FALSE (see elasticsearch_createindex).
+#
+# The documents are only routed to the indices that require it. An index created before the routing
+# has the documents of a feed spread over all the shards, and a routed write would add a second copy
+# of a document on another shard instead of replacing it. Which indices require it is read from their
+# mappings by es_bulk.detect_feed_routing; until then nothing is routed.
+FEED_ROUTING = os.getenv('ES_FEED_ROUTING', default='TRUE') == 'TRUE'
+
+# Whether the documents of FULL_EPISODE_INDEX, KEYWORDS_INDEX and ENTITY_ROLLUP_INDEX are routed
+_routed_indices = {}
+
+# Paragraphs flagged as boilerplate of the feed (see boilerplate.py) are indexed ONCE per feed, one
+# document that every episode repeating the paragraph overwrites, or SKIPped
+BOILERPLATE_INDEXING = os.getenv('BOILERPLATE_INDEXING', default='ONCE')
+
+
+# Paragraph documents get an id derived from the episode url and the start time of the paragraph, so
+# indexing the same episode again (Step Functions retries, feed reprocessing) overwrites the existing
+# documents instead of adding another copy of them.
+def paragraph_id(podcast_url, start_time):
+    return hashlib.sha1("{}|{:.3f}".format(podcast_url, float(start_time)).encode('utf-8')).hexdigest()
+
+
+def boilerplate_id(feed_url, boilerplate):
+    return hashlib.sha1("{}|boilerplate|{}".format(feed_url, boilerplate).encode('utf-8')).hexdigest()
+
+
+# The partition of the paragraphs of an episode published at publish_time (yyyy:MM:dd HH:mm:ss)
+def paragraph_index(publish_time):
+    match = PARTITION_MONTH.match(publish_time or '')
+    if match is None:
+        return KEYWORDS_INDEX + '-undated'
+    return '{}-{}.{}'.format(KEYWORDS_INDEX, match.group(1), match.group(2))
+
+
+def set_routed_indices(routed):
+    _routed_indices.clear()
+    _routed_indices.update(routed)
+
+
+def routed_indices():
+    return dict(_routed_indices)
+
+
+# The routing of the documents of the feed in the index, or None when the index isn't routed
+def feed_routing(feed_url, index):
+    if _routed_indices.get(index) and feed_url:
+        return feed_url
+    return None
+
+
+# Keyword arguments that route a request of the elasticsearch client to the shard of the feed
+def routing_params(feed_url, index):
+    routing = feed_routing(feed_url, index)
+    return {"routing": routing} if routing is not None else {}
+
+
+# The manifest of an episode is keyed by its url so reprocessing an episode replaces its manifest
+def manifest_key(podcast_url):
+    return MANIFEST_PREFIX + hashlib.sha1(podcast_url.encode('utf-8')).hexdigest() + '.json'
+
+
+def episode_manifest(event):
+    return dict((field, event[field]) for field in MANIFEST_FIELDS if field in event)
+
+
+def build_episode_doc(event, fullepisode):
+    s3_location = "s3://" + event['audioS3Location']['bucket'] + "/" + event['audioS3Location']['key']
+
+    doc = {
+        'audio_url': event['podcastUrl'],
+        'audio_type': event['audio_type'],
+        'title': event['Episode'],
+        'summary': event['summary'],
+        'published_time': event['publishTime'],
+        'source_feed': event['sourceFeed'],
+        'audio_s3_location': s3_location,
+        'transcript': fullepisode['transcript'],
+        'transcript_entities': fullepisode['transcript_entities']
+    }
+
+    if 'speakerNames' in event and len(event['speakerNames']) > 1:
+        doc['speakerNames'] = event['speakerNames']
+
+    # Only in transcripts processed since key phrases and sentiment were added
+    if 'key_phrases' in fullepisode:
+        doc['key_phrases'] = fullepisode['key_phrases']
+    if fullepisode.get('sentiment'):
+        doc['sentiment'] = fullepisode['sentiment']
+    # Only in transcripts processed since the analytics were added
+    if fullepisode.get('analytics'):
+        doc['analytics'] = fullepisode['analytics']
+
+    return doc
+
+
+def episode_action(event, fullepisode):
+    action = {
+        "_index": FULL_EPISODE_INDEX,
+        "_id": event['podcastUrl'],
+        "_source": build_episode_doc(event, fullepisode)
+    }
+    routing = feed_routing(event['sourceFeed'], FULL_EPISODE_INDEX)
+    if routing is not None:
+        action["_routing"] = routing
+    return action
+
+
+# Generates an upsert action for each paragraph, one at a time. The ids of the documents are
+# collected in indexed_ids if a list is passed in, and the entities of the paragraphs counted in
+# entity_counts if a dict is (see count_entities).
+def generate_keyword_actions(event, keywords, audioOffset, indexed_ids=None, entity_counts=None):
+    routing = feed_routing(event["sourceFeed"], KEYWORDS_INDEX)
+    partition = paragraph_index(event["publishTime"])
+    for keyword in keywords:
+        repeated = keyword.get("boilerplate")
+        if repeated and BOILERPLATE_INDEXING == 'SKIP':
+            continue
+        if repeated:
+            doc_id = boilerplate_id(event["sourceFeed"], repeated)
+        else:
+            doc_id = paragraph_id(event["podcastUrl"], keyword["startTime"])
+        if indexed_ids is not None:
+            indexed_ids.append(doc_id)
+        if entity_counts is not None and not repeated:
+            count_entities(entity_counts, keyword.get("entities", []))
+        # Offset the time that the word was spoken to the listener has some context to the phrase
+        time = str(max(float(keyword["startTime"]) - audioOffset, 0))
+        action = {
+            "_op_type": "update",
+            "_index": BOILERPLATE_PARTITION if repeated else partition,
+            "_id": doc_id,
+            "doc": {
+                "PodcastName": event["PodcastName"],
+                "Episode": event["Episode"],
+                "episode_url": event["podcastUrl"],
+                "source_feed": event["sourceFeed"],
+                "published_time": event["publishTime"],
+                "url": event["podcastUrl"] + "#t=" + time,
+                "text": keyword["text"],
+                "tags": keyword["tags"],
+                "speaker": keyword["speaker"],
+                "startTime": float(time),
+                "entities": entity_links(event["podcastUrl"], keyword.get("entities", []), audioOffset),
+                "offsets": keyword.get("offsets")
+            },
+            "doc_as_upsert": True
+        }
+        if repeated:
+            action["doc"]["boilerplate"] = True
+        if routing is not None:
+            action["_routing"] = routing
+        yield action
+
+
+# The paragraphs of the episode, without the boilerplate documents of the feed. Those carry the url of
+# the episode that last repeated them but are shared by all the episodes of the feed, so they aren't
+# removed with one of them.
+def episode_paragraphs_query(podcast_url):
+    return {
+        "query": {
+            "bool": {
+                "filter": [{"term": {"episode_url": podcast_url}}],
+                "must_not": [{"term": {"boilerplate": True}}]
+            }
+        }
+    }
+
+
+# The paragraphs of the episode that are not among the ids just indexed into partitions, left over from
+# an earlier segmentation of the episode. A paragraph is only kept in the partition it was just indexed
+# into: when the publish time of the episode changed, the copies with the same ids in the partition of
+# the old month are stale too.
+def stale_paragraphs_query(podcast_url, indexed_ids, partitions):
+    query = episode_paragraphs_query(podcast_url)
+    query['query']['bool']['must_not'].append({"bool": {"filter": [
+        {"ids": {"values": indexed_ids}},
+        {"terms": {"_index": sorted(set(partitions))}}
+    ]}})
+    return query
+
+
+# Adds the entities of a paragraph to the counts of the episode, {(type, text): [paragraphs, mentions]}
+def count_entities(entity_counts, entities):
+    mentions = {}
+    for entity in entities:
+        key = (entity["type"], entity["text"])
+        mentions[key] = mentions.get(key, 0) + 1
+    for key, count in mentions.items():
+        counts = entity_counts.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += count
+
+
+# A rollup document counts an entity over the episodes of a feed published on the same day. Every
+# episode keeps its own counts in the document, and the totals are summed over them, so indexing an
+# episode again replaces its counts instead of adding them a second time. Counts of 0 take the
+# episode out, and a document without episodes is deleted.
+ROLLUP_SCRIPT = """
+if (ctx._source.contributions == null) { ctx._source.contributions = new HashMap(); }
+if (params.paragraphs == 0) { ctx._source.contributions.remove(params.episode); }
+else { ctx._source.contributions.put(params.episode, ['paragraphs': params.paragraphs, 'mentions': params.mentions]); }
+long paragraphs = 0;
+long mentions = 0;
+for (def counts : ctx._source.contributions.values()) {
+    paragraphs += counts['paragraphs'];
+    mentions += counts['mentions'];
+}
+ctx._source.paragraphs = paragraphs;
+ctx._source.mentions = mentions;
+ctx._source.episodes = ctx._source.contributions.size();
+ctx._source.episode_ids = new ArrayList(ctx._source.contributions.keySet());
+if (ctx._source.episodes == 0) { ctx.op = 'delete'; }
+"""
+
+
+def rollup_id(feed_url, day, entity_type, text):
+    return hashlib.sha1("{}|{}|{}|{}".format(feed_url, day, entity_type, text).encode('utf-8')).hexdigest()
+
+
+def rollup_episode_id(podcast_url):
+    return hashlib.sha1(podcast_url.encode('utf-8')).hexdigest()
+
+
+def rollup_script(podcast_url, paragraphs=0, mentions=0):
+    return {
+        "source": ROLLUP_SCRIPT,
+        "lang": "painless",
+        "params": {"episode": rollup_episode_id(podcast_url), "paragraphs": paragraphs, "mentions": mentions}
+    }
+
+
+# Generates a scripted upsert of the rollup document of every entity counted in the episode. The ids
+# of the documents are collected in rollup_ids if a list is passed in.
+def rollup_actions(event, entity_counts, rollup_ids=None):
+    routing = feed_routing(event["sourceFeed"], ENTITY_ROLLUP_INDEX)
+    day = event["publishTime"][:10]
+    for (entity_type, text), (paragraphs, mentions) in sorted(entity_counts.items()):
+        doc_id = rollup_id(event["sourceFeed"], day, entity_type, text)
+        if rollup_ids is not None:
+            rollup_ids.append(doc_id)
+        action = {
+            "_op_type": "update",
+            "_index": ENTITY_ROLLUP_INDEX,
+            "_id": doc_id,
+            "script": rollup_script(event["podcastUrl"], paragraphs, mentions),
+            "upsert": {
+                "entity": text,
+                "entity_type": entity_type,
+                "source_feed": event["sourceFeed"],
+                "PodcastName": event["PodcastName"],
+                "day": day,
+                "contributions": {}
+            },
+            "scripted_upsert": True,
+            # Episodes of the feed published on the same day update the same documents
+            "retry_on_conflict": 5
+        }
+        if routing is not None:
+            action["_routing"] = routing
+        yield action
+
+
+# Takes the counts of the episode out of the rollup documents that are not among the ids just
+# upserted, entities the episode doesn't mention anymore, or all of them without ids
+def stale_rollups_query(podcast_url, rollup_ids=None):
+    query = {"bool": {"filter": [{"term": {"episode_ids": rollup_episode_id(podcast_url)}}]}}
+    if rollup_ids is not None:
+        query["bool"]["must_not"] = [{"ids": {"values": rollup_ids}}]
+    return {"query": query, "script": rollup_script(podcast_url)}
+
+
+# Each entity gets a deep link to the moment it is spoken, with the same offset as the paragraph link
+def entity_links(podcast_url, entities, audioOffset):
+    links = []
+    for entity in entities:
+        link = {"text": entity["text"], "type": entity["type"], "time": entity["time"]}
+        if entity["time"] is not None:
+            link["url"] = podcast_url + "#t=" + str(max(float(entity["time"]) - audioOffset, 0))
+        links.append(link)
+    return links
@@ -0,0 +1,234 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import re
+from artifact_io import read_json
+from aws_clients import get_client
+
+# Tags paragraphs with the entities a feed is already known to mention, without calling Comprehend.
+#
+# The names come from the custom vocabulary mapping of the episode and from the entities of the feed
+# seen before, which are kept per feed in S3 with their entity type:
+#
+#   podcasts/gazetteer/<sha1 of the feed url>.json
+#   {"entities": {"amazon web services": {"text": "Amazon Web Services", "type": "ORGANIZATION"}, ...}}
+#
+# process_podcast_rss seeds the file with the entities of the episode descriptions and
+# process_transcription_paragraph adds the ones Comprehend finds in the transcripts.
+#
+# All the names are matched in a single pass over a paragraph with an Aho-Corasick automaton over
+# normalized words (lower case, punctuation removed), so "Amazon Web Services," in a transcript
+# matches the name "Amazon Web Services" and the cost of a paragraph doesn't grow with the number of
+# names. Acronyms and short names only match with the same case, so "AWS" doesn't match "aws" and the
+# name "Bob" doesn't match "bob".
+#
+# Names that are common words ("us", "it", "may") or a single character are never used, and only the
+# entities Comprehend is confident about and that mix character classes ("Amazon", "S3", "iPhone"), or
+# are acronyms of at least ACRONYM_LENGTH letters, are learned.
+
+logger = logging.getLogger()
+
+GAZETTEER_PREFIX = 'podcasts/gazetteer/'
+
+WORD = re.compile(r"\S+")
+NOT_ALPHANUMERIC = re.compile(r"[\W_]+", re.UNICODE)
+
+# Names shorter than this, once normalized, are left out of the gazetteer
+GAZETTEER_MIN_LENGTH = int(os.getenv('GAZETTEER_MIN_LENGTH', default='2'))
+
+# Names up to this length, once normalized, only match with the same case
+GAZETTEER_SHORT_NAME = int(os.getenv('GAZETTEER_SHORT_NAME', default='4'))
+
+# Lowest Comprehend score of an entity that is learned
+GAZETTEER_MIN_SCORE = float(os.getenv('GAZETTEER_MIN_SCORE', default='0.9'))
+
+# Shortest all capitals name that is learned
+ACRONYM_LENGTH = 3
+
+STOPWORDS = frozenset('''
+a about after all also am an and any are as at be because been but by can could did do does for from had has
+have he her here him his how i if in into is it its just like may me might more most my no not now of on one
+only or our out over says she should so some than that the their them then there these they this those to
+too up us very was we well were what when where which who why will with would yes yet you your
+'''.split())
+
+
+def normalize_word(word):
+    return NOT_ALPHANUMERIC.sub('', word.lower())
+
+
+def normalize(text):
+    return ' '.join(word for word in (normalize_word(w) for w in text.split()) if word)
+
+
+# The words of the text with the punctuation removed but the case kept
+def case_words(text):
+    return tuple(word for word in (NOT_ALPHANUMERIC.sub('', w) for w in text.split()) if word)
+
+
+def is_acronym(text):
+    return text.isupper()
+
+
+# Whether the normalized name can be in a gazetteer at all
+def usable_name(name):
+    return len(name) >= GAZETTEER_MIN_LENGTH and name not in STOPWORDS
+
+
+# Whether a name matches only with the same case
+def case_sensitive(text):
+    return is_acronym(text) or len(normalize(text)) <= GAZETTEER_SHORT_NAME
+
+
+# Whether an entity found by Comprehend with this score can be learned for the feed
+def learnable(text, score):
+    if score < GAZETTEER_MIN_SCORE or not usable_name(normalize(text)):
+        return False
+    classes = sum(1 for test in (str.isupper, str.islower, str.isdigit) if any(test(c) for c in text))
+    return classes > 1 or (is_acronym(text) and len(normalize(text)) >= ACRONYM_LENGTH)
+
+
+# The normalized words of the text, each with the character span of the word without the punctuation
+# around it
+def tokenize(text):
+    tokens = []
+    for match in WORD.finditer(text):
+        word = normalize_word(match.group(0))
+        if not word:
+            continue
+        start, end = match.span()
+        while not text[start].isalnum():
+            start += 1
+        while not text[end - 1].isalnum():
+            end -= 1
+        tokens.append((word, start, end))
+    return tokens
+
+
+class Automaton(object):
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, words, value):
+        node = 0
+        for word in words:
+            if word not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][word] = len(self.goto) - 1
+            node = self.goto[node][word]
+        self.output[node].append((len(words), value))
+
+    # Links every node to the node of its longest proper suffix, breadth first. The children of the
+    # root keep their link to the root.
+    def build(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and word not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(word, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+        return self
+
+    # Yields (first word, number of words, value) for every match, overlapping ones included
+    def search(self, words):
+        node = 0
+        for i, word in enumerate(words):
+            while node and word not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(word, 0)
+            for length, value in self.output[node]:
+                yield i - length + 1, length, value
+
+
+class Gazetteer(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.automaton = Automaton()
+        for name, entity in entities.items():
+            exact = case_words(entity['text']) if case_sensitive(entity['text']) else None
+            self.automaton.add(name.split(' '), (entity['type'], exact))
+        self.automaton.build()
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, text):
+        return normalize(text) in self.entities
+
+    # Returns the entities in the text in the shape of Comprehend's detect_entities response. Where
+    # names overlap the longest one that starts first wins.
+    def find(self, text):
+        tokens = tokenize(text)
+        matches = sorted(self.automaton.search([word for word, start, end in tokens]),
+                         key=lambda match: (match[0], -match[1]))
+        entities = []
+        covered = 0
+        for first, length, (entity_type, exact) in matches:
+            if first < covered:
+                continue
+            begin = tokens[first][1]
+            end = tokens[first + length - 1][2]
+            if exact is not None and case_words(text[begin:end]) != exact:
+                continue
+            entities.append({
+                "Text": text[begin:end],
+                "Type": entity_type,
+                "Score": 1.0,
+                "BeginOffset": begin,
+                "EndOffset": end
+            })
+            covered = first + length
+        return entities
+
+
+def gazetteer_key(feed_url):
+    return GAZETTEER_PREFIX + hashlib.sha1(feed_url.encode('utf-8')).hexdigest() + '.json'
+
+
+def read_feed_entities(bucket, feed_url):
+    try:
+        return read_json(bucket, gazetteer_key(feed_url))['entities']
+    except get_client('s3').exceptions.NoSuchKey:
+        return {}
+
+
+# Adds the entities to the ones stored for the feed, leaving out the ones that can't be learned. Episodes
+# of a feed that finish at the same time can overwrite each other's additions, which only means a name
+# is learned from a later episode.
+def update_feed_entities(bucket, feed_url, entities):
+    stored = read_feed_entities(bucket, feed_url)
+    added = 0
+    for entity in entities:
+        name = normalize(entity['text'])
+        if name not in stored and learnable(entity['text'], entity.get('score', 1.0)):
+            stored[name] = {"text": entity['text'], "type": entity['type']}
+            added += 1
+    if added:
+        get_client('s3').put_object(Body=json.dumps({"entities": stored}), Bucket=bucket,
+                                    Key=gazetteer_key(feed_url))
+        logger.info("added {} entities to the gazetteer of {}".format(added, feed_url))
+    return added
+
+
+# Builds the gazetteer of an episode: the names of the vocabulary mapping and the entities stored for
+# the feed. Names of the mapping take the type they were stored with and are left out when the type
+# isn't known. Common words and single characters are left out, including the ones learned before
+# they were filtered.
+def build_gazetteer(known, mapping, entity_types):
+    entities = dict((name, entity) for name, entity in known.items()
+                    if entity['type'] in entity_types and usable_name(name))
+    for text in mapping.values():
+        name = normalize(text)
+        if name in entities:
+            entities[name] = {"text": text, "type": known[name]['type']}
+    return Gazetteer(entities)
@@ -0,0 +1,233 @@
+from __future__ import print_function
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+# Per-stage timing instrumentation for the lambdas.
+#
+# Every handler is wrapped with instrumented_handler, which tags the metrics recorded during the
+# invocation with the pipeline stage, and at the end of the invocation prints them as CloudWatch
+# embedded metric format (EMF) log lines. CloudWatch extracts the metrics from the logs, so there is no
+# PutMetricData call on the hot path. The feed the episode belongs to is logged with the metrics but
+# isn't a dimension, so the number of metrics doesn't grow with the number of feeds.
+#
+# Each invocation records into its own collector, held in a context variable, so handlers that run at
+# the same time in one process (see pipeline_worker) don't flush each other's metrics. Work handed to
+# a thread pool runs in a copy of the context to record into the collector of the invocation.
+#
+# Calls are timed with the timer context manager. boto3 clients passed through instrument_client are
+# timed automatically, with their request/response sizes and retry counts.
+#
+# Set METRICS_ENABLED to FALSE to turn everything off. instrumented_handler then returns the handler
+# unchanged and timer hands out a shared no-op object.
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', default='TRUE').upper() != 'FALSE'
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', default='PodcastIndexer')
+
+# EMF accepts at most 100 values per metric in a single log line
+MAX_VALUES_PER_LINE = 100
+
+METRIC_UNITS = [
+    ("Latency", "Milliseconds"),
+    ("BytesIn", "Bytes"),
+    ("BytesOut", "Bytes"),
+    ("Items", "Count"),
+    ("Retries", "Count"),
+    ("Errors", "Count")
+]
+
+
+class Measurement(object):
+    __slots__ = ['operation', 'bytes_in', 'bytes_out', 'items', 'retries', 'start']
+
+    def __init__(self, operation, bytes_in=0, bytes_out=0, items=0, retries=0):
+        self.operation = operation
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.items = items
+        self.retries = retries
+        self.start = time.time()
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.operation, time.time() - self.start, bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+               items=self.items, retries=self.retries, error=exc_type is not None)
+        return False
+
+
+class _NoopMeasurement(object):
+    operation = None
+    bytes_in = bytes_out = items = retries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NOOP = _NoopMeasurement()
+
+
+class Collector(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None, None)
+
+    def reset(self, stage, feed):
+        with self.lock:
+            self.stage = stage
+            self.feed = feed
+            self.operations = {}
+
+    def record(self, operation, seconds, bytes_in, bytes_out, items, retries, error):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {"Latency": [], "BytesIn": 0, "BytesOut": 0, "Items": 0,
+                                                      "Retries": 0, "Errors": 0}
+            stats["Latency"].append(round(seconds * 1000, 3))
+            stats["BytesIn"] += bytes_in or 0
+            stats["BytesOut"] += bytes_out or 0
+            stats["Items"] += items or 0
+            stats["Retries"] += retries or 0
+            stats["Errors"] += 1 if error else 0
+
+    # Builds one EMF document per operation, splitting the latency values over several documents
+    # if there are more than EMF accepts in one. The totals are only in the first document of an
+    # operation, so the later ones don't add zero values to them.
+    def emf_documents(self):
+        with self.lock:
+            operations = dict((name, dict(stats)) for name, stats in self.operations.items())
+            stage = self.stage or 'unknown'
+            feed = self.feed or 'none'
+
+        documents = []
+        timestamp = int(time.time() * 1000)
+        for operation, stats in sorted(operations.items()):
+            latencies = stats["Latency"]
+            for i in range(0, max(len(latencies), 1), MAX_VALUES_PER_LINE):
+                units = METRIC_UNITS if i == 0 else METRIC_UNITS[:1]
+                document = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["Stage", "Operation"]],
+                            "Metrics": [{"Name": name, "Unit": unit} for name, unit in units]
+                        }]
+                    },
+                    "Stage": stage,
+                    "Feed": feed,
+                    "Operation": operation,
+                    "Latency": latencies[i:i + MAX_VALUES_PER_LINE]
+                }
+                for name, unit in units[1:]:
+                    document[name] = stats[name]
+                documents.append(document)
+        return documents
+
+    def flush(self):
+        for document in self.emf_documents():
+            print(json.dumps(document))
+        self.reset(self.stage, self.feed)
+
+
+# Collects what is recorded outside of a handler
+collector = Collector()
+
+_invocation_collector = contextvars.ContextVar('invocation_collector', default=None)
+
+
+def current_collector():
+    return _invocation_collector.get() or collector
+
+
+def record(operation, seconds, bytes_in=0, bytes_out=0, items=0, retries=0, error=False):
+    if METRICS_ENABLED:
+        current_collector().record(operation, seconds, bytes_in, bytes_out, items, retries, error)
+
+
+# Times the body of the with statement. Byte, item and retry counts can be set on the returned object.
+#
+#   with timer('urlopen') as m:
+#       data = urlopen(url).read()
+#       m.bytes_in = len(data)
+def timer(operation, **counts):
+    if not METRICS_ENABLED:
+        return _NOOP
+    return Measurement(operation, **counts)
+
+
+# The episode payloads carry the feed as sourceFeed, the rss state machine payload as rss
+def feed_of(event):
+    if isinstance(event, dict):
+        return event.get('sourceFeed') or event.get('rss')
+    return None
+
+
+# Wraps a lambda handler: gives the invocation a collector tagged with the stage and feed, times the
+# handler and flushes the metrics as EMF when it returns or raises.
+def instrumented_handler(stage):
+    def decorator(handler):
+        if not METRICS_ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            invocation = Collector()
+            invocation.reset(stage, feed_of(event))
+            token = _invocation_collector.set(invocation)
+            try:
+                with Measurement('handler'):
+                    return handler(event, context)
+            finally:
+                invocation.flush()
+                _invocation_collector.reset(token)
+        return wrapper
+    return decorator
+
+
+def _size_of(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    return 0
+
+
+def _before_call(model, params, context, **kwargs):
+    context['instrumentation_start'] = time.time()
+    context['instrumentation_bytes_out'] = _size_of(params.get('body'))
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    start = context.get('instrumentation_start')
+    if start is None:
+        return
+    metadata = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+    headers = getattr(http_response, 'headers', {}) or {}
+    record(model.service_model.service_name + "." + model.name, time.time() - start,
+           bytes_in=int(headers.get('content-length', 0) or 0),
+           bytes_out=context.get('instrumentation_bytes_out', 0),
+           retries=metadata.get('RetryAttempts', 0),
+           error=getattr(http_response, 'status_code', 200) >= 400)
+
+
+# Registers botocore event handlers on the client that time every API call it makes
+def instrument_client(client):
+    if METRICS_ENABLED:
+        client.meta.events.register('before-call.*.*', _before_call)
+        client.meta.events.register('after-call.*.*', _after_call)
+    return client
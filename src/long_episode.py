@@ -0,0 +1,193 @@
+from __future__ import print_function
+import json
+import os
+import logging
+from urllib.request import urlopen
+from artifact_io import artifact_key, write_shard_plan
+from common_lib import id_generator
+from mp3_splitter import scan_frames, segment_count_for, plan_segments, MP3FormatError
+from transcript_segmenter import plan_shards, transcript_duration
+from transcript_stitcher import stitch_transcripts
+from vocabulary_cache import read_mapping
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler, timer
+
+# Log level
+logging.basicConfig()
+logger = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+# Episodes longer than this many seconds are split into segments that are transcribed in parallel
+SEGMENT_SECONDS = int(os.getenv('LONG_EPISODE_SEGMENT_SECONDS', default='3600'))
+
+# Upper bound on the number of transcription jobs a single episode can use
+MAX_SEGMENTS = int(os.getenv('LONG_EPISODE_MAX_SEGMENTS', default='8'))
+
+# Transcripts longer than this many seconds are processed in shards by parallel invocations of the
+# paragraph and full text lambdas
+SHARD_SECONDS = int(os.getenv('TRANSCRIPT_SHARD_SECONDS', default='3600'))
+
+# Upper bound on the number of shards of a single transcript
+MAX_SHARDS = int(os.getenv('TRANSCRIPT_MAX_SHARDS', default='8'))
+
+# If debug mode is TRUE, then S3 files are not deleted
+isDebugMode = os.getenv('DEBUG_MODE', default='FALSE')
+
+SPLITTABLE_TYPES = ['audio/mpeg']
+
+# How long the signed url to the stitched transcript stays valid for the processing steps
+STITCHED_URL_EXPIRATION = 3600
+
+s3_client = lazy_client('s3')
+
+
+# Splits a long mp3 episode into segments at frame boundaries, near silence when possible.
+#
+# Input is the episode payload with the audioS3Location returned by the download step.
+# Returns a list of segments, each with the S3 location of the audio and the number of seconds
+# into the episode that the segment starts. Episodes that don't need splitting come back as a
+# single segment pointing to the original audio file.
+@instrumented_handler('split_podcast')
+def split_handler(event, context):
+    bucket = event['audioS3Location']['bucket']
+    key = event['audioS3Location']['key']
+    whole_episode = {"segmentCount": 1, "segments": [{"bucket": bucket, "key": key, "offset": 0}]}
+
+    if event['audio_type'] not in SPLITTABLE_TYPES:
+        logger.info("not splitting audio type " + event['audio_type'])
+        return whole_episode
+
+    # Scan the frames straight off of the S3 stream so we never hold the whole file in memory
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    try:
+        with timer('scan_frames') as m:
+            index = scan_frames(response['Body'])
+            m.bytes_in = response['ContentLength']
+            m.items = len(index)
+    except MP3FormatError as e:
+        logger.error("unable to scan s3://" + bucket + "/" + key + ": " + str(e))
+        return whole_episode
+
+    segment_count = segment_count_for(index.duration, SEGMENT_SECONDS, MAX_SEGMENTS)
+    logger.info("episode is {:.1f} seconds, {} frames, {} segment(s)".format(index.duration, len(index),
+                                                                             segment_count))
+    if segment_count == 1:
+        return whole_episode
+
+    segments = []
+    for i, segment in enumerate(plan_segments(index, segment_count)):
+        segment_key = 'podcasts/audio/segments/' + id_generator() + "-" + str(i) + "-" + os.path.basename(key)
+        copy_byte_range(bucket, key, segment_key, segment['start'], segment['end'] - 1, event['audio_type'])
+        logger.info("segment {} starts at {:.3f}s, bytes {}-{} -> s3://{}/{}".format(
+            i, segment['offset'], segment['start'], segment['end'] - 1, bucket, segment_key))
+        segments.append({"bucket": bucket, "key": segment_key, "offset": segment['offset']})
+
+    return {"segmentCount": len(segments), "segments": segments}
+
+
+# Copies a byte range of an S3 object to a new object on the server side. A multipart upload with a
+# single part has no minimum part size, so this works for any segment length.
+def copy_byte_range(bucket, source_key, target_key, first_byte, last_byte, content_type):
+    upload = s3_client.create_multipart_upload(Bucket=bucket, Key=target_key, ContentType=content_type)
+    try:
+        part = s3_client.upload_part_copy(
+            Bucket=bucket,
+            Key=target_key,
+            UploadId=upload['UploadId'],
+            PartNumber=1,
+            CopySource={'Bucket': bucket, 'Key': source_key},
+            CopySourceRange="bytes={}-{}".format(first_byte, last_byte))
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=target_key,
+            UploadId=upload['UploadId'],
+            MultipartUpload={'Parts': [{'ETag': part['CopyPartResult']['ETag'], 'PartNumber': 1}]})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=target_key, UploadId=upload['UploadId'])
+        raise
+
+
+# Stitches the transcripts of the segments back together into a single transcribe output.
+#
+# Input is the episode payload with segmentTranscriptions, a list of {"offset", "transcriptionUrl"}
+# produced by the Map state. Returns the same shape as check_transcribe so the processing steps
+# don't need to know that the episode was split.
+@instrumented_handler('stitch_transcription')
+def stitch_handler(event, context):
+    bucket = os.environ['BUCKET_NAME']
+
+    segments = []
+    for transcription in event['segmentTranscriptions']:
+        with timer('urlopen') as m:
+            f = urlopen(transcription['transcriptionUrl'])
+            output = f.read()
+            m.bytes_in = len(output)
+        segments.append((transcription['offset'], json.loads(output)))
+
+    stitched = stitch_transcripts(segments)
+    logger.info("stitched {} segments into {} items".format(len(segments), len(stitched['results']['items'])))
+
+    key = 'podcasts/transcribe/' + id_generator() + '.json'
+    s3_client.put_object(Body=json.dumps(stitched), Bucket=bucket, Key=key)
+
+    # The segment audio is no longer needed once it is transcribed
+    if isDebugMode != 'TRUE':
+        for segment in event['audioSegments']['segments']:
+            if segment['key'] != event['audioS3Location']['key']:
+                s3_client.delete_object(Bucket=segment['bucket'], Key=segment['key'])
+
+    url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key},
+                                           ExpiresIn=STITCHED_URL_EXPIRATION)
+    return {
+        "status": "COMPLETED",
+        "transcriptionUrl": url
+    }
+
+
+# Plans the processing of a long transcript in shards.
+#
+# Input is the episode payload with the transcribeStatus of the whole episode. The items of the
+# transcript are cut into shards at speaker changes and pauses, and the state of the segmentation at
+# the start of every shard is stored in S3 with the plan. Returns the number of shards and a
+# {"bucket", "key", "index"} per shard for the Map state; a transcript that doesn't need sharding
+# comes back as a single shard, and is processed in one piece.
+@instrumented_handler('plan_transcript_shards')
+def shard_handler(event, context):
+    bucket = os.environ['BUCKET_NAME']
+    whole_transcript = {"shardCount": 1, "shards": []}
+
+    with timer('urlopen') as m:
+        f = urlopen(event['transcribeStatus']['transcriptionUrl'])
+        output = f.read()
+        m.bytes_in = len(output)
+    results = json.loads(output)['results']
+
+    duration = transcript_duration(results)
+    shard_count = segment_count_for(duration, SHARD_SECONDS, MAX_SHARDS)
+    logger.info("transcript is {:.1f} seconds, {} items, {} shard(s)".format(duration, len(results['items']),
+                                                                             shard_count))
+    if shard_count == 1:
+        return whole_transcript
+
+    mapping = {}
+    if 'mapping' in event.get('vocabularyInfo', {}):
+        mapping = read_mapping(event['vocabularyInfo']['mapping']['bucket'], event['vocabularyInfo']['mapping']['key'])
+
+    with timer('plan_shards') as m:
+        shards = plan_shards(results, mapping, mapping, shard_count)
+        m.items = len(results['items'])
+    if len(shards) == 1:
+        logger.info("no place to cut the transcript, processing it in one piece")
+        return whole_transcript
+
+    key = artifact_key('podcasts/shards/')
+    write_shard_plan(bucket, key, shards, len(results['items']))
+    for shard in shards:
+        logger.info("shard {index}: items {begin} to {end}".format(**shard))
+    return {
+        "shardCount": len(shards),
+        "shards": [{"bucket": bucket, "key": key, "index": shard['index']} for shard in shards]
+    }
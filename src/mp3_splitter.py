@@ -0,0 +1,318 @@
+from __future__ import print_function
+from array import array
+from bisect import bisect_left, bisect_right
+import math
+
+# Pure python MP3 frame scanner and split planner. Nothing in here talks to AWS so the
+# logic can be exercised offline against synthetic frames.
+
+MPEG_VERSION_1 = 3
+MPEG_VERSION_2 = 2
+MPEG_VERSION_25 = 0
+
+LAYER_1 = 3
+LAYER_2 = 2
+LAYER_3 = 1
+
+# Bitrates in kbps, indexed by the 4 bit bitrate index of the frame header
+BITRATES = {
+    (MPEG_VERSION_1, LAYER_1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (MPEG_VERSION_1, LAYER_2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (MPEG_VERSION_1, LAYER_3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (MPEG_VERSION_2, LAYER_1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (MPEG_VERSION_2, LAYER_2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (MPEG_VERSION_2, LAYER_3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+SAMPLE_RATES = {
+    MPEG_VERSION_1: [44100, 48000, 32000],
+    MPEG_VERSION_2: [22050, 24000, 16000],
+    MPEG_VERSION_25: [11025, 12000, 8000],
+}
+
+CHANNEL_MODE_MONO = 3
+
+HEADER_SIZE = 4
+
+# Number of seconds of audio on either side of the ideal split time that we search for a quiet spot
+DEFAULT_SEARCH_WINDOW = 20.0
+
+# Number of seconds over which the frame weights are averaged when looking for a quiet spot
+DEFAULT_QUIET_WINDOW = 0.5
+
+
+class MP3FormatError(ValueError):
+    pass
+
+
+class FrameHeader(object):
+    def __init__(self, version, layer, protected, bitrate, sample_rate, padding, channels):
+        self.version = version
+        self.layer = layer
+        self.protected = protected
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channels = channels
+
+    @property
+    def samples(self):
+        if self.layer == LAYER_1:
+            return 384
+        if self.layer == LAYER_3 and self.version != MPEG_VERSION_1:
+            return 576
+        return 1152
+
+    @property
+    def duration(self):
+        return float(self.samples) / self.sample_rate
+
+    @property
+    def length(self):
+        if self.layer == LAYER_1:
+            return (12 * self.bitrate * 1000 // self.sample_rate + self.padding) * 4
+        return self.samples // 8 * self.bitrate * 1000 // self.sample_rate + self.padding
+
+
+# Parses the 4 byte frame header. Returns None if the bytes are not a valid header.
+def parse_frame_header(data, offset=0):
+    if len(data) < offset + HEADER_SIZE:
+        return None
+    b0, b1, b2, b3 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = (b2 >> 4) & 0x0F
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # reserved values, or free format which we can't compute a frame length for
+        return None
+
+    table_version = MPEG_VERSION_1 if version == MPEG_VERSION_1 else MPEG_VERSION_2
+    return FrameHeader(
+        version=version,
+        layer=layer,
+        protected=(b1 & 0x01) == 0,
+        bitrate=BITRATES[(table_version, layer)][bitrate_index],
+        sample_rate=SAMPLE_RATES[version][sample_rate_index],
+        padding=(b2 >> 1) & 0x01,
+        channels=1 if ((b3 >> 6) & 0x03) == CHANNEL_MODE_MONO else 2)
+
+
+class _BitReader(object):
+    def __init__(self, data, offset):
+        self.data = data
+        self.position = offset * 8
+
+    def read(self, bits):
+        start = self.position >> 3
+        shift = self.position & 7
+        byte_count = (shift + bits + 7) // 8
+        value = int.from_bytes(bytes(self.data[start:start + byte_count]), 'big')
+        value >>= byte_count * 8 - shift - bits
+        self.position += bits
+        return value & ((1 << bits) - 1)
+
+    def skip(self, bits):
+        self.position += bits
+
+
+# Reads the layer III side information and returns (main_data_begin, weight).
+#
+# The weight is the average number of huffman coded bits per granule and channel (part2_3_length).
+# Silent audio encodes to very few bits, so it works as a cheap loudness proxy without having to
+# decode the audio. main_data_begin tells us how far the frame reaches back into the bit reservoir;
+# a frame with main_data_begin of 0 is self-contained and makes the cleanest split point.
+def read_side_info(data, offset, header):
+    if header.layer != LAYER_3:
+        return 0, 0
+    side_info_offset = offset + HEADER_SIZE + (2 if header.protected else 0)
+    mono = header.channels == 1
+    if header.version == MPEG_VERSION_1:
+        side_info_size = 17 if mono else 32
+    else:
+        side_info_size = 9 if mono else 17
+    if len(data) < side_info_offset + side_info_size:
+        return 0, 0
+
+    reader = _BitReader(data, side_info_offset)
+    if header.version == MPEG_VERSION_1:
+        main_data_begin = reader.read(9)
+        reader.skip((5 if mono else 3) + 4 * header.channels)
+        granules = 2
+        granule_bits = 59
+    else:
+        main_data_begin = reader.read(8)
+        reader.skip(1 if mono else 2)
+        granules = 1
+        granule_bits = 63
+
+    total = 0
+    for _ in range(granules * header.channels):
+        total += reader.read(12)
+        reader.skip(granule_bits - 12)
+    return main_data_begin, total // (granules * header.channels)
+
+
+# Returns the number of bytes to skip if the data starts with an ID3v2 tag
+def id3v2_size(data):
+    if len(data) < 10 or data[0:3] != b'ID3':
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+class FrameIndex(object):
+    # Compact index of the frames in an mp3 file. Arrays are used instead of a list of objects
+    # because a 4 hour episode has over half a million frames.
+    def __init__(self):
+        self.offsets = array('q')
+        self.start_times = array('d')
+        self.weights = array('H')
+        self.self_contained = array('b')
+        self.end_offset = 0
+        self.duration = 0.0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, header, main_data_begin, weight):
+        self.offsets.append(offset)
+        self.start_times.append(self.duration)
+        self.weights.append(min(weight, 0xFFFF))
+        self.self_contained.append(1 if main_data_begin == 0 else 0)
+        self.duration += header.duration
+        self.end_offset = offset + header.length
+
+
+# Scans an mp3 stream (any object with a read method) frame by frame without holding the whole
+# file in memory. Junk between frames (e.g. ID3v1 tags) is skipped by searching for the next header.
+def scan_frames(stream, read_size=1024 * 1024):
+    index = FrameIndex()
+    buffer = bytearray()
+    buffer_offset = 0
+    position = 0
+    eof = False
+    first_read = True
+
+    while True:
+        if not eof and len(buffer) - position < 64 * 1024:
+            chunk = stream.read(read_size)
+            if not chunk:
+                eof = True
+            else:
+                del buffer[:position]
+                buffer_offset += position
+                position = 0
+                buffer.extend(chunk)
+                if first_read:
+                    first_read = False
+                    skip = id3v2_size(bytes(buffer[:10]))
+                    if skip:
+                        # The tag can be larger than the first read, so keep reading until it is skipped
+                        while len(buffer) < skip and not eof:
+                            chunk = stream.read(read_size)
+                            if not chunk:
+                                eof = True
+                            buffer.extend(chunk)
+                        position = min(skip, len(buffer))
+                continue
+
+        header = parse_frame_header(buffer, position)
+        if header is None:
+            if len(buffer) - position < HEADER_SIZE and eof:
+                break
+            position += 1
+            if eof and position >= len(buffer):
+                break
+            continue
+
+        end = position + header.length
+        if end > len(buffer):
+            if eof:
+                break
+            continue
+
+        # Make sure we are not looking at a false sync inside of audio data by checking that the
+        # next frame also starts with a header, unless this is the last frame in the file.
+        if end + HEADER_SIZE <= len(buffer) and parse_frame_header(buffer, end) is None \
+                and buffer[end:end + 3] != b'TAG':
+            position += 1
+            continue
+
+        main_data_begin, weight = read_side_info(buffer, position, header)
+        index.append(buffer_offset + position, header, main_data_begin, weight)
+        position = end
+
+    if len(index) == 0:
+        raise MP3FormatError("no mpeg audio frames found")
+    return index
+
+
+# Decides how many segments a file of the given duration should be split into
+def segment_count_for(duration, segment_seconds, max_segments):
+    if segment_seconds <= 0 or duration <= segment_seconds:
+        return 1
+    return max(1, min(int(max_segments), int(math.ceil(duration / float(segment_seconds)))))
+
+
+# Picks the frame to start each of the segments at. The first segment always starts at frame 0.
+# For every other segment we look at the frames within search_window seconds of the ideal split
+# time and choose the quietest stretch of audio, preferring frames that don't depend on the bit
+# reservoir and frames that are closer to the ideal time.
+def plan_split_frames(index, segment_count, search_window=DEFAULT_SEARCH_WINDOW, quiet_window=DEFAULT_QUIET_WINDOW):
+    frame_count = len(index)
+    if segment_count <= 1 or frame_count < segment_count:
+        return [0]
+
+    # prefix sums so the average weight of any run of frames is O(1)
+    prefix = array('d', [0.0])
+    running = 0.0
+    for weight in index.weights:
+        running += weight
+        prefix.append(running)
+
+    average_frame = index.duration / frame_count
+    half_run = max(1, int(quiet_window / average_frame / 2))
+
+    split_frames = [0]
+    for i in range(1, segment_count):
+        target = index.duration * i / segment_count
+        low = max(bisect_left(index.start_times, target - search_window), split_frames[-1] + 1)
+        high = min(bisect_right(index.start_times, target + search_window), frame_count)
+        if low >= high:
+            continue
+
+        best = None
+        best_score = None
+        for frame in range(low, high):
+            run_start = max(0, frame - half_run)
+            run_end = min(frame_count, frame + half_run)
+            loudness = (prefix[run_end] - prefix[run_start]) / (run_end - run_start)
+            score = (loudness, 0 if index.self_contained[frame] else 1, abs(index.start_times[frame] - target))
+            if best_score is None or score < best_score:
+                best = frame
+                best_score = score
+        split_frames.append(best)
+
+    return split_frames
+
+
+# Converts the split frames into byte ranges and time offsets for each segment.
+def plan_segments(index, segment_count, search_window=DEFAULT_SEARCH_WINDOW, quiet_window=DEFAULT_QUIET_WINDOW):
+    split_frames = plan_split_frames(index, segment_count, search_window, quiet_window)
+    segments = []
+    for i, frame in enumerate(split_frames):
+        if i + 1 < len(split_frames):
+            end = index.offsets[split_frames[i + 1]]
+        else:
+            end = index.end_offset
+        segments.append({
+            "offset": index.start_times[frame],
+            "start": index.offsets[frame],
+            "end": end
+        })
+    return segments
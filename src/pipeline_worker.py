@@ -0,0 +1,372 @@
+from __future__ import print_function
+
+import argparse
+import asyncio
+import copy
+import importlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs the episode pipeline as one long-running process instead of through Step Functions, for batch
+# backfills. The same handlers are called in-process, following the flow of the rss and episode state
+# machines (rss-sfn-state-machine-defintion.json and podcast-state-definition.json):
+#
+#   download -> split -> transcribe (per segment for long episodes) -> stitch -> plan transcript shards
+#            -> process by paragraph + full text (per shard for long transcripts, then merged)
+#            -> upload to elasticsearch
+#
+# Each stage has its own worker pool and a bounded queue in front of it. When a stage falls behind,
+# its queue fills up and the stage before it waits to hand over work, so a slow domain or Transcribe
+# backlog throttles downloading instead of piling audio up in S3.
+#
+# The AWS endpoints can be pointed at local stand-ins with AWS_ENDPOINT_URL (see aws_clients), and
+# --endpoint accepts an http url for a local Elasticsearch (see es_client).
+#
+#   python pipeline_worker.py --bucket my-bucket --endpoint search-podcasts-xxxx.es.amazonaws.com \
+#       --feed https://example.com/podcast.rss --max-episodes 50
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+STAGES = ['download', 'transcribe', 'process', 'upload']
+
+# The handlers, by the name of the step that calls them
+HANDLERS = {
+    'process_rss': 'process_podcast_rss.lambda_handler',
+    'create_vocabulary': 'create_transcribe_vocabulary.lambda_handler',
+    'check_vocabulary': 'create_transcribe_vocabulary.check_vocabulary_status',
+    'delete_vocabulary': 'create_transcribe_vocabulary.delete_vocabulary',
+    'create_index': 'elasticsearch_createindex.lambda_handler',
+    'download': 'download_podcast.lambda_handler',
+    'split': 'long_episode.split_handler',
+    'start_transcribe': 'podcast_transcribe.lambda_handler',
+    'check_transcribe': 'check_transcribe.lambda_handler',
+    'stitch': 'long_episode.stitch_handler',
+    'plan_shards': 'long_episode.shard_handler',
+    'process_paragraph': 'process_transcription_paragraph.lambda_handler',
+    'process_full_text': 'process_transcription_full_text.lambda_handler',
+    'upload': 'upload_to_elasticsearch.lambda_handler'
+}
+
+
+# The handler modules read their settings from the environment when they are imported, so they are
+# only loaded once the command line options are in place.
+def load_handlers():
+    handlers = {}
+    for step, path in HANDLERS.items():
+        module, function = path.split('.')
+        handlers[step] = getattr(importlib.import_module(module), function)
+    return handlers
+
+
+class TranscribeFailed(Exception):
+    pass
+
+
+class Episode(object):
+    def __init__(self, event, feed):
+        self.event = event
+        self.feed = feed
+        self.started = time.time()
+
+
+class Feed(object):
+    def __init__(self, url, vocabulary_info):
+        self.url = url
+        self.vocabulary_info = vocabulary_info
+        self.remaining = 0
+        self.done = asyncio.Event()
+
+    def finish_episode(self):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.done.set()
+
+
+class StageStats(object):
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.seconds = 0.0
+
+    def summary(self):
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_seconds": round(self.seconds / self.processed, 1) if self.processed else 0
+        }
+
+
+class PipelineWorker(object):
+    def __init__(self, handlers, concurrency, queue_size=10, poll_seconds=60, segment_concurrency=4, retries=2,
+                 report_seconds=60, shard_concurrency=8):
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.segment_concurrency = segment_concurrency
+        self.shard_concurrency = shard_concurrency
+        self.retries = retries
+        self.report_seconds = report_seconds
+        self.queues = dict((stage, asyncio.Queue(maxsize=queue_size)) for stage in STAGES)
+        self.stats = dict((stage, StageStats()) for stage in STAGES)
+        self.completed = 0
+        self.failed = 0
+        self.start = time.time()
+        # The handlers block, so they run on threads. Transcribe workers spend most of their time
+        # waiting between status checks and only need a thread while a check runs.
+        self.executor = ThreadPoolExecutor(
+            max_workers=sum(concurrency.values()) + segment_concurrency + 2 * shard_concurrency + 4)
+
+    # Calls a handler on a copy of the payload, the way each Step Functions task gets its own copy of
+    # the state, and retries it with backoff if it raises.
+    async def invoke(self, step, event):
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                return await loop.run_in_executor(self.executor, self.handlers[step], copy.deepcopy(event), None)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("{} failed ({}), retrying".format(step, e))
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    # Process Podcast Rss, Create Custom Vocabulary and Create ElasticSearch Index Mapping
+    async def prepare_feed(self, feed_url, max_episodes):
+        event = {"rss": feed_url}
+        if max_episodes:
+            event['maxEpisodesToProcess'] = max_episodes
+        event = await self.invoke('process_rss', event)
+
+        vocabulary_info = await self.invoke('create_vocabulary', event)
+        while vocabulary_info['status'] == 'PENDING':
+            await asyncio.sleep(5)
+            vocabulary_info = await self.invoke('check_vocabulary', vocabulary_info)
+        if vocabulary_info['status'] != 'READY':
+            raise Exception("vocabulary for " + feed_url + " is " + vocabulary_info['status'])
+
+        await self.invoke('create_index', {})
+
+        from artifact_io import read_episode_list
+        from process_podcast_item import episode_request
+
+        episodes = read_episode_list(event['episodes']['bucket'], event['episodes']['key'])['episodes']
+        requests = [episode_request(episode, event['episodes']['bucket'], vocabulary_info)
+                    for episode in episodes if episode['status'] == 'PENDING']
+        return Feed(feed_url, vocabulary_info), requests
+
+    async def run_feed(self, feed_url, max_episodes):
+        feed, requests = await self.prepare_feed(feed_url, max_episodes)
+        feed.remaining = len(requests)
+        logger.info("queueing {} episodes of {}".format(len(requests), feed_url))
+        if not requests:
+            feed.done.set()
+        for request in requests:
+            # Blocks while the download queue is full
+            await self.queues['download'].put(Episode(request, feed))
+
+        # Delete Transcribe Custom Vocabulary once every episode of the feed is through
+        await feed.done.wait()
+        await self.invoke('delete_vocabulary', feed.vocabulary_info)
+
+    async def download(self, episode):
+        event = episode.event
+        if event.get('dryrun') == 'TRUE':
+            return False
+        event['audioS3Location'] = await self.invoke('download', event)
+        event['audioSegments'] = await self.invoke('split', event)
+        return True
+
+    # Start Transcribe until Is Transcribe Completed?, for the whole episode or for one segment
+    async def transcribe_until_complete(self, state):
+        state['transcribe'] = await self.invoke('start_transcribe', state)
+        while True:
+            status = await self.invoke('check_transcribe', state['transcribe'])
+            if status['status'] == 'COMPLETED':
+                return status
+            if status['status'] == 'FAILED':
+                raise TranscribeFailed(state['transcribe']['transcribeJob'])
+            await asyncio.sleep(self.poll_seconds)
+
+    async def transcribe(self, episode):
+        event = episode.event
+        if event['audioSegments']['segmentCount'] <= 1:
+            event['transcribeStatus'] = await self.transcribe_until_complete(event)
+            return True
+
+        # Transcribe Segments, with the same MaxConcurrency as the Map state
+        semaphore = asyncio.Semaphore(self.segment_concurrency)
+
+        async def transcribe_segment(segment):
+            async with semaphore:
+                state = {
+                    "audioS3Location": segment,
+                    "audio_type": event['audio_type'],
+                    "speakers": event['speakers'],
+                    "vocabularyInfo": event['vocabularyInfo']
+                }
+                status = await self.transcribe_until_complete(state)
+                return {"offset": segment['offset'], "transcriptionUrl": status['transcriptionUrl']}
+
+        event['segmentTranscriptions'] = await asyncio.gather(
+            *[transcribe_segment(segment) for segment in event['audioSegments']['segments']])
+        event['transcribeStatus'] = await self.invoke('stitch', event)
+        return True
+
+    # Process Transcription runs both branches in parallel, on the whole transcript or on one shard of it
+    async def process_transcription(self, event):
+        return list(await asyncio.gather(self.invoke('process_paragraph', event),
+                                         self.invoke('process_full_text', event)))
+
+    # Plan Transcript Shards, then Process Transcription for short transcripts, or Process Transcript
+    # Shards and Merge Transcript Shards for long ones
+    async def process(self, episode):
+        event = episode.event
+        event['shardPlan'] = await self.invoke('plan_shards', event)
+        if event['shardPlan']['shardCount'] <= 1:
+            event['processedTranscription'] = await self.process_transcription(event)
+            return True
+
+        # Process Transcript Shards, with the same MaxConcurrency as the Map state
+        semaphore = asyncio.Semaphore(self.shard_concurrency)
+
+        async def process_shard(shard):
+            async with semaphore:
+                state = {
+                    "shard": shard,
+                    "transcribeStatus": event['transcribeStatus'],
+                    "vocabularyInfo": event['vocabularyInfo'],
+                    "podcastUrl": event['podcastUrl'],
+                    "sourceFeed": event['sourceFeed']
+                }
+                return await self.process_transcription(state)
+
+        event['shardResults'] = await asyncio.gather(
+            *[process_shard(shard) for shard in event['shardPlan']['shards']])
+        event['processedTranscription'] = await self.process_transcription(event)
+        return True
+
+    async def upload(self, episode):
+        episode.event['elasticsearchResult'] = await self.invoke('upload', episode.event)
+        return True
+
+    def finish(self, episode, ok):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        episode.feed.finish_episode()
+
+    async def stage_worker(self, stage):
+        queue = self.queues[stage]
+        next_queue = self.queues[STAGES[STAGES.index(stage) + 1]] if stage != STAGES[-1] else None
+        stats = self.stats[stage]
+        while True:
+            episode = await queue.get()
+            stats.busy += 1
+            start = time.time()
+            try:
+                carry_on = await getattr(self, stage)(episode)
+            except Exception as e:
+                logger.exception("{} failed for {}: {}".format(stage, episode.event.get('podcastUrl'), e))
+                stats.failed += 1
+                self.finish(episode, False)
+            else:
+                stats.processed += 1
+                stats.seconds += time.time() - start
+                if carry_on and next_queue is not None:
+                    # Blocks while the next stage is backed up
+                    await next_queue.put(episode)
+                else:
+                    self.finish(episode, True)
+            finally:
+                stats.busy -= 1
+                queue.task_done()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "elapsed": round(elapsed, 1),
+            "episodes_per_hour": round(self.completed * 3600.0 / elapsed, 1) if elapsed else 0,
+            "queue_depth": dict((stage, self.queues[stage].qsize()) for stage in STAGES),
+            "busy": dict((stage, self.stats[stage].busy) for stage in STAGES),
+            "stages": dict((stage, self.stats[stage].summary()) for stage in STAGES)
+        }
+
+    async def reporter(self):
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            logger.info("progress: " + json.dumps(self.report()))
+
+    async def run(self, feeds, max_episodes=None):
+        self.start = time.time()
+        workers = [asyncio.ensure_future(self.stage_worker(stage))
+                   for stage in STAGES for _ in range(self.concurrency[stage])]
+        reporter = asyncio.ensure_future(self.reporter())
+        try:
+            results = await asyncio.gather(*[self.run_feed(feed, max_episodes) for feed in feeds],
+                                           return_exceptions=True)
+            for feed, result in zip(feeds, results):
+                if isinstance(result, Exception):
+                    logger.error("feed " + feed + " failed: " + str(result))
+        finally:
+            for task in workers + [reporter]:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+
+        report = self.report()
+        logger.info("pipeline complete: " + json.dumps(report))
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the episode pipeline for podcast feeds without Step Functions')
+    parser.add_argument('--feed', action='append', required=True, help='rss feed url, can be repeated')
+    parser.add_argument('--bucket', default=os.getenv('BUCKET_NAME'), required=not os.getenv('BUCKET_NAME'),
+                        help='bucket for the audio and the processed artifacts')
+    parser.add_argument('--endpoint', default=os.getenv('ES_DOMAIN'), help='Elasticsearch domain endpoint')
+    parser.add_argument('--max-episodes', type=int, help='maximum number of episodes per feed')
+    parser.add_argument('--download-concurrency', type=int, default=4)
+    parser.add_argument('--transcribe-concurrency', type=int, default=10,
+                        help='episodes transcribing at the same time')
+    parser.add_argument('--process-concurrency', type=int, default=4)
+    parser.add_argument('--upload-concurrency', type=int, default=2)
+    parser.add_argument('--segment-concurrency', type=int, default=4,
+                        help='segments of a long episode transcribing at the same time')
+    parser.add_argument('--shard-concurrency', type=int, default=8,
+                        help='shards of a long transcript processed at the same time')
+    parser.add_argument('--queue-size', type=int, default=10, help='episodes waiting in front of each stage')
+    parser.add_argument('--poll-seconds', type=int, default=60, help='seconds between transcribe status checks')
+    parser.add_argument('--report-seconds', type=int, default=60, help='seconds between progress reports')
+    parser.add_argument('--retries', type=int, default=2, help='retries of a failed step')
+    parser.add_argument('--debug', action='store_true', help='keep the intermediate files in S3')
+    args = parser.parse_args()
+
+    os.environ['BUCKET_NAME'] = args.bucket
+    if args.endpoint:
+        os.environ['ES_DOMAIN'] = args.endpoint
+    os.environ['DEBUG_MODE'] = 'TRUE' if args.debug else 'FALSE'
+    os.environ.setdefault('AUDIO_OFFSET', '1')
+    # The worker reports its own progress instead of printing the metrics of every handler call
+    os.environ.setdefault('METRICS_ENABLED', 'FALSE')
+
+    concurrency = {
+        'download': args.download_concurrency,
+        'transcribe': args.transcribe_concurrency,
+        'process': args.process_concurrency,
+        'upload': args.upload_concurrency
+    }
+    loop = asyncio.get_event_loop()
+    worker = PipelineWorker(load_handlers(), concurrency, args.queue_size, args.poll_seconds,
+                            args.segment_concurrency, args.retries, args.report_seconds, args.shard_concurrency)
+    loop.run_until_complete(worker.run(args.feed, args.max_episodes))
+
+
+if __name__ == '__main__':
+    main()
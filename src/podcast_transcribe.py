@@ -1,12 +1,12 @@
 from __future__ import print_function
-import boto3
 import json
 import datetime
 from time import mktime
 import os
 from common_lib import id_generator
 import logging
-from botocore.config import Config
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler
 
 # Log level
 logging.basicConfig()
@@ -40,20 +40,23 @@ class MyEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-# limit the number of retries submitted by boto3 because Step Functions will handle the exponential retries more efficiently
-config = Config(
-    retries=dict(
-        max_attempts=2
-    )
-)
+# The shared client retries the throttled and failed calls (see rate_limiter). When the account runs
+# too many jobs at once the step fails with ThrottlingException and the state machine retries it later.
+client = lazy_client('transcribe')
 
-client = boto3.client('transcribe', config=config)
+
+# Starting a job isn't idempotent: when the connection is lost after Transcribe got the request, the
+# retry with the same job name fails with ConflictException although the job was started. The job is
+# ours when it transcribes the same audio.
+def is_started(jobname, url):
+    job = client.get_transcription_job(TranscriptionJobName=jobname)['TranscriptionJob']
+    return job['Media']['MediaFileUri'] == url
 
 
 # Entrypoint for lambda funciton
+@instrumented_handler('start_transcribe')
 def lambda_handler(event, context):
-    session = boto3.session.Session()
-    region = session.region_name
+    region = client.meta.region_name
 
     # Default to unsuccessful
     isSuccessful = "FALSE"
@@ -95,6 +98,12 @@ def lambda_handler(event, context):
             }
         )
         isSuccessful = "TRUE"
+    except client.exceptions.ConflictException as e:
+        if not is_started(jobname, url):
+            logger.error(str(e))
+            raise ThrottlingException(e)
+        logger.info("transcription job {} was started by an earlier attempt".format(jobname))
+        isSuccessful = "TRUE"
     except client.exceptions.BadRequestException as e:
         # There is a limit to how many transcribe jobs can run concurrently. If you hit this limit,
         # return unsuccessful and the step function will retry.
@@ -1,11 +1,14 @@
 from __future__ import print_function
 import json
 import os
-import boto3
 import string
 import random
+from artifact_io import artifact_key, read_episode_list, write_episode_list
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler
 
-s3_client = boto3.client('s3')
+s3_client = lazy_client('s3')
+sfn_client = lazy_client('stepfunctions')
 
 
 # Generates a random ID for the step function execution
@@ -14,17 +17,14 @@ def id_generator(size=32, chars=string.ascii_uppercase + string.digits):
 
 
 # Entry point of the lamnda function
+@instrumented_handler('process_podcast_item')
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event, indent=2))
-    client = boto3.client('stepfunctions')
 
     isDebug = False
 
     # Pull the location of the episode list form S3 and parse the JSON
-    response = s3_client.get_object(Bucket=event["episodes"]['bucket'], Key=event["episodes"]['key'])
-    file_content = response['Body'].read().decode('utf-8')
-
-    request = json.loads(file_content)
+    request = read_episode_list(event["episodes"]['bucket'], event["episodes"]['key'])
     maxConcurrentEpisodes = request["maxConcurrentEpisodes"]
     episodes = request["episodes"]
 
@@ -46,7 +46,7 @@ def lambda_handler(event, context):
 
         if episode["status"] == "RUNNING":
             # get the status of the execution
-            response = client.describe_execution(executionArn=episode['executionArn'])
+            response = sfn_client.describe_execution(executionArn=episode['executionArn'])
             episode['status'] = response['status']
 
             if episode["status"] == "RUNNING":
@@ -64,29 +64,11 @@ def lambda_handler(event, context):
             break
 
         if episode["status"] == 'PENDING':
-            episodeRequest = {
-                "Episode": episode['Episode'],
-                "PodcastName": episode['PodcastName'],
-                "dryrun": episode['dryrun'],
-                "tags": episode['tags'],
-                "podcastUrl": episode['podcastUrl'],
-                "speakers": episode['speakers'],
-                "bucket": event["episodes"]['bucket'],
-                "publishTime": episode['publishedTime'],
-                "audio_type": episode['audioType'],
-                "summary": episode['summary'],
-                "sourceFeed": episode['sourceFeed'],
-                "vocabularyInfo": {
-                    "name": event["vocabularyInfo"]['name'],
-                    "mapping": event["vocabularyInfo"]['mapping']
-                }
-            }
-            if 'speakerNames' in episode:
-                episodeRequest['speakerNames'] = episode['speakerNames']
+            episodeRequest = episode_request(episode, event["episodes"]['bucket'], event["vocabularyInfo"])
 
             print("Calling Child Step Function: " + json.dumps(episodeRequest, indent=4, sort_keys=True, default=str))
 
-            response = client.start_execution(
+            response = sfn_client.start_execution(
                 stateMachineArn=stepFunctionArn,
                 name=id_generator(),
                 input=json.dumps(episodeRequest, indent=4, sort_keys=True, default=str)
@@ -104,9 +86,9 @@ def lambda_handler(event, context):
 
     # The execution list can get long, so we store it in s3 as to not exceed max for the payload of the
     # step function.
-    key = 'podcasts/keywords/' + id_generator() + '.json'
+    key = artifact_key('podcasts/episodelist/')
     if feedStatus != "COMPLETE":
-        response = s3_client.put_object(Body=json.dumps(request, indent=2), Bucket=event["episodes"]['bucket'], Key=key)
+        write_episode_list(event["episodes"]['bucket'], key, request)
 
     # Delete the prior item
     response = s3_client.delete_object(Bucket=event["episodes"]['bucket'], Key=event["episodes"]['key'])
@@ -118,3 +100,27 @@ def lambda_handler(event, context):
     # return the execution status of the child step functions
     return {"status": feedStatus, "remainingEpisodes": remainingEpisodes, "bucket": event["episodes"]['bucket'],
             "key": key}
+
+
+# Builds the input of the episode state machine from an entry of the episode list
+def episode_request(episode, bucket, vocabulary_info):
+    request = {
+        "Episode": episode['Episode'],
+        "PodcastName": episode['PodcastName'],
+        "dryrun": episode['dryrun'],
+        "tags": episode['tags'],
+        "podcastUrl": episode['podcastUrl'],
+        "speakers": episode['speakers'],
+        "bucket": bucket,
+        "publishTime": episode['publishedTime'],
+        "audio_type": episode['audioType'],
+        "summary": episode['summary'],
+        "sourceFeed": episode['sourceFeed'],
+        "vocabularyInfo": {
+            "name": vocabulary_info['name'],
+            "mapping": vocabulary_info['mapping']
+        }
+    }
+    if 'speakerNames' in episode:
+        request['speakerNames'] = episode['speakerNames']
+    return request
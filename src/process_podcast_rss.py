@@ -1,15 +1,19 @@
 from __future__ import print_function
 import json
 import os
-import boto3
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
 import xml.etree.ElementTree as ET
 import logging
 from dateutil import parser
-from common_lib import find_duplicate_person, id_generator
+from artifact_io import artifact_key, write_episode_list
+from chunk_packer import truncate_utf8
+from common_lib import find_duplicate_person, id_generator, summarize
+from gazetteer import update_feed_entities
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler, timer
 
-client = boto3.client('comprehend')
+client = lazy_client('comprehend')
 
 # Log level
 logging.basicConfig()
@@ -25,6 +29,7 @@ class InvalidInputError(ValueError):
 
 
 # Entry point for the lambda function
+@instrumented_handler('process_podcast_rss')
 def lambda_handler(event, context):
     logger.info("Received event: " + json.dumps(event, indent=2))
     feed_url = event['rss']
@@ -44,14 +49,20 @@ def lambda_handler(event, context):
     vocabularyTypes = ['COMMERCIAL_ITEM', 'EVENT', 'LOCATION', 'ORGANIZATION', 'TITLE']
     vocabularyItems = []
 
+    # The people and vocabulary entities of the descriptions, to seed the gazetteer of the feed
+    feedEntities = []
+
     try:
         filename = '/tmp/' + id_generator() + '.rss'
         # HTTP GET the RSS feed XML file
-        f = urlopen(feed_url)
+        with timer('urlopen') as m:
+            f = urlopen(feed_url)
+            rss = f.read()
+            m.bytes_in = len(rss)
 
         # Open our local file for writing
         with open(filename, "wb") as local_file:
-            local_file.write(f.read())
+            local_file.write(rss)
 
         # The RSS feed is an XML file, so parse it and traverse the tree and pull all the /channel/items
         tree = ET.parse(filename)
@@ -73,7 +84,7 @@ def lambda_handler(event, context):
             description = child.find('description').text
             description = description[0:4900]
 
-            comprehendResponse = client.detect_entities(Text=description, LanguageCode='en')
+            comprehendResponse = client.detect_entities(Text=truncate_utf8(description, 4900), LanguageCode='en')
 
             # we estimate the number of speakers in the podcast by parsing people names from the episode summary
             speaker_list = []
@@ -91,6 +102,7 @@ def lambda_handler(event, context):
                 if entity['Type'] == 'PERSON':
                     if not entity['Text'].startswith('@'):
                         speaker_list.append(entity['Text'])
+                        feedEntities.append({"text": entity['Text'], "type": entity['Type'], "score": entity['Score']})
                     else:
                         logger.info(f'skipping person {entity["Text"]}')
                 # add to vocabulary if not already in there
@@ -99,6 +111,7 @@ def lambda_handler(event, context):
                     cleanText = cleanText.replace('.', '')
                     if cleanText:
                         vocabularyItems.append(cleanText)
+                        feedEntities.append({"text": cleanText, "type": entity['Type'], "score": entity['Score']})
 
             duplicates = find_duplicate_person(speaker_list)
             for d in duplicates:
@@ -143,18 +156,17 @@ def lambda_handler(event, context):
         print("URL Error:", e.reason, feed_url)
         raise InvalidInputError("Unable to download RSS feed: " + feed_url)
 
-    logger.info(json.dumps(retval, indent=2))
+    logger.info("{} episodes: {}".format(len(retval), summarize(retval)))
 
     # This connection can be pretty big and exceed the capacity of the Step Function state data, so we store it
     # in S3 instead and return a link to the S3 file.
-    s3_client = boto3.client('s3')
-    key = 'podcasts/episodelist/' + id_generator() + '.json'
-    response = s3_client.put_object(
-        Body=json.dumps({"maxConcurrentEpisodes": maxConcurrentEpisodes, "episodes": retval}, indent=2), Bucket=bucket,
-        Key=key)
+    key = artifact_key('podcasts/episodelist/')
+    write_episode_list(bucket, key, {"maxConcurrentEpisodes": maxConcurrentEpisodes, "episodes": retval})
 
     event['episodes'] = {"status": 'RUNNING', "remainingEpisodes": episode_count, "bucket": bucket, "key": key}
     event['customVocabulary'] = vocabularyItems
 
+    update_feed_entities(bucket, feed_url, feedEntities)
+
     # Return the link to the episode JSON document and the custom vocabulary items.
     return event
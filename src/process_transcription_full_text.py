@@ -1,7 +1,5 @@
 from __future__ import print_function  # Python 2/3 compatibility
 
-import boto3
-import botocore
 import os
 import logging
 import time
@@ -9,10 +7,15 @@ import json
 from urllib.request import urlopen
 import string
 import random
-from common_lib import find_duplicate_person, id_generator
-
-# from requests_aws_sign import AWSV4Sign
-# from elasticsearch import Elasticsearch, RequestsHttpConnection
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from artifact_io import artifact_key, read_artifact, read_shard, write_transcript
+from common_lib import find_duplicate_person, summarize
+from aws_clients import client as lazy_client
+from botocore.exceptions import ClientError
+from instrumentation import instrumented_handler, timer
+from transcript_segmenter import TranscriptChunker, feed_items
+from vocabulary_cache import read_mapping
 
 # Log level
 logging.basicConfig()
@@ -24,15 +27,28 @@ else:
 # Parameters
 REGION = os.getenv('AWS_REGION', default='us-east-1')
 
-transcribe_client = boto3.client('transcribe', region_name=REGION)
-comprehend = boto3.client(service_name='comprehend', region_name=REGION)
-
-commonDict = {'i': 'I'}
+comprehend = lazy_client('comprehend', region_name=REGION)
 
 ENTITY_CONFIDENCE_THRESHOLD = 0.5
 
 KEY_PHRASES_CONFIDENCE_THRESHOLD = 0.7
 
+# Number of key phrases kept for the episode, the ones found in the most chunks first
+KEY_PHRASES_LIMIT = int(os.getenv('KEY_PHRASES_LIMIT', default='100'))
+
+# The batch APIs of Comprehend take at most 25 documents per call
+COMPREHEND_BATCH_SIZE = 25
+
+# Number of batch calls in flight at the same time, across all the analyses
+COMPREHEND_CONCURRENCY = int(os.getenv('COMPREHEND_CONCURRENCY', default='6'))
+
+# Sentiment is optional since it adds another Comprehend charge per chunk
+DETECT_SENTIMENT = os.getenv('COMPREHEND_DETECT_SENTIMENT', default='FALSE') == 'TRUE'
+
+# With BATCH the chunks are stored with the transcript instead of being analyzed, and the entities are
+# filled in later by a single asynchronous Comprehend job over many episodes (see comprehend_batch_job)
+COMPREHEND_MODE = os.getenv('COMPREHEND_MODE', default='SYNC')
+
 # get the Elasticsearch endpoint from the environment variables
 ES_ENDPOINT = os.getenv('ES_ENDPOINT', default='search-podcasts-fux2acvdz4giniry55uf23yc2i.us-east-1.es.amazonaws.com')
 
@@ -42,21 +58,7 @@ ES_INDEX = os.getenv('ES_INDEX', default='podcasts')
 # get the Elasticsearch document type from the environment variables
 ES_DOCTYPE = os.getenv('ES_DOCTYPE', default='episode')
 
-# Establish credentials
-session_var = boto3.session.Session()
-credentials = session_var.get_credentials()
-
-# Elasticsearch connection.
-# service = 'es'
-# auth = AWSV4Sign(credentials, REGION, service)
-# es_client = Elasticsearch(host=ES_ENDPOINT,
-#                           port=443,
-#                           connection_class=RequestsHttpConnection,
-#                           http_auth=auth,
-#                           use_ssl=True,
-#                           verify_ssl=True)
-
-s3_client = boto3.client("s3")
+s3_client = lazy_client("s3")
 
 # Pull the bucket name from the environment variable set in the cloudformation stack
 bucket = os.environ['BUCKET_NAME']
@@ -67,63 +69,125 @@ class InvalidInputError(ValueError):
     pass
 
 
-def process_transcript(transcription_url, podcast_url, vocabulary_info):
+def process_transcript(transcription_url, podcast_url, vocabulary_info, shard=None):
+    custom_vocabs = read_custom_vocabs(vocabulary_info)
+
+    # job_status_response = transcribe_client.get_transcription_job(TranscriptionJobName=transcribe_job_id)
+    with timer('urlopen') as m:
+        response = urlopen(transcription_url)
+        output = response.read()
+        m.bytes_in = len(output)
+    json_data = json.loads(output)
+
+    logger.debug(json.dumps(json_data, indent=4))
+    results = json_data['results']
+    # free up memory
+    del json_data
+
+    return process_results(results, custom_vocabs, shard)
+
+
+def read_custom_vocabs(vocabulary_info):
     custom_vocabs = None
     if "mapping" in vocabulary_info:
         try:
             vocab_mapping_bucket = vocabulary_info['mapping']['bucket']
             key = vocabulary_info['mapping']['key']
-            obj = s3_client.get_object(Bucket=vocab_mapping_bucket, Key=key)
-            custom_vocabs = json.loads(obj['Body'].read())
+            custom_vocabs = read_mapping(vocab_mapping_bucket, key)
             logger.info("key:" + key)
-            logger.info("using custom vocab mapping: \n" + json.dumps(custom_vocabs, indent=2))
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
+            logger.info("using custom vocab mapping: " + summarize(custom_vocabs))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey"):
                 raise InvalidInputError("The S3 file for custom vocab list does not exist.")
             else:
                 raise
+    return custom_vocabs
 
-    # job_status_response = transcribe_client.get_transcription_job(TranscriptionJobName=transcribe_job_id)
-    response = urlopen(transcription_url)
-    output = response.read()
-    json_data = json.loads(output)
 
-    logger.debug(json.dumps(json_data, indent=4))
-    results = json_data['results']
-    # free up memory
-    del json_data
+# Chunks up the transcript, analyzes the chunks and writes the transcript. Also called by
+# rerender_episodes on the stored transcripts.
+def process_results(results, custom_vocabs, shard=None):
+    with timer('chunk_up_transcript') as m:
+        comprehend_chunks, paragraphs, analytics = chunk_up_transcript(custom_vocabs, results, shard)
+        m.items = len(comprehend_chunks)
 
-    comprehend_chunks, paragraphs = chunk_up_transcript(custom_vocabs, results)
+    responses = None
+    if COMPREHEND_MODE != 'BATCH':
+        responses = analyze_chunks(comprehend_chunks)
+
+    # The shards are merged into the transcript of the episode once they are all done
+    if shard is not None:
+        key = artifact_key('podcasts/shards/')
+        write_transcript(bucket, key, paragraphs, shard=shard['index'], chunks=comprehend_chunks,
+                         responses=responses, analytics=analytics)
+        return {"bucket": bucket, "key": key}
+
+    return write_results(paragraphs, comprehend_chunks, responses, analytics)
 
-    start = time.time()
-    detected_entities_response = comprehend.batch_detect_entities(TextList=comprehend_chunks, LanguageCode='en')
-    round_trip = time.time() - start
-    logger.info('End of batch_detect_entities. Took time {:10.4f}\n'.format(round_trip))
 
-    entities = parse_detected_entities_response(detected_entities_response, {})
+# Merges the paragraphs, chunks and comprehend responses of the shards of a long episode, in order,
+# into the transcript of the episode, exactly the way a single invocation writes it. The state each
+# shard starts from carries the analytics of the shards before it, so the last shard has the analytics
+# of the episode. The shards are only removed once the transcript is written, so a merge that fails
+# can be retried from them.
+def merge_shards(shard_results):
+    analytics = None
+    paragraphs = []
+    comprehend_chunks = []
+    offsets = []
+    shard_responses = []
+    for paragraph_location, transcript_location in shard_results:
+        header, records = read_artifact(transcript_location['bucket'], transcript_location['key'])
+        paragraphs.extend(record['text'] for record in records)
+        offsets.append(len(comprehend_chunks))
+        comprehend_chunks.extend(header['chunks'])
+        shard_responses.append(header['responses'])
+        analytics = header.get('analytics') or analytics
+
+    responses = None
+    if COMPREHEND_MODE != 'BATCH':
+        responses = dict((name, merge_batch_responses([response[name] for response in shard_responses], offsets))
+                         for name in shard_responses[0])
+    location = write_results(paragraphs, comprehend_chunks, responses, analytics)
+
+    for paragraph_location, transcript_location in shard_results:
+        s3_client.delete_object(Bucket=transcript_location['bucket'], Key=transcript_location['key'])
+    return location
+
+
+def write_results(paragraphs, comprehend_chunks, responses, analytics):
+    logger.info("analytics: " + json.dumps(analytics))
+    if COMPREHEND_MODE == 'BATCH':
+        key = artifact_key('podcasts/transcript/')
+        write_transcript(bucket, key, paragraphs, transcript_entities={}, key_phrases=[],
+                         comprehend='pending', comprehend_chunks=comprehend_chunks, analytics=analytics)
+        logger.info("deferred comprehend of {} chunks, transcript at s3://{}/{}".format(
+            len(comprehend_chunks), bucket, key))
+        return {"bucket": bucket, "key": key}
+
+    entities = parse_detected_entities_response(responses['entities'], {})
     entities_as_list = {}
+    # Sorted so the transcript doesn't depend on the order the set happens to iterate in
     for entity_type in entities:
-        entities_as_list[entity_type] = list(entities[entity_type])
+        entities_as_list[entity_type] = sorted(entities[entity_type])
 
     clean_up_entity_results(entities_as_list)
-    print(json.dumps(entities_as_list, indent=4))
-
-    # start = time.time()
-    # detected_phrase_response = comprehend.batch_detect_key_phrases(TextList=comprehend_chunks, LanguageCode='en')
-    # round_trip = time.time() - start
-    # logger.info('End of batch_detect_key_phrases. Took time {:10.4f}\n'.format(round_trip))
-
-    # key_phrases = parse_detected_key_phrases_response(detected_phrase_response)
-    # logger.debug(json.dumps(key_phrases, indent=4))
-
-    doc_to_update = {'transcript': paragraphs}
-    doc_to_update['transcript_entities'] = entities_as_list
-    logger.info(json.dumps(doc_to_update, indent=4))
-    # doc_to_update['key_phrases'] = key_phrases
-    key = 'podcasts/transcript/' + id_generator() + '.json'
-
-    response = s3_client.put_object(Body=json.dumps(doc_to_update, indent=2), Bucket=bucket, Key=key)
-    logger.info(json.dumps(response, indent=2))
+    logger.info("transcript entities: " + summarize(entities_as_list))
+
+    fields = {
+        'transcript_entities': entities_as_list,
+        'key_phrases': parse_detected_key_phrases_response(responses['key_phrases']),
+        'analytics': analytics
+    }
+    logger.info("key phrases: " + summarize(fields['key_phrases']))
+    if 'sentiment' in responses:
+        fields['sentiment'] = parse_detected_sentiment_response(responses['sentiment'], comprehend_chunks)
+        logger.info("sentiment: " + json.dumps(fields['sentiment']))
+
+    # The transcript is stored a paragraph per line, the entities, key phrases, sentiment and analytics
+    # go into the header of the artifact
+    key = artifact_key('podcasts/transcript/')
+    write_transcript(bucket, key, paragraphs, **fields)
 
     logger.info("successfully written transcript to s3://" + bucket + "/" + key)
     # Return the bucket and key of the transcription / comprehend result.
@@ -132,7 +196,10 @@ def process_transcript(transcription_url, podcast_url, vocabulary_info):
 
 
 
-def chunk_up_transcript(custom_vocabs, results):
+# Breaks the transcript up into the paragraphs of the full text and the chunks sent to comprehend (see
+# transcript_segmenter.TranscriptChunker), with the analytics of the episode. With a shard, only the
+# items of the shard are processed, and there are analytics only for the last shard.
+def chunk_up_transcript(custom_vocabs, results, shard=None):
     # Here is the JSON returned by the Amazon Transcription SDK
     # {
     #  "jobName":"JobName",
@@ -187,80 +254,71 @@ def chunk_up_transcript(custom_vocabs, results):
     #  }
 
 
-    speaker_label_exist = False
-    speaker_segments = None
-    if 'speaker_labels' in results:
-        speaker_label_exist = True
-        speaker_segments = parse_speaker_segments(results)
-
-    items = results['items']
-    last_speaker = None
-    paragraphs = []
-    current_paragraph = ""
-    comprehend_chunks = []
-    current_comprehend_chunk = ""
-    previous_time = 0
-    last_pause = 0
-    last_item_was_sentence_end = False
-    for item in items:
-        if item["type"] == "pronunciation":
-            start_time = float(item['start_time'])
-
-            if speaker_label_exist:
-                current_speaker = get_speaker_label(speaker_segments, float(item['start_time']))
-                if last_speaker is None or current_speaker != last_speaker:
-                    if current_paragraph is not None:
-                        paragraphs.append(current_paragraph)
-                    current_paragraph = current_speaker + " :"
-                    last_pause = start_time
-                last_speaker = current_speaker
-
-            elif (start_time - previous_time) > 2 or (
-                            (start_time - last_pause) > 15 and last_item_was_sentence_end):
-                last_pause = start_time
-                if current_paragraph is not None or current_paragraph != "":
-                    paragraphs.append(current_paragraph)
-                current_paragraph = ""
-
-            phrase = item['alternatives'][0]['content']
-            if custom_vocabs is not None:
-                if phrase in custom_vocabs:
-                    phrase = custom_vocabs[phrase]
-                    logger.info("replaced custom vocab: " + phrase)
-            if phrase in commonDict:
-                phrase = commonDict[phrase]
-            current_paragraph += " " + phrase
-
-            # add chunking
-            current_comprehend_chunk += " " + phrase
-
-            last_item_was_sentence_end = False
-
-        elif item["type"] == "punctuation":
-            current_paragraph += item['alternatives'][0]['content']
-            current_comprehend_chunk += item['alternatives'][0]['content']
-            if item['alternatives'][0]['content'] in (".", "!", "?"):
-                last_item_was_sentence_end = True
-            else:
-                last_item_was_sentence_end = False
-
-        if (item["type"] == "punctuation" and len(current_comprehend_chunk) >= 4500) \
-                or len(current_comprehend_chunk) > 4900:
-            comprehend_chunks.append(current_comprehend_chunk)
-            current_comprehend_chunk = ""
-
-        if 'end_time' in item:
-            previous_time = float(item['end_time'])
-
-    if not current_comprehend_chunk == "":
-        comprehend_chunks.append(current_comprehend_chunk)
-    if not current_paragraph == "":
-        paragraphs.append(current_paragraph)
-
+    chunker = TranscriptChunker(results, custom_vocabs, shard['text'] if shard else None)
+    feed_items(chunker, results['items'], shard)
+    comprehend_chunks = chunker.chunks
+    paragraphs = chunker.paragraphs
+    logger.info("comprehend chunks: " + json.dumps(chunker.packer.stats()))
     logger.debug(json.dumps(paragraphs, indent=4))
     logger.debug(json.dumps(comprehend_chunks, indent=4))
 
-    return comprehend_chunks, "\n\n".join(paragraphs)
+    analytics = None
+    if shard is None or shard['last']:
+        analytics = chunker.report()
+    return comprehend_chunks, paragraphs, analytics
+
+
+# Runs the entity, key phrase and (optionally) sentiment analyses over the chunks at the same time.
+# Each analysis is split into batches of 25 chunks and every batch is its own call, so the wall time
+# is close to that of the slowest single call instead of the sum of all of them. Returns the merged
+# response of each analysis, in the shape of a single batch call over all the chunks.
+def analyze_chunks(chunks):
+    analyses = {
+        'entities': comprehend.batch_detect_entities,
+        'key_phrases': comprehend.batch_detect_key_phrases
+    }
+    if DETECT_SENTIMENT:
+        analyses['sentiment'] = comprehend.batch_detect_sentiment
+
+    batches = [chunks[i:i + COMPREHEND_BATCH_SIZE] for i in range(0, len(chunks), COMPREHEND_BATCH_SIZE)]
+    start = time.time()
+    # Each call runs in its own copy of the context, to be timed with the metrics of the invocation
+    with ThreadPoolExecutor(max_workers=COMPREHEND_CONCURRENCY) as executor:
+        futures = dict(((name, i), executor.submit(contextvars.copy_context().run, timed_batch_call, name, api,
+                                                   batch))
+                       for name, api in analyses.items() for i, batch in enumerate(batches))
+        results = dict((key, future.result()) for key, future in futures.items())
+
+    responses = {}
+    serial = 0.0
+    for name in analyses:
+        calls = [results[(name, i)] for i in range(len(batches))]
+        serial += sum(elapsed for response, elapsed in calls)
+        responses[name] = merge_batch_responses([response for response, elapsed in calls])
+    logger.info('comprehend: {} calls over {} chunks took {:.4f}s, {:.4f}s back to back'.format(
+        len(futures), len(chunks), time.time() - start, serial))
+    return responses
+
+
+def timed_batch_call(name, api, batch):
+    start = time.time()
+    response = api(TextList=batch, LanguageCode='en')
+    return response, time.time() - start
+
+
+# The Index of the results and errors of each batch is relative to the batch, renumber them so they
+# point into the full list of chunks. The batches are COMPREHEND_BATCH_SIZE chunks apart unless the
+# offsets of the batches are given.
+def merge_batch_responses(responses, offsets=None):
+    merged = {'ResultList': [], 'ErrorList': []}
+    for i, response in enumerate(responses):
+        offset = offsets[i] if offsets is not None else i * COMPREHEND_BATCH_SIZE
+        for name in ('ResultList', 'ErrorList'):
+            for result in response.get(name, []):
+                result = dict(result)
+                result['Index'] = result['Index'] + offset
+                merged[name].append(result)
+    return merged
 
 
 def parse_detected_key_phrases_response(detected_phrase_response):
@@ -270,19 +328,50 @@ def parse_detected_key_phrases_response(detected_phrase_response):
 
     if 'ResultList' in detected_phrase_response:
         result_list = detected_phrase_response["ResultList"]
-        phrases_set = set()
+        # Count the chunks each phrase shows up in, case insensitive, and keep the most common ones
+        counts = {}
+        texts = {}
         for result in result_list:
-            phrases = result['KeyPhrases']
-            for detected_phrase in phrases:
-                if float(detected_phrase["Score"]) >= ENTITY_CONFIDENCE_THRESHOLD:
+            seen = set()
+            for detected_phrase in result['KeyPhrases']:
+                if float(detected_phrase["Score"]) >= KEY_PHRASES_CONFIDENCE_THRESHOLD:
                     phrase = detected_phrase["Text"]
-                    phrases_set.add(phrase)
-        key_phrases = list(phrases_set)
+                    normalized = phrase.lower()
+                    if normalized not in seen:
+                        seen.add(normalized)
+                        counts[normalized] = counts.get(normalized, 0) + 1
+                        texts.setdefault(normalized, phrase)
+        ranked = sorted(counts, key=lambda normalized: (-counts[normalized], normalized))
+        key_phrases = [texts[normalized] for normalized in ranked[:KEY_PHRASES_LIMIT]]
         return key_phrases
     else:
         return []
 
 
+# Averages the sentiment scores of the chunks, weighted by the length of the chunk, and labels the
+# episode with the highest average
+def parse_detected_sentiment_response(detected_sentiment_response, chunks):
+    if 'ErrorList' in detected_sentiment_response and len(detected_sentiment_response['ErrorList']) > 0:
+        logger.error("encountered error during batch_detect_sentiment")
+        logger.error(json.dumps(detected_sentiment_response['ErrorList'], indent=4))
+
+    totals = {"positive": 0.0, "negative": 0.0, "neutral": 0.0, "mixed": 0.0}
+    weight = 0
+    for result in detected_sentiment_response.get('ResultList', []):
+        length = len(chunks[result['Index']])
+        for name, score in result['SentimentScore'].items():
+            totals[name.lower()] += score * length
+        weight += length
+    if not weight:
+        return None
+
+    scores = dict((name, round(total / weight, 4)) for name, total in totals.items())
+    return {
+        "label": max(sorted(scores), key=lambda name: scores[name]).upper(),
+        "scores": scores
+    }
+
+
 def clean_up_entity_results(entities_as_list):
     if 'PERSON' in entities_as_list:
         try:
@@ -335,25 +424,7 @@ def parse_detected_entities_response(detected_entities_response, entities):
         return {}
 
 
-def get_speaker_label(speaker_segments, start_time):
-    for segment in speaker_segments:
-        if segment['start_time'] <= start_time < segment['end_time']:
-            return segment['speaker']
-    return None
-
-
-def parse_speaker_segments(results):
-    speaker_labels = results['speaker_labels']['segments']
-    speaker_segments = []
-    for label in speaker_labels:
-        segment = dict()
-        segment["start_time"] = float(label["start_time"])
-        segment["end_time"] = float(label["end_time"])
-        segment["speaker"] = label["speaker_label"]
-        speaker_segments.append(segment)
-    return speaker_segments
-
-
+@instrumented_handler('process_transcription_full_text')
 def lambda_handler(event, context):
     """
         AWS Lambda handler
@@ -362,10 +433,19 @@ def lambda_handler(event, context):
     logger.info('Received event')
     logger.info(json.dumps(event))
 
+    if 'shardResults' in event:
+        return merge_shards(event['shardResults'])
+
     # Pull the signed URL for the payload of the transcription job
     transcription_url = event['transcribeStatus']['transcriptionUrl']
 
     vocab_info = None
     if 'vocabularyInfo' in event:
         vocab_info = event['vocabularyInfo']
-    return process_transcript(transcription_url, event['podcastUrl'], vocab_info)
+
+    # The transcript of a long episode is processed in shards (see long_episode.shard_handler)
+    shard = None
+    if 'shard' in event:
+        shard = read_shard(event['shard']['bucket'], event['shard']['key'], event['shard']['index'])
+        logger.info("shard {index}: items {begin} to {end}".format(**shard))
+    return process_transcript(transcription_url, event['podcastUrl'], vocab_info, shard)
@@ -1,42 +1,62 @@
-import os
 from urllib.request import urlopen
+import hashlib
 import json
 import os
-import string
-import random
-import boto3
-from botocore.client import Config
-from common_lib import id_generator
+from artifact_io import artifact_key, read_artifact, read_shard, write_keywords, write_raw_transcript
+from boilerplate import read_index, signature, write_index
+from common_lib import summarize
+from gazetteer import build_gazetteer, learnable, normalize, read_feed_entities, update_feed_entities
+from time_offsets import encode_offsets, offset_to_time
+from transcript_segmenter import ParagraphSegmenter, feed_items
+from vocabulary_cache import read_mapping
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler, record, timer
 
 # Create SDK clients for comprehend and S3
-client = boto3.client('comprehend')
-s3_client = boto3.client('s3')
+client = lazy_client('comprehend')
+s3_client = lazy_client('s3')
 
 entityTypes = ['COMMERCIAL_ITEM', 'EVENT', 'LOCATION', 'ORGANIZATION', 'TITLE', 'PERSON']
 
+# With BATCH the paragraphs are stored without entities and marked pending, to be tagged later by a
+# single asynchronous Comprehend job over many episodes (see comprehend_batch_job)
+COMPREHEND_MODE = os.getenv('COMPREHEND_MODE', default='SYNC')
+
+# Paragraphs that mention names the feed is known for are tagged from the gazetteer of the feed,
+# only the others are sent to comprehend
+GAZETTEER_TAGGING = os.getenv('GAZETTEER_TAGGING', default='TRUE') == 'TRUE'
+
+# Share of the paragraphs tagged from the gazetteer that are sent to comprehend anyway, to measure
+# how well the two agree
+GAZETTEER_SAMPLE_RATE = float(os.getenv('GAZETTEER_SAMPLE_RATE', default='0.1'))
+
+# Paragraphs the feed repeats in every episode (intros, sponsor reads) are flagged and not tagged
+BOILERPLATE_DETECTION = os.getenv('BOILERPLATE_DETECTION', default='TRUE') == 'TRUE'
+
+# Keep the output of Amazon Transcribe of every episode, so it can be processed again with
+# rerender_episodes
+RETAIN_RAW_TRANSCRIPTS = os.getenv('RETAIN_RAW_TRANSCRIPTS', default='TRUE') == 'TRUE'
+
 
 # Main entry point for the lambda function
+@instrumented_handler('process_transcription_paragraph')
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event, indent=2))
 
     # Pull the bucket name from the environment variable set in the cloudformation stack
     bucket = os.environ['BUCKET_NAME']
-    retval = []
-    paragraphs = []
+    if 'shardResults' in event:
+        return merge_shards(bucket, event)
 
     # Pull the signed URL for the payload of the transcription job
     transcriptionUrl = event['transcribeStatus']['transcriptionUrl']
 
-    response = s3_client.get_object(Bucket=event["vocabularyInfo"]['mapping']['bucket'],
-                                    Key=event["vocabularyInfo"]['mapping']['key'])
-    file_content = response['Body'].read().decode('utf-8')
-
-    mapping = json.loads(file_content)
-    print("Received mapping: " + json.dumps(mapping, indent=2))
-
     # Open the transcription job payload.
-    f = urlopen(transcriptionUrl)
-    j = json.loads(f.read())
+    with timer('urlopen') as m:
+        f = urlopen(transcriptionUrl)
+        output = f.read()
+        m.bytes_in = len(output)
+    j = json.loads(output)
 
     # Here is the JSON returned by the Amazon Transcription SDK
     # {
@@ -63,170 +83,276 @@ def lambda_handler(event, context):
     #     ]
     #  }
 
-    # Pull the items from the transcription. Each word will be its own item with a start and endtime
-    items = j["results"]["items"]
+    # The transcript of a long episode is processed in shards (see long_episode.shard_handler), each
+    # starting from the state the segmentation is in at the start of the shard
+    shard = None
+    if 'shard' in event:
+        shard = read_shard(event['shard']['bucket'], event['shard']['key'], event['shard']['index'])
+        print("Shard {index}: items {begin} to {end}".format(**shard))
 
-    # We would like to determine the key phrases in the transcript to so we can search on common phrases
-    # rather than a single word at a time. In order to maintain the relationship between the time
-    # the text is spoken and search on it, we need to pass each phrase individually along with its
-    # timestamp so we retain that relationship. We will use comprehend to extract the ckey phrases from
-    # the text.
+    # Every path through the state machine reads the whole transcript here, once per episode or once
+    # per shard, so the first shard keeps it
+    if RETAIN_RAW_TRANSCRIPTS and (shard is None or shard['index'] == 0):
+        with timer('write_raw_transcript') as m:
+            write_raw_transcript(bucket, event['podcastUrl'], output)
+            m.bytes_out = len(output)
 
-    contents = ""
-    timedata = []
+    return process_transcript(bucket, event, j['results'], shard)
 
-    prevEndTime = -1
-    paragraphGap = 1.5
-    prevStartTime = -1
-    newParagraph = False
-    prevSpeaker = 'spk_0'
 
-    hasSpeakerLabels = False
-    speakerMapping = []
+# Breaks the transcript up into paragraphs, tags them and writes them. Also called by
+# rerender_episodes on the stored transcripts, which doesn't learn from the episodes again.
+def process_transcript(bucket, event, results, shard=None, learn=True):
+    retval = []
 
-    # Create a mapping of the transitions from one speaker to another
-    if 'speaker_labels' in j['results']:
-        hasSpeakerLabels = True
-        for i in range(len(j['results']['speaker_labels']['segments'])):
-            speakerLabel = j['results']['speaker_labels']['segments'][i]
-            speakerMapping.append(
-                {
-                    "speakerLabel": speakerLabel['speaker_label'],
-                    "endTime": float(speakerLabel['end_time'])
-                })
+    # The mapping of the feed is usually still in the cache of a warm container
+    mapping = read_mapping(event["vocabularyInfo"]['mapping']['bucket'], event["vocabularyInfo"]['mapping']['key'])
+    print("Received mapping: " + summarize(mapping))
+
+    gazetteer = None
+    if GAZETTEER_TAGGING and COMPREHEND_MODE != 'BATCH' and 'sourceFeed' in event:
+        with timer('build_gazetteer') as m:
+            gazetteer = build_gazetteer(read_feed_entities(bucket, event['sourceFeed']), mapping, entityTypes)
+            m.items = len(gazetteer)
+    boilerplate = None
+    if BOILERPLATE_DETECTION and 'sourceFeed' in event:
+        with timer('read_boilerplate_index') as m:
+            boilerplate = read_index(bucket, event['sourceFeed'])
+            m.items = len(boilerplate)
+    tagger = ParagraphTagger(gazetteer, GAZETTEER_SAMPLE_RATE, event.get('podcastUrl'), boilerplate)
 
-    speakerIndex = 0
+    # Pull the items from the transcription. Each word will be its own item with a start and endtime
+    items = results["items"]
 
-    # Repeat the loop for each item (word and punctuation)
     # The transcription will be broken out into a number of sections that are referred to
-    # below as paragraphs. The paragraph is the unit text that is stored in the 
+    # below as paragraphs. The paragraph is the unit text that is stored in the
     # elasticsearch index. It is broken out by punctionation, speaker changes, a long pause
     # in the audio, or overall length
-    for i in range(len(items)): 
-        reason = ""
-
-        # If the transcription detected the end of a sentence, we'll 
-        if items[i]['type'] == 'punctuation':
-            if items[i]["alternatives"][0]["content"] == '.':
-                newParagraph = True
-
-            # Always assume the first guess is right.
-            contents += items[i]["alternatives"][0]["content"]
-
-        # Add the start time to the string -> timedata
-        if 'start_time' in items[i]:
-            speakerLabel = 'spk_0'
-
-            if prevStartTime == -1:
-                prevStartTime = float(items[i]["start_time"])
-
-            # gap refers to the amount of time between spoken words
-            gap = float(items[i]["start_time"]) - prevEndTime
-
-            if hasSpeakerLabels:
-                while speakerIndex < (len(speakerMapping) - 1) and speakerMapping[speakerIndex + 1]['endTime'] < float(
-                        items[i]["start_time"]):
-                    speakerIndex += 1
-
-                speakerLabel = speakerMapping[speakerIndex]['speakerLabel']
-
-            # Change paragraphs if the speaker changes
-            if speakerLabel != prevSpeaker:
-                newParagraph = True
-                reason = "Speaker Change from " + prevSpeaker + " to " + speakerLabel
-            # the gap exceeds a preset threshold
-            elif gap > paragraphGap:
-                newParagraph = True
-                reason = "Time gap"
-            # There are over 4900 words (The limit for comprehend is 5000)
-            elif len(contents) > 4900:
-                newParagraph = True
-                reason = "Long paragraph"
-            else:
-                newParagraph = False
-
-            if prevEndTime != -1 and newParagraph:
-
-                # append the block of text to the array. Call comprehend to get
-                # the keyword tags for this block of text
-                retval.append({
-                    "startTime": prevStartTime,
-                    "endTime": prevEndTime,
-                    "text": contents,
-                    "gap": gap,
-                    "tags": run_comprehend(contents),
-                    "reason": reason,
-                    "speaker": prevSpeaker,
-                    "len": len(contents)
-                })
-                # Reset the contents and the time mapping
-                # print('paragraph:' + contents)
-                contents = ""
-                timedata = []
-                prevEndTime = -1
-                prevStartTime = -1
-                newParagraph = False
-            else:
-                prevEndTime = float(items[i]["end_time"])
-
-            prevSpeaker = speakerLabel
-
-            # If the contents is not empty, prepend a space
-            if contents != "":
-                contents += " "
-
-            # Always assume the first guess is right.
-            word = items[i]["alternatives"][0]["content"]
-
-            # Map the custom words back to their original text
-            for key in mapping:
-                val = mapping[key]
-                word = word.replace(key, val)
-
-            contents += word
-
-    # Run Comprehend on the remaining text
-    # run_comprehend(contents, timedata, retval)
-
-    retval.append({
-        "startTime": prevStartTime,
-        "endTime": prevEndTime,
-        "text": contents,
-        "tags": run_comprehend(contents),
-        "speaker": prevSpeaker
-    })
+    with timer('segment_paragraphs') as m:
+        segmenter = ParagraphSegmenter(results, mapping, shard['paragraph'] if shard else None)
+        paragraphs = feed_items(segmenter, items, shard).paragraphs
+        m.items = len(paragraphs)
+
+    # We would like to determine the key phrases in the transcript to so we can search on common phrases
+    # rather than a single word at a time. In order to maintain the relationship between the time
+    # the text is spoken and search on it, we need to pass each phrase individually along with its
+    # timestamp so we retain that relationship. We will use comprehend to extract the ckey phrases from
+    # the text.
+    for paragraph in paragraphs:
+        tags, entities, repeated = tagger.tag(paragraph['text'], paragraph['timedata'])
+        retval.append(paragraph_record(paragraph, tags, entities, repeated))
+
+    # The shards are merged into the keywords of the episode once they are all done
+    if shard is not None:
+        key = artifact_key('podcasts/shards/')
+        write_keywords(bucket, key, retval, shard=shard['index'], counts=tagger.counts(),
+                       gazetteer_names=len(gazetteer) if gazetteer else 0, learned=tagger.learned)
+        return {"bucket": bucket, "key": key}
 
+    return finish_episode(bucket, event, retval, tagger.report(), tagger.learned, boilerplate, tagger.signatures,
+                          learn)
+
+
+# Merges the keywords of the shards of a long episode, in order, into the keywords of the episode,
+# exactly the way a single invocation writes them. The shards are only removed once the keywords of the
+# episode are written, so a merge that fails can be retried from them.
+def merge_shards(bucket, event):
+    retval = []
+    learned = []
+    counts = {}
+    gazetteer_names = 0
+    for paragraph_location, transcript_location in event['shardResults']:
+        header, records = read_artifact(paragraph_location['bucket'], paragraph_location['key'])
+        retval.extend(records)
+        learned.extend(header['learned'])
+        gazetteer_names = header['gazetteer_names']
+        for name, count in header['counts'].items():
+            counts[name] = counts.get(name, 0) + count
+
+    boilerplate = None
+    signatures = None
+    if BOILERPLATE_DETECTION and 'sourceFeed' in event:
+        boilerplate = read_index(bucket, event['sourceFeed'])
+        signatures = [(paragraph['text'], signature(paragraph['text'])) for paragraph in retval]
+    location = finish_episode(bucket, event, retval, tagging_report(counts, gazetteer_names), learned, boilerplate,
+                              signatures)
+
+    # Nothing reads the shards or their plan anymore
+    for paragraph_location, transcript_location in event['shardResults']:
+        s3_client.delete_object(Bucket=paragraph_location['bucket'], Key=paragraph_location['key'])
+    plan = event['shardPlan']['shards'][0]
+    s3_client.delete_object(Bucket=plan['bucket'], Key=plan['key'])
+    return location
+
+
+# Writes the keywords of the episode, and what the feed learned from it: the new names for the
+# gazetteer and the paragraphs for the boilerplate index
+def finish_episode(bucket, event, retval, report, learned, boilerplate, signatures, learn=True):
     # Create a payload for the output of the transcribe and comprehend API calls. There's a limit on the
-    # amount of data stored in a step function payload, so we will use S3 to store the payload instead. 
+    # amount of data stored in a step function payload, so we will use S3 to store the payload instead.
     # This can get to be pretty big.
-    key = 'podcasts/keywords/' + id_generator() + '.json'
-    # store retval to s3 
-    response = s3_client.put_object(Body=json.dumps(retval, indent=2), Bucket=bucket, Key=key)
-
-    print("Return Value: " + json.dumps(retval, indent=2))
+    key = artifact_key('podcasts/keywords/')
+    # store retval to s3
+    print("Tagging: " + json.dumps(report))
+    record('gazetteer', 0, items=report['gazetteer_tagged'])
+    record('boilerplate', 0, items=report['boilerplate'])
+    if COMPREHEND_MODE == 'BATCH':
+        write_keywords(bucket, key, retval, comprehend='pending', tagging=report)
+    else:
+        write_keywords(bucket, key, retval, tagging=report)
+    if learn and learned:
+        update_feed_entities(bucket, event['sourceFeed'], learned)
+    if learn and boilerplate is not None and boilerplate.add_episode(event['podcastUrl'], signatures):
+        write_index(bucket, event['sourceFeed'], boilerplate)
+
+    print("Return Value: {} paragraphs, first: {}".format(len(retval), summarize(retval[:1])))
 
     # Return the bucket and key of the transcription / comprehend result.
     return {"bucket": bucket, "key": key}
 
 
-# Run comprehend and extract the key phrases from the podcast.
+# The paragraph as it is stored, the last paragraph of the episode has no gap, reason or length
+def paragraph_record(paragraph, tags, entities, repeated):
+    retval = {
+        "startTime": paragraph['startTime'],
+        "endTime": paragraph['endTime'],
+        "text": paragraph['text']
+    }
+    if 'gap' in paragraph:
+        retval['gap'] = paragraph['gap']
+    retval['tags'] = tags
+    retval['entities'] = entities
+    retval['boilerplate'] = repeated
+    retval['offsets'] = encode_offsets(paragraph['timedata'])
+    if 'reason' in paragraph:
+        retval['reason'] = paragraph['reason']
+    retval['speaker'] = paragraph['speaker']
+    if 'len' in paragraph:
+        retval['len'] = paragraph['len']
+    return retval
+
+
+# Tags the paragraphs of an episode. Paragraphs that are boilerplate of the feed aren't tagged.
+# Paragraphs with gazetteer hits are tagged from the gazetteer, except for a sample of them that also
+# goes to comprehend to measure the agreement; the rest go to comprehend, and the entities it finds
+# there are learned for the next episodes of the feed.
+class ParagraphTagger(object):
+    # Counters that add up over the shards of an episode
+    COUNTERS = ('paragraphs', 'boilerplate_paragraphs', 'gazetteer_tagged', 'comprehend_calls', 'sampled',
+                'gazetteer_tags', 'confirmed', 'known_detected', 'known_found')
+
+    def __init__(self, gazetteer, sample_rate, seed=None, boilerplate=None):
+        self.gazetteer = gazetteer
+        self.boilerplate = boilerplate
+        self.signatures = []
+        self.boilerplate_paragraphs = 0
+        self.sample_rate = sample_rate
+        self.seed = seed
+        self.learned = []
+        self.paragraphs = 0
+        self.gazetteer_tagged = 0
+        self.comprehend_calls = 0
+        self.sampled = 0
+        # Agreement over the sampled paragraphs: gazetteer tags that comprehend also found, and known
+        # names found by comprehend that the gazetteer also found
+        self.gazetteer_tags = 0
+        self.confirmed = 0
+        self.known_detected = 0
+        self.known_found = 0
+
+    # Returns the tags and entities of the paragraph, and the id of the boilerplate it repeats
+    def tag(self, text, timedata):
+        self.paragraphs += 1
+        if self.boilerplate is not None:
+            sig = signature(text)
+            self.signatures.append((text, sig))
+            entry = self.boilerplate.boilerplate(sig)
+            if entry is not None:
+                self.boilerplate_paragraphs += 1
+                return [], [], entry['id']
+        if COMPREHEND_MODE == 'BATCH':
+            return [], [], None
+        offsets = [position for position, start_time in timedata]
+        times = [float(start_time) for position, start_time in timedata]
+
+        hits = self.gazetteer.find(text) if self.gazetteer else []
+        if hits and not self.in_sample(text, timedata):
+            self.gazetteer_tagged += 1
+            return paragraph_entities(hits, offsets, times) + (None,)
+
+        detected = run_comprehend(text)
+        tags, entities = paragraph_entities(detected, offsets, times)
+        self.comprehend_calls += 1
+        if self.gazetteer is not None:
+            if hits:
+                self.sampled += 1
+                self.compare(hits, entities)
+            self.learned.extend({"text": entity['Text'], "type": entity['Type'], "score": entity['Score']}
+                                for entity in detected if entity['Type'] in entityTypes and
+                                entity['Text'] not in self.gazetteer and learnable(entity['Text'], entity['Score']))
+        return tags, entities, None
+
+    # Whether the paragraph is in the sample that goes to comprehend anyway. Decided by a hash of the
+    # paragraph rather than a random sequence, so the same paragraphs are sampled whether the episode
+    # is processed in one piece or in shards.
+    def in_sample(self, text, timedata):
+        start_time = timedata[0][1] if timedata else ''
+        value = u'{}|{}|{}'.format(self.seed, start_time, text).encode('utf-8')
+        return int(hashlib.sha1(value).hexdigest()[:8], 16) / float(0x100000000) < self.sample_rate
+
+    def compare(self, hits, entities):
+        found = set(normalize(hit['Text']) for hit in hits)
+        detected = set(normalize(entity['text']) for entity in entities)
+        known = set(name for name in detected if name in self.gazetteer.entities)
+        self.gazetteer_tags += len(found)
+        self.confirmed += len(found & detected)
+        self.known_detected += len(known)
+        self.known_found += len(known & found)
+
+    def counts(self):
+        return dict((name, getattr(self, name)) for name in self.COUNTERS)
+
+    def report(self):
+        return tagging_report(self.counts(), len(self.gazetteer) if self.gazetteer else 0)
+
+
+def tagging_report(counts, gazetteer_names):
+    paragraphs = counts['paragraphs']
+    return {
+        "paragraphs": paragraphs,
+        "boilerplate": counts['boilerplate_paragraphs'],
+        "gazetteer_names": gazetteer_names,
+        "gazetteer_tagged": counts['gazetteer_tagged'],
+        "comprehend_calls": counts['comprehend_calls'],
+        "call_reduction": round(1 - counts['comprehend_calls'] / float(paragraphs), 3) if paragraphs else 0,
+        "sampled": counts['sampled'],
+        "precision": round(counts['confirmed'] / float(counts['gazetteer_tags']), 3)
+        if counts['gazetteer_tags'] else None,
+        "recall": round(counts['known_found'] / float(counts['known_detected']), 3)
+        if counts['known_detected'] else None
+    }
+
+
+# Run comprehend and return the entities it detects in the paragraph
 def run_comprehend(text):
     response = client.detect_entities(Text=text, LanguageCode='en')
+    return response["Entities"]
+
+
+# Keeps the entities of the types we tag paragraphs with and links each to the time it is spoken. The
+# BeginOffset of each entity is mapped through the timedata of the paragraph to the time.
+def paragraph_entities(detected_entities, offsets, times):
     keywords = []
-    for i in range(len(response["Entities"])):
-        entity = response["Entities"][i]
+    entities = []
+    for i in range(len(detected_entities)):
+        entity = detected_entities[i]
         if entity['Type'] in entityTypes:
             keywords.append(entity["Text"])
+            entities.append({
+                "text": entity["Text"],
+                "type": entity["Type"],
+                "time": offset_to_time(offsets, times, entity["BeginOffset"])
+            })
 
-    return keywords
-
-
-# uses the offset in the string and the timedata mapping to convert the string index to a time value from
-# the audio file.
-def convertPositionToTime(offset, timedata):
-    timeposition = ""
-    for i in range(len(timedata)):
-        if int(timedata[i]["position"]) <= int(offset):
-            timeposition = timedata[i]["startTime"]
+    return keywords, entities
 
-    return timeposition
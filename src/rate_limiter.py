@@ -0,0 +1,254 @@
+from __future__ import print_function
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from instrumentation import record
+
+# Client side rate limiting for the Comprehend and Transcribe APIs.
+#
+# Every rate limited operation has a token bucket that refills at the TPS the account allows for it,
+# and a call waits for a token before it is sent, so the functions together stay at the limit instead
+# of running into it, getting throttled, and backing off all at once.
+#
+# Without RATE_LIMIT_TABLE each container has its own buckets, which only smooths the calls of one
+# invocation. With RATE_LIMIT_TABLE the bucket state lives in a DynamoDB item per operation that all
+# the concurrent invocations take their tokens from, with a conditional write so two invocations never
+# take the same token.
+#
+# Calls that are throttled anyway (a limit set too high, other clients in the account), fail on the
+# service side or don't get through to it (connection and read timeouts) are retried with full jitter
+# exponential backoff. This is the only retry policy of the limited clients: botocore doesn't retry
+# their calls. Transcribe's LimitExceededException (too many jobs running at once) is not retried here,
+# the state machine retries the step that starts the job instead.
+
+logger = logging.getLogger()
+
+# Requests per second per operation. Overridden or extended with a JSON object in RATE_LIMITS, e.g.
+# RATE_LIMITS='{"comprehend.DetectEntities": 50}'
+DEFAULT_RATE_LIMITS = {
+    'comprehend.DetectEntities': 20,
+    'comprehend.DetectKeyPhrases': 20,
+    'comprehend.BatchDetectEntities': 10,
+    'comprehend.BatchDetectKeyPhrases': 10,
+    'comprehend.BatchDetectSentiment': 10,
+    'transcribe.StartTranscriptionJob': 10,
+    'transcribe.GetTranscriptionJob': 10,
+    'transcribe.CreateVocabulary': 5,
+    'transcribe.GetVocabulary': 10,
+    'transcribe.DeleteVocabulary': 5
+}
+
+RATE_LIMITS = dict(DEFAULT_RATE_LIMITS, **json.loads(os.getenv('RATE_LIMITS', default='{}')))
+
+RATE_LIMITING_ENABLED = os.getenv('RATE_LIMITING', default='TRUE') == 'TRUE'
+
+# DynamoDB table (hash key "api") that holds the shared buckets
+RATE_LIMIT_TABLE = os.getenv('RATE_LIMIT_TABLE')
+
+# Attempts of a call that keeps getting throttled, and the bounds of the backoff between them
+RATE_LIMIT_ATTEMPTS = int(os.getenv('RATE_LIMIT_ATTEMPTS', default='6'))
+RETRY_BASE_SECONDS = 0.2
+RETRY_CAP_SECONDS = 10.0
+
+# Bounds of the backoff between attempts to write a shared bucket that another invocation just updated
+CONFLICT_BASE_SECONDS = 0.01
+CONFLICT_CAP_SECONDS = 0.5
+
+THROTTLING_ERRORS = ['ThrottlingException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                     'RequestLimitExceeded', 'Throttling']
+
+# The limited clients don't retry on their own, so the limiter also retries the transient errors
+TRANSIENT_ERRORS = ['InternalServerException', 'InternalFailure', 'ServiceUnavailableException',
+                    'ServiceUnavailable']
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    # Takes a token if there is one. Returns the seconds until the next token otherwise.
+    def take(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # Blocks until a token is available. Returns the seconds spent waiting.
+    def acquire(self):
+        waited = 0.0
+        while True:
+            wait = self.take()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+# Keeps the bucket of every operation in a DynamoDB item: {"api": ..., "tokens": ..., "updated": ...}
+class DynamoDBTokenStore(object):
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client
+
+    def dynamodb(self):
+        if self.client is None:
+            from aws_clients import get_client
+            self.client = get_client('dynamodb')
+        return self.client
+
+    # Takes a token from the shared bucket. Returns the seconds until the next token when there is
+    # none, the write is retried after a short random backoff when another invocation updated the bucket
+    # in the meantime, so the invocations that collided don't collide again.
+    def take(self, api, rate, burst):
+        dynamodb = self.dynamodb()
+        conflicts = 0
+        while True:
+            item = dynamodb.get_item(TableName=self.table, Key={'api': {'S': api}}, ConsistentRead=True).get('Item')
+            now = time.time()
+            if item is None:
+                tokens = burst
+                condition = {'ConditionExpression': 'attribute_not_exists(api)'}
+            else:
+                previous = item['updated']['N']
+                tokens = min(burst, float(item['tokens']['N']) + (now - float(previous)) * rate)
+                condition = {'ConditionExpression': 'updated = :previous',
+                             'ExpressionAttributeValues': {':previous': {'N': previous}}}
+            if tokens < 1:
+                return (1 - tokens) / rate
+            values = condition.setdefault('ExpressionAttributeValues', {})
+            values[':tokens'] = {'N': repr(tokens - 1)}
+            values[':now'] = {'N': repr(now)}
+            try:
+                dynamodb.update_item(TableName=self.table, Key={'api': {'S': api}},
+                                     UpdateExpression='SET tokens = :tokens, updated = :now', **condition)
+                return 0
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                time.sleep(backoff(conflicts, CONFLICT_BASE_SECONDS, CONFLICT_CAP_SECONDS))
+                conflicts += 1
+
+
+# A token bucket whose state is kept in a store shared with the other invocations
+class SharedTokenBucket(object):
+    def __init__(self, store, api, rate, burst=None):
+        self.store = store
+        self.api = api
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            wait = self.store.take(self.api, self.rate, self.burst)
+            if not wait:
+                return waited
+            # Spread the invocations that wait for the same token
+            wait *= random.uniform(1, 1.5)
+            time.sleep(wait)
+            waited += wait
+
+
+def error_code(e):
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+    return None
+
+
+# Whether the call failed before getting an answer from the service: a connection that couldn't be
+# opened, or was closed or timed out before the response came back
+def is_connection_error(e):
+    from botocore.exceptions import ConnectionError as BotoConnectionError, HTTPClientError
+    return isinstance(e, (BotoConnectionError, HTTPClientError))
+
+
+# Sleep before the next attempt: a random time up to the exponential backoff (full jitter), so the
+# throttled callers don't all come back at the same time
+def backoff(attempt, base=RETRY_BASE_SECONDS, cap=RETRY_CAP_SECONDS):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Calls the operation once a token is available, retrying it when it is throttled, fails on the
+# service side or doesn't reach it
+def call_with_limit(bucket, api, method, *args, **kwargs):
+    waited = 0.0
+    for attempt in range(RATE_LIMIT_ATTEMPTS):
+        waited += bucket.acquire()
+        try:
+            result = method(*args, **kwargs)
+            record('ratelimit.' + api, waited, retries=attempt)
+            return result
+        except Exception as e:
+            code = error_code(e)
+            retry = code in THROTTLING_ERRORS + TRANSIENT_ERRORS if code else is_connection_error(e)
+            code = code or type(e).__name__
+            if not retry or attempt == RATE_LIMIT_ATTEMPTS - 1:
+                record('ratelimit.' + api, waited, retries=attempt, error=True)
+                raise
+            sleep = backoff(attempt)
+            logger.info("{} failed with {}, retrying in {:.2f}s".format(api, code, sleep))
+            time.sleep(sleep)
+            waited += sleep
+
+
+class RateLimitedClient(object):
+    def __init__(self, client, buckets):
+        self._client = client
+        self._buckets = buckets
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name not in self._buckets:
+            return attribute
+        api, bucket = self._buckets[name]
+
+        def limited(*args, **kwargs):
+            return call_with_limit(bucket, api, attribute, *args, **kwargs)
+        return limited
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_store = None
+
+
+# The buckets are shared by all the clients of the container
+def get_bucket(api):
+    global _store
+    with _buckets_lock:
+        if api not in _buckets:
+            if RATE_LIMIT_TABLE:
+                if _store is None:
+                    _store = DynamoDBTokenStore(RATE_LIMIT_TABLE)
+                _buckets[api] = SharedTokenBucket(_store, api, RATE_LIMITS[api])
+            else:
+                _buckets[api] = TokenBucket(RATE_LIMITS[api])
+        return _buckets[api]
+
+
+def is_limited(service_name):
+    return RATE_LIMITING_ENABLED and any(api.startswith(service_name + '.') for api in RATE_LIMITS)
+
+
+# Wraps the client so the rate limited operations of its service wait for a token. Clients of other
+# services are returned as they are.
+def limit_client(client, service_name):
+    if not is_limited(service_name):
+        return client
+    buckets = {}
+    for method, operation in client.meta.method_to_api_mapping.items():
+        api = service_name + '.' + operation
+        if api in RATE_LIMITS:
+            buckets[method] = (api, get_bucket(api))
+    return RateLimitedClient(client, buckets)
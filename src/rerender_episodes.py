@@ -0,0 +1,179 @@
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from artifact_io import read_json, read_raw_transcript
+from aws_clients import get_client
+from backfill_elasticsearch import Checkpoint, list_manifests, load_episode
+from es_bulk import bulk_index, detect_feed_routing, episode_partitions, unsealed_partitions
+from es_client import get_es_client, latency_histogram
+from es_documents import ENTITY_ROLLUP_INDEX, KEYWORDS_INDEX, MANIFEST_PREFIX, routing_params, routed_indices, \
+    set_routed_indices, stale_paragraphs_query, stale_rollups_query
+from vocabulary_cache import read_feed_mapping
+
+# Processes stored episodes again with the current vocabulary mapping, paragraph rules and tagging,
+# without transcribing them again.
+#
+# The episode state machine keeps the output of Amazon Transcribe of every episode under
+# podcasts/raw/ (see process_transcription_paragraph). For every episode manifest, the stored transcript is
+# run through the same segmentation, mapping and tagging as the processing lambdas, in a local process
+# pool. The new keywords and transcript artifacts replace the old ones in the manifest, and the
+# episode is indexed again, dropping the paragraphs of the old segmentation. Episodes processed
+# before the transcripts were kept are skipped. The episodes take the latest vocabulary mapping of
+# their feed, the one they were processed with when the feed has none recorded.
+#
+# The feeds don't learn from the episodes a second time: the gazetteer and the boilerplate index are
+# used but not updated. With COMPREHEND_MODE=BATCH in the environment the paragraphs are stored
+# pending, to be tagged by comprehend_batch_job instead of a comprehend call per paragraph.
+#
+#   python rerender_episodes.py --bucket my-bucket --endpoint search-podcasts-xxxx.es.amazonaws.com
+#   python rerender_episodes.py --bucket my-bucket --feed https://example.com/feed.xml --no-index
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Runs in the worker processes. Processes the stored transcript of one episode, points its manifest
+# at the new artifacts and returns the index actions for it, or None for the actions when the episode
+# is skipped.
+def render_episode(bucket, manifest_key, feed, audio_offset):
+    # process_transcription_full_text reads the bucket at import time
+    os.environ.setdefault('BUCKET_NAME', bucket)
+    import process_transcription_full_text as full_text
+    import process_transcription_paragraph as paragraph
+
+    manifest = read_json(bucket, manifest_key)
+    if feed and manifest.get('sourceFeed') != feed:
+        return manifest_key, None, 'other feed'
+    try:
+        results = read_raw_transcript(bucket, manifest['podcastUrl'])['results']
+    except get_client('s3').exceptions.NoSuchKey:
+        return manifest_key, None, 'no raw transcript'
+
+    mapping = read_feed_mapping(bucket, manifest['sourceFeed']) if manifest.get('sourceFeed') else None
+    if mapping is not None:
+        manifest['vocabularyInfo'] = dict(manifest.get('vocabularyInfo', {}), mapping=mapping)
+
+    previous = manifest['processedTranscription']
+    manifest['processedTranscription'] = [
+        paragraph.process_transcript(bucket, manifest, results, learn=False),
+        full_text.process_results(results, full_text.read_custom_vocabs(manifest.get('vocabularyInfo', {})))
+    ]
+    s3_client = get_client('s3')
+    s3_client.put_object(Body=json.dumps(manifest, indent=2), Bucket=bucket, Key=manifest_key)
+    for location in previous:
+        s3_client.delete_object(Bucket=location['bucket'], Key=location['key'])
+
+    key, actions = load_episode(bucket, manifest_key, audio_offset)
+    return manifest_key, actions, 'rendered'
+
+
+# Indexes the actions of an episode, then removes the paragraphs of its old segmentation and its counts
+# of the entities it doesn't mention anymore
+def reindex_episode(es, actions):
+    podcast_url = actions[0]['_id']
+    feed_url = actions[0]['_source']['source_feed']
+    paragraphs = [action for action in actions if action['_index'].startswith(KEYWORDS_INDEX + '-')]
+    ids = [action['_id'] for action in paragraphs]
+    routing = routing_params(feed_url, KEYWORDS_INDEX)
+    # The partitions of old episodes are sealed
+    indexed_partitions = [action['_index'] for action in paragraphs]
+    with unsealed_partitions(es, indexed_partitions + episode_partitions(es, podcast_url, routing)):
+        stats = bulk_index(es, actions)
+        if stats.errors:
+            return stats
+        res = es.delete_by_query(index=KEYWORDS_INDEX,
+                                 body=stale_paragraphs_query(podcast_url, ids, indexed_partitions),
+                                 conflicts='proceed', **routing)
+    rollup_ids = [action['_id'] for action in actions if action['_index'] == ENTITY_ROLLUP_INDEX]
+    rollups = es.update_by_query(index=ENTITY_ROLLUP_INDEX, body=stale_rollups_query(podcast_url, rollup_ids),
+                                 conflicts='proceed', **routing_params(feed_url, ENTITY_ROLLUP_INDEX))
+    logger.info("reindexed {}: {} documents, removed {} stale paragraphs and {} stale entity counts".format(
+        podcast_url, stats.indexed, res['deleted'], rollups['updated'] + rollups['deleted']))
+    return stats
+
+
+def rerender(es, bucket, keys, checkpoint, workers, batch_size, feed, audio_offset):
+    totals = {"episodes": 0, "skipped": 0, "failed_episodes": 0, "docs": 0}
+    start = time.time()
+    if es is not None:
+        detect_feed_routing(es)
+    # Spawned rather than forked, so the workers don't share the connections of the clients of this process.
+    # They route the documents the way the indices read here require.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=set_routed_indices, initargs=(routed_indices(),)) as pool:
+        for batch_number, first in enumerate(range(0, len(keys), batch_size)):
+            batch = {"batch": batch_number, "episodes": 0, "skipped": 0, "failed_episodes": 0, "docs": 0}
+            batch_start = time.time()
+            futures = [pool.submit(render_episode, bucket, key, feed, audio_offset)
+                       for key in keys[first:first + batch_size]]
+            for future in as_completed(futures):
+                try:
+                    key, actions, outcome = future.result()
+                except Exception as e:
+                    logger.exception("unable to render episode: " + str(e))
+                    batch['failed_episodes'] += 1
+                    continue
+                if actions is None:
+                    logger.info("skipped {}: {}".format(key, outcome))
+                    batch['skipped'] += 1
+                    continue
+                if es is not None:
+                    stats = reindex_episode(es, actions)
+                    if stats.errors:
+                        logger.error("{} documents of {} failed to index".format(len(stats.errors), key))
+                        batch['failed_episodes'] += 1
+                        continue
+                    batch['docs'] += stats.indexed
+                checkpoint.mark_done(key)
+                batch['episodes'] += 1
+
+            elapsed = time.time() - batch_start
+            batch['seconds'] = round(elapsed, 1)
+            batch['episodes_per_minute'] = round(batch['episodes'] / elapsed * 60, 1) if elapsed else 0
+            logger.info("batch: " + json.dumps(batch))
+            for name in totals:
+                totals[name] += batch[name]
+
+    elapsed = time.time() - start
+    totals['elapsed'] = round(elapsed, 1)
+    totals['episodes_per_minute'] = round(totals['episodes'] / elapsed * 60, 1) if elapsed else 0
+    logger.info("rerender complete: " + json.dumps(totals))
+    if es is not None:
+        latency_histogram.log_summary()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process stored transcripts again and reindex the episodes')
+    parser.add_argument('--bucket', required=True, help='bucket the episode state machine writes to')
+    parser.add_argument('--endpoint', default=os.getenv('ES_DOMAIN'), help='Elasticsearch domain endpoint')
+    parser.add_argument('--prefix', default=MANIFEST_PREFIX, help='prefix of the episode manifests')
+    parser.add_argument('--feed', help='only the episodes of this feed')
+    parser.add_argument('--max-episodes', type=int, help='stop after this many episodes')
+    parser.add_argument('--checkpoint', default='rerender.checkpoint', help='file that records finished episodes')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--batch-size', type=int, default=50, help='episodes per reported batch')
+    parser.add_argument('--no-index', action='store_true', help='only write the artifacts, don\'t reindex')
+    parser.add_argument('--audio-offset', type=int, default=int(os.getenv('AUDIO_OFFSET', default='1')),
+                        help='seconds before a paragraph that its deep link starts')
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    keys = [key for key in list_manifests(args.bucket, args.prefix) if key not in checkpoint.done]
+    if args.max_episodes:
+        keys = keys[:args.max_episodes]
+    logger.info("{} episodes to render, {} already done".format(len(keys), len(checkpoint.done)))
+
+    es = None if args.no_index else get_es_client(args.endpoint)
+    rerender(es, args.bucket, keys, checkpoint, args.workers, args.batch_size, args.feed, args.audio_offset)
+
+
+if __name__ == '__main__':
+    main()
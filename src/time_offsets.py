@@ -0,0 +1,47 @@
+from __future__ import print_function
+from bisect import bisect_right
+
+# Maps character offsets in a paragraph to the time in the audio the word at that offset is spoken.
+#
+# Each paragraph carries a compact, delta encoded list of (character offset, start time) pairs, one
+# per word. Offsets are in characters and times in milliseconds, both stored as the difference to the
+# previous word, which keeps the numbers small in the JSON artifacts and the index.
+#
+#   {"o": [0, 4, 6, ...], "t": [630400, 410, 250, ...]}
+
+
+def encode_offsets(timedata):
+    offsets = []
+    times = []
+    previous_offset = 0
+    previous_time = 0
+    for position, start_time in timedata:
+        time_ms = int(round(float(start_time) * 1000))
+        offsets.append(position - previous_offset)
+        times.append(time_ms - previous_time)
+        previous_offset = position
+        previous_time = time_ms
+    return {"o": offsets, "t": times}
+
+
+# Returns the character offsets and the start times in seconds of the words
+def decode_offsets(encoded):
+    offsets = []
+    times = []
+    position = 0
+    time_ms = 0
+    for offset_delta, time_delta in zip(encoded["o"], encoded["t"]):
+        position += offset_delta
+        time_ms += time_delta
+        offsets.append(position)
+        times.append(time_ms / 1000.0)
+    return offsets, times
+
+
+# Returns the time that the word containing the character offset starts, or None if the offset
+# comes before the first word.
+def offset_to_time(offsets, times, offset):
+    i = bisect_right(offsets, int(offset)) - 1
+    if i < 0:
+        return None
+    return times[i]
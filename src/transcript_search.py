@@ -0,0 +1,348 @@
+from __future__ import print_function
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from es_bulk import detect_feed_routing
+from es_client import get_es_client, LatencyHistogram
+from es_documents import ENTITY_ROLLUP_INDEX, FULL_EPISODE_INDEX, KEYWORDS_INDEX, feed_routing, routing_params
+from time_offsets import decode_offsets, offset_to_time
+from instrumentation import instrumented_handler
+
+# Programmatic search over the paragraphs and episodes indices. Returns ranked paragraph hits with
+# a deep link to the moment the matched words are spoken.
+#
+# The most mentioned entities are read from the precomputed counts of the entity rollup index.
+#
+# A search within a feed is routed to the shard that holds the feed, when the index is routed (see
+# es_documents.FEED_ROUTING).
+#
+# Results are kept in an LRU cache with a time to live, and identical queries that arrive while the
+# same query is already running wait for its result instead of hitting the domain again.
+
+# Log level
+logging.basicConfig()
+logger = logging.getLogger()
+if os.getenv('LOG_LEVEL') == 'DEBUG':
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', default='1024'))
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', default='60'))
+
+# Number of seconds before the matched word that the deep link starts
+AUDIO_OFFSET = int(os.getenv('AUDIO_OFFSET', default='1'))
+
+HIGHLIGHT_PATTERN = re.compile(r'<em>(.+?)</em>')
+HIGHLIGHT_TAGS = re.compile(r'</?em>')
+
+
+class TTLCache(object):
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TranscriptSearch(object):
+    def __init__(self, es, paragraph_index=KEYWORDS_INDEX, episode_index=FULL_EPISODE_INDEX,
+                 cache=None, audio_offset=AUDIO_OFFSET, rollup_index=ENTITY_ROLLUP_INDEX):
+        self.es = es
+        self.paragraph_index = paragraph_index
+        self.episode_index = episode_index
+        self.rollup_index = rollup_index
+        self.cache = cache if cache is not None else TTLCache()
+        self.audio_offset = audio_offset
+        self.latency = LatencyHistogram()
+        self.counters = {"cache_hits": 0, "cache_misses": 0, "coalesced": 0}
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def search(self, query, feed=None, speaker=None, tags=None, date_from=None, date_to=None, size=10, start=0):
+        params = {"query": query, "feed": feed, "speaker": speaker, "tags": sorted(tags) if tags else None,
+                  "date_from": date_from, "date_to": date_to, "size": size, "start": start}
+        key = json.dumps(params, sort_keys=True)
+        begin = time.time()
+
+        result = self.cache.get(key)
+        if result is not None:
+            self._count('cache_hits')
+            self.latency.record('cached', time.time() - begin)
+            return result
+
+        # Only the first caller of an identical query runs it, everybody else waits for its result
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+        if not leader:
+            self._count('coalesced')
+            result = future.result()
+            self.latency.record('coalesced', time.time() - begin)
+            return result
+
+        self._count('cache_misses')
+        try:
+            result = self._run(**params)
+            self.cache.put(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            self.latency.record('search', time.time() - begin)
+
+    # The entities mentioned in the most paragraphs, summed over the rollup documents of the feeds and
+    # days in range instead of aggregating the tags of the paragraphs
+    def top_entities(self, feed=None, entity_type=None, date_from=None, date_to=None, size=20):
+        params = {"feed": feed, "entity_type": entity_type, "date_from": date_from, "date_to": date_to,
+                  "size": size}
+        key = json.dumps(dict(params, rollup=True), sort_keys=True)
+        begin = time.time()
+        result = self.cache.get(key)
+        if result is not None:
+            self._count('cache_hits')
+            self.latency.record('cached', time.time() - begin)
+            return result
+
+        self._count('cache_misses')
+        filters = []
+        if feed:
+            filters.append({"term": {"source_feed": feed}})
+        if entity_type:
+            filters.append({"term": {"entity_type": entity_type}})
+        if date_from or date_to:
+            date_range = {"format": "yyyy:MM:dd HH:mm:ss"}
+            if date_from:
+                date_range['gte'] = date_from
+            if date_to:
+                date_range['lte'] = date_to
+            filters.append({"range": {"day": date_range}})
+        body = {
+            "size": 0,
+            "query": {"bool": {"filter": filters}},
+            "aggs": {"entities": {
+                "terms": {"field": "entity", "size": size, "order": {"paragraphs": "desc"}},
+                "aggs": {
+                    "paragraphs": {"sum": {"field": "paragraphs"}},
+                    "mentions": {"sum": {"field": "mentions"}},
+                    "episodes": {"sum": {"field": "episodes"}},
+                    "type": {"terms": {"field": "entity_type", "size": 1}}
+                }
+            }}
+        }
+        response = self.es.search(index=self.rollup_index, body=body, **routing_params(feed, self.rollup_index))
+        result = {"entities": [{
+            "entity": bucket['key'],
+            "type": bucket['type']['buckets'][0]['key'] if bucket['type']['buckets'] else None,
+            "paragraphs": int(bucket['paragraphs']['value']),
+            "mentions": int(bucket['mentions']['value']),
+            "episodes": int(bucket['episodes']['value'])
+        } for bucket in response['aggregations']['entities']['buckets']]}
+        self.cache.put(key, result)
+        self.latency.record('top_entities', time.time() - begin)
+        return result
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+        metrics['latency'] = self.latency.summary()
+        return metrics
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _run(self, query, feed, speaker, tags, date_from, date_to, size, start):
+        body = {
+            "from": start,
+            "size": size,
+            "query": {"bool": {"must": [{"match": {"text": query}}], "filter": build_filters(
+                feed, speaker, tags, date_from, date_to)}},
+            "highlight": {"fields": {"text": {"number_of_fragments": 1}}},
+            "_source": ["PodcastName", "Episode", "episode_url", "source_feed", "url", "text", "tags", "speaker",
+                        "startTime", "published_time", "offsets"]
+        }
+        response = self.es.search(index=self.paragraph_index, body=body,
+                                  **routing_params(feed, self.paragraph_index))
+
+        hits = [self._to_hit(hit) for hit in response['hits']['hits']]
+        self._add_episodes(hits)
+        total = response['hits']['total']
+        return {
+            "total": total['value'] if isinstance(total, dict) else total,
+            "hits": hits
+        }
+
+    def _to_hit(self, hit):
+        source = hit['_source']
+        highlight = hit.get('highlight', {}).get('text', [])
+        return {
+            "score": hit['_score'],
+            "podcast": source.get('PodcastName'),
+            "episode": source.get('Episode'),
+            "episode_url": source.get('episode_url'),
+            "source_feed": source.get('source_feed'),
+            "speaker": source.get('speaker'),
+            "tags": source.get('tags', []),
+            "text": source.get('text'),
+            "highlight": highlight[0] if highlight else None,
+            "url": self.deep_link(source, highlight)
+        }
+
+    # Links to the first highlighted word if the paragraph has word offsets, otherwise to the start of
+    # the paragraph.
+    def deep_link(self, source, highlight):
+        if not source.get('offsets') or not source.get('episode_url') or not highlight:
+            return source.get('url')
+        position = highlight_position(source['text'], highlight[0])
+        if position < 0:
+            return source['url']
+        offsets, times = decode_offsets(source['offsets'])
+        spoken = offset_to_time(offsets, times, position)
+        if spoken is None:
+            return source['url']
+        return source['episode_url'] + "#t=" + str(max(spoken - self.audio_offset, 0))
+
+    # The episodes are looked up by id, each with the routing of its feed
+    def _add_episodes(self, hits):
+        feeds = dict((hit['episode_url'], hit['source_feed']) for hit in hits if hit['episode_url'])
+        if not feeds:
+            return
+        docs = []
+        for url in sorted(feeds):
+            doc = {"_id": url}
+            routing = feed_routing(feeds[url], self.episode_index)
+            if routing is not None:
+                doc["routing"] = routing
+            docs.append(doc)
+        response = self.es.mget(index=self.episode_index, body={"docs": docs},
+                                _source=["title", "summary", "published_time", "source_feed"])
+        episodes = dict((doc['_id'], doc['_source']) for doc in response['docs'] if doc.get('found'))
+        for hit in hits:
+            episode = episodes.get(hit['episode_url'])
+            if episode is not None:
+                hit['published_time'] = episode.get('published_time')
+                hit['source_feed'] = episode.get('source_feed')
+                hit['summary'] = episode.get('summary')
+
+
+# Where the first highlighted word of the fragment is in the text. The fragment is looked up in the
+# text with the tags removed, which places the word even when it appears earlier in the paragraph
+# inside another word or on its own. When the fragment can't be found the first occurrence of the word
+# as a whole word is used, so "art" doesn't link to "start". Returns -1 when neither is found.
+def highlight_position(text, fragment):
+    match = HIGHLIGHT_PATTERN.search(fragment)
+    if match is None:
+        return -1
+    start = text.find(HIGHLIGHT_TAGS.sub('', fragment))
+    if start >= 0:
+        return start + len(HIGHLIGHT_TAGS.sub('', fragment[:match.start()]))
+    word = re.search(r'(?<!\w)' + re.escape(match.group(1)) + r'(?!\w)', text, re.IGNORECASE | re.UNICODE)
+    return word.start() if word else -1
+
+
+def build_filters(feed, speaker, tags, date_from, date_to):
+    filters = []
+    if feed:
+        filters.append({"term": {"source_feed": feed}})
+    if speaker:
+        filters.append({"term": {"speaker": speaker}})
+    if tags:
+        filters.append({"terms": {"tags": tags}})
+    if date_from or date_to:
+        date_range = {}
+        if date_from:
+            date_range['gte'] = date_from
+        if date_to:
+            date_range['lte'] = date_to
+        filters.append({"range": {"published_time": date_range}})
+    return filters
+
+
+_searcher = None
+
+
+def get_searcher():
+    global _searcher
+    if _searcher is None:
+        _searcher = TranscriptSearch(get_es_client())
+    return _searcher
+
+
+# Entry point for the lambda function
+# {
+#  "query": "natural language processing",
+#  "feed": "optional rss feed url",
+#  "speaker": "optional speaker label",
+#  "tags": ["optional", "tags"],
+#  "dateFrom": "optional yyyy:MM:dd HH:mm:ss",
+#  "dateTo": "optional yyyy:MM:dd HH:mm:ss",
+#  "size": 10,
+#  "from": 0
+# }
+#
+# or for the most mentioned entities
+# {
+#  "topEntities": {"feed": "optional", "entityType": "optional, like PERSON", "dateFrom": "optional",
+#                  "dateTo": "optional", "size": 20}
+# }
+@instrumented_handler('search_transcripts')
+def lambda_handler(event, context):
+    searcher = get_searcher()
+    detect_feed_routing(searcher.es)
+    if 'topEntities' in event:
+        request = event['topEntities']
+        result = searcher.top_entities(feed=request.get('feed'),
+                                       entity_type=request.get('entityType'),
+                                       date_from=request.get('dateFrom'),
+                                       date_to=request.get('dateTo'),
+                                       size=int(request.get('size', 20)))
+        logger.info("search metrics: " + json.dumps(searcher.metrics()))
+        return result
+    result = searcher.search(event['query'],
+                             feed=event.get('feed'),
+                             speaker=event.get('speaker'),
+                             tags=event.get('tags'),
+                             date_from=event.get('dateFrom'),
+                             date_to=event.get('dateTo'),
+                             size=int(event.get('size', 10)),
+                             start=int(event.get('from', 0)))
+    logger.info("search metrics: " + json.dumps(searcher.metrics()))
+    return result
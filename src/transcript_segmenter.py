@@ -0,0 +1,432 @@
+from __future__ import print_function
+
+import copy
+import logging
+import os
+import re
+from itertools import islice
+from chunk_packer import ChunkPacker, utf8_length
+
+# The rules that break the items of a transcript up into paragraphs (and comprehend chunks), written
+# as state machines that take one item at a time.
+#
+# process_transcription_paragraph and process_transcription_full_text feed them the whole transcript.
+# The transcripts of very long episodes are cut into shards that are processed by separate
+# invocations: plan_shards runs both machines over the items once, and at every shard boundary
+# stores the state they are in. A shard restores that state and feeds its own items, so the
+# paragraphs and chunks it produces are exactly the ones a single pass produces over those items,
+# and concatenating the shards in order gives the output of a single pass.
+#
+# Pure python so it can be exercised offline against synthetic transcribe outputs.
+
+logger = logging.getLogger()
+
+# The rules can be tuned without transcribing anything again: rerender_episodes applies them to the
+# stored transcripts. The shard planner and the processing lambdas need the same values.
+
+# A pause between two words longer than this many seconds starts a new paragraph
+PARAGRAPH_GAP = float(os.getenv('PARAGRAPH_GAP', default='1.5'))
+
+# Without speaker labels, a pause longer than this starts a new paragraph of the full text, and so
+# does the first sentence end this long after the last break
+FULL_TEXT_PAUSE = float(os.getenv('FULL_TEXT_PAUSE', default='2'))
+FULL_TEXT_PARAGRAPH_SECONDS = float(os.getenv('FULL_TEXT_PARAGRAPH_SECONDS', default='15'))
+
+# Paragraphs are cut before they reach the 5000 byte limit of comprehend
+PARAGRAPH_BYTES = 4900
+
+LONG_PARAGRAPH = "Long paragraph"
+
+commonDict = {'i': 'I'}
+
+
+# The vocabulary mapping, from the words Amazon Transcribe writes for the terms of the custom
+# vocabulary (EC-Two) back to the terms (EC2). Reads like the mapping dict, and replace applies all
+# of it to a word.
+class VocabularyMapping(dict):
+    def __init__(self, mapping):
+        super(VocabularyMapping, self).__init__(mapping)
+        self.replacements = list(mapping.items())
+        # Matches a word that contains any of the words of the mapping. Most words don't, and for
+        # those a single search replaces a replace per entry of the mapping.
+        self.matcher = re.compile('|'.join(re.escape(key) for key in mapping)) if mapping else None
+
+    # Same result as replacing every entry of the mapping in the word, in order: when no entry occurs
+    # in the word, none of the replaces changes it
+    def replace(self, word):
+        if self.matcher is None or self.matcher.search(word) is None:
+            return word
+        for key, value in self.replacements:
+            word = word.replace(key, value)
+        return word
+
+
+# The paragraphs of process_transcription_paragraph: broken out by punctuation, speaker changes, a
+# long pause in the audio, or overall length. Each paragraph keeps the timedata of its words, the
+# (position in the paragraph, start time) of every word. The UTF-8 length of the paragraph is kept up
+# to date as words are added, rather than measured again for every word.
+class ParagraphSegmenter(object):
+    STATE = ('contents', 'contents_bytes', 'timedata', 'prev_end_time', 'prev_start_time', 'new_paragraph',
+             'prev_speaker', 'speaker_index')
+
+    def __init__(self, results, mapping, state=None):
+        self.mapping = mapping if isinstance(mapping, VocabularyMapping) else VocabularyMapping(mapping)
+        self.paragraphs = []
+
+        # Create a mapping of the transitions from one speaker to another
+        self.has_speaker_labels = 'speaker_labels' in results
+        self.speaker_mapping = []
+        if self.has_speaker_labels:
+            for segment in results['speaker_labels']['segments']:
+                self.speaker_mapping.append({
+                    "speakerLabel": segment['speaker_label'],
+                    "endTime": float(segment['end_time'])
+                })
+
+        self.contents = ""
+        self.contents_bytes = 0
+        self.timedata = []
+        self.prev_end_time = -1
+        self.prev_start_time = -1
+        self.new_paragraph = False
+        self.prev_speaker = 'spk_0'
+        self.speaker_index = 0
+        if state is not None:
+            restore(self, state)
+            # States saved before the length was kept
+            if 'contents_bytes' not in state:
+                self.contents_bytes = utf8_length(self.contents)
+
+    def state(self):
+        return snapshot(self)
+
+    # Returns the paragraph the item closes, if it closes one
+    def feed(self, item):
+        paragraph = None
+        reason = ""
+
+        # If the transcription detected the end of a sentence, we'll
+        if item['type'] == 'punctuation':
+            if item["alternatives"][0]["content"] == '.':
+                self.new_paragraph = True
+
+            # Always assume the first guess is right.
+            self.append(item["alternatives"][0]["content"])
+
+        # Add the start time to the string -> timedata
+        if 'start_time' in item:
+            speaker_label = 'spk_0'
+            start_time = float(item["start_time"])
+
+            if self.prev_start_time == -1:
+                self.prev_start_time = start_time
+
+            # gap refers to the amount of time between spoken words
+            gap = start_time - self.prev_end_time
+
+            if self.has_speaker_labels:
+                while self.speaker_index < (len(self.speaker_mapping) - 1) and \
+                        self.speaker_mapping[self.speaker_index + 1]['endTime'] < start_time:
+                    self.speaker_index += 1
+
+                speaker_label = self.speaker_mapping[self.speaker_index]['speakerLabel']
+
+            # Change paragraphs if the speaker changes
+            if speaker_label != self.prev_speaker:
+                self.new_paragraph = True
+                reason = "Speaker Change from " + self.prev_speaker + " to " + speaker_label
+            # the gap exceeds a preset threshold
+            elif gap > PARAGRAPH_GAP:
+                self.new_paragraph = True
+                reason = "Time gap"
+            # There are over 4900 bytes (The limit for comprehend is 5000 bytes of UTF-8)
+            elif self.contents_bytes > PARAGRAPH_BYTES:
+                self.new_paragraph = True
+                reason = LONG_PARAGRAPH
+            else:
+                self.new_paragraph = False
+
+            if self.prev_end_time != -1 and self.new_paragraph:
+                paragraph = {
+                    "startTime": self.prev_start_time,
+                    "endTime": self.prev_end_time,
+                    "text": self.contents,
+                    "gap": gap,
+                    "timedata": self.timedata,
+                    "reason": reason,
+                    "speaker": self.prev_speaker,
+                    "len": len(self.contents)
+                }
+                self.paragraphs.append(paragraph)
+                # Reset the contents and the time mapping
+                self.contents = ""
+                self.contents_bytes = 0
+                self.timedata = []
+                self.prev_end_time = -1
+                self.prev_start_time = -1
+                self.new_paragraph = False
+            else:
+                self.prev_end_time = float(item["end_time"])
+
+            self.prev_speaker = speaker_label
+
+            # If the contents is not empty, prepend a space
+            if self.contents != "":
+                self.append(" ")
+
+            # Always assume the first guess is right.
+            word = item["alternatives"][0]["content"]
+
+            # Map the custom words back to their original text
+            word = self.mapping.replace(word)
+
+            # Remember where the word starts in the paragraph and when it is spoken
+            self.timedata.append((len(self.contents), item["start_time"]))
+            self.append(word)
+
+        return paragraph
+
+    def append(self, text):
+        self.contents += text
+        self.contents_bytes += utf8_length(text)
+
+    # The remaining text is the last paragraph, it has no gap or reason
+    def finish(self):
+        paragraph = {
+            "startTime": self.prev_start_time,
+            "endTime": self.prev_end_time,
+            "text": self.contents,
+            "timedata": self.timedata,
+            "speaker": self.prev_speaker
+        }
+        self.paragraphs.append(paragraph)
+        return paragraph
+
+
+# Statistics of the episode, gathered from the words as the chunker goes over them: the words and
+# their time per speaker, and the time between the words. The talk time of the speakers comes from
+# the speaker_labels segments of Amazon Transcribe, summed in one go at the end. Used to be computed
+# by downloading the transcripts again.
+class EpisodeAnalytics(object):
+    STATE = ('words', 'speech_seconds', 'end_time', 'speaker_words')
+
+    def __init__(self, state=None):
+        self.words = 0
+        self.speech_seconds = 0.0
+        self.end_time = 0.0
+        self.speaker_words = {}
+        if state is not None:
+            restore(self, state)
+
+    def feed(self, item, speaker=None):
+        if item["type"] != "pronunciation":
+            return
+        end_time = float(item['end_time'])
+        self.words += 1
+        self.speech_seconds += end_time - float(item['start_time'])
+        self.end_time = end_time
+        if speaker is not None:
+            self.speaker_words[speaker] = self.speaker_words.get(speaker, 0) + 1
+
+    def report(self, speaker_segments=None):
+        talk_seconds = {}
+        for segment in speaker_segments or []:
+            speaker = segment['speaker']
+            talk_seconds[speaker] = talk_seconds.get(speaker, 0.0) + segment['end_time'] - segment['start_time']
+        total_talk = sum(talk_seconds.values())
+
+        speakers = []
+        for speaker in sorted(set(talk_seconds) | set(self.speaker_words)):
+            seconds = talk_seconds.get(speaker, 0.0)
+            words = self.speaker_words.get(speaker, 0)
+            speakers.append({
+                "speaker": speaker,
+                "talk_seconds": round(seconds, 3),
+                "talk_ratio": round(seconds / total_talk, 4) if total_talk else 0,
+                "words": words,
+                "words_per_minute": round(words * 60 / seconds, 1) if seconds else 0
+            })
+
+        silence = max(self.end_time - self.speech_seconds, 0.0)
+        return {
+            "duration_seconds": round(self.end_time, 3),
+            "speech_seconds": round(self.speech_seconds, 3),
+            "silence_seconds": round(silence, 3),
+            "silence_ratio": round(silence / self.end_time, 4) if self.end_time else 0,
+            "words": self.words,
+            "words_per_minute": round(self.words * 60 / self.end_time, 1) if self.end_time else 0,
+            "speakers": speakers
+        }
+
+
+# The paragraphs of the full text transcript and the chunks sent to comprehend, the way
+# chunk_up_transcript breaks them out: a paragraph per speaker turn, or without speaker labels at
+# pauses of over FULL_TEXT_PAUSE seconds and at the first sentence end FULL_TEXT_PARAGRAPH_SECONDS
+# after the last break. The analytics of the episode are gathered on the way.
+class TranscriptChunker(object):
+    STATE = ('last_speaker', 'current_paragraph', 'previous_time', 'last_pause', 'last_item_was_sentence_end')
+    PACKER_STATE = ('chunk', 'chunk_bytes', 'sentence', 'sentence_bytes')
+
+    def __init__(self, results, custom_vocabs=None, state=None):
+        self.custom_vocabs = custom_vocabs
+        self.speaker_segments = None
+        if 'speaker_labels' in results:
+            self.speaker_segments = parse_speaker_segments(results)
+
+        self.paragraphs = []
+        self.packer = ChunkPacker()
+        self.analytics = EpisodeAnalytics()
+        self.last_speaker = None
+        self.current_paragraph = ""
+        self.previous_time = 0
+        self.last_pause = 0
+        self.last_item_was_sentence_end = False
+        if state is not None:
+            restore(self, state)
+            restore(self.packer, state['packer'])
+            if 'analytics' in state:
+                self.analytics = EpisodeAnalytics(state['analytics'])
+
+    @property
+    def chunks(self):
+        return self.packer.chunks
+
+    def state(self):
+        state = snapshot(self)
+        state['packer'] = snapshot(self.packer, self.PACKER_STATE)
+        state['analytics'] = snapshot(self.analytics)
+        return state
+
+    def feed(self, item):
+        current_speaker = None
+        if item["type"] == "pronunciation":
+            start_time = float(item['start_time'])
+
+            if self.speaker_segments is not None:
+                current_speaker = get_speaker_label(self.speaker_segments, start_time)
+                if self.last_speaker is None or current_speaker != self.last_speaker:
+                    if self.current_paragraph is not None:
+                        self.paragraphs.append(self.current_paragraph)
+                    self.current_paragraph = current_speaker + " :"
+                    self.last_pause = start_time
+                self.last_speaker = current_speaker
+
+            elif (start_time - self.previous_time) > FULL_TEXT_PAUSE or (
+                            (start_time - self.last_pause) > FULL_TEXT_PARAGRAPH_SECONDS and
+                            self.last_item_was_sentence_end):
+                self.last_pause = start_time
+                if self.current_paragraph is not None or self.current_paragraph != "":
+                    self.paragraphs.append(self.current_paragraph)
+                self.current_paragraph = ""
+
+            phrase = item['alternatives'][0]['content']
+            if self.custom_vocabs is not None:
+                if phrase in self.custom_vocabs:
+                    phrase = self.custom_vocabs[phrase]
+                    logger.info("replaced custom vocab: " + phrase)
+            if phrase in commonDict:
+                phrase = commonDict[phrase]
+            self.current_paragraph += " " + phrase
+
+            # add chunking
+            self.packer.add(" " + phrase)
+
+            self.last_item_was_sentence_end = False
+
+        elif item["type"] == "punctuation":
+            self.current_paragraph += item['alternatives'][0]['content']
+            if item['alternatives'][0]['content'] in (".", "!", "?"):
+                self.last_item_was_sentence_end = True
+            else:
+                self.last_item_was_sentence_end = False
+            self.packer.add(item['alternatives'][0]['content'], self.last_item_was_sentence_end)
+
+        if 'end_time' in item:
+            self.previous_time = float(item['end_time'])
+        self.analytics.feed(item, current_speaker)
+
+    def finish(self):
+        self.packer.finish()
+        if not self.current_paragraph == "":
+            self.paragraphs.append(self.current_paragraph)
+
+    # The analytics of the whole episode, once the last item has been fed
+    def report(self):
+        return self.analytics.report(self.speaker_segments)
+
+
+def get_speaker_label(speaker_segments, start_time):
+    for segment in speaker_segments:
+        if segment['start_time'] <= start_time < segment['end_time']:
+            return segment['speaker']
+    return None
+
+
+def parse_speaker_segments(results):
+    speaker_labels = results['speaker_labels']['segments']
+    speaker_segments = []
+    for label in speaker_labels:
+        segment = dict()
+        segment["start_time"] = float(label["start_time"])
+        segment["end_time"] = float(label["end_time"])
+        segment["speaker"] = label["speaker_label"]
+        speaker_segments.append(segment)
+    return speaker_segments
+
+
+# The state is stored as JSON, so it only holds strings, numbers and lists. It is copied since the
+# machine keeps appending to its lists.
+def snapshot(machine, fields=None):
+    return copy.deepcopy(dict((name, getattr(machine, name)) for name in fields or machine.STATE))
+
+
+def restore(machine, state):
+    for name, value in state.items():
+        if name not in ('packer', 'analytics'):
+            setattr(machine, name, value)
+
+
+# Feeds the items of the shard to the machine, all of them without a shard. Only the last shard
+# finishes the machine: what is left over at the end of the other shards is carried into the next one
+# by its state.
+def feed_items(machine, items, shard=None):
+    begin, end, last = 0, len(items), True
+    if shard is not None:
+        begin, end, last = shard['begin'], shard['end'], shard['last']
+    for item in islice(items, begin, end):
+        machine.feed(item)
+    if last:
+        machine.finish()
+    return machine
+
+
+# Returns the time the last word of the transcript ends
+def transcript_duration(results):
+    for item in reversed(results['items']):
+        if 'end_time' in item:
+            return float(item['end_time'])
+    return 0.0
+
+
+# Cuts the items of the transcript into shard_count shards of about the same duration. A shard starts
+# right after a word the paragraph rules start a new paragraph with because the speaker changed or
+# paused, never in the middle of a paragraph cut for its length, and the state of both machines
+# after that word is stored with the shard. Returns one shard when there is no such boundary.
+def plan_shards(results, mapping, custom_vocabs, shard_count):
+    items = results['items']
+    duration = transcript_duration(results)
+    paragraphs = ParagraphSegmenter(results, mapping)
+    chunker = TranscriptChunker(results, custom_vocabs)
+    shards = [{"begin": 0, "paragraph": None, "text": None}]
+    for i, item in enumerate(items):
+        paragraph = paragraphs.feed(item)
+        chunker.feed(item)
+        if len(shards) < shard_count and paragraph is not None and paragraph['reason'] != LONG_PARAGRAPH and \
+                float(item['start_time']) >= duration * len(shards) / shard_count:
+            shards[-1]['end'] = i + 1
+            shards.append({"begin": i + 1, "paragraph": paragraphs.state(), "text": chunker.state()})
+    shards[-1]['end'] = len(items)
+    for index, shard in enumerate(shards):
+        shard['index'] = index
+        shard['last'] = index == len(shards) - 1
+    return shards
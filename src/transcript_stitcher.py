@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+# Stitches the Amazon Transcribe output of several consecutive audio segments back into a single
+# results document with the same shape that Amazon Transcribe returns for the whole file, so
+# chunk_up_transcript and the paragraph lambda can consume it unchanged. Pure python so it can be
+# exercised offline against synthetic transcribe outputs.
+
+
+def _shift(value, offset):
+    return "%.3f" % (float(value) + offset)
+
+
+# spk_1 of the third segment becomes spk_2_1
+def _speaker(label, segment):
+    return 'spk_{}_{}'.format(segment, label[len('spk_'):] if label.startswith('spk_') else label)
+
+
+def _shift_times(entry, offset, segment):
+    shifted = dict(entry)
+    if 'start_time' in entry:
+        shifted['start_time'] = _shift(entry['start_time'], offset)
+    if 'end_time' in entry:
+        shifted['end_time'] = _shift(entry['end_time'], offset)
+    if 'speaker_label' in entry:
+        shifted['speaker_label'] = _speaker(entry['speaker_label'], segment)
+    if 'items' in entry:
+        shifted['items'] = [_shift_times(item, offset, segment) for item in entry['items']]
+    return shifted
+
+
+# segments is a list of (offset, transcribe_output) tuples, where offset is the number of seconds
+# into the original audio file that the segment starts and transcribe_output is the parsed JSON
+# returned by Amazon Transcribe for that segment.
+#
+# Amazon Transcribe numbers the speakers of each job independently, so spk_0 in one segment is not
+# guaranteed to be the same person as spk_0 in the next. The speaker labels are namespaced by the
+# position of the segment (spk_<segment>_<n>) rather than matched up across segments, so a speaker is
+# never credited with what another one said. A speaker that talks in several segments counts once per
+# segment in the speaker count and in the analytics, and the paragraphs always break at the start of a
+# segment.
+def stitch_transcripts(segments):
+    segments = sorted(segments, key=lambda segment: float(segment[0]))
+    transcripts = []
+    items = []
+    speaker_segments = []
+    speakers = set()
+    all_have_speaker_labels = len(segments) > 0
+
+    for position, (offset, output) in enumerate(segments):
+        offset = float(offset)
+        results = output['results']
+
+        text = " ".join(t['transcript'] for t in results.get('transcripts', []) if t['transcript'])
+        if text:
+            transcripts.append(text)
+
+        for item in results['items']:
+            items.append(_shift_times(item, offset, position))
+
+        if 'speaker_labels' in results:
+            for segment in results['speaker_labels']['segments']:
+                speaker_segments.append(_shift_times(segment, offset, position))
+                speakers.add(speaker_segments[-1]['speaker_label'])
+        else:
+            all_have_speaker_labels = False
+
+    stitched = {
+        "jobName": segments[0][1].get('jobName') if segments else None,
+        "accountId": segments[0][1].get('accountId') if segments else None,
+        "status": "COMPLETED",
+        "results": {
+            "transcripts": [{"transcript": " ".join(transcripts)}],
+            "items": items
+        }
+    }
+    if all_have_speaker_labels:
+        stitched['results']['speaker_labels'] = {
+            "speakers": len(speakers),
+            "segments": speaker_segments
+        }
+    return stitched
@@ -1,14 +1,18 @@
 from __future__ import print_function
 
-import boto3
-import certifi
 import json
 import os
-from aws_requests_auth.aws_auth import AWSRequestsAuth
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from elasticsearch import helpers
+from es_client import get_es_client, latency_histogram
 import logging
 import time
+from es_bulk import bulk_index, bulk_load_settings, detect_feed_routing, episode_partitions, unsealed_partitions, \
+    BULK_LOAD_THRESHOLD
+from artifact_io import read_keywords, read_transcript
+from aws_clients import client as lazy_client
+from instrumentation import instrumented_handler
+from es_documents import ENTITY_ROLLUP_INDEX, FULL_EPISODE_INDEX, KEYWORDS_INDEX, build_episode_doc, \
+    episode_paragraphs_query, generate_keyword_actions, episode_manifest, manifest_key, paragraph_index, \
+    rollup_actions, routing_params, stale_paragraphs_query, stale_rollups_query
 
 # Log level
 logging.basicConfig()
@@ -18,47 +22,26 @@ if os.getenv('LOG_LEVEL') == 'DEBUG':
 else:
     logger.setLevel(logging.INFO)
 
-# Parameters
-REGION = os.getenv('AWS_REGION', default='us-east-1')
-
 # Pull environment data for the ES domain
 esendpoint = os.environ['ES_DOMAIN']
 # If debug mode is TRUE, then S3 files are not deleted
 isDebugMode = os.environ['DEBUG_MODE']
 
-# get the Elasticsearch index name from the environment variables
-FULL_EPISODE_INDEX = os.getenv('ES_EPISODE_INDEX', default='episodes')
-# get the Elasticsearch index name from the environment variables
-KEYWORDS_INDEX = os.getenv('ES_PARAGRAPH_INDEX', default='paragraphs')
-
-s3_client = boto3.client('s3')
-# Create the auth token for the sigv4 signature
-session = boto3.session.Session()
-credentials = session.get_credentials().get_frozen_credentials()
-awsauth = AWSRequestsAuth(
-    aws_access_key=credentials.access_key,
-    aws_secret_access_key=credentials.secret_key,
-    aws_token=credentials.token,
-    aws_host=esendpoint,
-    aws_region=REGION,
-    aws_service='es'
-)
-
-# Connect to the elasticsearch cluster using aws authentication. The lambda function
-# must have access in an IAM policy to the ES cluster.
-es = Elasticsearch(
-    hosts=[{'host': esendpoint, 'port': 443}],
-    http_auth=awsauth,
-    use_ssl=True,
-    verify_certs=True,
-    ca_certs=certifi.where(),
-    timeout=120,
-    connection_class=RequestsHttpConnection
-)
+s3_client = lazy_client('s3')
+
+# The paragraph partitions this container has seen exist
+_partitions = set()
 
 
 # Entry point into the lambda function
+@instrumented_handler('upload_to_elasticsearch')
 def lambda_handler(event, context):
+    # The latency histogram covers the requests of this invocation only
+    latency_histogram.reset()
+    # Shared client with refreshing sigv4 auth and a pooled connection, built on first use
+    es = get_es_client(esendpoint)
+    detect_feed_routing(es)
+
     # Pull the keywords S3 location for the payload of the previous lambda function
     keywordsS3Location = event["processedTranscription"][0]
 
@@ -69,44 +52,78 @@ def lambda_handler(event, context):
     index_episode(es, event, fullEpisodeS3Location)
     # Episode level payload
 
-    # If it is not debug mode, then clean up the temp files.
+    # Record where the processed artifacts of the episode are, so the indices can be rebuilt from S3
+    # with backfill_elasticsearch without transcribing the episode again.
+    write_manifest(event)
+
+    # If it is not debug mode, then clean up the temp files. The processed artifacts are kept for the
+    # backfill.
     if isDebugMode != 'TRUE':
         response = s3_client.delete_object(Bucket=event['audioS3Location']['bucket'],
                                            Key=event['audioS3Location']['key'])
-        response = s3_client.delete_object(Bucket=keywordsS3Location['bucket'], Key=keywordsS3Location['key'])
 
+    latency_histogram.log_summary()
     return
 
 
-def index_episode(es, event, fullEpisodeS3Location):
-    response = s3_client.get_object(Bucket=fullEpisodeS3Location['bucket'], Key=fullEpisodeS3Location['key'])
-    file_content = response['Body'].read().decode('utf-8')
-    fullepisode = json.loads(file_content)
-    audio_url = event['podcastUrl']
+def write_manifest(event):
+    bucket = event["processedTranscription"][0]['bucket']
+    key = manifest_key(event['podcastUrl'])
+    s3_client.put_object(Body=json.dumps(episode_manifest(event), indent=2), Bucket=bucket, Key=key)
+    logger.info("wrote episode manifest to s3://" + bucket + "/" + key)
+
+
+# Entry point for removing an episode that was taken down or replaced in the feed.
+# {
+#  "podcastUrl": "The url of the mp3 file provided by the RSS feed.",
+#  "sourceFeed": "Optional, the url of the feed. Without it every shard is searched for the episode."
+# }
+@instrumented_handler('delete_episode')
+def delete_episode_handler(event, context):
+    latency_histogram.reset()
+    es = get_es_client(esendpoint)
+    detect_feed_routing(es)
+    deleted = delete_episode(es, event['podcastUrl'], event.get('sourceFeed'))
+    latency_histogram.log_summary()
+    return deleted
+
+
+# Removes the episode document and all of its paragraphs from the indices. The boilerplate documents
+# of the feed stay, the other episodes of the feed repeat them.
+def delete_episode(es, podcast_url, feed_url=None):
+    routing = routing_params(feed_url, KEYWORDS_INDEX)
+    with unsealed_partitions(es, episode_partitions(es, podcast_url, routing)):
+        start = time.time()
+        res = es.delete_by_query(index=KEYWORDS_INDEX, body=episode_paragraphs_query(podcast_url),
+                                 conflicts='proceed', **routing)
+        logger.info('REQUEST_TIME es_client.delete_by_query {:10.4f}'.format(time.time() - start))
+    deleted = {"paragraphs": res['deleted'], "episode": 0}
+
+    # A delete by id needs the routing of the document, by query it doesn't
+    res = es.delete_by_query(index=FULL_EPISODE_INDEX,
+                             body={"query": {"ids": {"values": [podcast_url]}}},
+                             conflicts='proceed', **routing_params(feed_url, FULL_EPISODE_INDEX))
+    deleted['episode'] = res['deleted']
+
+    res = es.update_by_query(index=ENTITY_ROLLUP_INDEX, body=stale_rollups_query(podcast_url),
+                             conflicts='proceed', **routing_params(feed_url, ENTITY_ROLLUP_INDEX))
+    deleted['entity_rollups'] = res['updated'] + res['deleted']
+    logger.info("deleted " + podcast_url + ": " + json.dumps(deleted))
+    return deleted
 
-    s3_location = "s3://" + event['audioS3Location']['bucket'] + "/" + event['audioS3Location']['key']
 
-    doc = {
-        'audio_url': audio_url,
-        'audio_type': event['audio_type'],
-        'title': event['Episode'],
-        'summary': event['summary'],
-        'published_time': event['publishTime'],
-        'source_feed': event['sourceFeed'],
-        'audio_s3_location': s3_location,
-        'transcript': fullepisode['transcript'],
-        'transcript_entities': fullepisode['transcript_entities']
-    }
+def index_episode(es, event, fullEpisodeS3Location):
+    fullepisode = read_transcript(fullEpisodeS3Location['bucket'], fullEpisodeS3Location['key'])
+    audio_url = event['podcastUrl']
 
-    if 'speakerNames' in event and len(event['speakerNames']) > 1:
-        doc['speakerNames'] = event['speakerNames']
+    doc = build_episode_doc(event, fullepisode)
 
     logger.info("request")
     logger.debug(json.dumps(doc))
     # add the document to the index
     start = time.time()
     res = es.index(index=FULL_EPISODE_INDEX,
-                   body=doc, id=audio_url)
+                   body=doc, id=audio_url, **routing_params(event['sourceFeed'], FULL_EPISODE_INDEX))
     logger.info("response")
     logger.info(json.dumps(res, indent=4))
     logger.info('REQUEST_TIME es_client.index {:10.4f}'.format(time.time() - start))
@@ -120,34 +137,75 @@ def index_keywords(es, event, keywordsS3Location):
     # is usually good, but occasionally you'll land after the word was spoken.
     audioOffset = int(os.environ['AUDIO_OFFSET'])
 
-    response = s3_client.get_object(Bucket=keywordsS3Location['bucket'], Key=keywordsS3Location['key'])
-    file_content = response['Body'].read().decode('utf-8')
-    keywords = json.loads(file_content)
-    actions = []
-    # Iterate through all the keywords and create an index document for each phrase
-    for i in range(len(keywords)):
-        keyword = keywords[i]["text"]
-        tags = keywords[i]["tags"]
-        # Offset the time that the word was spoken to the listener has some context to the phrase
-        time = str(max(float(keywords[i]["startTime"]) - audioOffset, 0))
-        actions.append({
-            "_index": KEYWORDS_INDEX,
-            "_type": "_doc",
-            "_source": {
-                "PodcastName": event["PodcastName"],
-                "Episode": event["Episode"],
-                "url": event["podcastUrl"] + "#t=" + time,
-                "text": keyword,
-                "tags": tags,
-                "speaker": keywords[i]["speaker"],
-                "startTime": float(time)
-            }
-        })
-
-    # Bulk load the documents into the index.
-    result = helpers.bulk(es, actions)
+    # The paragraphs are decoded off the S3 stream as the bulk requests consume them
+    count, keywords = read_keywords(keywordsS3Location['bucket'], keywordsS3Location['key'])
+
+    # Stream the documents into the index in chunks capped by count and bytes, so large episodes
+    # don't get rejected with a 413/429 and fail the whole step.
+    indexed_ids = []
+    entity_counts = {}
+    actions = generate_keyword_actions(event, keywords, audioOffset, indexed_ids, entity_counts)
+    partition = paragraph_index(event["publishTime"])
+    ensure_partition(es, partition)
+    routing = routing_params(event["sourceFeed"], KEYWORDS_INDEX)
+    # The partition of the episode may be sealed when it is an old one, and so may the partitions its
+    # stale paragraphs are removed from
+    with unsealed_partitions(es, [partition] + episode_partitions(es, event["podcastUrl"], routing)):
+        if count >= BULK_LOAD_THRESHOLD:
+            with bulk_load_settings(es, partition):
+                stats = bulk_index(es, actions)
+        else:
+            stats = bulk_index(es, actions)
+
+        # Fail the step so the state machine retries the upload. The ids of the paragraphs are
+        # deterministic, so indexing the episode again overwrites the documents that made it.
+        stats.raise_for_errors()
+
+        # If the episode was indexed before with a different segmentation or publish time, remove the
+        # paragraphs that aren't part of this run. Only the documents of this episode are visited.
+        start = time.time()
+        res = es.delete_by_query(index=KEYWORDS_INDEX,
+                                 body=stale_paragraphs_query(event["podcastUrl"], indexed_ids, [partition]),
+                                 conflicts='proceed', **routing)
+        logger.info('REQUEST_TIME es_client.delete_by_query {:10.4f}'.format(time.time() - start))
+        logger.info("removed {} stale paragraphs".format(res['deleted']))
+    update_entity_rollup(es, event, entity_counts).raise_for_errors()
 
     logger.info("indexed keywords to ES")
-    logger.info(json.dumps(result, indent=2))
-    return result
+    return stats.indexed, stats.errors
 
+
+# Upserts the counts of the entities of the episode into the rollup, and takes the episode out of the
+# rollup documents of entities it mentioned when it was indexed before but doesn't anymore
+def update_entity_rollup(es, event, entity_counts):
+    rollup_ids = []
+    stats = bulk_index(es, rollup_actions(event, entity_counts, rollup_ids))
+    if stats.errors:
+        return stats
+    start = time.time()
+    res = es.update_by_query(index=ENTITY_ROLLUP_INDEX, body=stale_rollups_query(event["podcastUrl"], rollup_ids),
+                             conflicts='proceed', **routing_params(event["sourceFeed"], ENTITY_ROLLUP_INDEX))
+    logger.info('REQUEST_TIME es_client.update_by_query {:10.4f}'.format(time.time() - start))
+    logger.info("entity rollup: {} entities, {} stale".format(len(rollup_ids), res['updated'] + res['deleted']))
+    return stats
+
+
+# A partition is created from the template by the first document written to it. The partition of the
+# episode is created up front so the bulk load settings can be applied to it.
+def ensure_partition(es, index):
+    if index in _partitions:
+        return
+    if not es.indices.exists(index=index):
+        from elasticsearch.exceptions import RequestError
+
+        start = time.time()
+        try:
+            es.indices.create(index=index)
+            logger.info("created paragraph partition " + index)
+        except RequestError as e:
+            # Another upload may create it at the same time. Any other error, like a template that
+            # can't be applied, fails the upload.
+            if e.error != 'resource_already_exists_exception':
+                raise
+        logger.info('REQUEST_TIME es_client.indices.create {:10.4f}'.format(time.time() - start))
+    _partitions.add(index)
@@ -0,0 +1,144 @@
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from aws_clients import get_client
+from botocore.exceptions import ClientError
+from instrumentation import record
+from transcript_segmenter import VocabularyMapping
+
+# Keeps the vocabulary mappings of the feeds in memory across the invocations of a warm container.
+#
+# Every episode of a feed points to the same mapping object in S3, and both processing lambdas (and
+# the shard planner) read it for every episode. The cache holds the parsed mapping together with its
+# compiled matcher, keyed by bucket and key:
+#
+#   - within VOCABULARY_CACHE_TTL seconds of the last check the cached mapping is used as is, without
+#     a request to S3
+#   - after that it is revalidated with a conditional GET on its ETag, which comes back as 304 Not
+#     Modified without a body when the object hasn't changed
+#   - otherwise (or when it isn't cached) the object is read and parsed, and the matcher rebuilt
+#
+# A change to a mapping object is therefore seen up to VOCABULARY_CACHE_TTL seconds late by a warm
+# container. The state machine never changes one in place, every run of the rss state machine writes
+# the mapping under a new key, so only a mapping edited by hand is affected. VOCABULARY_CACHE_TTL=0
+# revalidates on every lookup.
+#
+# At most VOCABULARY_CACHE_SIZE mappings are kept, the least recently used is evicted first. Every
+# lookup logs the hit rate of the container so far.
+
+logger = logging.getLogger()
+
+VOCABULARY_CACHE_SIZE = int(os.getenv('VOCABULARY_CACHE_SIZE', default='16'))
+
+# Seconds a cached mapping is used without checking S3, how stale a mapping edited in place can be
+VOCABULARY_CACHE_TTL = float(os.getenv('VOCABULARY_CACHE_TTL', default='300'))
+
+NOT_MODIFIED = ('304', 'NotModified')
+
+# Every run of the rss state machine stores a new mapping for the feed, and the feed points to the
+# latest one here
+FEED_MAPPING_PREFIX = 'podcasts/vocabularyMapping/feeds/'
+
+
+class VocabularyCache(object):
+    def __init__(self, size=VOCABULARY_CACHE_SIZE, ttl=VOCABULARY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, bucket, key):
+        start = time.time()
+        with self.lock:
+            entry = self.entries.get((bucket, key))
+            if entry is not None:
+                self.entries.move_to_end((bucket, key))
+
+        outcome = 'hit'
+        if entry is None or time.time() - entry['checked'] >= self.ttl:
+            params = {'Bucket': bucket, 'Key': key}
+            if entry is not None:
+                params['IfNoneMatch'] = entry['etag']
+            try:
+                response = get_client('s3').get_object(**params)
+            except ClientError as e:
+                if entry is None or e.response['Error']['Code'] not in NOT_MODIFIED:
+                    raise
+                outcome = 'revalidated'
+                entry['checked'] = time.time()
+            else:
+                outcome = 'miss'
+                body = response['Body'].read()
+                entry = {
+                    "mapping": VocabularyMapping(json.loads(body)),
+                    "etag": response.get('ETag'),
+                    "checked": time.time(),
+                    "bytes": len(body)
+                }
+                self.store(bucket, key, entry)
+
+        with self.lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'revalidated':
+                self.revalidated += 1
+            else:
+                self.misses += 1
+        record('vocabulary_cache.' + outcome, time.time() - start,
+               bytes_in=entry['bytes'] if outcome == 'miss' else 0, items=len(entry['mapping']))
+        logger.info("vocabulary mapping s3://{}/{}: {}, {}".format(bucket, key, outcome, json.dumps(self.stats())))
+        return entry['mapping']
+
+    def store(self, bucket, key, entry):
+        with self.lock:
+            self.entries[(bucket, key)] = entry
+            self.entries.move_to_end((bucket, key))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            # Lookups that didn't read and parse the mapping
+            "hit_rate": round((self.hits + self.revalidated) / float(lookups), 3) if lookups else 0
+        }
+
+
+_cache = VocabularyCache()
+
+
+# Returns the VocabularyMapping stored at the key, from the cache of the container when it can
+def read_mapping(bucket, key):
+    return _cache.get(bucket, key)
+
+
+def feed_mapping_key(feed_url):
+    return FEED_MAPPING_PREFIX + hashlib.sha1(feed_url.encode('utf-8')).hexdigest() + '.json'
+
+
+# Points the feed to the {"bucket", "key"} of its latest mapping
+def write_feed_mapping(bucket, feed_url, location):
+    get_client('s3').put_object(Body=json.dumps(location), Bucket=bucket, Key=feed_mapping_key(feed_url))
+
+
+# Returns the {"bucket", "key"} of the latest mapping of the feed, or None for feeds that haven't been
+# processed since the mappings were tracked per feed
+def read_feed_mapping(bucket, feed_url):
+    try:
+        body = get_client('s3').get_object(Bucket=bucket, Key=feed_mapping_key(feed_url))['Body'].read()
+    except get_client('s3').exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
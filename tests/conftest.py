@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import types
+
+import pytest
+
+# The lambdas are flat modules under src/, imported the way the lambda runtime imports them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# The handlers print their metrics when they return, which the tests don't need
+os.environ['METRICS_ENABLED'] = 'FALSE'
+os.environ.setdefault('BUCKET_NAME', 'test-bucket')
+os.environ.setdefault('ES_DOMAIN', 'http://localhost:9200')
+os.environ.setdefault('DEBUG_MODE', 'TRUE')
+os.environ.setdefault('AUDIO_OFFSET', '1')
+
+# elasticsearch isn't installed where the tests run. The bulk helper is replaced with one that sends
+# every chunk it is given to the bulk method of the client under test, which answers with the
+# (ok, item) of every action, and yields the failures like streaming_bulk does with yield_ok=False.
+try:
+    import elasticsearch.helpers  # noqa: F401
+except ImportError:
+    elasticsearch = types.ModuleType('elasticsearch')
+    helpers = types.ModuleType('elasticsearch.helpers')
+
+    def streaming_bulk(client, actions, chunk_size=500, raise_on_error=True, yield_ok=True, **kwargs):
+        actions = list(actions)
+        assert len(actions) <= chunk_size
+        for ok, item in client.bulk(actions):
+            if yield_ok or not ok:
+                yield ok, item
+
+    helpers.streaming_bulk = streaming_bulk
+    elasticsearch.helpers = helpers
+    sys.modules['elasticsearch'] = elasticsearch
+    sys.modules['elasticsearch.helpers'] = helpers
+
+
+# The tests don't talk to AWS. Some modules import botocore.exceptions at import time, so when botocore
+# isn't installed a stand-in with the exception classes they use is put in its place.
+try:
+    import botocore.exceptions  # noqa: F401
+except ImportError:
+    botocore = types.ModuleType('botocore')
+    exceptions = types.ModuleType('botocore.exceptions')
+
+    class BotoCoreError(Exception):
+        def __init__(self, **kwargs):
+            super(BotoCoreError, self).__init__(kwargs)
+            self.kwargs = kwargs
+
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            super(ClientError, self).__init__(error_response.get('Error', {}).get('Code'))
+            self.response = error_response
+            self.operation_name = operation_name
+
+    class ConnectionError(BotoCoreError):
+        pass
+
+    class HTTPClientError(BotoCoreError):
+        pass
+
+    class ReadTimeoutError(HTTPClientError):
+        pass
+
+    for error in (BotoCoreError, ClientError, ConnectionError, HTTPClientError, ReadTimeoutError):
+        setattr(exceptions, error.__name__, error)
+    botocore.exceptions = exceptions
+    sys.modules['botocore'] = botocore
+    sys.modules['botocore.exceptions'] = exceptions
+
+
+class StubElasticsearch(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class StubSession(object):
+    def __init__(self):
+        self.adapters = {}
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+
+class StubConnection(object):
+    def __init__(self, *args, **kwargs):
+        self.session = StubSession()
+
+    def perform_request(self, method, url, *args, **kwargs):
+        return 200, {}, '{}'
+
+
+class StubAuth(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class RequestError(Exception):
+    def __init__(self, status_code, error, info=None):
+        super(RequestError, self).__init__(status_code, error, info)
+        self.status_code = status_code
+        self.error = error
+
+
+class StubAdapter(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+# The modules that build clients when they are imported get stand-ins for boto3, the signer, requests and
+# the elasticsearch client that don't connect to anything, and are imported again by every test.
+@pytest.fixture
+def client_modules(monkeypatch):
+    boto3 = types.ModuleType('boto3')
+    boto3.client = lambda service_name, **kwargs: None
+    boto_utils = types.ModuleType('aws_requests_auth.boto_utils')
+    boto_utils.BotoAWSRequestsAuth = StubAuth
+    certifi = types.ModuleType('certifi')
+    certifi.where = lambda: 'cacert.pem'
+    elasticsearch = types.ModuleType('elasticsearch')
+    elasticsearch.Elasticsearch = StubElasticsearch
+    elasticsearch.RequestsHttpConnection = StubConnection
+    elasticsearch.helpers = sys.modules['elasticsearch'].helpers
+    exceptions = types.ModuleType('elasticsearch.exceptions')
+    exceptions.RequestError = RequestError
+    elasticsearch.exceptions = exceptions
+    adapters = types.ModuleType('requests.adapters')
+    adapters.HTTPAdapter = StubAdapter
+    for name, module in [('boto3', boto3), ('aws_requests_auth', types.ModuleType('aws_requests_auth')),
+                         ('aws_requests_auth.boto_utils', boto_utils), ('certifi', certifi),
+                         ('elasticsearch', elasticsearch), ('elasticsearch.exceptions', exceptions),
+                         ('requests', types.ModuleType('requests')),
+                         ('requests.adapters', adapters)]:
+        monkeypatch.setitem(sys.modules, name, module)
+    for name in ['es_client', 'transcript_search', 'upload_to_elasticsearch']:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+
+# Routes the documents of every index by feed, like the indices created with the routing
+@pytest.fixture
+def routed():
+    import es_documents
+
+    previous = es_documents.routed_indices()
+    es_documents.set_routed_indices(dict((index, True) for index in [
+        es_documents.FULL_EPISODE_INDEX, es_documents.KEYWORDS_INDEX, es_documents.ENTITY_ROLLUP_INDEX]))
+    yield
+    es_documents.set_routed_indices(previous)
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+# In memory S3 with the calls the modules make
+class FakeS3(object):
+    class exceptions(object):
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[(Bucket, Key)] = Fileobj.read()
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        Fileobj.write(self.get_object(Bucket, Key)['Body'].read())
+
+    def get_paginator(self, name):
+        objects = self.objects
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix=''):
+                keys = sorted(key for bucket, key in objects if bucket == Bucket and key.startswith(Prefix))
+                return [{'Contents': [{'Key': key} for key in keys]}]
+        return Paginator()
+
+
+@pytest.fixture
+def s3():
+    import aws_clients
+
+    fake = FakeS3()
+    previous = aws_clients._clients.get('s3')
+    aws_clients._clients['s3'] = fake
+    yield fake
+    if previous is None:
+        aws_clients._clients.pop('s3', None)
+    else:
+        aws_clients._clients['s3'] = previous
@@ -0,0 +1,74 @@
+import gzip
+import json
+
+import artifact_io
+
+BUCKET = 'test-bucket'
+
+PARAGRAPHS = [{"startTime": 0.0, "text": "Welcome to the show", "tags": [], "speaker": "spk_0"},
+              {"startTime": 12.5, "text": "Today we talk about art", "tags": ["Art"], "speaker": "spk_1"}]
+
+
+def test_an_artifact_is_a_header_line_and_a_line_per_record(s3):
+    stats = artifact_io.write_keywords(BUCKET, 'k.ndjson.gz', PARAGRAPHS)
+
+    lines = gzip.decompress(s3.objects[(BUCKET, 'k.ndjson.gz')]).decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == [{"records": 2}] + PARAGRAPHS
+    assert (stats.records, stats.raw_bytes) == (2, sum(len(line) + 1 for line in lines))
+    assert stats.compressed_bytes == len(s3.objects[(BUCKET, 'k.ndjson.gz')])
+
+
+def test_keywords_round_trip(s3):
+    artifact_io.write_keywords(BUCKET, 'k.ndjson.gz', PARAGRAPHS)
+
+    count, records = artifact_io.read_keywords(BUCKET, 'k.ndjson.gz')
+    assert count == 2
+    assert list(records) == PARAGRAPHS
+
+
+def test_transcript_round_trip(s3):
+    artifact_io.write_transcript(BUCKET, 't.ndjson.gz', ["First paragraph.", "Second paragraph."],
+                                 transcript_entities=[{"Text": "Art"}], speakers=2)
+
+    assert artifact_io.read_transcript(BUCKET, 't.ndjson.gz') == {
+        "transcript": "First paragraph.\n\nSecond paragraph.",
+        "transcript_entities": [{"Text": "Art"}],
+        "speakers": 2
+    }
+
+
+def test_episode_list_round_trip(s3):
+    request = {"maxConcurrentEpisodes": 10, "episodes": [{"Episode": "a"}, {"Episode": "b"}]}
+    artifact_io.write_episode_list(BUCKET, 'e.ndjson.gz', request)
+    assert artifact_io.read_episode_list(BUCKET, 'e.ndjson.gz') == request
+
+
+def test_the_same_records_give_the_same_bytes(s3):
+    artifact_io.write_keywords(BUCKET, 'a.ndjson.gz', PARAGRAPHS)
+    artifact_io.write_keywords(BUCKET, 'b.ndjson.gz', PARAGRAPHS)
+    assert s3.objects[(BUCKET, 'a.ndjson.gz')] == s3.objects[(BUCKET, 'b.ndjson.gz')]
+
+
+def test_json_artifacts_written_before_the_switch_are_still_read(s3):
+    s3.put_object(Body=json.dumps(PARAGRAPHS), Bucket=BUCKET, Key='k.json')
+    s3.put_object(Body=json.dumps({"transcript": "Old transcript", "transcript_entities": []}),
+                  Bucket=BUCKET, Key='t.json')
+
+    count, records = artifact_io.read_keywords(BUCKET, 'k.json')
+    assert (count, list(records)) == (2, PARAGRAPHS)
+    assert artifact_io.read_transcript(BUCKET, 't.json') == {"transcript": "Old transcript",
+                                                            "transcript_entities": []}
+
+
+def test_artifact_keys():
+    key = artifact_io.artifact_key('podcasts/keywords/')
+    assert key.startswith('podcasts/keywords/') and artifact_io.is_artifact(key)
+    assert not artifact_io.is_artifact('podcasts/keywords/abc.json')
+
+
+def test_raw_transcripts_are_kept_per_episode(s3):
+    body = json.dumps({"results": {"transcripts": [{"transcript": "Hello"}]}}).encode('utf-8')
+    location = artifact_io.write_raw_transcript(BUCKET, 'https://example.com/a.mp3', body)
+
+    assert location == {"bucket": BUCKET, "key": artifact_io.raw_transcript_key('https://example.com/a.mp3')}
+    assert artifact_io.read_raw_transcript(BUCKET, 'https://example.com/a.mp3') == json.loads(body.decode('utf-8'))
@@ -0,0 +1,59 @@
+import sys
+import types
+
+import pytest
+
+import aws_clients
+
+
+class StubClient(object):
+    def __init__(self, service_name, **kwargs):
+        self.service_name = service_name
+        self.kwargs = kwargs
+
+    def list_buckets(self):
+        return self.service_name
+
+
+@pytest.fixture
+def built(monkeypatch):
+    built = []
+    boto3 = types.ModuleType('boto3')
+
+    def client(service_name, **kwargs):
+        built.append(StubClient(service_name, **kwargs))
+        return built[-1]
+
+    boto3.client = client
+    monkeypatch.setitem(sys.modules, 'boto3', boto3)
+    monkeypatch.setattr(aws_clients, '_clients', {})
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    monkeypatch.delenv('AWS_ENDPOINT_URL_S3', raising=False)
+    return built
+
+
+def test_clients_are_built_on_first_use_and_shared(built):
+    first = aws_clients.client('s3')
+    second = aws_clients.client('s3')
+    assert built == []
+
+    assert first.list_buckets() == 's3'
+    assert second.list_buckets() == 's3'
+    assert len(built) == 1
+    assert first.resolve() is second.resolve() is aws_clients.get_client('s3')
+
+
+def test_clients_with_their_own_settings_are_not_shared(built):
+    regional = aws_clients.client('s3', region_name='eu-west-1')
+
+    assert regional.resolve() is not aws_clients.get_client('s3')
+    assert regional.resolve() is regional.resolve()
+    assert [client.kwargs for client in built] == [{'region_name': 'eu-west-1'}, {}]
+
+
+def test_endpoint_overrides(built, monkeypatch):
+    monkeypatch.setenv('AWS_ENDPOINT_URL', 'http://localhost:4566')
+    monkeypatch.setenv('AWS_ENDPOINT_URL_S3', 'http://localhost:9000')
+
+    assert aws_clients.get_client('s3').kwargs == {'endpoint_url': 'http://localhost:9000'}
+    assert aws_clients.get_client('sqs').kwargs == {'endpoint_url': 'http://localhost:4566'}
@@ -0,0 +1,86 @@
+import boilerplate
+from boilerplate import BoilerplateIndex, read_index, signature, similarity, write_index
+
+BUCKET = 'test-bucket'
+FEED = 'https://example.com/feed.xml'
+
+SPONSOR = "This episode is brought to you by Example Cloud, the simplest way to run your servers"
+SPONSOR_AGAIN = "This episode is brought to you by Example Cloud, the easiest way to run your servers"
+CONTENT = [
+    "Today we talk with a historian about the first computers and the people who programmed them",
+    "The analytical engine was never built but its design already had memory and a processing unit",
+    "Our guest spent ten years in the archives reading the letters of the engineers of the time"
+]
+
+
+def episode(*texts):
+    return [(text, signature(text)) for text in texts]
+
+
+# Adds the next episode of the feed to the index
+def add_episode(index, *texts):
+    return index.add_episode('https://example.com/{}.mp3'.format(index.episodes + 1), episode(*texts))
+
+
+def test_near_duplicates_have_similar_signatures():
+    assert signature("Thanks for listening.") is None
+    assert signature(SPONSOR) == signature(SPONSOR.upper() + "!")
+    assert similarity(signature(SPONSOR), signature(SPONSOR_AGAIN)) >= boilerplate.BOILERPLATE_SIMILARITY
+    assert similarity(signature(SPONSOR), signature(CONTENT[0])) < 0.2
+
+
+def test_a_paragraph_repeated_across_episodes_becomes_boilerplate():
+    index = BoilerplateIndex()
+    add_episode(index, SPONSOR, CONTENT[0])
+    assert index.boilerplate(signature(SPONSOR)) is None
+
+    add_episode(index, SPONSOR_AGAIN, CONTENT[1])
+    entry = index.boilerplate(signature(SPONSOR_AGAIN))
+    assert entry is not None and entry['count'] == 2
+    assert index.boilerplate(signature(CONTENT[1])) is None
+    assert index.boilerplate(None) is None
+
+
+def test_a_paragraph_counts_once_per_episode():
+    index = BoilerplateIndex()
+    add_episode(index, SPONSOR, SPONSOR_AGAIN)
+    assert len(index) == 1
+    assert index.boilerplate(signature(SPONSOR)) is None
+
+
+def test_an_episode_processed_again_is_not_counted_again():
+    index = BoilerplateIndex()
+    assert index.add_episode('https://example.com/a.mp3', episode(SPONSOR, CONTENT[0]))
+    assert not index.add_episode('https://example.com/a.mp3', episode(SPONSOR, CONTENT[0]))
+
+    assert index.episodes == 1
+    assert index.boilerplate(signature(SPONSOR)) is None
+    assert index.add_episode('https://example.com/b.mp3', episode(SPONSOR))
+    assert index.boilerplate(signature(SPONSOR)) is not None
+
+
+def test_paragraphs_that_do_not_repeat_leave_the_window():
+    index = BoilerplateIndex()
+    add_episode(index, SPONSOR, CONTENT[0])
+    add_episode(index, SPONSOR)
+    for i in range(boilerplate.BOILERPLATE_WINDOW - 2):
+        add_episode(index)
+    assert index.match(signature(CONTENT[0])) is not None
+
+    add_episode(index)
+    assert index.match(signature(CONTENT[0])) is None
+    assert index.boilerplate(signature(SPONSOR)) is not None
+
+
+def test_the_index_is_stored_per_feed(s3):
+    assert len(read_index(BUCKET, FEED)) == 0
+
+    index = BoilerplateIndex()
+    add_episode(index, SPONSOR, CONTENT[0])
+    add_episode(index, SPONSOR_AGAIN, CONTENT[2])
+    write_index(BUCKET, FEED, index)
+
+    stored = read_index(BUCKET, FEED)
+    assert (stored.episodes, len(stored)) == (2, 3)
+    assert stored.boilerplate(signature(SPONSOR))['id'] == index.boilerplate(signature(SPONSOR))['id']
+    assert len(read_index(BUCKET, 'https://example.com/other.xml')) == 0
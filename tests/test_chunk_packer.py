@@ -0,0 +1,52 @@
+from chunk_packer import ChunkPacker, comprehend_units, split_piece, truncate_utf8, utf8_length
+
+
+# Feeds the sentences to the packer the way chunk_up_transcript does: a word with the space before it,
+# the punctuation that ends the sentence on its own
+def pack(sentences, max_bytes):
+    packer = ChunkPacker(max_bytes)
+    for sentence in sentences:
+        words = sentence.rstrip('.').split(' ')
+        for word in words:
+            packer.add(' ' + word)
+        packer.add('.', sentence_end=True)
+    return packer.finish(), packer
+
+
+def test_whole_sentences_fill_a_chunk_while_they_fit():
+    chunks, packer = pack(["One two three.", "Four five.", "Six seven eight nine."], max_bytes=30)
+
+    assert chunks == ["One two three. Four five.", "Six seven eight nine."]
+    assert all(utf8_length(chunk) <= 30 for chunk in chunks)
+    assert packer.stats()['chunks'] == 2
+
+
+def test_chunks_are_measured_in_utf8_bytes():
+    # Every cyrillic letter is two bytes
+    chunks, packer = pack(["Привет мир.", "Как дела."], max_bytes=22)
+
+    assert chunks == ["Привет мир.", "Как дела."]
+    assert [utf8_length(chunk) for chunk in chunks] == [20, 16]
+
+
+def test_a_sentence_longer_than_a_chunk_is_split_between_words():
+    chunks, packer = pack(["Short.", "one two three four five six seven eight."], max_bytes=16)
+
+    assert chunks == ["Short.", "one two three", "four five six", "seven eight."]
+    assert all(utf8_length(chunk) <= 16 for chunk in chunks)
+
+
+def test_a_word_longer_than_a_chunk_is_split_between_characters():
+    assert split_piece(u"ééééé", 4) == [u"éé", u"éé", u"é"]
+    chunks, packer = pack([u"x" * 25 + "."], max_bytes=10)
+    assert [len(chunk) for chunk in chunks] == [9, 10, 7]
+
+
+def test_truncate_does_not_split_a_character():
+    assert truncate_utf8(u"aé", 2) == "a"
+    assert truncate_utf8(u"aé", 3) == u"aé"
+
+
+def test_comprehend_units():
+    assert comprehend_units("x" * 10) == 3
+    assert comprehend_units("x" * 301) == 4
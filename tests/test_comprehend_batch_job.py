@@ -0,0 +1,176 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+import comprehend_batch_job
+from artifact_io import read_artifact, write_keywords, write_transcript
+from comprehend_batch_job import CAPITALIZED_PHRASE, JOB_PREFIX, LocalComprehendJobClient, apply_results, \
+    find_pending, read_output, submit, wait_for_job, write_input
+from es_documents import MANIFEST_PREFIX
+from time_offsets import encode_offsets
+
+BUCKET = 'test-bucket'
+CHUNK = "Ada Lovelace wrote the first program and Charles Babbage built it"
+
+
+# Every capitalized phrase is a person
+def detect_people(text):
+    return [{"Score": 0.99, "Type": "PERSON", "Text": match.group(0), "BeginOffset": match.start(),
+             "EndOffset": match.end()} for match in CAPITALIZED_PHRASE.finditer(text)]
+
+
+def paragraph(text, start, boilerplate=False):
+    words = []
+    position = 0
+    for number, word in enumerate(text.split(' ')):
+        words.append((position, start + number * 0.5))
+        position += len(word) + 1
+    item = {"startTime": start, "text": text, "tags": [], "entities": [], "speaker": "spk_0",
+            "offsets": encode_offsets(words)}
+    if boilerplate:
+        item['boilerplate'] = True
+    return item
+
+
+# An episode stored by the state machine with COMPREHEND_MODE=BATCH, or already tagged
+def store_episode(s3, name, pending=True, only_boilerplate=False):
+    marker = {"comprehend": "pending"} if pending else {}
+    keywords_key = 'podcasts/keywords/' + name + '.ndjson.gz'
+    transcript_key = 'podcasts/transcript/' + name + '.ndjson.gz'
+    write_keywords(BUCKET, keywords_key, [
+        paragraph("Ada Lovelace wrote the first program", 10.0, boilerplate=only_boilerplate),
+        paragraph("Thanks For Listening", 15.0, boilerplate=True),
+        paragraph("and Charles Babbage built it", 20.0, boilerplate=only_boilerplate)
+    ], **marker)
+    chunks = [] if only_boilerplate else [CHUNK]
+    fields = dict(marker, comprehend_chunks=chunks) if pending else {"transcript_entities": {}}
+    write_transcript(BUCKET, transcript_key, ["Ada Lovelace wrote the first program.", "And Charles Babbage."],
+                     key_phrases=[], **fields)
+    manifest_key = MANIFEST_PREFIX + name + '.json'
+    manifest = {"podcastUrl": "https://example.com/" + name + ".mp3", "sourceFeed": "https://example.com/feed.xml",
+                "processedTranscription": [{"bucket": BUCKET, "key": keywords_key},
+                                           {"bucket": BUCKET, "key": transcript_key}]}
+    s3.put_object(Body=json.dumps(manifest), Bucket=BUCKET, Key=manifest_key)
+    return manifest_key
+
+
+def artifacts(s3, manifest_key):
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key=manifest_key)['Body'].read().decode('utf-8'))
+    keywords_location, transcript_location = manifest['processedTranscription']
+    keywords_header, paragraphs = read_artifact(BUCKET, keywords_location['key'])
+    transcript_header, records = read_artifact(BUCKET, transcript_location['key'])
+    records.close()
+    return manifest, keywords_header, list(paragraphs), transcript_header
+
+
+def test_tags_the_pending_episodes_with_one_job(s3):
+    pending = store_episode(s3, 'a')
+    store_episode(s3, 'b', pending=False)
+    previous = [location['key'] for location in artifacts(s3, pending)[0]['processedTranscription']]
+
+    manifest_keys = find_pending(BUCKET, MANIFEST_PREFIX)
+    assert manifest_keys == [pending]
+
+    index, empty = write_input(BUCKET, manifest_keys, JOB_PREFIX + 'job/input/documents.txt')
+    # The boilerplate paragraph isn't sent
+    assert index == [[pending, 'paragraph', 0], [pending, 'paragraph', 2], [pending, 'chunk', 0]]
+    assert empty == []
+
+    comprehend = LocalComprehendJobClient(detect_people)
+    job_id = submit(comprehend, BUCKET, 'job', None)
+    results, failed = read_output(wait_for_job(comprehend, job_id, 0))
+    assert (sorted(results), failed) == ([0, 1, 2], set())
+
+    assert apply_results(BUCKET, index, results, failed) == [pending]
+
+    manifest, keywords_header, paragraphs, transcript_header = artifacts(s3, pending)
+    assert 'comprehend' not in keywords_header
+    assert [p['tags'] for p in paragraphs] == [["Ada Lovelace"], [], ["Charles Babbage"]]
+    assert paragraphs[2]['entities'] == [{"text": "Charles Babbage", "type": "PERSON", "time": 20.5}]
+    assert transcript_header['transcript_entities'] == {"PERSON": ["Ada Lovelace", "Charles Babbage"]}
+    assert 'comprehend' not in transcript_header and 'comprehend_chunks' not in transcript_header
+    # The old artifacts are replaced
+    assert not any((BUCKET, key) in s3.objects for key in previous)
+    assert find_pending(BUCKET, MANIFEST_PREFIX) == []
+
+
+def job_output(s3, lines):
+    data = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        info = tarfile.TarInfo('output')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    s3.put_object(Body=archive.getvalue(), Bucket=BUCKET, Key=JOB_PREFIX + 'job/output/output.tar.gz')
+    return 's3://' + BUCKET + '/' + JOB_PREFIX + 'job/output/output.tar.gz'
+
+
+def test_a_rejected_document_leaves_its_artifact_pending(s3):
+    pending = store_episode(s3, 'a')
+    index, empty = write_input(BUCKET, [pending], JOB_PREFIX + 'job/input/documents.txt')
+    transcript = artifacts(s3, pending)[0]['processedTranscription'][1]
+
+    results, failed = read_output(job_output(s3, [
+        {"File": "documents.txt", "Line": 0, "Entities": detect_people("Ada Lovelace wrote the first program")},
+        {"File": "documents.txt", "Line": 1, "Entities": []},
+        {"File": "documents.txt", "Line": 2, "ErrorCode": "INTERNAL_SERVER_ERROR", "ErrorMessage": "failed"}
+    ]))
+    assert (sorted(results), failed) == ([0, 1], {2})
+
+    assert apply_results(BUCKET, index, results, failed) == [pending]
+
+    manifest, keywords_header, paragraphs, transcript_header = artifacts(s3, pending)
+    assert [p['tags'] for p in paragraphs] == [["Ada Lovelace"], [], []]
+    assert manifest['processedTranscription'][1] == transcript
+    assert transcript_header['comprehend'] == 'pending'
+    # The next run submits the transcript chunks again
+    assert find_pending(BUCKET, MANIFEST_PREFIX) == [pending]
+    assert write_input(BUCKET, [pending], JOB_PREFIX + 'next/input/documents.txt') == ([[pending, 'chunk', 0]], [])
+
+
+def test_an_incomplete_output_tags_nothing(s3):
+    pending = store_episode(s3, 'a')
+    index, empty = write_input(BUCKET, [pending], JOB_PREFIX + 'job/input/documents.txt')
+    before = dict(s3.objects)
+
+    with pytest.raises(RuntimeError):
+        apply_results(BUCKET, index, {0: [], 2: []})
+    assert s3.objects == before
+
+
+def test_an_episode_with_nothing_to_submit_is_marked_done(s3):
+    pending = store_episode(s3, 'a')
+    empty_episode = store_episode(s3, 'b', only_boilerplate=True)
+    index, empty = write_input(BUCKET, [pending, empty_episode], JOB_PREFIX + 'job/input/documents.txt')
+    assert [entry[0] for entry in index] == [pending] * 3
+    assert empty == [[empty_episode, 'paragraph'], [empty_episode, 'chunk']]
+
+    results, failed = read_output(job_output(s3, [{"File": "documents.txt", "Line": line, "Entities": []}
+                                                  for line in range(len(index))]))
+    assert sorted(apply_results(BUCKET, index, results, failed, empty)) == [pending, empty_episode]
+
+    manifest, keywords_header, paragraphs, transcript_header = artifacts(s3, empty_episode)
+    assert 'comprehend' not in keywords_header and 'comprehend' not in transcript_header
+    assert [p['tags'] for p in paragraphs] == [[], [], []]
+    assert find_pending(BUCKET, MANIFEST_PREFIX) == []
+
+
+def test_reading_a_header_closes_the_object(s3, monkeypatch):
+    store_episode(s3, 'a')
+    bodies = []
+    get_object = s3.get_object
+
+    def tracked_get_object(**kwargs):
+        response = get_object(**kwargs)
+        bodies.append(response['Body'])
+        return response
+
+    monkeypatch.setattr(s3, 'get_object', tracked_get_object)
+    assert find_pending(BUCKET, MANIFEST_PREFIX) == [MANIFEST_PREFIX + 'a.json']
+    # The manifest, read in full, and the header of the keywords artifact
+    assert len(bodies) == 2 and bodies[1].closed
+    assert comprehend_batch_job.read_header(
+        {"bucket": BUCKET, "key": 'podcasts/transcript/a.ndjson.gz'})['comprehend'] == 'pending'
+    assert bodies[2].closed
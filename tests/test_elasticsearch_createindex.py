@@ -0,0 +1,128 @@
+import calendar
+import time
+
+import pytest
+
+import elasticsearch_createindex as createindex
+
+
+class StubIndices(object):
+    def __init__(self, existing=(), aliases=(), sealed=()):
+        self.existing = set(existing)
+        self.aliases = set(aliases)
+        self.sealed = set(sealed)
+        self.created = []
+        self.templates = {}
+        self.merged = []
+        self.alias_actions = []
+        self.meta = {}
+
+    def exists(self, index):
+        return index in self.existing
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def create(self, index, body=None, **kwargs):
+        self.created.append(index)
+        self.existing.add(index)
+
+    def update_aliases(self, body):
+        self.alias_actions.extend(body['actions'])
+
+    def put_template(self, name, body):
+        self.templates[name] = body
+
+    def get_settings(self, index, name, flat_settings):
+        return dict((partition, {"settings": {"index.blocks.write": "true"} if partition in self.sealed else {}})
+                    for partition in self.existing if partition.startswith('paragraphs-'))
+
+    def get_mapping(self, index):
+        return dict((name, {"mappings": {"_meta": dict(self.meta.get(name, {}))}}) for name in index.split(','))
+
+    def put_mapping(self, index, body):
+        self.meta[index] = body['_meta']
+
+    def forcemerge(self, index, max_num_segments, request_timeout):
+        self.merged.append(index)
+
+    def put_settings(self, index, body):
+        if body == {"index": {"blocks.write": True}}:
+            self.sealed.add(index)
+
+
+class StubDomain(object):
+    def __init__(self, indices, failures=()):
+        self.indices = indices
+        self.failures = list(failures)
+        self.reindexed = []
+
+    def reindex(self, body, **kwargs):
+        self.reindexed.append(body)
+        return {"created": 10, "updated": 0, "failures": self.failures}
+
+
+@pytest.fixture
+def domain(monkeypatch):
+    domain = StubDomain(StubIndices())
+    monkeypatch.setattr(createindex, 'get_es_client', lambda endpoint: domain)
+    return domain
+
+
+def test_the_partitions_get_the_template_and_the_alias(domain):
+    createindex.lambda_handler({}, None)
+
+    template = domain.indices.templates['paragraphs']
+    assert template['index_patterns'] == ['paragraphs-*']
+    assert template['aliases'] == {'paragraphs': {}}
+    assert template['mappings']['_routing'] == {"required": True}
+    assert domain.indices.created == ['episodes', 'entity_rollup', time.strftime('paragraphs-%Y.%m', time.gmtime())]
+
+
+def test_a_paragraphs_index_from_before_the_partitions_is_migrated(domain):
+    partition = time.strftime('paragraphs-%Y.%m', time.gmtime())
+    domain.indices.existing.add('paragraphs')
+
+    createindex.lambda_handler({}, None)
+
+    assert domain.indices.created == ['episodes', 'entity_rollup', partition]
+    body = domain.reindexed[0]
+    assert (body['source'], body['dest']) == ({"index": "paragraphs"}, {"index": partition})
+    assert 'ctx._routing = ctx._source.source_feed' in body['script']['source']
+    assert domain.indices.alias_actions == [{"remove_index": {"index": "paragraphs"}},
+                                    {"add": {"index": "paragraphs-*", "alias": "paragraphs"}}]
+    # The template gets the alias back once the index is gone
+    assert domain.indices.templates['paragraphs']['aliases'] == {'paragraphs': {}}
+
+
+def test_the_index_is_kept_when_paragraphs_fail_to_migrate(domain):
+    domain.failures = [{"id": "a", "cause": {"type": "mapper_parsing_exception"}}]
+    domain.indices.existing.add('paragraphs')
+
+    with pytest.raises(createindex.MigrationError):
+        createindex.lambda_handler({}, None)
+    assert domain.indices.alias_actions == []
+    assert domain.indices.templates['paragraphs']['aliases'] == {}
+
+
+def test_partitions_older_than_the_writable_months_are_sealed():
+    indices = StubIndices(existing=['paragraphs-2019.11', 'paragraphs-2019.12', 'paragraphs-2020.01',
+                                    'paragraphs-2020.02', 'paragraphs-2020.03', 'paragraphs-boilerplate',
+                                    'paragraphs-undated'],
+                          sealed=['paragraphs-2019.11'])
+    now = calendar.timegm((2020, 4, 15, 12, 0, 0))
+
+    assert createindex.seal_partitions(StubDomain(indices), 3, now) == ['paragraphs-2019.12', 'paragraphs-2020.01']
+    assert indices.merged == ['paragraphs-2019.12', 'paragraphs-2020.01']
+    assert createindex.seal_partitions(StubDomain(indices), 3, now) == []
+
+
+def test_a_partition_being_written_to_is_sealed_once_the_writer_is_done_or_gone():
+    indices = StubIndices(existing=['paragraphs-2019.12'])
+    now = calendar.timegm((2020, 4, 15, 12, 0, 0))
+    indices.meta['paragraphs-2019.12'] = {"unsealed": {"a": now + 60}}
+
+    assert createindex.seal_partitions(StubDomain(indices), 3, now) == []
+    # The writer died without sealing it again
+    assert createindex.seal_partitions(StubDomain(indices), 3, now + 61) == ['paragraphs-2019.12']
+    assert indices.meta['paragraphs-2019.12'] == {}
@@ -0,0 +1,229 @@
+import json
+
+import pytest
+
+from es_bulk import (BulkIndexError, action_size, bulk_index, bulk_load_settings, chunk_actions,
+                     restore_expired_bulk_loads, unsealed_partitions)
+
+
+# A client that indexes every action it is sent except the ids in reject
+class StubClient(object):
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.requests = []
+
+    def bulk(self, actions):
+        self.requests.append([action['_id'] for action in actions])
+        return [(action['_id'] not in self.reject, {"index": {"_id": action['_id'], "status": 400}})
+                for action in actions]
+
+
+def action(number, text='x'):
+    return {"_index": "paragraphs", "_id": str(number), "_op_type": "update",
+            "doc": {"text": text}, "doc_as_upsert": True}
+
+
+def test_action_size_counts_both_lines():
+    a = action(1, 'some text')
+    meta = {"_index": "paragraphs", "_id": "1", "_op_type": "update"}
+    source = {"doc": {"text": "some text"}, "doc_as_upsert": True}
+    assert action_size(a) == len(json.dumps(meta)) + 1 + len(json.dumps(source)) + 1
+    assert action_size({"_index": "i", "_id": "1", "_source": {"a": 1}}) == \
+        len(json.dumps({"_index": "i", "_id": "1"})) + 1 + len(json.dumps({"a": 1})) + 1
+
+
+def test_chunk_actions_caps_the_count():
+    chunks = list(chunk_actions((action(i) for i in range(25)), chunk_size=10, max_chunk_bytes=10 ** 6))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert [a['_id'] for chunk in chunks for a in chunk] == [str(i) for i in range(25)]
+
+
+def test_chunk_actions_caps_the_bytes():
+    actions = [action(i, 'x' * 100) for i in range(10)]
+    size = action_size(actions[0])
+    chunks = list(chunk_actions(actions, chunk_size=100, max_chunk_bytes=size * 3 + 1))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    assert all(sum(action_size(a) for a in chunk) <= size * 3 + 1 for chunk in chunks)
+
+
+def test_chunk_actions_sends_an_oversized_action_on_its_own():
+    actions = [action(1), action(2, 'x' * 1000), action(3)]
+    chunks = list(chunk_actions(actions, chunk_size=100, max_chunk_bytes=200))
+    assert [[a['_id'] for a in chunk] for chunk in chunks] == [['1'], ['2'], ['3']]
+
+
+def test_chunk_actions_consumes_the_stream_lazily():
+    consumed = []
+
+    def actions():
+        for i in range(10):
+            consumed.append(i)
+            yield action(i)
+
+    chunks = chunk_actions(actions(), chunk_size=4, max_chunk_bytes=10 ** 6)
+    next(chunks)
+    assert consumed == [0, 1, 2, 3, 4]
+
+
+def test_bulk_index_sends_a_request_per_chunk():
+    client = StubClient()
+    stats = bulk_index(client, (action(i) for i in range(12)), chunk_size=5)
+    assert client.requests == [[str(i) for i in range(0, 5)], [str(i) for i in range(5, 10)], ['10', '11']]
+    assert stats.indexed == 12
+    assert stats.errors == []
+    assert len(stats.chunk_latencies) == 3
+    assert stats.summary()['chunks'] == 3
+    stats.raise_for_errors()
+
+
+def test_bulk_index_collects_the_failures():
+    client = StubClient(reject={'3', '7'})
+    stats = bulk_index(client, [action(i) for i in range(10)], chunk_size=4)
+    assert stats.indexed == 8
+    assert [error['index']['_id'] for error in stats.errors] == ['3', '7']
+    assert stats.summary()['failed'] == 2
+    with pytest.raises(BulkIndexError):
+        stats.raise_for_errors()
+
+
+# The settings and mapping _meta of a set of indices
+class StubIndices(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.meta = dict((name, {}) for name in settings)
+
+    def get_settings(self, index, name, flat_settings):
+        return dict((index_name, {"settings": dict(settings)}) for index_name, settings in self.settings.items()
+                    if any(index_name.startswith(name) for name in index.split(',')))
+
+    def put_settings(self, index, body):
+        for index_name in self.get_settings(index, None, True):
+            for name, value in body['index'].items():
+                if value is None:
+                    self.settings[index_name].pop('index.' + name, None)
+                else:
+                    self.settings[index_name]['index.' + name] = str(value).lower()
+
+    def get_mapping(self, index):
+        return dict((name, {"mappings": {"_meta": self.meta[name]}}) for name in index.split(','))
+
+    def put_mapping(self, index, body):
+        self.meta[index] = body['_meta']
+
+    def refresh(self, index):
+        pass
+
+
+class SettingsDomain(object):
+    def __init__(self, settings):
+        self.indices = StubIndices(settings)
+
+
+def test_bulk_load_settings_are_restored_after_the_load():
+    es = SettingsDomain({'paragraphs-2020.01': {'index.number_of_replicas': '2'}})
+
+    with bulk_load_settings(es, 'paragraphs-2020.01'):
+        assert es.indices.settings['paragraphs-2020.01'] == {'index.refresh_interval': '-1',
+                                                             'index.number_of_replicas': '0'}
+        assert es.indices.meta['paragraphs-2020.01']['bulk_load']['previous'] == {'index.number_of_replicas': '2'}
+
+    assert es.indices.settings['paragraphs-2020.01'] == {'index.number_of_replicas': '2'}
+    assert es.indices.meta['paragraphs-2020.01'] == {}
+
+
+def test_the_settings_are_restored_by_the_last_load():
+    es = SettingsDomain({'paragraphs-2020.01': {'index.number_of_replicas': '2'}})
+    bulk = {'index.refresh_interval': '-1', 'index.number_of_replicas': '0'}
+    first = bulk_load_settings(es, 'paragraphs-2020.01')
+    second = bulk_load_settings(es, 'paragraphs-2020.01')
+    first.__enter__()
+    # The second load starts from the bulk load settings, and keeps the ones from before the first
+    second.__enter__()
+    assert len(es.indices.meta['paragraphs-2020.01']['bulk_load']['loads']) == 2
+    assert es.indices.meta['paragraphs-2020.01']['bulk_load']['previous'] == {'index.number_of_replicas': '2'}
+
+    # The first load is done before the second one
+    first.__exit__(None, None, None)
+    assert es.indices.settings['paragraphs-2020.01'] == bulk
+    assert len(es.indices.meta['paragraphs-2020.01']['bulk_load']['loads']) == 1
+    second.__exit__(None, None, None)
+    assert es.indices.settings['paragraphs-2020.01'] == {'index.number_of_replicas': '2'}
+    assert es.indices.meta['paragraphs-2020.01'] == {}
+
+
+def test_a_load_that_died_is_restored_once_its_marker_expires():
+    es = SettingsDomain({'paragraphs-2020.01': {'index.number_of_replicas': '2'},
+                         'paragraphs-2020.02': {'index.refresh_interval': '-1', 'index.number_of_replicas': '0'}})
+    # A load the lambda timeout killed never gets to restore the settings
+    load = bulk_load_settings(es, 'paragraphs-2020.01')
+    load.__enter__()
+    expires, = es.indices.meta['paragraphs-2020.01']['bulk_load']['loads'].values()
+
+    # The live load is left alone, the index without a marker is reset to the defaults
+    assert restore_expired_bulk_loads(es, 'paragraphs', now=expires - 1) == ['paragraphs-2020.02']
+    assert es.indices.settings['paragraphs-2020.02'] == {}
+    assert restore_expired_bulk_loads(es, 'paragraphs', now=expires + 1) == ['paragraphs-2020.01']
+    assert es.indices.settings['paragraphs-2020.01'] == {'index.number_of_replicas': '2'}
+
+
+def test_a_sealed_partition_is_sealed_again_by_its_last_writer():
+    es = SettingsDomain({'paragraphs-2019.12': {'index.blocks.write': 'true'}, 'paragraphs-2020.03': {}})
+
+    with unsealed_partitions(es, ['paragraphs-2019.12', 'paragraphs-2020.03', 'paragraphs-2019.12']):
+        assert es.indices.settings['paragraphs-2019.12'] == {'index.blocks.write': 'false'}
+        # Another upload of the same month finds the partition writable, but another writer on it
+        with unsealed_partitions(es, ['paragraphs-2019.12']):
+            assert len(es.indices.meta['paragraphs-2019.12']['unsealed']) == 2
+        assert es.indices.settings['paragraphs-2019.12'] == {'index.blocks.write': 'false'}
+        assert len(es.indices.meta['paragraphs-2019.12']['unsealed']) == 1
+
+    assert es.indices.settings == {'paragraphs-2019.12': {'index.blocks.write': 'true'}, 'paragraphs-2020.03': {}}
+    assert es.indices.meta == {'paragraphs-2019.12': {}, 'paragraphs-2020.03': {}}
+
+
+class MappingIndices(object):
+    def __init__(self, mappings):
+        self.mappings = mappings
+        self.requests = 0
+
+    def get_mapping(self, index, ignore_unavailable):
+        self.requests += 1
+        return dict((name, {"mappings": mapping}) for name, mapping in self.mappings.items())
+
+
+@pytest.fixture
+def detect(monkeypatch):
+    import es_bulk
+    import es_documents
+
+    monkeypatch.setattr(es_bulk, '_routing_detected_at', None)
+    previous = es_documents.routed_indices()
+    yield es_bulk.detect_feed_routing
+    es_documents.set_routed_indices(previous)
+
+
+def test_the_documents_are_routed_to_the_indices_that_require_it(detect):
+    from es_documents import routing_params
+
+    routing = {"_routing": {"required": True}}
+    es = SettingsDomain({})
+    es.indices = MappingIndices({'episodes': routing, 'paragraphs-2020.01': routing, 'paragraphs-2020.02': routing})
+
+    # The rollup index doesn't exist yet, it is created with the routing
+    assert detect(es) == {'episodes': True, 'paragraphs': True, 'entity_rollup': True}
+    assert routing_params('https://example.com/feed.xml', 'episodes') == {"routing": 'https://example.com/feed.xml'}
+    # Remembered for a while
+    detect(es)
+    assert es.indices.requests == 1
+
+
+def test_indices_created_before_the_routing_are_not_routed(detect):
+    from es_documents import routing_params
+
+    es = SettingsDomain({})
+    # A deployment from before the routing, with a partition created since
+    es.indices = MappingIndices({'episodes': {}, 'paragraphs': {}, 'entity_rollup': {},
+                                 'paragraphs-2020.02': {"_routing": {"required": True}}})
+
+    assert detect(es) == {'episodes': False, 'paragraphs': False, 'entity_rollup': False}
+    assert routing_params('https://example.com/feed.xml', 'episodes') == {}
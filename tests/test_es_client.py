@@ -0,0 +1,61 @@
+import pytest
+
+
+@pytest.fixture
+def es_client(client_modules):
+    import es_client
+    return es_client
+
+
+def test_one_client_per_endpoint(es_client):
+    client = es_client.get_es_client('search-a.es.amazonaws.com')
+
+    assert es_client.get_es_client('search-a.es.amazonaws.com') is client
+    assert es_client.get_es_client('search-b.es.amazonaws.com') is not client
+    assert client.kwargs['hosts'] == [{'host': 'search-a.es.amazonaws.com', 'port': 443}]
+    assert client.kwargs['pool_maxsize'] == es_client.ES_POOL_SIZE
+    assert client.kwargs['connection_class'].__name__ == 'TimedRequestsHttpConnection'
+    # The signer looks up the credentials for every request instead of being given them once
+    assert client.kwargs['http_auth'].kwargs == {'aws_host': 'search-a.es.amazonaws.com',
+                                                 'aws_region': es_client.REGION, 'aws_service': 'es'}
+
+
+def test_the_connection_pool_has_the_configured_size(es_client):
+    connection = es_client.timed_connection_class()(pool_maxsize=25)
+
+    adapter = connection.session.adapters['https://']
+    assert adapter.kwargs == {'pool_connections': 1, 'pool_maxsize': 25}
+    assert connection.session.adapters['http://'] is adapter
+
+
+def test_operation_name(es_client):
+    operation_name = es_client.operation_name
+
+    assert operation_name('POST', '/_bulk') == 'POST _bulk'
+    assert operation_name('PUT', '/paragraphs/_doc/abc?refresh=true') == 'PUT _doc'
+    assert operation_name('POST', '/paragraphs/_delete_by_query?conflicts=proceed') == 'POST _delete_by_query'
+    assert operation_name('GET', '/') == 'GET /'
+
+
+def test_latency_histogram(es_client):
+    histogram = es_client.LatencyHistogram(buckets=[10, 100, 1000])
+    for seconds in [0.005] * 98 + [0.05, 2.0]:
+        histogram.record('POST _bulk', seconds)
+
+    summary = histogram.summary()['POST _bulk']
+    assert summary['count'] == 100
+    assert (summary['p50_ms'], summary['p99_ms'], summary['max_ms']) == (10, 100, 2000.0)
+    assert summary['histogram'] == {'10': 98, '100': 1, '1000': 0, 'inf': 1}
+
+    histogram.reset()
+    assert histogram.summary() == {}
+
+
+def test_every_request_is_timed(es_client):
+    es_client.latency_histogram.reset()
+    connection = es_client.timed_connection_class()()
+
+    connection.perform_request('POST', '/_bulk')
+    connection.perform_request('POST', '/_bulk')
+
+    assert es_client.latency_histogram.summary()['POST _bulk']['count'] == 2
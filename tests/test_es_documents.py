@@ -0,0 +1,98 @@
+import es_documents
+from es_documents import boilerplate_id, entity_links, episode_action, generate_keyword_actions, paragraph_id, \
+    paragraph_index, rollup_actions, rollup_episode_id, routing_params, stale_rollups_query
+
+EVENT = {"podcastUrl": "https://example.com/a.mp3", "sourceFeed": "https://example.com/feed.xml",
+         "PodcastName": "Podcast", "Episode": "Episode", "publishTime": "2020:01:02 10:00:00"}
+
+
+def keywords(*start_times):
+    return [{"startTime": start, "text": "paragraph at {}".format(start), "tags": [], "speaker": "spk_0"}
+            for start in start_times]
+
+
+def test_paragraph_ids_only_depend_on_the_episode_and_the_start_time():
+    first = [action['_id'] for action in generate_keyword_actions(EVENT, keywords(0, 10.5), 1)]
+    again = [action['_id'] for action in generate_keyword_actions(EVENT, keywords('0', '10.500'), 1)]
+    other = [action['_id'] for action in generate_keyword_actions(
+        dict(EVENT, podcastUrl="https://example.com/b.mp3"), keywords(0, 10.5), 1)]
+
+    assert first == again
+    assert first[0] != first[1]
+    assert set(first).isdisjoint(other)
+    assert first[1] == paragraph_id(EVENT['podcastUrl'], 10.5)
+
+
+def test_boilerplate_is_indexed_once_per_feed(monkeypatch):
+    paragraphs = keywords(0, 10.5)
+    paragraphs[0]['boilerplate'] = '3f2a'
+    actions = list(generate_keyword_actions(EVENT, paragraphs, 1))
+    other = list(generate_keyword_actions(dict(EVENT, podcastUrl="https://example.com/b.mp3"), paragraphs, 1))
+
+    assert actions[0]['_id'] == other[0]['_id'] == boilerplate_id(EVENT['sourceFeed'], '3f2a')
+    assert actions[0]['doc']['boilerplate'] is True
+    assert 'boilerplate' not in actions[1]['doc']
+
+    monkeypatch.setattr(es_documents, 'BOILERPLATE_INDEXING', 'SKIP')
+    assert [action['_id'] for action in generate_keyword_actions(EVENT, paragraphs, 1)] == [actions[1]['_id']]
+
+
+def test_paragraphs_are_partitioned_by_the_month_of_the_episode():
+    assert paragraph_index("2020:01:02 10:00:00") == 'paragraphs-2020.01'
+    assert paragraph_index("2019:12:31 23:59:59") == 'paragraphs-2019.12'
+    assert paragraph_index(None) == paragraph_index("Tue, 2 Jan 2020") == 'paragraphs-undated'
+
+    paragraphs = keywords(0, 10.5)
+    paragraphs[0]['boilerplate'] = '3f2a'
+    actions = list(generate_keyword_actions(EVENT, paragraphs, 1))
+    assert [action['_index'] for action in actions] == ['paragraphs-boilerplate', 'paragraphs-2020.01']
+
+
+def test_documents_are_routed_by_feed(routed):
+    event = dict(EVENT, audio_type='audio/mpeg', summary='About art',
+                 audioS3Location={"bucket": "test-bucket", "key": "podcasts/audio/a.mp3"})
+    transcript = {"transcript": "Paragraph at 0.", "transcript_entities": {}}
+    actions = list(generate_keyword_actions(event, keywords(0, 10.5), 1)) + [episode_action(event, transcript)]
+    assert [action['_routing'] for action in actions] == [EVENT['sourceFeed']] * 3
+    assert routing_params(EVENT['sourceFeed'], 'paragraphs') == {"routing": EVENT['sourceFeed']}
+    assert routing_params(None, 'paragraphs') == {}
+
+    # The episodes index was created before the routing
+    es_documents.set_routed_indices({'paragraphs': True, 'episodes': False})
+    actions = list(generate_keyword_actions(event, keywords(0, 10.5), 1)) + [episode_action(event, transcript)]
+    assert [action.get('_routing') for action in actions] == [EVENT['sourceFeed']] * 2 + [None]
+    assert routing_params(EVENT['sourceFeed'], 'episodes') == {}
+
+
+def test_entities_link_to_the_moment_they_are_spoken():
+    entities = [{"text": "Amazon", "type": "ORGANIZATION", "time": 631.06},
+                {"text": "Seattle", "type": "LOCATION", "time": 0.5},
+                {"text": "Bob", "type": "PERSON", "time": None}]
+    links = entity_links(EVENT['podcastUrl'], entities, 1)
+    assert [link.get('url') for link in links] == [EVENT['podcastUrl'] + "#t=630.06", EVENT['podcastUrl'] + "#t=0",
+                                                   None]
+    assert [link['time'] for link in links] == [631.06, 0.5, None]
+
+
+def test_the_entities_of_repeated_paragraphs_are_not_counted(routed):
+    paragraphs = keywords(0, 10.5, 20.0)
+    paragraphs[0]['entities'] = [{"text": "Ada", "type": "PERSON", "time": 1.0}, {"text": "Ada", "type": "PERSON", "time": 1.0}]
+    paragraphs[1]['entities'] = [{"text": "Ada", "type": "PERSON", "time": 1.0}, {"text": "Acme", "type": "ORGANIZATION", "time": 11.0}]
+    paragraphs[2]['entities'] = [{"text": "Ada", "type": "PERSON", "time": 1.0}]
+    paragraphs[2]['boilerplate'] = '3f2a'
+    entity_counts = {}
+    list(generate_keyword_actions(EVENT, paragraphs, 1, entity_counts=entity_counts))
+    assert entity_counts == {("PERSON", "Ada"): [2, 3], ("ORGANIZATION", "Acme"): [1, 1]}
+
+    rollup_ids = []
+    actions = list(rollup_actions(EVENT, entity_counts, rollup_ids))
+    assert [action['upsert']['entity'] for action in actions] == ["Acme", "Ada"]
+    assert [action['_id'] for action in actions] == rollup_ids
+    assert actions[1]['script']['params'] == {"episode": rollup_episode_id(EVENT['podcastUrl']), "paragraphs": 2,
+                                              "mentions": 3}
+    assert all(action['_routing'] == EVENT['sourceFeed'] and action['scripted_upsert'] for action in actions)
+
+    stale = stale_rollups_query(EVENT['podcastUrl'], rollup_ids)
+    assert stale['query']['bool']['must_not'] == [{"ids": {"values": rollup_ids}}]
+    assert stale['script']['params']['paragraphs'] == 0
+    assert 'must_not' not in stale_rollups_query(EVENT['podcastUrl'])['query']['bool']
@@ -0,0 +1,87 @@
+from gazetteer import Automaton, Gazetteer, build_gazetteer, gazetteer_key, learnable, normalize, \
+    read_feed_entities, tokenize, update_feed_entities
+
+BUCKET = 'test-bucket'
+FEED = 'https://example.com/feed.xml'
+
+
+def entity(text, entity_type):
+    return {"text": text, "type": entity_type}
+
+
+GAZETTEER = Gazetteer({
+    "amazon": entity("Amazon", "ORGANIZATION"),
+    "amazon web services": entity("Amazon Web Services", "ORGANIZATION"),
+    "web": entity("Web", "TITLE"),
+    "jeff bezos": entity("Jeff Bezos", "PERSON")
+})
+
+
+def test_normalize_and_tokenize():
+    assert normalize("  Amazon Web-Services, Inc. ") == "amazon webservices inc"
+    assert tokenize("Hi, (Jeff) Bezos!") == [("hi", 0, 2), ("jeff", 5, 9), ("bezos", 11, 16)]
+
+
+def test_the_automaton_finds_overlapping_names():
+    automaton = Automaton()
+    for name in ["a b", "b c", "b", "a b c d"]:
+        automaton.add(name.split(' '), name)
+    automaton.build()
+
+    assert sorted(automaton.search("x a b c d".split(' '))) == [(1, 2, "a b"), (1, 4, "a b c d"), (2, 1, "b"),
+                                                              (2, 2, "b c")]
+
+
+def test_the_longest_name_that_starts_first_wins():
+    text = "Jeff Bezos founded Amazon Web Services, not Amazon."
+
+    assert GAZETTEER.find(text) == [
+        {"Text": "Jeff Bezos", "Type": "PERSON", "Score": 1.0, "BeginOffset": 0, "EndOffset": 10},
+        {"Text": "Amazon Web Services", "Type": "ORGANIZATION", "Score": 1.0, "BeginOffset": 19, "EndOffset": 38},
+        {"Text": "Amazon", "Type": "ORGANIZATION", "Score": 1.0, "BeginOffset": 44, "EndOffset": 50}
+    ]
+    assert GAZETTEER.find("nothing to see here") == []
+    assert "AMAZON web services" in GAZETTEER
+
+
+def test_acronyms_and_short_names_only_match_with_the_same_case():
+    gazetteer = Gazetteer({"us": entity("US", "LOCATION"), "aws": entity("AWS", "ORGANIZATION"),
+                           "bob": entity("Bob", "PERSON"), "amazon": entity("Amazon", "ORGANIZATION")})
+
+    found = gazetteer.find("Bob told us about aws and AWS in the US, bob said amazon")
+    assert [(e['Text'], e['BeginOffset']) for e in found] == [("Bob", 0), ("AWS", 26), ("US", 37), ("amazon", 50)]
+
+
+def test_common_words_are_never_names():
+    known = {"us": entity("US", "LOCATION"), "it": entity("IT", "ORGANIZATION"), "x": entity("X", "ORGANIZATION"),
+             "jeff bezos": entity("Jeff Bezos", "PERSON")}
+    assert list(build_gazetteer(known, {"i. t.": "IT"}, {"LOCATION", "ORGANIZATION", "PERSON"}).entities) == \
+        ["jeff bezos"]
+
+
+def test_only_distinctive_confident_entities_are_learned():
+    assert learnable("Amazon", 0.99)
+    assert learnable("S3", 0.99)
+    assert learnable("NASA", 0.99)
+    assert not learnable("Amazon", 0.5)
+    assert not learnable("amazon", 0.99)
+    assert not learnable("AI", 0.99)
+    assert not learnable("US", 0.99)
+
+
+def test_mapping_names_need_a_known_type():
+    known = {"aws": entity("AWS", "ORGANIZATION"), "s3": entity("S3", "COMMERCIAL_ITEM")}
+    gazetteer = build_gazetteer(known, {"a. w. s.": "AWS", "lambda": "Lambda"}, {"ORGANIZATION", "PERSON"})
+    assert gazetteer.entities == {"aws": entity("AWS", "ORGANIZATION")}
+
+
+def test_the_feed_entities_are_stored_per_feed(s3):
+    assert read_feed_entities(BUCKET, FEED) == {}
+
+    assert update_feed_entities(BUCKET, FEED, [entity("Jeff Bezos", "PERSON"), entity("jeff bezos", "PERSON"),
+                                               entity("it", "ORGANIZATION")]) == 1
+    assert update_feed_entities(BUCKET, FEED, [entity("Jeff Bezos", "PERSON")]) == 0
+
+    assert read_feed_entities(BUCKET, FEED) == {"jeff bezos": entity("Jeff Bezos", "PERSON")}
+    assert read_feed_entities(BUCKET, 'https://example.com/other.xml') == {}
+    assert gazetteer_key(FEED).startswith('podcasts/gazetteer/')
@@ -0,0 +1,35 @@
+import contextvars
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+
+
+def test_handlers_running_at_the_same_time_flush_their_own_metrics(monkeypatch, capsys):
+    monkeypatch.setattr(instrumentation, 'METRICS_ENABLED', True)
+    both_recorded = threading.Barrier(2)
+
+    def handler(event, context):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for future in [executor.submit(contextvars.copy_context().run, instrumentation.record,
+                                           event['operation'], 0.01) for _ in range(2)]:
+                future.result()
+        # Neither invocation flushes before the other one has recorded
+        both_recorded.wait(timeout=5)
+        return event['operation']
+
+    handlers = dict((stage, instrumentation.instrumented_handler(stage)(handler)) for stage in ('first', 'second'))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(handlers[stage], {"operation": stage + '.call', "sourceFeed": stage}, None)
+                   for stage in handlers]
+        assert [future.result() for future in futures] == ['first.call', 'second.call']
+
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    operations = dict(((document['Stage'], document['Operation']), document) for document in documents)
+    assert sorted(operations) == [('first', 'first.call'), ('first', 'handler'),
+                                  ('second', 'handler'), ('second', 'second.call')]
+    assert len(operations[('first', 'first.call')]['Latency']) == 2
+    assert all(document['Feed'] == document['Stage'] for document in documents)
+    # Nothing was left in the collector of the process
+    assert instrumentation.collector.operations == {}
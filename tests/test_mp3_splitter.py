@@ -0,0 +1,98 @@
+import io
+import random
+
+import pytest
+
+from mp3_splitter import MP3FormatError, parse_frame_header, plan_segments, scan_frames, segment_count_for
+
+# MPEG 1 layer III, 128 kbps, 44.1 kHz, stereo, no padding: 417 byte frames of 1152 samples
+HEADER = bytes([0xFF, 0xFB, 0x90, 0x64])
+FRAME_LENGTH = 417
+FRAME_SECONDS = 1152 / 44100.0
+
+
+def pack_bits(fields):
+    bits = ''.join(format(value, '0{}b'.format(width)) for value, width in fields)
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+# A frame whose side information gives every granule weight huffman bits. main_data_begin is how far the
+# frame reaches back into the bit reservoir.
+def frame(weight, main_data_begin=0):
+    fields = [(main_data_begin, 9), (0, 3), (0, 8)]
+    for granule in range(4):
+        fields += [(weight, 12), (0, 47)]
+    side_info = pack_bits(fields)
+    assert len(side_info) == 32
+    data = HEADER + side_info
+    return data + bytes(FRAME_LENGTH - len(data))
+
+
+def id3v2_tag(size):
+    return b'ID3\x03\x00\x00' + bytes([0, 0, (size >> 7) & 0x7F, size & 0x7F]) + bytes(size)
+
+
+# Ten minutes of loud frames with two quiet stretches, one near each third of the file
+def episode(quiet):
+    rng = random.Random(1)
+    count = int(600 / FRAME_SECONDS)
+    frames = [frame(5 if i in quiet else rng.randint(800, 2000), 0 if i % 3 == 0 else 100) for i in range(count)]
+    return count, b''.join(frames)
+
+
+def test_parse_frame_header():
+    header = parse_frame_header(HEADER)
+    assert header.bitrate == 128
+    assert header.sample_rate == 44100
+    assert header.channels == 2
+    assert header.length == FRAME_LENGTH
+    assert header.duration == pytest.approx(FRAME_SECONDS)
+    assert parse_frame_header(b'\xff\xfb\xf0\x64') is None
+    assert parse_frame_header(b'ID3\x03') is None
+
+
+def test_scan_frames_skips_tags_across_reads():
+    count, frames = episode(set())
+    tag = id3v2_tag(300)
+    data = tag + frames + b'TAG' + bytes(125)
+
+    index = scan_frames(io.BytesIO(data), read_size=5000)
+
+    assert len(index) == count
+    assert index.offsets[0] == len(tag)
+    assert index.offsets[1] - index.offsets[0] == FRAME_LENGTH
+    assert index.end_offset == len(tag) + len(frames)
+    assert index.duration == pytest.approx(count * FRAME_SECONDS)
+
+
+def test_scan_frames_without_frames():
+    with pytest.raises(MP3FormatError):
+        scan_frames(io.BytesIO(bytes(10000)))
+
+
+def test_segment_count_for():
+    assert segment_count_for(100, 200, 8) == 1
+    assert segment_count_for(600, 200, 8) == 3
+    assert segment_count_for(601, 200, 8) == 4
+    assert segment_count_for(6000, 200, 8) == 8
+    assert segment_count_for(6000, 0, 8) == 1
+
+
+def test_plan_segments_splits_at_the_quiet_stretches():
+    quiet = set(range(7650, 7700)) | set(range(15300, 15340))
+    count, frames = episode(quiet)
+    index = scan_frames(io.BytesIO(frames))
+
+    segments = plan_segments(index, segment_count_for(index.duration, 200, 8))
+
+    assert len(segments) == 3
+    assert segments[0] == {"offset": 0.0, "start": 0, "end": segments[1]['start']}
+    assert segments[1]['end'] == segments[2]['start']
+    assert segments[2]['end'] == len(frames)
+    for segment in segments[1:]:
+        split_frame = segment['start'] // FRAME_LENGTH
+        assert split_frame in quiet
+        # a frame that doesn't reach back into the bit reservoir
+        assert split_frame % 3 == 0
+        assert segment['offset'] == pytest.approx(split_frame * FRAME_SECONDS)
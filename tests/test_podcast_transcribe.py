@@ -0,0 +1,75 @@
+import pytest
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+
+import podcast_transcribe
+import rate_limiter
+from rate_limiter import RateLimitedClient
+
+EVENT = {"audioS3Location": {"bucket": "test-bucket", "key": "podcasts/audio/a.mp3"}, "audio_type": "audio/mpeg",
+         "vocabularyInfo": {"name": "VOCAB"}, "speakers": 1}
+URL = "https://s3-us-east-1.amazonaws.com/test-bucket/podcasts/audio/a.mp3"
+
+
+class FreeBucket(object):
+    def acquire(self):
+        return 0.0
+
+
+# Transcribe that starts the jobs it is asked to, and loses the connection of the first response
+class FakeTranscribe(object):
+    class meta(object):
+        region_name = 'us-east-1'
+
+    class exceptions(object):
+        class ClientError(ClientError):
+            pass
+
+        class ConflictException(ClientError):
+            pass
+
+        class BadRequestException(ClientError):
+            pass
+
+        class LimitExceededException(ClientError):
+            pass
+
+    def __init__(self, lose_response=True):
+        self.jobs = {}
+        self.lose_response = lose_response
+
+    def start_transcription_job(self, TranscriptionJobName, Media, **kwargs):
+        if TranscriptionJobName in self.jobs:
+            raise self.exceptions.ConflictException({"Error": {"Code": "ConflictException"}},
+                                                    'StartTranscriptionJob')
+        self.jobs[TranscriptionJobName] = {"TranscriptionJobName": TranscriptionJobName, "Media": Media}
+        if self.lose_response:
+            self.lose_response = False
+            raise BotoConnectionError(error='connection reset')
+        return {"TranscriptionJob": self.jobs[TranscriptionJobName]}
+
+    def get_transcription_job(self, TranscriptionJobName):
+        return {"TranscriptionJob": self.jobs[TranscriptionJobName]}
+
+
+@pytest.fixture
+def transcribe(monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, 'sleep', lambda seconds: None)
+    fake = FakeTranscribe()
+    limited = RateLimitedClient(fake, {'start_transcription_job': ('transcribe.StartTranscriptionJob', FreeBucket())})
+    monkeypatch.setattr(podcast_transcribe, 'client', limited)
+    return fake
+
+
+def test_a_job_started_by_a_lost_attempt_is_a_success(transcribe):
+    result = podcast_transcribe.lambda_handler(dict(EVENT), None)
+    assert result['success'] == 'TRUE'
+    assert list(transcribe.jobs) == [result['transcribeJob']]
+    assert transcribe.jobs[result['transcribeJob']]['Media'] == {'MediaFileUri': URL}
+
+
+def test_a_job_of_other_audio_is_a_conflict(transcribe, monkeypatch):
+    transcribe.lose_response = False
+    monkeypatch.setattr(podcast_transcribe, 'id_generator', lambda: 'TAKEN')
+    transcribe.jobs['TAKEN'] = {"TranscriptionJobName": 'TAKEN', "Media": {"MediaFileUri": URL + '.other'}}
+    with pytest.raises(podcast_transcribe.ThrottlingException):
+        podcast_transcribe.lambda_handler(dict(EVENT), None)
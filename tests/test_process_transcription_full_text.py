@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import process_transcription_full_text as full_text
+
+
+# Answers every batch call after all the calls of the test have started, so the calls only complete
+# when they are sent at the same time
+class FakeComprehend(object):
+    def __init__(self, calls):
+        self.started = threading.Barrier(calls, timeout=5)
+        self.batches = []
+
+    def respond(self, name, TextList, result):
+        self.batches.append((name, len(TextList)))
+        self.started.wait()
+        return {"ResultList": [dict(result(text), Index=i) for i, text in enumerate(TextList)], "ErrorList": []}
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        return self.respond('entities', TextList, lambda text: {"Entities": []})
+
+    def batch_detect_key_phrases(self, TextList, LanguageCode):
+        return self.respond('key_phrases', TextList, lambda text: {"KeyPhrases": [
+            {"Text": word, "Score": 0.9} for word in text.split()]})
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        return self.respond('sentiment', TextList, lambda text: {"SentimentScore": {
+            "Positive": 1.0 if 'good' in text else 0.0, "Negative": 0.0 if 'good' in text else 1.0,
+            "Neutral": 0.0, "Mixed": 0.0}})
+
+
+@pytest.fixture
+def comprehend(monkeypatch):
+    fake = FakeComprehend(calls=6)
+    monkeypatch.setattr(full_text, 'comprehend', fake)
+    monkeypatch.setattr(full_text, 'DETECT_SENTIMENT', True)
+    return fake
+
+
+def test_every_analysis_and_batch_is_sent_concurrently(comprehend):
+    chunks = ["chunk {}".format(i) for i in range(30)]
+
+    responses = full_text.analyze_chunks(chunks)
+
+    assert sorted(comprehend.batches) == sorted([(name, size) for name in ('entities', 'key_phrases', 'sentiment')
+                                                 for size in (25, 5)])
+    for name in ('entities', 'key_phrases', 'sentiment'):
+        assert [result['Index'] for result in responses[name]['ResultList']] == list(range(30))
+
+
+def test_merged_batch_indices_point_into_the_chunks():
+    merged = full_text.merge_batch_responses([
+        {"ResultList": [{"Index": 0}, {"Index": 24}], "ErrorList": []},
+        {"ResultList": [{"Index": 1}], "ErrorList": [{"Index": 0, "ErrorCode": "TEXT_SIZE_LIMIT_EXCEEDED"}]}
+    ])
+    assert [result['Index'] for result in merged['ResultList']] == [0, 24, 26]
+    assert merged['ErrorList'] == [{"Index": 25, "ErrorCode": "TEXT_SIZE_LIMIT_EXCEEDED"}]
+
+
+def test_key_phrases_are_ranked_by_the_chunks_they_appear_in():
+    response = {"ResultList": [
+        {"Index": 0, "KeyPhrases": [{"Text": "Modern art", "Score": 0.9}, {"Text": "museum", "Score": 0.9}]},
+        {"Index": 1, "KeyPhrases": [{"Text": "modern art", "Score": 0.8}, {"Text": "modern art", "Score": 0.8},
+                                    {"Text": "guess", "Score": 0.5}]}
+    ]}
+    assert full_text.parse_detected_key_phrases_response(response) == ["Modern art", "museum"]
+
+
+def test_sentiment_is_weighted_by_the_length_of_the_chunks():
+    chunks = ["good", "this one is much longer"]
+    response = {"ResultList": [
+        {"Index": 0, "SentimentScore": {"Positive": 1.0, "Negative": 0.0, "Neutral": 0.0, "Mixed": 0.0}},
+        {"Index": 1, "SentimentScore": {"Positive": 0.0, "Negative": 1.0, "Neutral": 0.0, "Mixed": 0.0}}
+    ]}
+
+    sentiment = full_text.parse_detected_sentiment_response(response, chunks)
+
+    assert sentiment['label'] == 'NEGATIVE'
+    assert sentiment['scores'] == {"positive": round(4 / 27.0, 4), "negative": round(23 / 27.0, 4),
+                                   "neutral": 0.0, "mixed": 0.0}
+    assert full_text.parse_detected_sentiment_response({"ResultList": []}, []) is None
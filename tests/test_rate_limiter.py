@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+
+import rate_limiter
+from rate_limiter import DynamoDBTokenStore, TokenBucket, call_with_limit
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, 'StartTranscriptionJob')
+
+
+class FreeBucket(object):
+    def acquire(self):
+        return 0.0
+
+
+# An operation that fails with the errors it is given before it succeeds
+class Operation(object):
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"ok": True}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_limiter.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_token_bucket_holds_the_rate_across_threads():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.time()
+
+    def take(count):
+        for i in range(count):
+            bucket.acquire()
+
+    threads = [threading.Thread(target=take, args=(10,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    # The burst goes out at once, the other 35 calls at 50 a second
+    assert 0.65 <= time.time() - start < 1.5
+
+
+def test_throttled_and_failed_calls_are_retried(sleeps):
+    operation = Operation(client_error('ThrottlingException'), client_error('ServiceUnavailableException'))
+    assert call_with_limit(FreeBucket(), 'transcribe.GetTranscriptionJob', operation, JobName='a') == {"ok": True}
+    assert operation.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_connection_errors_are_retried(sleeps):
+    operation = Operation(BotoConnectionError(error='connection reset'))
+    assert call_with_limit(FreeBucket(), 'comprehend.DetectEntities', operation) == {"ok": True}
+    assert operation.calls == 2
+
+
+def test_too_many_jobs_is_left_to_the_state_machine(sleeps):
+    operation = Operation(client_error('LimitExceededException'))
+    with pytest.raises(ClientError):
+        call_with_limit(FreeBucket(), 'transcribe.StartTranscriptionJob', operation)
+    assert operation.calls == 1
+    assert sleeps == []
+
+    operation = Operation(ValueError('bad request'))
+    with pytest.raises(ValueError):
+        call_with_limit(FreeBucket(), 'transcribe.StartTranscriptionJob', operation)
+    assert operation.calls == 1
+
+
+def test_gives_up_after_the_last_attempt(sleeps):
+    operation = Operation(*[client_error('ThrottlingException')] * rate_limiter.RATE_LIMIT_ATTEMPTS)
+    with pytest.raises(ClientError):
+        call_with_limit(FreeBucket(), 'comprehend.DetectEntities', operation)
+    assert operation.calls == rate_limiter.RATE_LIMIT_ATTEMPTS
+    assert len(sleeps) == rate_limiter.RATE_LIMIT_ATTEMPTS - 1
+    assert all(0 <= sleep <= rate_limiter.RETRY_CAP_SECONDS for sleep in sleeps)
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+# The shared bucket item, with another invocation updating it before the first writes
+class FakeDynamoDB(object):
+    class exceptions(object):
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, item=None, conflicts=0):
+        self.item = item
+        self.conflicts = conflicts
+        self.updates = 0
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        return {"Item": dict(self.item)} if self.item else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues):
+        self.updates += 1
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConditionalCheckFailedException()
+        self.item = {"api": Key['api'], "tokens": ExpressionAttributeValues[':tokens'],
+                     "updated": ExpressionAttributeValues[':now']}
+
+
+def test_shared_bucket_backs_off_on_conflicts(sleeps):
+    dynamodb = FakeDynamoDB(conflicts=3)
+    store = DynamoDBTokenStore('rate-limits', client=dynamodb)
+
+    assert store.take('comprehend.DetectEntities', 20, 20) == 0
+    assert dynamodb.updates == 4
+    assert float(dynamodb.item['tokens']['N']) == 19
+    assert len(sleeps) == 3
+    for conflict, sleep in enumerate(sleeps):
+        assert 0 <= sleep <= rate_limiter.CONFLICT_BASE_SECONDS * 2 ** conflict
+
+
+def test_shared_bucket_without_tokens_returns_the_wait(sleeps):
+    dynamodb = FakeDynamoDB(item={"api": {"S": "comprehend.DetectEntities"}, "tokens": {"N": "0.5"},
+                                  "updated": {"N": repr(time.time())}})
+    store = DynamoDBTokenStore('rate-limits', client=dynamodb)
+
+    assert store.take('comprehend.DetectEntities', 10, 10) == pytest.approx(0.05, abs=0.01)
+    assert dynamodb.updates == 0
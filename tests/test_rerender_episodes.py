@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import process_transcription_full_text as full_text
+import process_transcription_paragraph as paragraph
+import rerender_episodes
+from artifact_io import write_raw_transcript
+from vocabulary_cache import read_feed_mapping, write_feed_mapping
+
+BUCKET = 'test-bucket'
+FEED = 'https://example.com/feed.xml'
+MANIFEST = 'podcasts/manifests/a.json'
+
+
+@pytest.fixture
+def rendered(s3, monkeypatch):
+    s3.put_object(Body=json.dumps({"podcastUrl": "https://example.com/a.mp3", "sourceFeed": FEED,
+                                   "vocabularyInfo": {"name": "OLD", "mapping": {"bucket": BUCKET, "key": "old.json"}},
+                                   "processedTranscription": []}), Bucket=BUCKET, Key=MANIFEST)
+    write_raw_transcript(BUCKET, "https://example.com/a.mp3", json.dumps({"results": {"items": []}}).encode('utf-8'))
+    vocabularies = []
+
+    def process_transcript(bucket, event, results, learn):
+        vocabularies.append(event['vocabularyInfo'])
+        return {"bucket": bucket, "key": "keywords.json"}
+
+    monkeypatch.setattr(paragraph, 'process_transcript', process_transcript)
+    monkeypatch.setattr(full_text, 'read_custom_vocabs', lambda vocabulary_info: vocabularies.append(vocabulary_info))
+    monkeypatch.setattr(full_text, 'process_results', lambda results, custom_vocabs: {"bucket": BUCKET,
+                                                                                      "key": "transcript.json"})
+    monkeypatch.setattr(rerender_episodes, 'load_episode', lambda bucket, key, audio_offset: (key, []))
+
+    def render():
+        del vocabularies[:]
+        rerender_episodes.render_episode(BUCKET, MANIFEST, None, 1)
+        return vocabularies
+    return render
+
+
+def test_episodes_are_rendered_with_the_latest_mapping_of_the_feed(s3, rendered):
+    # Feeds that haven't been processed since the mappings were tracked keep the mapping of the episode
+    assert read_feed_mapping(BUCKET, FEED) is None
+    assert [info['mapping']['key'] for info in rendered()] == ['old.json', 'old.json']
+
+    write_feed_mapping(BUCKET, FEED, {"bucket": BUCKET, "key": "new.json"})
+    assert [info['mapping']['key'] for info in rendered()] == ['new.json', 'new.json']
+    manifest = json.loads(s3.objects[(BUCKET, MANIFEST)].decode('utf-8'))
+    assert manifest['vocabularyInfo'] == {"name": "OLD", "mapping": {"bucket": BUCKET, "key": "new.json"}}
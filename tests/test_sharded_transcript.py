@@ -0,0 +1,190 @@
+import asyncio
+import io
+import json
+import random
+import re
+
+import pytest
+
+import artifact_io
+import gazetteer
+import long_episode
+import pipeline_worker
+import process_transcription_full_text as full_text
+import process_transcription_paragraph as paragraph
+
+BUCKET = 'test-bucket'
+FEED = 'https://example.com/feed.xml'
+NAMES = ['Jeff Bezos', 'Andy Jassy', 'Werner Vogels', 'Ada Lovelace', 'Zoë Müller']
+VOCABULARY = 'the a podcast today serverless search Widgetz i data we talk about'.split()
+
+
+def people(text):
+    return [{"Text": match.group(0), "Type": "PERSON", "BeginOffset": match.start(), "EndOffset": match.end(),
+             "Score": 0.9} for match in re.finditer(r'[A-Z][a-z]+ [A-Z][a-z]+', text)]
+
+
+# Comprehend that finds every pair of capitalized words, keeps the first words as key phrases and
+# is always a bit positive
+class FakeComprehend(object):
+    def detect_entities(self, Text, LanguageCode):
+        return {"Entities": people(Text)}
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        return {"ResultList": [{"Index": i, "Entities": people(text)} for i, text in enumerate(TextList)],
+                "ErrorList": []}
+
+    def batch_detect_key_phrases(self, TextList, LanguageCode):
+        return {"ResultList": [{"Index": i, "KeyPhrases": [{"Text": word, "Score": 0.9} for word in text.split()[:5]]}
+                               for i, text in enumerate(TextList)], "ErrorList": []}
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        return {"ResultList": [{"Index": i, "SentimentScore": {"Positive": 0.5, "Negative": 0.1, "Neutral": 0.3,
+                                                               "Mixed": 0.1}} for i in range(len(TextList))],
+                "ErrorList": []}
+
+
+# An hour of random sentences, some with a name in them, with pauses and speaker changes
+def transcribe_output(speaker_labels):
+    rng = random.Random(1)
+    items = []
+    segments = []
+    t = 0.0
+    speaker = 0
+    segment_start = 0.0
+    while t < 3600:
+        words = [rng.choice(VOCABULARY) for i in range(rng.randint(5, 25))]
+        if rng.random() < 0.3:
+            words[rng.randrange(len(words))] = rng.choice(NAMES)
+        for word in ' '.join(words).split():
+            items.append({"type": "pronunciation", "start_time": "%.3f" % t, "end_time": "%.3f" % (t + 0.3),
+                          "alternatives": [{"content": word}]})
+            t += 0.35
+        items.append({"type": "punctuation", "alternatives": [{"content": rng.choice(['.', '.', '?', ','])}]})
+        t += rng.choice([0.1, 0.2, 1.0, 2.5])
+        if rng.random() < 0.15:
+            segments.append({"start_time": "%.3f" % segment_start, "end_time": "%.3f" % t,
+                             "speaker_label": "spk_%d" % speaker})
+            speaker = 1 - speaker
+            segment_start = t
+    segments.append({"start_time": "%.3f" % segment_start, "end_time": "%.3f" % (t + 1),
+                     "speaker_label": "spk_%d" % speaker})
+    results = {"items": items}
+    if speaker_labels:
+        results['speaker_labels'] = {"speakers": 2, "segments": segments}
+    return json.dumps({"results": results}).encode('utf-8')
+
+
+@pytest.fixture
+def episode(s3, monkeypatch):
+    comprehend = FakeComprehend()
+    monkeypatch.setattr(paragraph, 'client', comprehend)
+    monkeypatch.setattr(full_text, 'comprehend', comprehend)
+    for module in (paragraph, full_text, long_episode):
+        monkeypatch.setattr(module, 's3_client', s3)
+    monkeypatch.setattr(full_text, 'DETECT_SENTIMENT', True)
+    monkeypatch.setattr(long_episode, 'SHARD_SECONDS', 600)
+
+    s3.put_object(Body=json.dumps({"Widgetz": "Widgets"}), Bucket=BUCKET, Key='vocabulary/sharded.json')
+    s3.put_object(Body=json.dumps({"entities": {"jeff bezos": {"text": "Jeff Bezos", "type": "PERSON"}}}),
+                  Bucket=BUCKET, Key=gazetteer.gazetteer_key(FEED))
+    return {"transcribeStatus": {"transcriptionUrl": "https://transcribe.example.com/a.json"},
+            "vocabularyInfo": {"mapping": {"bucket": BUCKET, "key": "vocabulary/sharded.json"}},
+            "sourceFeed": FEED, "podcastUrl": "https://example.com/a.mp3"}
+
+
+def process(event):
+    return [paragraph.lambda_handler(dict(event), None), full_text.lambda_handler(dict(event), None)]
+
+
+def feed_stores(s3):
+    return dict((key, body) for (bucket, key), body in s3.objects.items() if 'gazetteer' in key or 'boilerplate' in key)
+
+
+@pytest.mark.parametrize('speaker_labels', [True, False])
+def test_shards_give_the_artifacts_of_a_single_pass(s3, episode, monkeypatch, speaker_labels):
+    output = transcribe_output(speaker_labels)
+    for module in (paragraph, full_text, long_episode):
+        monkeypatch.setattr(module, 'urlopen', lambda url: io.BytesIO(output))
+    before = dict(s3.objects)
+
+    single = [s3.objects[(location['bucket'], location['key'])] for location in process(episode)]
+    single_stores = feed_stores(s3)
+
+    # The feed starts over, as if the episode had been sharded the first time
+    s3.objects = dict(before)
+    plan = long_episode.shard_handler(dict(episode), None)
+    assert plan['shardCount'] > 1
+    results = [process(dict(episode, shard=shard)) for shard in plan['shards']]
+    merged = process(dict(episode, shardPlan=plan, shardResults=results))
+
+    assert [s3.objects[(location['bucket'], location['key'])] for location in merged] == single
+    assert feed_stores(s3) == single_stores
+    # The shard plan is removed once the shards are merged
+    assert [key for bucket, key in s3.objects if key.startswith('podcasts/shards/')] == []
+
+
+def test_a_merge_that_fails_keeps_the_shards_to_be_retried(s3, episode, monkeypatch):
+    output = transcribe_output(True)
+    for module in (paragraph, full_text, long_episode):
+        monkeypatch.setattr(module, 'urlopen', lambda url: io.BytesIO(output))
+    plan = long_episode.shard_handler(dict(episode), None)
+    results = [process(dict(episode, shard=shard)) for shard in plan['shards']]
+    shards = set(key for bucket, key in s3.objects if key.startswith('podcasts/shards/'))
+
+    def fail(*args):
+        raise IOError('S3 is down')
+
+    for module, name in ((paragraph, 'finish_episode'), (full_text, 'write_results')):
+        with monkeypatch.context() as patch:
+            patch.setattr(module, name, fail)
+            with pytest.raises(IOError):
+                module.lambda_handler(dict(episode, shardPlan=plan, shardResults=results), None)
+        assert set(key for bucket, key in s3.objects if key.startswith('podcasts/shards/')) == shards
+
+    merged = process(dict(episode, shardPlan=plan, shardResults=results))
+    assert all((location['bucket'], location['key']) in s3.objects for location in merged)
+    assert [key for bucket, key in s3.objects if key.startswith('podcasts/shards/')] == []
+
+
+def test_the_pipeline_worker_shards_long_transcripts(s3, episode, monkeypatch):
+    output = transcribe_output(True)
+    for module in (paragraph, full_text, long_episode):
+        monkeypatch.setattr(module, 'urlopen', lambda url: io.BytesIO(output))
+    before = dict(s3.objects)
+    single = [s3.objects[(location['bucket'], location['key'])] for location in process(episode)]
+
+    s3.objects = dict(before)
+    handlers = {'plan_shards': long_episode.shard_handler, 'process_paragraph': paragraph.lambda_handler,
+                'process_full_text': full_text.lambda_handler}
+    sharded = pipeline_worker.Episode(dict(episode), None)
+    loop = asyncio.new_event_loop()
+    try:
+        worker = pipeline_worker.PipelineWorker(handlers, {}, shard_concurrency=2)
+        loop.run_until_complete(worker.process(sharded))
+    finally:
+        loop.close()
+
+    assert sharded.event['shardPlan']['shardCount'] > 1
+    assert len(sharded.event['shardResults']) == sharded.event['shardPlan']['shardCount']
+    assert [s3.objects[(location['bucket'], location['key'])]
+            for location in sharded.event['processedTranscription']] == single
+
+
+@pytest.mark.parametrize('sharded', [True, False])
+def test_the_raw_transcript_is_kept_once_per_episode(s3, episode, monkeypatch, sharded):
+    output = transcribe_output(True)
+    for module in (paragraph, full_text, long_episode):
+        monkeypatch.setattr(module, 'urlopen', lambda url: io.BytesIO(output))
+    writes = []
+    write = paragraph.write_raw_transcript
+    monkeypatch.setattr(paragraph, 'write_raw_transcript', lambda *args: writes.append(args) or write(*args))
+    if sharded:
+        plan = long_episode.shard_handler(dict(episode), None)
+        results = [process(dict(episode, shard=shard)) for shard in plan['shards']]
+        process(dict(episode, shardPlan=plan, shardResults=results))
+    else:
+        process(episode)
+
+    assert len(writes) == 1
+    assert artifact_io.read_raw_transcript(BUCKET, episode['podcastUrl']) == json.loads(output.decode('utf-8'))
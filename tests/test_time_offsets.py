@@ -0,0 +1,31 @@
+from time_offsets import decode_offsets, encode_offsets, offset_to_time
+
+TEXT = "Hello from Amazon Web Services"
+# Each word with the position it starts at in the paragraph and when it is spoken
+TIMEDATA = [(0, "630.4"), (6, "630.81"), (11, "631.06"), (18, "631.5"), (22, "631.77")]
+
+
+def test_encodes_the_differences_to_the_previous_word():
+    assert encode_offsets(TIMEDATA) == {"o": [0, 6, 5, 7, 4], "t": [630400, 410, 250, 440, 270]}
+    assert encode_offsets([]) == {"o": [], "t": []}
+
+
+def test_decodes_the_positions_and_the_seconds():
+    offsets, times = decode_offsets(encode_offsets(TIMEDATA))
+    assert offsets == [0, 6, 11, 18, 22]
+    assert times == [630.4, 630.81, 631.06, 631.5, 631.77]
+
+
+def test_an_offset_maps_to_the_word_it_falls_in():
+    offsets, times = decode_offsets(encode_offsets(TIMEDATA))
+    # "Amazon Web Services" starts at the third word
+    assert offset_to_time(offsets, times, TEXT.index("Amazon")) == 631.06
+    assert offset_to_time(offsets, times, TEXT.index("azon")) == 631.06
+    assert offset_to_time(offsets, times, len(TEXT) - 1) == 631.77
+    assert offset_to_time(offsets, times, 0) == 630.4
+
+
+def test_an_offset_before_the_first_word_has_no_time():
+    offsets, times = decode_offsets(encode_offsets([(3, "1.0")]))
+    assert offset_to_time(offsets, times, 2) is None
+    assert offset_to_time([], [], 0) is None
@@ -0,0 +1,172 @@
+import threading
+import time
+
+import pytest
+
+from time_offsets import encode_offsets
+
+TEXT = "Let's start the art of it"
+# The start time of every word, in seconds
+WORDS = [(0, 100.0), (6, 100.5), (12, 101.0), (16, 101.5), (20, 102.0), (23, 102.5)]
+
+EPISODE = "https://example.com/a.mp3"
+FEED = "https://example.com/feed.xml"
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def paragraph_hit(highlight):
+    return {"_score": 2.5, "_source": {
+        "PodcastName": "Podcast", "Episode": "Episode", "episode_url": EPISODE, "source_feed": FEED,
+        "url": EPISODE + "#t=99.0", "text": TEXT, "tags": ["Art"], "speaker": "spk_0",
+        "startTime": 100.0, "offsets": encode_offsets(WORDS)
+    }, "highlight": {"text": [highlight]}}
+
+
+# A domain that answers every search with the same paragraph and records the requests
+class StubES(object):
+    def __init__(self, highlight="the <em>art</em> of it", release=None):
+        self.highlight = highlight
+        self.release = release
+        self.searches = []
+        self.mgets = []
+
+    def search(self, index, body, **kwargs):
+        self.searches.append((index, body, kwargs))
+        if self.release is not None:
+            self.release.wait(5)
+        if 'aggs' in body:
+            return {"aggregations": {"entities": {"buckets": [
+                {"key": "Ada Lovelace", "type": {"buckets": [{"key": "PERSON"}]}, "paragraphs": {"value": 12.0},
+                 "mentions": {"value": 15.0}, "episodes": {"value": 3.0}}
+            ]}}}
+        return {"hits": {"total": {"value": 1}, "hits": [paragraph_hit(self.highlight)]}}
+
+    def mget(self, index, body, _source):
+        self.mgets.append((index, body))
+        return {"docs": [{"_id": EPISODE, "found": True, "_source": {
+            "published_time": "2020:01:02 10:00:00", "source_feed": FEED, "summary": "About art"}}]}
+
+
+@pytest.fixture
+def search(client_modules, routed):
+    import transcript_search
+    return transcript_search
+
+
+def test_highlight_position_skips_the_word_inside_another_word(search):
+    assert search.highlight_position(TEXT, "the <em>art</em> of it") == 16
+    # The fragment isn't in the text, so the word is looked up on its own
+    assert search.highlight_position(TEXT, "<em>Art</em> history") == 16
+    assert search.highlight_position(TEXT, "<em>sculpture</em>") == -1
+    assert search.highlight_position(TEXT, "no highlight") == -1
+
+def test_build_filters(search):
+    assert search.build_filters(None, None, None, None, None) == []
+    assert search.build_filters(FEED, "spk_1", ["Art"], "2020:01:01 00:00:00", None) == [
+        {"term": {"source_feed": FEED}},
+        {"term": {"speaker": "spk_1"}},
+        {"terms": {"tags": ["Art"]}},
+        {"range": {"published_time": {"gte": "2020:01:01 00:00:00"}}}
+    ]
+
+
+def test_ttl_cache_expires_and_evicts_the_least_recently_used(search):
+    clock = Clock()
+    cache = search.TTLCache(maxsize=2, ttl=60, clock=clock)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+    clock.now += 61
+    assert cache.get('a') is None
+    assert cache.entries == {'c': (1060.0, 3)}
+
+
+def test_search_links_to_the_highlighted_word(search):
+    es = StubES()
+    searcher = search.TranscriptSearch(es, cache=search.TTLCache(clock=Clock()), audio_offset=1)
+
+    result = searcher.search("art", feed=FEED, tags=["Art"])
+
+    assert result['total'] == 1
+    hit = result['hits'][0]
+    assert hit['url'] == EPISODE + "#t=100.5"
+    assert hit['highlight'] == "the <em>art</em> of it"
+    assert (hit['published_time'], hit['summary']) == ("2020:01:02 10:00:00", "About art")
+    index, body, params = es.searches[0]
+    assert (index, params) == ('paragraphs', {"routing": FEED})
+    assert {"terms": {"tags": ["Art"]}} in body['query']['bool']['filter']
+    assert es.mgets == [('episodes', {"docs": [{"_id": EPISODE, "routing": FEED}]})]
+
+
+def test_a_search_across_feeds_is_not_routed(search):
+    es = StubES()
+    search.TranscriptSearch(es, cache=search.TTLCache(clock=Clock())).search("art")
+    assert es.searches[0][2] == {}
+
+
+def test_search_falls_back_to_the_paragraph_link(search):
+    searcher = search.TranscriptSearch(StubES(highlight="<em>sculpture</em>"), cache=search.TTLCache(clock=Clock()))
+    assert searcher.search("sculpture")['hits'][0]['url'] == EPISODE + "#t=99.0"
+
+
+def test_search_caches_the_results(search):
+    clock = Clock()
+    es = StubES()
+    searcher = search.TranscriptSearch(es, cache=search.TTLCache(ttl=60, clock=clock))
+
+    first = searcher.search("art", tags=["b", "a"])
+    assert searcher.search("art", tags=["a", "b"]) is first
+    assert len(es.searches) == 1
+
+    clock.now += 61
+    searcher.search("art", tags=["a", "b"])
+    assert len(es.searches) == 2
+    metrics = searcher.metrics()
+    assert (metrics['cache_hits'], metrics['cache_misses']) == (1, 2)
+
+
+def test_identical_searches_in_flight_share_one_request(search):
+    release = threading.Event()
+    es = StubES(release=release)
+    searcher = search.TranscriptSearch(es, cache=search.TTLCache(clock=Clock()))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(searcher.search("art"))) for i in range(2)]
+
+    threads[0].start()
+    while not es.searches:
+        time.sleep(0.01)
+    threads[1].start()
+    while searcher.metrics()['coalesced'] == 0:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(es.searches) == 1
+    assert len(results) == 2 and results[0] is results[1]
+
+
+def test_top_entities_reads_the_rollups(search):
+    es = StubES()
+    searcher = search.TranscriptSearch(es, cache=search.TTLCache(clock=Clock()))
+
+    result = searcher.top_entities(feed=FEED, entity_type="PERSON", size=5)
+
+    assert result == {"entities": [{"entity": "Ada Lovelace", "type": "PERSON", "paragraphs": 12, "mentions": 15,
+                                    "episodes": 3}]}
+    index, body, params = es.searches[0]
+    assert index == 'entity_rollup'
+    assert params == {"routing": FEED}
+    assert body['aggs']['entities']['terms']['size'] == 5
+    assert searcher.top_entities(feed=FEED, entity_type="PERSON", size=5) is result
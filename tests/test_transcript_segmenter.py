@@ -0,0 +1,92 @@
+import pytest
+
+from transcript_segmenter import (LONG_PARAGRAPH, PARAGRAPH_BYTES, EpisodeAnalytics, ParagraphSegmenter,
+                                  TranscriptChunker)
+
+
+def word(text, start, end):
+    return {"type": "pronunciation", "start_time": str(start), "end_time": str(end),
+            "alternatives": [{"content": text, "confidence": "0.99"}]}
+
+
+def punctuation(text):
+    return {"type": "punctuation", "alternatives": [{"content": text, "confidence": "0.0"}]}
+
+
+# Two speakers: spk_0 talks for 4 seconds, then spk_1 for 2 seconds after a pause
+RESULTS = {
+    "items": [word("Hello", 0.0, 1.0), word("and", 1.0, 2.0), word("welcome", 2.0, 4.0), punctuation("."),
+              word("Thanks", 6.0, 7.0), word("Bob", 7.0, 8.0), punctuation(".")],
+    "speaker_labels": {"segments": [
+        {"speaker_label": "spk_0", "start_time": "0.0", "end_time": "4.0"},
+        {"speaker_label": "spk_1", "start_time": "6.0", "end_time": "8.0"}
+    ]}
+}
+
+
+def test_the_chunker_reports_the_analytics_of_the_episode():
+    chunker = TranscriptChunker(RESULTS)
+    for item in RESULTS['items']:
+        chunker.feed(item)
+    chunker.finish()
+
+    assert chunker.report() == {
+        "duration_seconds": 8.0,
+        "speech_seconds": 6.0,
+        "silence_seconds": 2.0,
+        "silence_ratio": 0.25,
+        "words": 5,
+        "words_per_minute": 37.5,
+        "speakers": [
+            {"speaker": "spk_0", "talk_seconds": 4.0, "talk_ratio": 0.6667, "words": 3, "words_per_minute": 45.0},
+            {"speaker": "spk_1", "talk_seconds": 2.0, "talk_ratio": 0.3333, "words": 2, "words_per_minute": 60.0}
+        ]
+    }
+
+
+def test_a_chunker_resumed_from_its_state_reports_the_whole_episode():
+    first = TranscriptChunker(RESULTS)
+    for item in RESULTS['items'][:4]:
+        first.feed(item)
+    resumed = TranscriptChunker(RESULTS, state=first.state())
+    for item in RESULTS['items'][4:]:
+        resumed.feed(item)
+    resumed.finish()
+
+    whole = TranscriptChunker(RESULTS)
+    for item in RESULTS['items']:
+        whole.feed(item)
+    whole.finish()
+    assert resumed.report() == whole.report()
+
+
+def test_an_episode_without_words_or_speakers():
+    assert EpisodeAnalytics().report() == {"duration_seconds": 0.0, "speech_seconds": 0.0, "silence_seconds": 0.0,
+                                           "silence_ratio": 0, "words": 0, "words_per_minute": 0, "speakers": []}
+    analytics = EpisodeAnalytics()
+    analytics.feed(word("Hi", 0.5, 1.5))
+    assert analytics.report()['speakers'] == []
+    assert analytics.report()['words_per_minute'] == pytest.approx(40.0)
+
+
+def test_long_paragraphs_are_split_on_their_utf8_length():
+    # Three bytes a word and one for every space
+    words = [word(u"\u00e9t\u00e9", i * 0.1, i * 0.1 + 0.05) for i in range(PARAGRAPH_BYTES // 6 + 10)]
+    segmenter = ParagraphSegmenter({"items": words}, {})
+    for item in words:
+        segmenter.feed(item)
+
+    first = segmenter.paragraphs[0]
+    assert first['reason'] == LONG_PARAGRAPH
+    assert PARAGRAPH_BYTES < len(first['text'].encode('utf-8')) <= PARAGRAPH_BYTES + 7
+    assert segmenter.contents_bytes == len(segmenter.contents.encode('utf-8'))
+
+
+def test_a_state_saved_without_the_byte_length_is_measured_again():
+    segmenter = ParagraphSegmenter(RESULTS, {})
+    for item in RESULTS['items'][:3]:
+        segmenter.feed(item)
+    state = segmenter.state()
+    del state['contents_bytes']
+
+    assert ParagraphSegmenter(RESULTS, {}, state=state).contents_bytes == len("Hello and welcome")
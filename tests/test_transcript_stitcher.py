@@ -0,0 +1,68 @@
+from transcript_stitcher import stitch_transcripts
+
+
+def word(content, start, end, speaker=None):
+    item = {"start_time": start, "end_time": end, "type": "pronunciation",
+            "alternatives": [{"content": content, "confidence": "1.0"}]}
+    if speaker is not None:
+        item['speaker_label'] = speaker
+    return item
+
+
+# The output of a transcribe job, with speaker labels when speakers are given as
+# [(label, start, end, [(content, start, end), ...]), ...]
+def transcribe_output(job, speakers=None, words=None):
+    if speakers is not None:
+        words = [w for label, start, end, spoken in speakers for w in spoken]
+    results = {
+        "transcripts": [{"transcript": " ".join(content for content, start, end in words)}],
+        "items": [word(content, start, end) for content, start, end in words]
+    }
+    if speakers is not None:
+        results['speaker_labels'] = {
+            "speakers": len(set(label for label, start, end, spoken in speakers)),
+            "segments": [{"start_time": start, "end_time": end, "speaker_label": label,
+                          "items": [{"start_time": s, "end_time": e, "speaker_label": label}
+                                    for content, s, e in spoken]}
+                         for label, start, end, spoken in speakers]
+        }
+    return {"jobName": job, "accountId": "123", "status": "COMPLETED", "results": results}
+
+
+def test_shifts_the_times_of_every_segment():
+    first = transcribe_output('a', words=[("hello", "0.5", "0.9"), ("there", "1.0", "1.4")])
+    second = transcribe_output('b', words=[("general", "0.2", "0.7")])
+
+    stitched = stitch_transcripts([(300.0, second), (0, first)])
+
+    assert stitched['jobName'] == 'a'
+    assert stitched['results']['transcripts'] == [{"transcript": "hello there general"}]
+    assert [(i['start_time'], i['end_time']) for i in stitched['results']['items']] == \
+        [("0.500", "0.900"), ("1.000", "1.400"), ("300.200", "300.700")]
+    assert 'speaker_labels' not in stitched['results']
+
+
+def test_namespaces_the_speakers_of_every_segment():
+    first = transcribe_output('a', speakers=[
+        ("spk_0", "0.0", "2.0", [("hi", "0.5", "0.9")]),
+        ("spk_1", "2.0", "4.0", [("hello", "2.5", "3.0")])
+    ])
+    # The same labels in the next job can be other people
+    second = transcribe_output('b', speakers=[
+        ("spk_0", "0.0", "1.0", [("bye", "0.1", "0.4")])
+    ])
+
+    labels = stitch_transcripts([(0, first), (600, second)])['results']['speaker_labels']
+
+    assert labels['speakers'] == 3
+    assert [(s['speaker_label'], s['start_time'], s['end_time']) for s in labels['segments']] == \
+        [("spk_0_0", "0.000", "2.000"), ("spk_0_1", "2.000", "4.000"), ("spk_1_0", "600.000", "601.000")]
+    assert labels['segments'][2]['items'] == [{"start_time": "600.100", "end_time": "600.400",
+                                               "speaker_label": "spk_1_0"}]
+
+
+def test_drops_the_speaker_labels_unless_every_segment_has_them():
+    first = transcribe_output('a', speakers=[("spk_0", "0.0", "1.0", [("hi", "0.1", "0.4")])])
+    second = transcribe_output('b', words=[("bye", "0.1", "0.4")])
+
+    assert 'speaker_labels' not in stitch_transcripts([(0, first), (60, second)])['results']
@@ -0,0 +1,280 @@
+import pytest
+
+from artifact_io import write_keywords
+from es_bulk import BulkIndexError
+
+EVENT = {"podcastUrl": "https://example.com/a.mp3", "sourceFeed": "https://example.com/feed.xml",
+         "PodcastName": "Podcast", "Episode": "Episode", "publishTime": "2020:01:02 10:00:00"}
+
+
+def keywords(*start_times, **entities):
+    return [{"startTime": start, "text": "paragraph at {}".format(start), "tags": [], "speaker": "spk_0",
+             "entities": [{"text": text, "type": "PERSON", "time": start} for text in entities.get(str(start), [])]}
+            for start in start_times]
+
+
+# What the painless ROLLUP_SCRIPT does to a rollup document
+def run_rollup_script(doc, params):
+    contributions = doc.setdefault('contributions', {})
+    if params['paragraphs'] == 0:
+        contributions.pop(params['episode'], None)
+    else:
+        contributions[params['episode']] = {"paragraphs": params['paragraphs'], "mentions": params['mentions']}
+    doc['paragraphs'] = sum(counts['paragraphs'] for counts in contributions.values())
+    doc['mentions'] = sum(counts['mentions'] for counts in contributions.values())
+    doc['episodes'] = len(contributions)
+    doc['episode_ids'] = list(contributions)
+    return doc['episodes'] > 0
+
+
+# Whether the paragraph document of the action matches the query of a delete_by_query
+def matches(action, query):
+    if 'bool' in query:
+        return all(matches(action, clause) for clause in query['bool'].get('filter', [])) and \
+            not any(matches(action, clause) for clause in query['bool'].get('must_not', []))
+    if 'ids' in query:
+        return action['_id'] in query['ids']['values']
+    if 'terms' in query:
+        return action['_index'] in query['terms']['_index']
+    (field, value), = query['term'].items()
+    return action['doc'].get(field) == value
+
+
+class StubIndices(object):
+    def __init__(self, existing=(), error=None, sealed=()):
+        self.existing = set(existing)
+        self.error = error
+        self.sealed = set(sealed)
+        self.meta = {}
+        self.created = []
+
+    def exists(self, index):
+        return index in self.existing
+
+    def create(self, index, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.created.append(index)
+        self.existing.add(index)
+
+    def get_settings(self, index, name, flat_settings):
+        return dict((name, {"settings": {"index.blocks.write": "true"} if name in self.sealed else {}})
+                    for name in index.split(','))
+
+    def put_settings(self, index, body):
+        for name in index.split(','):
+            if body['index']['blocks.write']:
+                self.sealed.add(name)
+            else:
+                self.sealed.discard(name)
+
+    def get_mapping(self, index):
+        return dict((name, {"mappings": {"_meta": dict(self.meta.get(name, {}))}}) for name in index.split(','))
+
+    def put_mapping(self, index, body):
+        self.meta[index] = body['_meta']
+
+
+# The domain as the upload sees it, recording the requests. Like a write block, bulk requests and
+# deletes fail on the sealed partitions.
+class StubDomain(object):
+    def __init__(self, deleted=None, indices=(), reject=(), sealed=()):
+        self.deleted = deleted or {}
+        self.reject = set(reject)
+        self.indices = StubIndices(indices, sealed=sealed)
+        self.indexed = []
+        self.requests = []
+        self.rollups = {}
+
+    def bulk(self, actions):
+        results = []
+        for action in actions:
+            ok = action['_id'] not in self.reject and action['_index'] not in self.indices.sealed
+            if ok and action['_index'] == 'entity_rollup':
+                self.upsert_rollup(action)
+            elif ok:
+                self.indexed.append(action)
+            results.append((ok, {"update": {"_id": action['_id'], "status": 400}}))
+        return results
+
+    def partitions(self, podcast_url):
+        return sorted(set(action['_index'] for action in self.indexed
+                          if action['doc'].get('episode_url') == podcast_url and not action['doc'].get('boilerplate')))
+
+    def search(self, index, body, **kwargs):
+        podcast_url = body['query']['bool']['filter'][0]['term']['episode_url']
+        return {"aggregations": {"partitions": {"buckets": [{"key": partition, "doc_count": 1}
+                                                            for partition in self.partitions(podcast_url)]}}}
+
+    def upsert_rollup(self, action):
+        doc = self.rollups.get(action['_id'], dict(action['upsert']))
+        if run_rollup_script(doc, action['script']['params']):
+            self.rollups[action['_id']] = doc
+        else:
+            self.rollups.pop(action['_id'], None)
+
+    def delete_by_query(self, index, body, **kwargs):
+        self.requests.append(('delete_by_query', index, body, kwargs))
+        if index != 'paragraphs':
+            return {"deleted": self.deleted.get(index, 0)}
+        podcast_url = body['query']['bool']['filter'][0]['term']['episode_url']
+        assert not self.indices.sealed.intersection(self.partitions(podcast_url))
+        stale = [action for action in self.indexed if matches(action, body['query'])]
+        self.indexed = [action for action in self.indexed if action not in stale]
+        return {"deleted": self.deleted.get(index, len(stale))}
+
+    def update_by_query(self, index, body, **kwargs):
+        self.requests.append(('update_by_query', index, body, kwargs))
+        query = body['query']['bool']
+        episode = query['filter'][0]['term']['episode_ids']
+        keep = query['must_not'][0]['ids']['values'] if 'must_not' in query else []
+        updated = deleted = 0
+        for doc_id, doc in list(self.rollups.items()):
+            if episode in doc['episode_ids'] and doc_id not in keep:
+                if run_rollup_script(doc, body['script']['params']):
+                    updated += 1
+                else:
+                    del self.rollups[doc_id]
+                    deleted += 1
+        return {"updated": updated, "deleted": deleted}
+
+
+@pytest.fixture
+def upload(client_modules, routed):
+    import upload_to_elasticsearch
+    return upload_to_elasticsearch
+
+
+def test_indexing_an_episode_again_removes_the_paragraphs_it_no_longer_has(upload, s3):
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, 12.0))
+    es = StubDomain(deleted={'paragraphs': 3})
+
+    indexed, errors = upload.index_keywords(es, EVENT, {"bucket": "test-bucket", "key": "a.ndjson.gz"})
+
+    assert (indexed, errors) == (2, [])
+    assert all(action['_op_type'] == 'update' and action['doc_as_upsert'] for action in es.indexed)
+    # The paragraphs go to the partition of the month the episode was published in
+    assert es.indices.created == ['paragraphs-2020.01']
+    assert set(action['_index'] for action in es.indexed) == {'paragraphs-2020.01'}
+    operation, index, body, params = es.requests[0]
+    assert (operation, index) == ('delete_by_query', 'paragraphs')
+    assert params['routing'] == EVENT['sourceFeed']
+    assert body['query']['bool']['filter'] == [{"term": {"episode_url": EVENT['podcastUrl']}}]
+    # The boilerplate documents of the feed are shared with its other episodes
+    assert body['query']['bool']['must_not'] == [{"term": {"boilerplate": True}}, {"bool": {"filter": [
+        {"ids": {"values": [action['_id'] for action in es.indexed]}},
+        {"terms": {"_index": ['paragraphs-2020.01']}}
+    ]}}]
+
+
+def test_the_stale_paragraphs_are_kept_when_a_paragraph_fails_to_index(upload, s3):
+    from es_documents import paragraph_id
+
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, 12.0))
+    es = StubDomain(reject={paragraph_id(EVENT['podcastUrl'], 12.0)})
+
+    with pytest.raises(BulkIndexError):
+        upload.index_keywords(es, EVENT, {"bucket": "test-bucket", "key": "a.ndjson.gz"})
+    assert es.requests == []
+
+
+def test_the_paragraphs_move_to_the_partition_of_a_new_publish_time(upload, s3):
+    location = {"bucket": "test-bucket", "key": "a.ndjson.gz"}
+    es = StubDomain(sealed=['paragraphs-2020.01'])
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, 12.0))
+
+    upload.index_keywords(es, EVENT, location)
+    upload.index_keywords(es, dict(EVENT, publishTime="2020:02:03 10:00:00"), location)
+
+    # The copies with the same ids in the partition of the old month are gone
+    assert [action['_index'] for action in es.indexed] == ['paragraphs-2020.02'] * 2
+
+
+def test_an_episode_of_a_sealed_partition_is_indexed_and_deleted(upload, s3):
+    location = {"bucket": "test-bucket", "key": "a.ndjson.gz"}
+    es = StubDomain(indices=['paragraphs-2020.01'], sealed=['paragraphs-2020.01'])
+
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, 12.0))
+    assert upload.index_keywords(es, EVENT, location) == (2, [])
+    # Indexed again, its stale paragraph is removed from the sealed partition
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0))
+    assert upload.index_keywords(es, EVENT, location) == (1, [])
+    upload.delete_episode(es, EVENT['podcastUrl'], EVENT['sourceFeed'])
+
+    assert [request[1] for request in es.requests if request[0] == 'delete_by_query'] == ['paragraphs'] * 3 + \
+        ['episodes']
+    assert es.indices.sealed == {'paragraphs-2020.01'}
+    assert es.indices.meta['paragraphs-2020.01'] == {}
+
+
+def test_delete_episode_removes_the_episode_and_its_paragraphs(upload):
+    url = EVENT['podcastUrl']
+    es = StubDomain(deleted={'paragraphs': 12, 'episodes': 1})
+    assert upload.delete_episode(es, url, EVENT['sourceFeed']) == {"paragraphs": 12, "episode": 1,
+                                                                   "entity_rollups": 0}
+    routed = {"conflicts": "proceed", "routing": EVENT['sourceFeed']}
+    assert es.requests[:2] == [
+        ('delete_by_query', 'paragraphs', {"query": {"bool": {"filter": [{"term": {"episode_url": url}}],
+                                                              "must_not": [{"term": {"boilerplate": True}}]}}},
+         routed),
+        ('delete_by_query', 'episodes', {"query": {"ids": {"values": [url]}}}, routed)
+    ]
+    assert es.requests[2][1] == 'entity_rollup'
+
+    # Without the feed every shard is searched for the episode
+    es = StubDomain()
+    assert upload.delete_episode(es, url) == {"paragraphs": 0, "episode": 0, "entity_rollups": 0}
+    assert [params for operation, index, body, params in es.requests] == [{"conflicts": "proceed"}] * 3
+
+
+def test_a_partition_is_only_created_once(upload, s3):
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0))
+    es = StubDomain(indices=['paragraphs-2020.01'])
+
+    upload.index_keywords(es, EVENT, {"bucket": "test-bucket", "key": "a.ndjson.gz"})
+    upload.index_keywords(es, dict(EVENT, publishTime="2020:02:01 10:00:00"), {"bucket": "test-bucket",
+                                                                              "key": "a.ndjson.gz"})
+    upload.index_keywords(es, dict(EVENT, publishTime="2020:02:03 10:00:00"), {"bucket": "test-bucket",
+                                                                              "key": "a.ndjson.gz"})
+
+    assert es.indices.created == ['paragraphs-2020.02']
+
+
+def test_a_partition_another_upload_created_is_used(upload):
+    from elasticsearch.exceptions import RequestError
+
+    es = StubDomain()
+    es.indices.error = RequestError(400, 'resource_already_exists_exception')
+    upload.ensure_partition(es, 'paragraphs-2019.06')
+
+    # A template that can't be applied fails the upload
+    es.indices.error = RequestError(400, 'illegal_argument_exception')
+    with pytest.raises(RequestError):
+        upload.ensure_partition(es, 'paragraphs-2019.07')
+
+
+def test_the_entity_rollup_counts_every_episode_once(upload, s3):
+    location = {"bucket": "test-bucket", "key": "a.ndjson.gz"}
+    other = dict(EVENT, podcastUrl="https://example.com/b.mp3")
+    es = StubDomain()
+
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, 12.0, **{"0": ["Ada", "Ada"], "12.0": ["Ada", "Bob"]}))
+    upload.index_keywords(es, EVENT, location)
+    upload.index_keywords(es, other, location)
+    # Indexing an episode again replaces its counts
+    upload.index_keywords(es, EVENT, location)
+
+    totals = dict((doc['entity'], (doc['paragraphs'], doc['mentions'], doc['episodes'])) for doc in es.rollups.values())
+    assert totals == {"Ada": (4, 6, 2), "Bob": (2, 2, 2)}
+    assert set(doc['day'] for doc in es.rollups.values()) == {"2020:01:02"}
+
+    # The episode doesn't mention Bob anymore
+    write_keywords('test-bucket', 'a.ndjson.gz', keywords(0, **{"0": ["Ada"]}))
+    upload.index_keywords(es, EVENT, location)
+    totals = dict((doc['entity'], (doc['paragraphs'], doc['mentions'], doc['episodes'])) for doc in es.rollups.values())
+    assert totals == {"Ada": (3, 4, 2), "Bob": (1, 1, 1)}
+
+    # The last episode that mentions an entity takes its document with it
+    assert upload.delete_episode(es, other['podcastUrl'], other['sourceFeed'])['entity_rollups'] == 2
+    totals = dict((doc['entity'], (doc['paragraphs'], doc['mentions'], doc['episodes'])) for doc in es.rollups.values())
+    assert totals == {"Ada": (1, 1, 1)}
@@ -0,0 +1,116 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import aws_clients
+import vocabulary_cache
+from transcript_segmenter import VocabularyMapping
+from vocabulary_cache import VocabularyCache
+
+BUCKET = 'test-bucket'
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+# S3 with an ETag per object, answering a conditional GET on the current ETag with 304 Not Modified
+class VersionedS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        self.versions = 0
+
+    def put(self, key, mapping):
+        self.versions += 1
+        self.objects[key] = (json.dumps(mapping).encode('utf-8'), '"v{}"'.format(self.versions))
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.requests.append((Key, IfNoneMatch))
+        body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, 'GetObject')
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vocabulary_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = VersionedS3()
+    monkeypatch.setitem(aws_clients._clients, 's3', s3)
+    return s3
+
+
+def test_a_cached_mapping_is_used_without_a_request_within_the_ttl(s3, clock):
+    s3.put('a.json', {"a. w. s.": "AWS"})
+    cache = VocabularyCache(ttl=300)
+
+    mapping = cache.get(BUCKET, 'a.json')
+    assert isinstance(mapping, VocabularyMapping) and mapping == {"a. w. s.": "AWS"}
+    clock.now += 299
+    assert cache.get(BUCKET, 'a.json') is mapping
+
+    assert s3.requests == [('a.json', None)]
+    assert cache.stats() == {"entries": 1, "hits": 1, "revalidated": 0, "misses": 1, "hit_rate": 0.5}
+
+
+def test_an_expired_mapping_is_revalidated_on_its_etag(s3, clock):
+    s3.put('a.json', {"a. w. s.": "AWS"})
+    cache = VocabularyCache(ttl=300)
+    mapping = cache.get(BUCKET, 'a.json')
+    etag = s3.objects['a.json'][1]
+
+    clock.now += 300
+    assert cache.get(BUCKET, 'a.json') is mapping
+    assert s3.requests[-1] == ('a.json', etag)
+    assert cache.revalidated == 1
+
+    s3.put('a.json', {"a. w. s.": "AWS", "s. three": "S3"})
+    clock.now += 300
+    assert cache.get(BUCKET, 'a.json') == {"a. w. s.": "AWS", "s. three": "S3"}
+    assert s3.requests[-1] == ('a.json', etag)
+    assert cache.misses == 2
+
+
+def test_without_a_ttl_every_lookup_is_revalidated(s3, clock):
+    s3.put('a.json', {"a. w. s.": "AWS"})
+    cache = VocabularyCache(ttl=0)
+    mapping = cache.get(BUCKET, 'a.json')
+    etag = s3.objects['a.json'][1]
+
+    assert cache.get(BUCKET, 'a.json') is mapping
+    s3.put('a.json', {"s. three": "S3"})
+    assert cache.get(BUCKET, 'a.json') == {"s. three": "S3"}
+    assert s3.requests == [('a.json', None), ('a.json', etag), ('a.json', etag)]
+
+
+def test_the_least_recently_used_mapping_is_evicted(s3, clock):
+    for key in ('a.json', 'b.json', 'c.json'):
+        s3.put(key, {key: key.upper()})
+    cache = VocabularyCache(size=2)
+
+    cache.get(BUCKET, 'a.json')
+    cache.get(BUCKET, 'b.json')
+    cache.get(BUCKET, 'a.json')
+    cache.get(BUCKET, 'c.json')
+
+    assert list(cache.entries) == [(BUCKET, 'a.json'), (BUCKET, 'c.json')]
+
+
+def test_the_matcher_replaces_like_the_mapping():
+    mapping = VocabularyMapping({"a. w. s.": "AWS", "e. c. two": "EC2"})
+    assert mapping.replace("a. w. s.") == "AWS"
+    assert mapping.replace("the") == "the"
+    assert VocabularyMapping({}).replace("the") == "the"